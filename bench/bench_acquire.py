@@ -0,0 +1,81 @@
+# End-to-end acquisition cycle latency against simulated sensors.
+#
+#   python bench/bench_acquire.py [--cycles N] [--samples 130] [--bus-hz 100000]
+#
+# One BME280 and one TCS34725 share a simulated I2C bus with real transfer
+# times, BME280 conversion waits and TCS34725 integration sleeps.  "serial"
+# reads them one after the other as the scripts used to; "concurrent" uses
+# kaliot.acquire.Acquisition with the bus serialised by a per-bus lock, and
+# "aligned" also centres the BME280 conversion on the colour window.
+# skew is how far apart the two capture timestamps of a cycle are.
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.acquire import Acquisition, LockedBus
+from kaliot.bme280 import BME280
+from kaliot.sim import FakeSMBus, FakeTCS34725, TCS34725_ADDRESS
+from kaliot.tcs import ColorSampler
+
+
+class SerialAcquisition(Acquisition):
+
+  def read(self):
+    return dict((name, self._read(name, read)) for name, read in self.sensors)
+
+
+def measure(acquisition, bus, cycles):
+  bus.transactions = 0
+  times = []
+  skews = []
+  for _ in range(cycles):
+    start = time.time()
+    samples = acquisition.read()
+    times.append(time.time() - start)
+    skews.append(abs(samples['bme280'].ts - samples['tcs34725'].ts))
+  return (samples, sum(times) / cycles, max(times), sum(skews) / cycles,
+          float(bus.transactions) / cycles)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--cycles', type=int, default=5)
+  parser.add_argument('--samples', type=int, default=130)
+  parser.add_argument('--bus-hz', type=int, default=100000)
+  args = parser.parse_args(argv)
+
+  fake = FakeSMBus(bus_hz=args.bus_hz)
+  fake.add_bme280()
+  fake.add_device(TCS34725_ADDRESS)
+  bus = LockedBus(fake, threading.RLock())
+  bme = BME280(bus)
+  colour = ColorSampler(FakeTCS34725(bus=bus), samples=args.samples)
+  sensors = [('bme280', bme.read), ('tcs34725', colour.read)]
+
+  rows = []
+  for name, cls, align in (('serial', SerialAcquisition, False),
+                           ('concurrent', Acquisition, False),
+                           ('aligned', Acquisition, True)):
+    acquisition = cls(sensors, align=align)
+    rows.append((name, measure(acquisition, fake, args.cycles)))
+    acquisition.close()
+
+  print('%-11s %10s %10s %10s %8s' % ('path', 'ms/cycle', 'max ms', 'skew ms', 'xfers'))
+  for name, (samples, mean, worst, skew, xfers) in rows:
+    print('%-11s %10.1f %10.1f %10.1f %8.0f' % (name, mean * 1e3, worst * 1e3, skew * 1e3, xfers))
+  values = [dict((k, s.value) for k, s in samples.items()) for _, (samples, _, _, _, _) in rows]
+  if any(v != values[0] for v in values):
+    print('MISMATCH between serial and concurrent readings')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,76 @@
+# Upstream volume and cost of windowed aggregation on recorded or synthetic
+# 1 Hz data.
+#
+#   python bench/bench_aggregate.py [--csv recorded.csv] [--window 600] [--hop 600]
+#
+# Every local sample sent on its own is compared with one summary per hop in
+# each encoding.  The streaming statistics are checked against an exact
+# two-pass computation over the same readings.  Data sources as in
+# bench_deadband.py.
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_deadband import recorded, synthetic
+
+from kaliot.aggregate import WindowAggregator
+from kaliot.encoding import BinaryEncoder, JsonEncoder
+from kaliot.telemetry import FIELDS
+
+
+def exact(values):
+  n = len(values)
+  mean = sum(values) / n
+  var = sum((v - mean) ** 2 for v in values) / (n - 1) if n > 1 else 0.0
+  return min(values), max(values), mean, math.sqrt(var)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--csv', default=None)
+  parser.add_argument('--seconds', type=int, default=86400)
+  parser.add_argument('--window', type=float, default=600)
+  parser.add_argument('--hop', type=float, default=None)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  readings = list(recorded(args.csv) if args.csv else synthetic(args.seconds, args.seed))
+  summaries = []
+  aggregator = WindowAggregator(summaries.append, args.window, args.hop)
+  start = time.time()
+  for reading in readings:
+    aggregator.add(reading)
+  elapsed = time.time() - start
+  # close the last window as a quiet spell would
+  aggregator.clock = lambda: readings[-1].ts + aggregator.hop
+  aggregator.poll()
+
+  times = [r.ts for r in readings]
+  worst = 0.0
+  for summary in summaries:
+    window = readings[bisect.bisect_left(times, summary.start):bisect.bisect_left(times, summary.end)]
+    for i, name in enumerate(FIELDS):
+      stats = summary[3 + i]
+      for got, want in zip(stats, exact([r[1 + i] for r in window])):
+        worst = max(worst, abs(got - want) / max(abs(want), 1e-9))
+
+  print('readings       %8d  (%.2f us per add)' % (len(readings), elapsed / len(readings) * 1e6))
+  print('summaries      %8d  (window %g s, hop %g s)' % (len(summaries), aggregator.window, aggregator.hop))
+  for name, encoder in (('json', JsonEncoder(device_id='us-stl-c0001')), ('binary', BinaryEncoder())):
+    raw = sum(len(encoder.encode(r)) for r in readings)
+    summarised = sum(len(encoder.encode_summary(s)) for s in summaries)
+    print('%-6s bytes   %10d -> %8d  (%.0fx less)' % (name, raw, summarised, float(raw) / summarised))
+  print('max rel error  %8.1e  vs two-pass' % worst)
+  return 0 if worst < 1e-9 else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
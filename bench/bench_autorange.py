@@ -0,0 +1,79 @@
+# Time per light reading and accuracy, fixed window against auto-ranging,
+# across light levels, with a simulated TCS34725.
+#
+#   python bench/bench_autorange.py [--levels 0.05 2 30 912 3000 20000]
+#                                   [--windows 20] [--samples 130] [--seed 1]
+#
+# Levels are clear counts at the reference 4x / 2.4 ms (912 is the office
+# the other benches use; the chip clips at 1024 there, and at 4096 even at
+# 1x), with the office's colour balance.  The sensor is a FakeTCS34725 with
+# shot and read noise (kaliot.sim.tcs34725_counts) and no real sleeps.
+# "fixed" is ColorSampler as it always ran - --samples frames at 4x / 2.4 ms;
+# "ranged" is ColorSampler(auto_range=True).  For each it prints:
+#   - integration time per reading (what the window costs on the chip)
+#   - frames per reading
+#   - RMS error of the clear mean against the true level, in percent
+#   - share of readings flagged saturated ("fixed" never flags, so its
+#     clipped readings are errors nobody sees)
+#   - the range in use at the end
+
+from __future__ import print_function
+
+import argparse
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot import tcs
+from kaliot.sim import TCS34725_RAW, FakeTCS34725
+from kaliot.tcs import ColorSampler
+
+
+def run(level, auto_range, args):
+  r, g, b, c = TCS34725_RAW
+  light = tuple(level * v / float(c) for v in (r, g, b, c))
+  chip = FakeTCS34725(time_scale=0, light=light, rng=random.Random(args.seed))
+  sampler = ColorSampler(chip, samples=args.samples, auto_range=auto_range)
+  sampler.read()  # let the range settle
+  chip.elapsed = 0.0
+  chip.reads = 0
+  squares = 0.0
+  saturated = 0
+  for _ in range(args.windows):
+    clear = sampler.read()[3]
+    saturated += sampler.saturated
+    squares += ((clear - level) / level) ** 2
+  meter = sampler.meter
+  rng = '4x 2.4ms' if meter is None else '%dx %gms' % (
+    tcs.GAIN_FACTOR[meter.gain], tcs.INTEGRATION_TIME_DELAY[meter.integration_time] * 1e3)
+  return {
+    'ms': chip.elapsed / args.windows * 1e3,
+    'frames': float(chip.reads) / args.windows,
+    'error': math.sqrt(squares / args.windows) * 100,
+    'saturated': 100.0 * saturated / args.windows,
+    'range': rng,
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--levels', type=float, nargs='+', default=[0.05, 2, 30, 912, 3000, 20000])
+  parser.add_argument('--windows', type=int, default=20)
+  parser.add_argument('--samples', type=int, default=tcs.SAMPLES)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  print('%9s %-7s %10s %8s %9s %7s  %s' % ('level', 'path', 'ms/read', 'frames', 'error %', 'sat %', 'range'))
+  for level in args.levels:
+    for name, auto_range in (('fixed', False), ('ranged', True)):
+      res = run(level, auto_range, args)
+      print('%9g %-7s %10.1f %8.1f %9.2f %7.0f  %s' % (
+        level, name, res['ms'], res['frames'], res['error'], res['saturated'], res['range']))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,79 @@
+# Messages and bytes per hour with and without batching, against the local
+# broker stand-in, on a simulated clock.
+#
+#   python bench/bench_batching.py [--period 66] [--hours 24] [--max-age 600]
+#                                  [--encoding json|binary]
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.batching import TelemetryBatcher
+from kaliot.encoding import get_encoder
+from kaliot.standin import LocalBroker, StandInClient, StandInDevice, StandInMessage
+from kaliot.telemetry import make_reading
+
+
+class Clock(object):
+
+  def __init__(self):
+    self.now = 1500000000.0
+
+  def __call__(self):
+    return self.now
+
+
+def readings(clock, period, count, seed):
+  rnd = random.Random(seed)
+  for _ in range(count):
+    clock.now += period
+    yield make_reading(45.4 + rnd.gauss(0, 0.05), 1006.5 + rnd.gauss(0, 0.1),
+                       38.3 + rnd.gauss(0, 0.3), 310.0, 352.0, 270.0, 912.0,
+                       257.0, 5180.0, ts=clock.now)
+
+
+def run(transport, max_count, args):
+  clock = Clock()
+  broker = LocalBroker(clock=clock)
+  if transport == 'iothub':
+    client = StandInClient(broker)
+    send = lambda payload: client.send_event_async(StandInMessage(payload), None, 0)
+  else:
+    device = StandInDevice(broker)
+    device.connect()
+    send = device.sendTelemetry
+  batcher = TelemetryBatcher(send, max_count=max_count, max_age=args.max_age, clock=clock,
+                             encoder=get_encoder(args.encoding))
+  count = int(args.hours * 3600 / args.period)
+  for reading in readings(clock, args.period, count, args.seed):
+    batcher.add(reading)
+  batcher.flush()
+  stats = broker.stats(elapsed=args.hours * 3600)
+  print('%-7s %6d %10.1f %12.0f %10.1f' % (
+    transport, max_count, stats['messages_per_hour'], stats['wire_bytes_per_hour'],
+    float(stats['wire_bytes']) / count))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--period', type=float, default=66.0, help='seconds between readings')
+  parser.add_argument('--hours', type=float, default=24.0)
+  parser.add_argument('--max-age', type=float, default=600.0)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--encoding', default='json')
+  args = parser.parse_args(argv)
+
+  print('%-7s %6s %10s %12s %10s' % ('path', 'batch', 'msgs/h', 'wire B/h', 'B/reading'))
+  for transport in ('iothub', 'iotc'):
+    for max_count in (1, 5, 10, 60):
+      run(transport, max_count, args)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
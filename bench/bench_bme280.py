@@ -0,0 +1,83 @@
+# Per-sample latency of the BME280 read path against a fake bus.
+#
+#   python bench/bench_bme280.py [--samples N] [--bus-hz HZ]
+#
+# "legacy" repeats what readBME280All() used to do on every sample (control
+# writes, three calibration reads and a re-decode), "cached" is BME280.read()
+# in forced mode (trigger, conversion wait, burst) and "normal" is
+# BME280.read() in normal mode (burst only; the one wait for the first
+# conversion is paid in the constructor).
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot import bme280
+from kaliot.bme280 import BME280, BME280Calibration
+from kaliot.sim import FakeSMBus
+
+
+def legacy_read(bus, addr, wait):
+  bus.write_byte_data(addr, bme280.REG_CONTROL_HUM, bme280.OVERSAMPLE_HUM)
+  control = bme280.OVERSAMPLE_TEMP<<5 | bme280.OVERSAMPLE_PRES<<2 | bme280.MODE_FORCED
+  bus.write_byte_data(addr, bme280.REG_CONTROL, control)
+  cal1 = bus.read_i2c_block_data(addr, bme280.REG_CAL1, 24)
+  cal2 = bus.read_i2c_block_data(addr, bme280.REG_CAL2, 1)
+  cal3 = bus.read_i2c_block_data(addr, bme280.REG_CAL3, 7)
+  cal = BME280Calibration.from_blocks(cal1, cal2, cal3)
+  time.sleep(wait)
+  data = bus.read_i2c_block_data(addr, bme280.REG_DATA, 8)
+  return cal.compensate(*bme280.unpack_data(data))
+
+
+def measure(fn, bus, samples):
+  bus.transactions = 0
+  bus.bytes = 0
+  start = time.time()
+  for _ in range(samples):
+    result = fn()
+  elapsed = time.time() - start
+  return result, elapsed / samples, float(bus.transactions) / samples, float(bus.bytes) / samples
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Per-sample latency of the BME280 read path against a fake bus.')
+  parser.add_argument('--samples', type=int, default=200)
+  parser.add_argument('--bus-hz', type=int, default=100000,
+                      help='simulated I2C clock, 0 for no transfer time')
+  parser.add_argument('--no-wait', action='store_true',
+                      help='skip the conversion wait to isolate bus and CPU cost')
+  args = parser.parse_args(argv)
+
+  bus = FakeSMBus(bus_hz=args.bus_hz)
+  bus.add_bme280()
+  sensor = BME280(bus)
+  wait = 0 if args.no_wait else sensor._wait
+  if args.no_wait:
+    sensor._wait = 0
+
+  normal_bus = FakeSMBus(bus_hz=args.bus_hz)
+  normal_bus.add_bme280()
+  normal = BME280(normal_bus, mode=bme280.MODE_NORMAL, standby=0.5, iir_filter=16)
+
+  rows = [
+    ('legacy', measure(lambda: legacy_read(bus, bme280.DEVICE, wait), bus, args.samples)),
+    ('cached', measure(sensor.read, bus, args.samples)),
+    ('normal', measure(normal.read, normal_bus, args.samples)),
+  ]
+  print('%-8s %12s %8s %8s  %s' % ('path', 'us/sample', 'xfers', 'bytes', 'reading'))
+  for name, (result, latency, xfers, nbytes) in rows:
+    print('%-8s %12.1f %8.1f %8.1f  %s' % (name, latency * 1e6, xfers, nbytes, result))
+  if any(row[1][0] != rows[0][1][0] for row in rows):
+    print('MISMATCH between readings')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,184 @@
+# SDK callback-thread hold time and command throughput under a burst.
+#
+#   python bench/bench_commands.py [--burst 400] [--methods 0.25]
+#                                  [--history 86400] [--seconds 3600]
+#
+# A StandInClient plays the hub delivering --burst cloud-to-device messages
+# and direct method calls back to back on one thread, as the SDK's callback
+# thread would; --methods of them are "getReadings" calls for the last
+# --seconds of a ring file holding --history seconds of readings, the rest
+# small JSON messages.  The callbacks are kaliot-iot.py's: handled right
+# there with no workers, or copied out and queued on a kaliot.workers pool
+# whose workers answer through device_method_response.
+#
+# For each setup it prints the time one callback holds the thread (p50, p99,
+# max), how long the thread took to get through the whole burst - the delay
+# a send confirmation behind it would see - and commands completed per
+# second from the first delivery to the last completion, with what a full
+# queue turned away: messages abandoned, jobs dropped (a dropped method is
+# answered 503, and counted there too) and methods answered 503.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_deadband import synthetic
+
+from kaliot.ring import RingFile, handle_query
+from kaliot.standin import LocalBroker, StandInClient
+from kaliot.workers import DROP_OLDEST, REJECT, WorkerPool
+
+ACCEPTED = 'ACCEPTED'
+ABANDONED = 'ABANDONED'
+BUSY = '{ "Response": "Busy, try again later" }'
+
+SETUPS = [
+  ('inline', 0, 0, None),
+  ('2 workers / 32', 2, 32, REJECT),
+  ('2 workers / 32 drop', 2, 32, DROP_OLDEST),
+  ('4 workers / 512', 4, 512, REJECT),
+]
+
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+
+class Device(object):
+  # kaliot-iot.py's receive / method callbacks against a StandInClient
+
+  def __init__(self, client, ring, now, commands):
+    self.client = client
+    self.ring = ring
+    self.now = now
+    self.commands = commands
+    self.holds = []
+    self.completed = []
+    self.lock = threading.Lock()
+    client.set_message_callback(self.receive_message_callback, 0)
+    if commands is None:
+      client.set_device_method_callback(self.device_method_callback, 0)
+    else:
+      client.set_device_method_callback_ex(self.device_method_callback_ex, 0)
+
+  def _done(self):
+    with self.lock:
+      self.completed.append(time.time())
+
+  def handle_message(self, message_buffer, properties, counter):
+    json.loads(message_buffer.decode('utf-8'))
+    self._done()
+
+  def handle_method(self, method_name, payload):
+    result = handle_query(self.ring, payload, self.now)
+    self._done()
+    return result
+
+  def receive_message_callback(self, message, counter):
+    t0 = time.perf_counter()
+    message_buffer = bytes(message.get_bytearray())
+    properties = message.properties().get_internals()
+    disposition = ACCEPTED
+    if self.commands is None:
+      self.handle_message(message_buffer, properties, counter)
+    elif not self.commands.submit('message', self.handle_message, message_buffer, properties, counter):
+      disposition = ABANDONED
+    self.holds.append(time.perf_counter() - t0)
+    return disposition
+
+  def device_method_callback(self, method_name, payload, context):
+    t0 = time.perf_counter()
+    status, response = self.handle_method(method_name, payload)
+    self.holds.append(time.perf_counter() - t0)
+    return _Return(status, response)
+
+  def device_method_callback_ex(self, method_name, payload, method_id):
+    t0 = time.perf_counter()
+    client = self.client
+    def respond(status, response):
+      client.device_method_response(method_id, response, len(response), status)
+    def run():
+      respond(*self.handle_method(method_name, payload))
+    if not self.commands.submit('method', run, on_drop=lambda: respond(503, BUSY)):
+      respond(503, BUSY)
+    self.holds.append(time.perf_counter() - t0)
+
+
+class _Return(object):
+  # DeviceMethodReturnValue
+
+  def __init__(self, status, response):
+    self.status = status
+    self.response = response
+
+
+def run(setup, ring, now, args):
+  name, workers, size, policy = setup
+  commands = None
+  if workers:
+    commands = WorkerPool(workers, size, policy)
+    commands.start()
+  client = StandInClient(LocalBroker())
+  device = Device(client, ring, now, commands)
+  every = int(round(1 / args.methods)) if args.methods else 0
+  method = json.dumps({'seconds': args.seconds, 'max_points': 3600, 'format': 'json'})
+  abandoned = 0
+  dropped = 0
+  start = time.time()
+  for n in range(args.burst):
+    if every and n % every == 0:
+      client.invoke('getReadings', method)
+    else:
+      abandoned += client.receive(json.dumps({'command': 'blink', 'n': n}),
+                                  {'source': 'bench'}) == ABANDONED
+  through = time.time() - start
+  if commands is not None:
+    commands.join()
+    commands.stop()
+    dropped = commands.dropped
+  busy = sum(1 for status, _, _ in client.responses.values() if status == 503)
+  completed = device.completed
+  elapsed = (max(completed) - start) if completed else through
+  print('%-20s %8.3f %8.3f %8.2f %10.1f %8d %8.0f %6d %6d %6d' % (
+    name, percentile(device.holds, 0.5) * 1e3, percentile(device.holds, 0.99) * 1e3,
+    max(device.holds) * 1e3, through * 1e3, len(completed), len(completed) / elapsed,
+    abandoned, dropped, busy))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--burst', type=int, default=400)
+  parser.add_argument('--methods', type=float, default=0.25, help='share of the burst that is method calls')
+  parser.add_argument('--history', type=int, default=86400)
+  parser.add_argument('--seconds', type=int, default=3600, help='span each getReadings asks for')
+  args = parser.parse_args(argv)
+
+  directory = tempfile.mkdtemp(prefix='kaliot-commands-')
+  try:
+    ring = RingFile(os.path.join(directory, 'ring.dat'), args.history)
+    reading = None
+    for reading in synthetic(args.history, 1):
+      ring.append(reading)
+    now = reading.ts + 1
+    print('%-20s %8s %8s %8s %10s %8s %8s %6s %6s %6s' % (
+      'setup', 'hold p50', 'hold p99', 'hold max', 'thread ms', 'done', 'done/s', 'aband', 'drop', '503'))
+    for setup in SETUPS:
+      run(setup, ring, now, args)
+    ring.close()
+  finally:
+    shutil.rmtree(directory)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
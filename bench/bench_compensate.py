@@ -0,0 +1,70 @@
+# Scalar vs NumPy batch BME280 compensation over archived-style raw frames.
+#
+#   python bench/bench_compensate.py [--frames 1000000] [--seed 1]
+#
+# Raw values are drawn over the full ADC ranges, so the humidity clamp is
+# exercised at both ends; a second calibration with dig_P1 = 0 checks the
+# var1 == 0 pressure guard.  Results must match the scalar path exactly.
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from kaliot.bme280 import BME280Calibration
+from kaliot.compensate import compensate_batch
+from kaliot.sim import BME280_CALIBRATION, bme280_calibration_blocks
+
+
+def calibration(**overrides):
+  cal = dict(BME280_CALIBRATION)
+  cal.update(overrides)
+  return BME280Calibration.from_blocks(*bme280_calibration_blocks(cal))
+
+
+def scalar(cal, pres_raw, temp_raw, hum_raw):
+  compensate = cal.compensate
+  out = [compensate(p, t, h) for p, t, h in zip(pres_raw, temp_raw, hum_raw)]
+  return tuple(np.array(column, dtype=np.float64) for column in zip(*out))
+
+
+def run(name, cal, frames, rng):
+  pres_raw = rng.integers(0, 1 << 20, frames)
+  temp_raw = rng.integers(400000, 600000, frames)
+  hum_raw = rng.integers(0, 1 << 16, frames)
+
+  start = time.time()
+  expected = scalar(cal, pres_raw.tolist(), temp_raw.tolist(), hum_raw.tolist())
+  scalar_s = time.time() - start
+
+  start = time.time()
+  actual = compensate_batch(cal, pres_raw, temp_raw, hum_raw)
+  batch_s = time.time() - start
+
+  same = all(np.array_equal(e, a) for e, a in zip(expected, actual))
+  print('%-10s %9d %10.3f %10.3f %8.1fx  %s' % (
+    name, frames, scalar_s, batch_s, scalar_s / batch_s, 'exact' if same else 'MISMATCH'))
+  return same
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--frames', type=int, default=1000000)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  rng = np.random.default_rng(args.seed)
+  print('%-10s %9s %10s %10s %9s' % ('cal', 'frames', 'scalar s', 'batch s', 'speedup'))
+  ok = run('typical', calibration(), args.frames, rng)
+  ok = run('dig_P1=0', calibration(dig_P1=0), min(args.frames, 10000), rng) and ok
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,98 @@
+# Compression ratio and CPU time per message size, for each codec and level.
+#
+#   python bench/bench_compression.py [--sizes 1 10 100 1000] [--levels 1 6 9]
+#                                     [--seconds 0.1] [--csv recorded.csv]
+#
+# Messages are JSON (with deviceId, as the entry scripts send) and binary
+# batches of --sizes consecutive 1 Hz readings, plus a 600 s window summary.
+# For every codec - gzip, deflate and deflate with the kaliot preset
+# dictionary - and level, prints compressed/original size and the time to
+# compress and decompress one message.  The size where the ratio first drops
+# below ~0.8 is a sensible COMPRESS_MIN_BYTES; on a Pi Zero expect the times
+# to be 10-15x these.  Data as in bench_deadband.py.
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_deadband import recorded, synthetic
+
+from kaliot.aggregate import WindowAggregator
+from kaliot.compression import DICTIONARY, Compressor, decompress
+from kaliot.encoding import BinaryEncoder, JsonEncoder
+
+
+def per_call(fn, seconds):
+  # best of three runs of a loop lasting about `seconds`
+  count = 0
+  start = time.time()
+  while time.time() - start < seconds:
+    fn()
+    count += 1
+  best = None
+  for _ in range(3):
+    start = time.time()
+    for _ in range(count):
+      fn()
+    elapsed = (time.time() - start) / count
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--csv', default=None)
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+  parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+  parser.add_argument('--seconds', type=float, default=0.1)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  readings = list(recorded(args.csv) if args.csv else synthetic(max(args.sizes) + 600, args.seed))
+  json_encoder = JsonEncoder(device_id='us-stl-c0001')
+  binary_encoder = BinaryEncoder()
+  summaries = []
+  aggregator = WindowAggregator(summaries.append, 600)
+  for reading in readings[:601]:
+    aggregator.add(reading)
+
+  messages = [('json summary', json_encoder.encode_summary(summaries[0]))]
+  for size in args.sizes:
+    batch = readings[:size]
+    if size == 1:
+      messages.append(('json x1', json_encoder.encode(batch[0])))
+      messages.append(('binary x1', binary_encoder.encode(batch[0])))
+    else:
+      messages.append(('json x%d' % size, json_encoder.encode_batch(batch)))
+      messages.append(('binary x%d' % size, binary_encoder.encode_batch(batch)))
+
+  codecs = [('gzip', None), ('deflate', None), ('deflate-dict', DICTIONARY)]
+  print('%-14s %8s %-13s %5s %8s %10s %10s' % (
+    'message', 'bytes', 'codec', 'level', 'ratio', 'comp us', 'decomp us'))
+  failures = 0
+  for name, payload in messages:
+    for codec, dictionary in codecs:
+      for level in args.levels:
+        compressor = Compressor(codec.split('-')[0], level, min_bytes=0, dictionary=dictionary)
+        compressed, content_encoding = compressor.compress(payload)
+        if content_encoding is None:
+          # not worth it: compressor.compress sends the original
+          compressed = payload
+          content_encoding = 'identity'
+        if decompress(compressed, content_encoding) != payload:
+          failures += 1
+        comp = per_call(lambda: compressor.compress(payload), args.seconds)
+        decomp = per_call(lambda: decompress(compressed, content_encoding), args.seconds)
+        print('%-14s %8d %-13s %5d %8.3f %10.1f %10.1f' % (
+          name, len(payload), codec, level, float(len(compressed)) / len(payload),
+          comp * 1e6, decomp * 1e6))
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,72 @@
+# Hub traffic with send-on-delta reporting, on recorded or synthetic data.
+#
+#   python bench/bench_deadband.py [--csv recorded.csv] [--heartbeat 600]
+#
+# The CSV needs a header row with ts and the telemetry field names (one row
+# per local sample).  Without --csv a day of 1 Hz samples is synthesised:
+# slow diurnal drift plus sensor noise and a few lights-on/off steps.
+
+from __future__ import print_function
+
+import argparse
+import csv
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.deadband import DeadbandFilter
+from kaliot.telemetry import FIELDS, Reading
+
+
+def recorded(path):
+  with open(path) as f:
+    for row in csv.DictReader(f):
+      yield Reading(float(row['ts']), *[float(row[name]) for name in FIELDS])
+
+
+def synthetic(seconds, seed):
+  rnd = random.Random(seed)
+  start = 1500000000.0
+  for t in range(seconds):
+    day = math.sin(2 * math.pi * t / 86400.0)
+    lights = 1.0 if 7 * 3600 <= t % 86400 < 19 * 3600 else 0.15
+    counts = [lights * base * (1 + rnd.gauss(0, 0.01)) for base in (310, 352, 270, 912)]
+    r, g, b, c = counts
+    yield Reading(start + t,
+                  45.46 + 0.05 * day + rnd.gauss(0, 0.002),
+                  1006.5 + 2.0 * day + rnd.gauss(0, 0.05),
+                  38.3 - 5.0 * day + rnd.gauss(0, 0.2),
+                  lights * 257.0 * (1 + rnd.gauss(0, 0.01)),
+                  5180.0 + rnd.gauss(0, 20), g, b, c, r)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--csv', default=None)
+  parser.add_argument('--seconds', type=int, default=86400)
+  parser.add_argument('--heartbeat', type=float, default=600)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  now = [0.0]
+  band = DeadbandFilter(heartbeat=args.heartbeat, clock=lambda: now[0])
+  source = recorded(args.csv) if args.csv else synthetic(args.seconds, args.seed)
+  for reading in source:
+    now[0] = reading.ts
+    band.offer(reading)
+
+  stats = band.stats()
+  total = stats['sent'] + stats['suppressed']
+  print('samples     %8d' % total)
+  print('sent        %8d  (%d heartbeats)' % (stats['sent'], stats['heartbeats']))
+  print('suppressed  %8d  (%.1f%% fewer messages)' % (stats['suppressed'], 100 * stats['reduction']))
+  for name in FIELDS:
+    print('  %-15s %6d triggers' % (name, stats['triggers'].get(name, 0)))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
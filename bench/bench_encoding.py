@@ -0,0 +1,89 @@
+# Encode cost and bytes per reading for each payload encoder, next to the two
+# hand-built formats the entry scripts used to send.
+#
+#   python bench/bench_encoding.py [--readings 20000] [--batch 10]
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.encoding import BinaryEncoder, JsonEncoder
+from kaliot.telemetry import FIELDS, make_reading
+
+MSG_TXT = "{\"deviceId\": us-stl-c0001,\"airtemperature\": %.2f,\"airpressure\": %.2f,\"airhumidity\": %.2f,\"red\": %.2f,\"green\": %.2f,\"blue\": %.2f,\"lux\": %.2f,\"colortemp\": %.2f}"
+
+
+def msg_txt(r):
+  return MSG_TXT % (r.airtemperature, r.airpressure, r.airhumidity, r.red, r.green,
+                    r.blue, r.lux, r.colortemp)
+
+
+def iotc_concat(r):
+  return "{ \
+\"airtemperature\": " + str(r.airtemperature) + ", \
+\"airpressure\": " + str(r.airpressure) + ", \
+\"airhumidity\": " + str(r.airhumidity) + ", \
+\"lux\": " + str(r.lux) + ", \
+\"colortemp\": " + str(r.colortemp) + ", \
+\"green\": " + str(r.green) + ", \
+\"blue\": " + str(r.blue) + ", \
+\"clear\": " + str(r.clear) + ", \
+\"red\": " + str(r.red) + "}"
+
+
+def json_dumps(r):
+  record = dict(zip(FIELDS, r[1:]))
+  record['ts'] = r.ts
+  return json.dumps(record, separators=(',', ':'))
+
+
+def readings(count):
+  return [make_reading(45.464 + i * 1e-4, 1006.5325814481472, 38.275054276373446,
+                       310.4, 352.1, 270.9, 912.3, 257.0, 5180.0, ts=1500000000.123 + i)
+          for i in range(count)]
+
+
+def measure(fn, items):
+  start = time.time()
+  total = 0
+  for item in items:
+    total += len(fn(item))
+  return (time.time() - start) / len(items), float(total) / len(items)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--readings', type=int, default=20000)
+  parser.add_argument('--batch', type=int, default=10)
+  args = parser.parse_args(argv)
+
+  data = readings(args.readings)
+  batches = [data[i:i + args.batch] for i in range(0, len(data), args.batch)]
+  json_encoder = JsonEncoder(device_id='us-stl-c0001')
+  binary_encoder = BinaryEncoder()
+
+  print('%-16s %12s %12s' % ('encoder', 'us/reading', 'B/reading'))
+  for name, fn, items, per in (
+      ('MSG_TXT (old)', msg_txt, data, 1),
+      ('iotc str (old)', iotc_concat, data, 1),
+      ('json.dumps', json_dumps, data, 1),
+      ('json', json_encoder.encode, data, 1),
+      ('binary', binary_encoder.encode, data, 1),
+      ('json batch', json_encoder.encode_batch, batches, args.batch),
+      ('binary batch', binary_encoder.encode_batch, batches, args.batch)):
+    seconds, size = measure(fn, items)
+    print('%-16s %12.2f %12.1f' % (name, seconds * 1e6 / per, size / per))
+
+  decoded = binary_encoder.decode(binary_encoder.encode(data[0]))
+  print('binary round trip: %s' % (decoded,))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,73 @@
+# Fleet load generator: N virtual kaliot devices against a local MQTT
+# endpoint stand-in.
+#
+#   python bench/bench_fleet.py [--devices 1000] [--duration 30] [--interval 1]
+#                               [--procs 4] [--encoding json] [--window 130]
+#                               [--ack-delay 0.005] [--ingest-time 0]
+#
+# Every device samples simulated sensors through the scripts' driver, colour
+# window and encoder path each interval and publishes the payload; see
+# kaliot.loadgen.  Devices are split evenly over --procs worker processes,
+# each running its own asyncio loop and broker stand-in.  Reports achieved
+# messages/s, publish-to-ack latency and the client-side CPU each device
+# costs.
+
+from __future__ import print_function
+
+import argparse
+import concurrent.futures
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.loadgen import ACK_DELAY, INGEST_TIME, WINDOW, FleetStats, run_worker
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--devices', type=int, default=1000)
+  parser.add_argument('--duration', type=float, default=30.0)
+  parser.add_argument('--interval', type=float, default=1.0)
+  parser.add_argument('--procs', type=int, default=os.cpu_count() or 1)
+  parser.add_argument('--encoding', default='json')
+  parser.add_argument('--window', type=int, default=WINDOW)
+  parser.add_argument('--ack-delay', type=float, default=ACK_DELAY)
+  parser.add_argument('--ingest-time', type=float, default=INGEST_TIME)
+  args = parser.parse_args(argv)
+
+  kwargs = {'encoding': args.encoding, 'window': args.window,
+            'ack_delay': args.ack_delay, 'ingest_time': args.ingest_time}
+  procs = max(1, min(args.procs, args.devices))
+  jobs = []
+  first = 0
+  for n in range(procs):
+    count = args.devices // procs + (1 if n < args.devices % procs else 0)
+    jobs.append((first, count, args.duration, args.interval, kwargs))
+    first += count
+
+  stats = FleetStats()
+  if procs == 1:
+    stats.merge(run_worker(jobs[0]))
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=procs) as pool:
+      for result in pool.map(run_worker, jobs):
+        stats.merge(result)
+
+  summary = stats.summary()
+  offered = args.devices / args.interval
+  print('devices            %8d (%d procs)' % (summary['devices'], procs))
+  print('offered msg/s      %8.1f' % offered)
+  print('achieved msg/s     %8.1f' % summary['messages_per_s'])
+  print('failed             %8d' % summary['failed'])
+  print('late samples       %8d' % summary['late'])
+  print('p50 ack ms         %8.2f' % summary['p50_ms'])
+  print('p99 ack ms         %8.2f' % summary['p99_ms'])
+  print('cpu ms/message     %8.3f' % summary['cpu_ms_per_message'])
+  print('cpu %%/device       %8.3f' % summary['cpu_pct_per_device'])
+  print('wire bytes/s       %8.0f' % summary['wire_bytes_per_s'])
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
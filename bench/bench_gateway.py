@@ -0,0 +1,244 @@
+# One process per device against one gateway for all of them.
+#
+#   python bench/bench_gateway.py [--devices 20] [--duration 20] [--interval 1]
+#
+# A hub stand-in runs in this process: a kaliot.gateway.Gateway on a local
+# port whose spool is a LocalBroker, so it counts connections, devices and
+# messages.  Two layouts then send one JSON reading per device per interval
+# for --duration seconds:
+#   per-device  --devices processes, each as kaliot-iot.py is without its
+#               sensors: spool, Drainer and a connection of its own to the hub
+#   gateway     one process as kaliot-gateway.py: nodes connect to it with
+#               their node secrets, it spools and forwards every device over
+#               one hub connection.  The nodes are driven from this process;
+#               on a site they are their own boards and not counted
+# For each it prints the hub connections, the messages delivered, and the
+# resident memory and CPU (past start-up) of the processes in the layout, in
+# total and per device.  The SDK is not involved, so the per-process figures
+# are the floor of what kaliot-iot.py costs; TLS and the SDK's own threads add
+# to every connection.
+#
+# CPU depends on the host more than memory does: the gateway process runs its
+# event loop and the hub link's ack reader as two threads that hand the GIL
+# back and forth on every message, and what that costs depends on the cores
+# and the scheduler.  The CPU count is printed with the table; compare runs
+# on the same kind of board.
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.encoding import JsonEncoder
+from kaliot.gateway import Gateway, GatewayLink, content_code, open_envelope
+from kaliot.spool import Drainer, OutboundQueue
+from kaliot.standin import LocalBroker
+from kaliot.telemetry import make_reading
+
+READING = (22.5, 1013.2, 41.0, 120, 140, 90, 380, 210.5, 4100.0)
+
+
+def footprint(since=0.0):
+  # (resident KB, CPU seconds after since) of this process
+  rss = 0
+  with open('/proc/self/status') as f:
+    for line in f:
+      if line.startswith('VmRSS:'):
+        rss = int(line.split()[1])
+  times = os.times()
+  return rss, times[0] + times[1] - since
+
+
+class HubSpool(object):
+  # what the hub stand-in's Gateway appends to: straight to the broker
+
+  def __init__(self, broker):
+    self.broker = broker
+    self.devices = set()
+
+  def append(self, entry):
+    device_id, content_type, content_encoding, payload = open_envelope(entry)
+    self.devices.add(device_id)
+    properties = {'$.ct': content_type}
+    if content_encoding:
+      properties['$.ce'] = content_encoding
+    self.broker.publish(device_id, payload, properties)
+
+
+def start_hub():
+  loop = asyncio.new_event_loop()
+  thread = threading.Thread(target=loop.run_forever)
+  thread.daemon = True
+  thread.start()
+  spool = HubSpool(LocalBroker())
+  hub = Gateway(spool)
+  server = asyncio.run_coroutine_threadsafe(hub.start(('127.0.0.1', 0)), loop).result()
+  return hub, spool, server.sockets[0].getsockname()[1]
+
+
+def forward(drainer, link, device_id=None):
+  # Drainer send(): a device's own payload, or a gateway envelope
+  def send(entry_id, entry):
+    target, payload = device_id, entry
+    code = content_code(JsonEncoder.content_type, JsonEncoder.content_encoding)
+    if target is None:
+      target, content_type, content_encoding, payload = open_envelope(entry)
+      code = content_code(content_type, content_encoding)
+    def done(accepted):
+      if accepted:
+        drainer.confirmed(entry_id)
+      else:
+        drainer.failed(entry_id, transient=accepted is None)
+    link.send(target, payload, code, done)
+  return send
+
+
+def run_device(args):
+  # one kaliot-iot.py, minus the sensors and the SDK
+  spool = OutboundQueue(os.path.join(args.tmp, args.id + '.db'))
+  link = GatewayLink(('127.0.0.1', args.hub))
+  drainer = Drainer(spool, None, rate=5.0)
+  drainer.send = forward(drainer, link, args.id)
+  encoder = JsonEncoder(device_id=args.id)
+  started = footprint()[1]
+  end = time.time() + args.duration
+  due = time.time()
+  while time.time() < end:
+    spool.append(encoder.encode(make_reading(*READING)))
+    due += args.interval
+    while time.time() < min(due, end):
+      drainer.pump()
+      time.sleep(min(0.2, max(0.0, due - time.time())))
+  settle = time.time() + 2.0
+  while len(spool) and time.time() < settle:
+    drainer.pump()
+    time.sleep(0.05)
+  return footprint(started)
+
+
+def secret(device_id):
+  return 'bench-' + device_id
+
+
+def run_gateway(args):
+  # kaliot-gateway.py with the hub stand-in for the SDK; stops when stdin closes
+  spool = OutboundQueue(os.path.join(args.tmp, 'gateway.db'))
+  link = GatewayLink(('127.0.0.1', args.hub))
+  drainer = Drainer(spool, None, rate=10000.0, window=32)
+  drainer.send = forward(drainer, link)
+  started = footprint()[1]
+
+  async def main():
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    stopping = asyncio.Event()
+    secrets = dict((device_id, secret(device_id)) for device_id in device_ids(args.devices))
+    gateway = Gateway(spool, secrets, wake=ready.set)
+    server = await gateway.start(('127.0.0.1', 0))
+    print(server.sockets[0].getsockname()[1])
+    sys.stdout.flush()
+    def stop():
+      loop.remove_reader(sys.stdin.fileno())
+      stopping.set()
+    loop.add_reader(sys.stdin.fileno(), stop)
+    while not stopping.is_set() or len(spool):
+      drainer.pump()
+      try:
+        await asyncio.wait_for(ready.wait(), 0.05)
+      except asyncio.TimeoutError:
+        pass
+      ready.clear()
+    gateway.close()
+
+  asyncio.run(main())
+  return footprint(started)
+
+
+def child(role, args, **extra):
+  argv = [sys.executable, os.path.abspath(__file__), '--role', role, '--hub', str(args.hub),
+          '--tmp', args.tmp, '--duration', str(args.duration), '--interval', str(args.interval),
+          '--devices', str(args.devices)]
+  for name, value in extra.items():
+    argv += ['--' + name, str(value)]
+  return subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+
+def report(label, devices, hub, spool, delivered, results, elapsed):
+  rss = sum(r[0] for r in results)
+  cpu = sum(r[1] for r in results)
+  minutes = elapsed / 60.0
+  print('%-11s %6d %8d %8d %9d %10.0f %10.1f %12.1f' % (
+    label, len(results), hub.peak, len(spool.devices), delivered, rss / 1024.0,
+    rss / float(devices), 1000.0 * cpu / devices / minutes))
+
+
+def device_ids(n):
+  return ['us-stl-c%04d' % (i + 1) for i in range(n)]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--devices', type=int, default=20)
+  parser.add_argument('--duration', type=float, default=20.0)
+  parser.add_argument('--interval', type=float, default=1.0)
+  parser.add_argument('--role', default=None, help=argparse.SUPPRESS)
+  parser.add_argument('--hub', type=int, default=0, help=argparse.SUPPRESS)
+  parser.add_argument('--tmp', default=None, help=argparse.SUPPRESS)
+  parser.add_argument('--id', default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  if args.role is not None:
+    result = run_device(args) if args.role == 'device' else run_gateway(args)
+    print(json.dumps(result))
+    return 0
+
+  args.tmp = tempfile.mkdtemp(prefix='kaliot-gateway-')
+  ids = device_ids(args.devices)
+  print('%d CPUs' % os.cpu_count())
+  print('%-11s %6s %8s %8s %9s %10s %10s %12s' % (
+    'layout', 'procs', 'hub conn', 'devices', 'messages', 'rss MB', 'rss KB/dev', 'cpu ms/dev/min'))
+  try:
+    hub, spool, args.hub = start_hub()
+    start = time.time()
+    procs = [child('device', args, id=device_id) for device_id in ids]
+    results = [json.loads(proc.communicate()[0].splitlines()[-1]) for proc in procs]
+    report('per-device', args.devices, hub, spool, spool.broker.messages, results, time.time() - start)
+
+    hub, spool, args.hub = start_hub()
+    start = time.time()
+    proc = child('gateway', args)
+    port = int(proc.stdout.readline())
+    links = [GatewayLink(('127.0.0.1', port), device_id=device_id, secret=secret(device_id))
+             for device_id in ids]
+    code = content_code(JsonEncoder.content_type, JsonEncoder.content_encoding)
+    encoders = [JsonEncoder(device_id=device_id) for device_id in ids]
+    end = time.time() + args.duration
+    due = time.time()
+    while time.time() < end:
+      for device_id, link, encoder in zip(ids, links, encoders):
+        link.send(device_id, encoder.encode(make_reading(*READING)), code)
+      due += args.interval
+      time.sleep(max(0.0, min(due, end) - time.time()))
+    # every node's last frames into the gateway before it is told to stop
+    time.sleep(0.5)
+    for link in links:
+      link.close()
+    results = [json.loads(proc.communicate('')[0].splitlines()[-1])]
+    report('gateway', args.devices, hub, spool, spool.broker.messages, results, time.time() - start)
+  finally:
+    shutil.rmtree(args.tmp, ignore_errors=True)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,136 @@
+# Per-cycle cost of the scripts' console output, prints against kaliot.log.
+#
+#   python bench/bench_logging.py [--cycles 20000]
+#
+# One cycle is what kaliot-iot.py says about one reading: the sample (red
+# value and sensor timings), the send and its confirmation.  It is run
+# --cycles times back to back, with the console going to an unbuffered file
+# as under journald, in these setups:
+#   print           the per-event prints the script used to make
+#   default         kaliot.log as configured: console at WARNING, ring at
+#                   INFO, so every per-cycle line is below both levels
+#   ring debug      ring at DEBUG, console at WARNING
+#   console debug   console at DEBUG, confirmations and sends throttled to
+#                   one line a minute as in the script
+#   unthrottled     console at DEBUG with the throttles off
+# For each it prints the time per cycle and the console bytes and write
+# calls per cycle.
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot import log as kaliot_log
+from kaliot.encoding import JsonEncoder
+from kaliot.log import Throttle
+from kaliot.standin import StandInMessage
+from kaliot.telemetry import make_reading
+
+READING = (22.5, 1013.2, 41.0, 120, 140, 90, 380, 210.5, 4100.0)
+DURATIONS = (0.0183, 0.3124, 0.0021)  # BME280 s, TCS34725 s, skew s
+
+
+class CountingFile(io.FileIO):
+  # the console: every write is a syscall, as with an unbuffered stdout
+
+  writes = 0
+
+  def write(self, data):
+    self.writes += 1
+    return io.FileIO.write(self, data)
+
+
+def console(path):
+  raw = CountingFile(path, 'w')
+  return raw, io.TextIOWrapper(raw, write_through=True)
+
+
+def print_cycle(n, message, payload):
+  # as the script printed it: sample(), send_message() and
+  # send_confirmation_callback()
+  print ( "IoTHubClient sampling telemetry data" )
+  print ( READING[3] )
+  print ( "    BME280 %.1f ms, TCS34725 %.1f ms, skew %.1f ms" % (
+    DURATIONS[0] * 1e3, DURATIONS[1] * 1e3, DURATIONS[2] * 1e3) )
+  print ( "IoTHubClient.send_event_async accepted message %d for transmission to IoT Hub." % n )
+  print ( payload )
+  print ( "Confirmation[%d] received for message with result = %s" % (n, 'OK') )
+  map_properties = message.properties()
+  print ( "    message_id: %s" % message.message_id )
+  print ( "    correlation_id: %s" % message.correlation_id )
+  key_value_pair = map_properties.get_internals()
+  print ( "    Properties: %s" % key_value_pair )
+  print ( "    Total calls confirmed: %d" % n )
+
+
+def log_cycle(log, sent_log, confirmed_log):
+  # as the script logs it now
+  def cycle(n, message, payload):
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug("Sampled red %s; BME280 %.1f ms, TCS34725 %.1f ms, skew %.1f ms", READING[3],
+                DURATIONS[0] * 1e3, DURATIONS[1] * 1e3, DURATIONS[2] * 1e3)
+    sent_log.debug("IoTHubClient.send_event_async accepted message %d for transmission to IoT Hub: %r",
+                   n, payload)
+    confirmed_log.debug("Confirmation[%d] received with result %s, %d in total", n, 'OK', n)
+  return cycle
+
+
+def run(name, setup, args, directory):
+  raw, stream = console(os.path.join(directory, name.replace(' ', '-') + '.log'))
+  payload = JsonEncoder(device_id='us-stl-c0001').encode(make_reading(*READING))
+  message = StandInMessage(payload)
+  if setup is None:
+    cycle = print_cycle
+    redirect = contextlib.redirect_stdout(stream)
+  else:
+    level, ring_level, throttle = setup
+    kaliot_log.setup(level, 1000, ring_level, stream=stream, dump_signal=None)
+    log = logging.getLogger('kaliot.iot')
+    cycle = log_cycle(log, Throttle(log, throttle), Throttle(log, throttle))
+    redirect = contextlib.suppress()
+  with redirect:
+    start = time.perf_counter()
+    for n in range(args.cycles):
+      cycle(n, message, payload)
+    elapsed = time.perf_counter() - start
+  stream.flush()
+  size = os.path.getsize(raw.name)
+  print('%-14s %10.2f %10.1f %10.2f' % (name, elapsed / args.cycles * 1e6, size / float(args.cycles),
+                                        raw.writes / float(args.cycles)))
+  stream.close()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--cycles', type=int, default=20000)
+  args = parser.parse_args(argv)
+
+  setups = [
+    ('print', None),
+    ('default', (kaliot_log.LEVEL, kaliot_log.RING_LEVEL, 60.0)),
+    ('ring debug', (logging.WARNING, logging.DEBUG, 60.0)),
+    ('console debug', (logging.DEBUG, logging.DEBUG, 60.0)),
+    ('unthrottled', (logging.DEBUG, logging.DEBUG, 0)),
+  ]
+  directory = tempfile.mkdtemp(prefix='kaliot-logging-')
+  try:
+    print('%-14s %10s %10s %10s' % ('setup', 'us/cycle', 'bytes', 'writes'))
+    for name, setup in setups:
+      run(name, setup, args, directory)
+  finally:
+    shutil.rmtree(directory)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
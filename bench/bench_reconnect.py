@@ -0,0 +1,194 @@
+# Reconnect behaviour of a fleet over outages and flapping links, against the
+# broker stand-in in simulated time.
+#
+#   python bench/bench_reconnect.py [--devices 1000] [--connect-rate 100]
+#                                   [--interval 10] [--step 0.1] [--seed 1]
+#
+# Every device is a StandInDevice owned by a kaliot.connection
+# ConnectionManager.  It samples every --interval seconds whatever the link
+# does, buffers while disconnected and sends the buffer once it is back.  The
+# broker accepts at most --connect-rate connects per second, as the hub
+# throttles them.  Scenarios:
+#
+#   outage    the broker is down for 300 s, then stays up
+#   flapping  the broker goes down for 5 s every 30 s for 5 minutes
+#
+# Each scenario runs with three retry strategies:
+#   fixed 60 s  the old iotc reconnect: every 60 s, in lockstep
+#   exp         exponential backoff without jitter
+#   jittered    the default Backoff
+# For each run it prints:
+#   - connect attempts, and how many the broker refused
+#   - the busiest second of attempts
+#   - how long after the link came back the whole fleet was connected
+#   - readings not delivered by the end (must be 0)
+
+from __future__ import print_function
+
+import argparse
+import collections
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.connection import BACKOFF_BASE, BACKOFF_CAP, Backoff, ConnectionManager
+from kaliot.standin import LocalBroker, StandInDevice
+
+SETTLE = 900.0  # seconds simulated after the last change of the link
+
+
+class Clock(object):
+
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+class CountingBroker(LocalBroker):
+  # attempts per simulated second, and every payload that arrived
+
+  def __init__(self, clock, connect_rate):
+    LocalBroker.__init__(self, clock, connect_rate)
+    self.per_second = collections.Counter()
+    self.seen = set()
+
+  def connect(self, device):
+    self.per_second[int(self.clock())] += 1
+    return LocalBroker.connect(self, device)
+
+  def publish(self, device_id, payload, properties=None):
+    self.seen.add(payload)
+    return LocalBroker.publish(self, device_id, payload, properties)
+
+
+class SimDevice(object):
+
+  def __init__(self, n, broker, clock, backoff, down):
+    self.n = n
+    self.broker = broker
+    self.down = down
+    self.pending = collections.deque()
+    self.seq = 0
+    self.manager = ConnectionManager(self.open, close=self.close, on_up=self.on_up,
+                                     on_down=self.on_down, backoff=backoff, clock=clock)
+
+  def open(self):
+    device = StandInDevice(self.broker, device_id='dev%d' % self.n)
+    device.on('ConnectionStatus', self.status)
+    device.connect()
+    return device
+
+  def close(self, device):
+    if device.isConnected():
+      device.disconnect()
+
+  def status(self, info):
+    if info.getStatusCode() == 0:
+      self.manager.up()
+    else:
+      self.manager.down()
+
+  def on_up(self, device):
+    self.down.discard(self)
+    self.flush()
+
+  def on_down(self):
+    self.down.add(self)
+
+  def sample(self):
+    self.pending.append(b'%d:%d' % (self.n, self.seq))
+    self.seq += 1
+    if self.manager.connected:
+      self.flush()
+
+  def flush(self):
+    device = self.manager.client
+    while self.pending:
+      device.sendTelemetry(self.pending[0])
+      self.pending.popleft()
+    device.doNext()
+
+
+def run(events, strategy, args):
+  clock = Clock()
+  broker = CountingBroker(clock, args.connect_rate)
+  rng = random.Random(args.seed)
+  down = set()
+  devices = []
+  for n in range(args.devices):
+    if strategy == 'fixed 60 s':
+      backoff = Backoff(60.0, 60.0, random=lambda: 1.0)
+    elif strategy == 'exp':
+      backoff = Backoff(BACKOFF_BASE, BACKOFF_CAP, random=lambda: 1.0)
+    else:
+      backoff = Backoff(BACKOFF_BASE, BACKOFF_CAP, random=random.Random(rng.random()).random)
+    device = SimDevice(n, broker, clock, backoff, down)
+    down.add(device)
+    devices.append(device)
+
+  steps_per_sample = int(round(args.interval / args.step))
+  phases = collections.defaultdict(list)
+  for device in devices:
+    phases[rng.randrange(steps_per_sample)].append(device)
+
+  events = sorted(events)
+  last_change = events[-1][0]
+  end = last_change + SETTLE
+  settled = None
+  step = 0
+  while clock.now < end:
+    while events and events[0][0] <= clock.now:
+      broker.set_online(events.pop(0)[1])
+    for device in phases.get(step % steps_per_sample, ()):
+      device.sample()
+    for device in list(down):
+      device.manager.poll()
+    if settled is None and clock.now >= last_change and not down:
+      settled = clock.now - last_change
+    step += 1
+    clock.now = step * args.step
+
+  sampled = sum(device.seq for device in devices)
+  after = [count for second, count in broker.per_second.items() if second >= last_change]
+  return {
+    'attempts': sum(device.manager.attempts for device in devices),
+    'refused': broker.refused,
+    'peak': max(after or [0]),
+    'settled': settled,
+    'undelivered': sampled - len(broker.seen),
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--devices', type=int, default=1000)
+  parser.add_argument('--connect-rate', type=int, default=100)
+  parser.add_argument('--interval', type=float, default=10.0)
+  parser.add_argument('--step', type=float, default=0.1)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  scenarios = [
+    ('outage', [(60.0, False), (360.0, True)]),
+    ('flapping', [(t, online) for start in range(60, 360, 30)
+                  for t, online in ((float(start), False), (start + 5.0, True))]),
+  ]
+  failures = 0
+  print('%-9s %-11s %9s %9s %10s %11s %12s' % (
+    'scenario', 'strategy', 'attempts', 'refused', 'peak/s', 'settled s', 'undelivered'))
+  for name, events in scenarios:
+    for strategy in ('fixed 60 s', 'exp', 'jittered'):
+      r = run(events, strategy, args)
+      failures += r['undelivered'] != 0
+      print('%-9s %-11s %9d %9d %10d %11s %12d' % (
+        name, strategy, r['attempts'], r['refused'], r['peak'],
+        'never' if r['settled'] is None else '%.1f' % r['settled'], r['undelivered']))
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,194 @@
+# Capture a simulated rig, then replay it through the drivers and pipeline.
+#
+#   python bench/bench_replay.py [--cycles 200] [--samples 130] [--speed 1]
+#                                [--capture PREFIX]
+#
+# Two rigs run against kaliot.sim sensors with no real sleeps:
+#   pair    one BME280 on a FakeSMBus and one FakeTCS34725 under changing
+#           light (auto-ranged), read by Acquisition and encoded by
+#           JsonEncoder, as the entry scripts do
+#   mux     four BME280s and two TCS34725s behind TCA9548A channels, read by
+#           BusPoller and encoded by SampleEncoder
+# Each is captured with RecordingBus / RecordingTCS, then replayed from the
+# file at full speed and at --speed times the recorded pace.  For each it
+# prints the capture size, the cycles per second, and whether every replayed
+# payload (timestamps aside) is what the rig produced; the paced run should
+# come out at about --speed times the capture's cycle rate.
+
+from __future__ import print_function
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.acquire import Acquisition
+from kaliot.bme280 import BME280
+from kaliot.capture import Recorder, RecordingBus, RecordingTCS, Replay, ReplayFinished
+from kaliot.encoding import JsonEncoder
+from kaliot.sensors import BusPoller, SampleEncoder, parse_sensors
+from kaliot.sim import BME280_RAW, TCS34725_RAW, FakeSMBus, FakeTCS34725, TCA9548A_ADDRESS
+from kaliot.tcs import ColorSampler
+from kaliot.telemetry import make_reading
+
+MUX_SENSORS = [
+  {'id': 'rack%d-env' % n, 'type': 'bme280', 'bus': 1, 'addr': 0x76 + n % 2,
+   'mux': TCA9548A_ADDRESS, 'channel': n // 2} for n in range(4)
+] + [
+  {'id': 'rack%d-light' % n, 'type': 'tcs34725', 'bus': 1, 'mux': TCA9548A_ADDRESS, 'channel': n}
+  for n in range(2)
+]
+
+
+class Drift(object):
+  # raw BME280 values that move a little every cycle
+
+  def __init__(self, bus, addrs):
+    self.bus = bus
+    self.addrs = addrs
+    self.n = 0
+
+  def step(self):
+    self.n += 1
+    for i, (addr, channel) in enumerate(self.addrs):
+      wobble = int(2000 * math.sin(self.n / 10.0 + i))
+      self.bus.set_bme280_raw(addr, BME280_RAW[0] + wobble, BME280_RAW[1] + wobble // 2,
+                              BME280_RAW[2] + wobble // 4, channel=channel)
+
+
+def pair_pipeline(bus, chip, samples):
+  # one cycle -> payload, as kaliot-iotc.py's sample() + handle()
+  sensor = BME280(bus)
+  sensor._wait = 0  # no conversion to wait for, as bench_bme280.py --no-wait
+  sampler = ColorSampler(chip, samples=samples, auto_range=True)
+  acquisition = Acquisition([('bme280', sensor.read), ('tcs34725', sampler.read)], align=False)
+  encoder = JsonEncoder(device_id='us-stl-c0001')
+  def cycle():
+    values = acquisition.read()
+    airtemp, airpressure, airhumidity = values['bme280'].value
+    r, g, b, c, lux, color_temp = values['tcs34725'].value
+    reading = make_reading(airtemp, airpressure, airhumidity, r, g, b, c, lux, color_temp, ts=0.0)
+    return encoder.encode(reading)
+  return cycle, acquisition.close
+
+
+def mux_pipeline(bus, samples):
+  specs = parse_sensors(MUX_SENSORS)
+  poller = BusPoller(bus, specs, samples=samples, sleep=lambda seconds: None)
+  encoder = SampleEncoder(dict((spec.id, spec.kind) for spec in specs))
+  def cycle():
+    return encoder.encode([s._replace(ts=0.0) for s in sorted(poller.poll(), key=lambda s: s.name)])
+  return cycle, lambda: None
+
+
+def capture_pair(path, args):
+  recorder = Recorder(path)
+  bus = FakeSMBus()
+  bus.add_bme280()
+  drift = Drift(bus, [(0x77, None)])
+  level = [0]
+  def light():
+    # a day compressed into the capture: dark, office, bright, back down
+    x = math.sin(math.pi * level[0] / float(args.cycles))
+    return tuple(v * (0.01 + 3.0 * x) for v in TCS34725_RAW)
+  chip = FakeTCS34725(time_scale=0, light=light)
+  cycle, close = pair_pipeline(RecordingBus(bus, recorder, 1), RecordingTCS(chip, recorder), args.samples)
+  payloads = []
+  for n in range(args.cycles):
+    level[0] = n
+    drift.step()
+    payloads.append(cycle())
+  close()
+  recorder.close()
+  return payloads
+
+
+def capture_mux(path, args):
+  recorder = Recorder(path)
+  bus = FakeSMBus()
+  addrs = []
+  for entry in MUX_SENSORS:
+    if entry['type'] == 'bme280':
+      bus.add_bme280(entry['addr'], channel=entry['channel'])
+      addrs.append((entry['addr'], entry['channel']))
+    else:
+      bus.add_tcs34725(channel=entry['channel'])
+  drift = Drift(bus, addrs)
+  cycle, close = mux_pipeline(RecordingBus(bus, recorder, 1), args.samples)
+  payloads = []
+  for _ in range(args.cycles):
+    drift.step()
+    payloads.append(cycle())
+  close()
+  recorder.close()
+  return payloads
+
+
+def replay(rig, path, speed, args, limit=None):
+  source = Replay(path, speed=speed)
+  if rig == 'pair':
+    cycle, close = pair_pipeline(source.bus(1), source.tcs34725(), args.samples)
+  else:
+    cycle, close = mux_pipeline(source.bus(1), args.samples)
+  payloads = []
+  start = time.time()
+  try:
+    while limit is None or len(payloads) < limit:
+      payloads.append(cycle())
+  except ReplayFinished:
+    pass
+  elapsed = time.time() - start
+  close()
+  return payloads, elapsed, source
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--cycles', type=int, default=200)
+  parser.add_argument('--samples', type=int, default=130)
+  parser.add_argument('--speed', type=float, default=1.0)
+  parser.add_argument('--capture', default=None, help='keep the capture files, with this prefix')
+  args = parser.parse_args(argv)
+
+  failures = 0
+  print('%-5s %-10s %8s %10s %10s %9s' % ('rig', 'run', 'cycles', 'bytes', 'cycles/s', 'payloads'))
+  for rig, capture in (('pair', capture_pair), ('mux', capture_mux)):
+    if args.capture:
+      path = '%s-%s.cap' % (args.capture, rig)
+      if os.path.exists(path):
+        os.remove(path)
+    else:
+      fd, path = tempfile.mkstemp(suffix='.cap')
+      os.close(fd)
+      os.remove(path)
+    try:
+      start = time.time()
+      recorded = capture(path, args)
+      elapsed = time.time() - start
+      size = os.path.getsize(path)
+      print('%-5s %-10s %8d %10d %10.1f %9s' % (rig, 'capture', len(recorded), size,
+                                                len(recorded) / elapsed, ''))
+      replayed, elapsed, _ = replay(rig, path, 0, args)
+      same = replayed == recorded
+      failures += not same
+      print('%-5s %-10s %8d %10s %10.1f %9s' % (rig, 'replay', len(replayed), '',
+                                                len(replayed) / elapsed, 'same' if same else 'DIFFER'))
+      # long enough to measure the pacing, short enough to wait for
+      limit = max(2, args.cycles // 4)
+      paced, elapsed, source = replay(rig, path, args.speed, args, limit=limit)
+      same = paced == recorded[:len(paced)]
+      failures += not same
+      print('%-5s %-10s %8d %10s %10.1f %9s' % (rig, 'x%g' % args.speed, len(paced), '',
+                                                len(paced) / elapsed, 'same' if same else 'DIFFER'))
+    finally:
+      if not args.capture and os.path.exists(path):
+        os.remove(path)
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,104 @@
+# Append cost and range-query latency of the local history ring file.
+#
+#   python bench/bench_ring.py [--capacity 604800] [--extra 0.1] [--repeat 20]
+#
+# A ring of --capacity records (a week at 1 Hz) is filled with synthetic
+# 1 Hz readings and then --extra of a lap more, so the queries below cross
+# the wrap point.  Appends are timed one by one over the whole fill.  Each
+# query shape is run --repeat times against the mapped file, through
+# handle_query() as the direct method would, and its result is checked
+# against the readings that went in.  Memory is the tracemalloc peak of one
+# query.  Data as in bench_deadband.py.
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_deadband import synthetic
+
+from kaliot.encoding import BinaryEncoder
+from kaliot.ring import RingFile, handle_query
+
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--capacity', type=int, default=7 * 24 * 3600)
+  parser.add_argument('--extra', type=float, default=0.1)
+  parser.add_argument('--repeat', type=int, default=20)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  total = int(args.capacity * (1 + args.extra))
+  directory = tempfile.mkdtemp(prefix='kaliot-ring-')
+  try:
+    path = os.path.join(directory, 'ring.dat')
+    ring = RingFile(path, args.capacity)
+    readings = list(synthetic(total, args.seed))
+    start = time.time()
+    for reading in readings:
+      ring.append(reading)
+    elapsed = time.time() - start
+    print('file           %8.1f MB  (%d records of %d bytes)' % (
+      os.path.getsize(path) / 1048576.0, args.capacity, ring.size))
+    print('append         %8.2f us  (%d appends)' % (elapsed / total * 1e6, total))
+
+    # what a query should give back: the readings through the record packing
+    encoder = BinaryEncoder()
+    kept = [encoder.decode(encoder.encode(r)) for r in readings[-args.capacity:]]
+    times = [r.ts for r in kept]
+    end = times[-1] + 1
+    shapes = [
+      ('last hour', end - 3600, end, 3600),
+      ('last day / 1440', end - 86400, end, 1440),
+      ('week / 3600', times[0], end, 3600),
+      ('across wrap', times[-int(total - args.capacity) - 1800], times[-int(total - args.capacity) + 1800], 3600),
+    ]
+    failures = 0
+    print('%-16s %8s %10s %10s %10s' % ('query', 'points', 'p50 ms', 'p99 ms', 'peak KB'))
+    for name, lo, hi, points in shapes:
+      latencies = []
+      for _ in range(args.repeat):
+        t0 = time.time()
+        batch = ring.query(lo, hi, points)
+        latencies.append(time.time() - t0)
+      tracemalloc.start()
+      ring.query(lo, hi, points)
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      got = encoder.decode(batch)
+      window = [r for r in kept if lo <= r.ts < hi]
+      step = -(-len(window) // points)
+      if got != window[::step]:
+        failures += 1
+        print('%-16s MISMATCH: %d records, expected %d' % (name, len(got), len(window[::step])))
+      print('%-16s %8d %10.3f %10.3f %10.0f' % (
+        name, len(got), percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3, peak / 1024.0))
+
+    latencies = []
+    for _ in range(args.repeat):
+      t0 = time.time()
+      status, response = handle_query(ring, '{"seconds": 86400, "max_points": 1440}', end)
+      latencies.append(time.time() - t0)
+    print('method (day)     %8s %10.3f %10.3f  %d bytes' % (
+      status, percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3, len(response)))
+    ring.close()
+  finally:
+    shutil.rmtree(directory)
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,104 @@
+# Sampling period accuracy and CPU use of the old sleep-polling loops vs the
+# asyncio runtime, with time scaled down so a run takes seconds.
+#
+#   python bench/bench_runtime.py [--scale 0.005] [--samples 20]
+#
+# iotc-loop: wake every 5 s, doNext(), sample once 66 s have passed
+# iot-loop:  sample, then 60 x (get_send_status(), sleep 10 s)
+# runtime:   kaliot.runtime.Runtime with a 66 s period and a 1 s pump
+#
+# A sample takes as long as a BME280 forced read plus a 130 x 2.4 ms colour
+# window.  Periods are reported in unscaled seconds.
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.runtime import Runtime
+
+SAMPLE_TIME = 0.0115 + 130 * 0.0024
+
+
+def summarise(name, starts, nominal, scale, cpu, wall):
+  intervals = [(b - a) / scale for a, b in zip(starts, starts[1:])]
+  mean = sum(intervals) / len(intervals)
+  spread = (sum((i - mean) ** 2 for i in intervals) / len(intervals)) ** 0.5
+  drift = starts[-1] - starts[0] - nominal * scale * (len(starts) - 1)
+  print('%-10s %10.2f %10.3f %12.2f %8.2f' % (
+    name, mean, spread, drift / scale, 100.0 * cpu / wall))
+
+
+def sample_fn(starts, scale):
+  def sample():
+    starts.append(time.time())
+    time.sleep(SAMPLE_TIME * scale)
+    return None
+  return sample
+
+
+def iotc_loop(args):
+  starts = []
+  sample = sample_fn(starts, args.scale)
+  sample()
+  starttime = time.time()
+  while len(starts) < args.samples:
+    time.sleep(5 * args.scale)
+    if time.time() - starttime > 66 * args.scale:
+      sample()
+      starttime = time.time()
+  return starts, 66
+
+
+def iot_loop(args):
+  starts = []
+  sample = sample_fn(starts, args.scale)
+  while len(starts) < args.samples:
+    sample()
+    for _ in range(60):
+      time.sleep(10 * args.scale)
+  return starts, 600
+
+
+def runtime(args):
+  starts = []
+  sample = sample_fn(starts, args.scale)
+  def handle(reading):
+    if len(starts) >= args.samples:
+      rt.stop()
+  rt = Runtime(sample, handle, 66 * args.scale, pump=lambda: None, pump_interval=args.scale)
+  asyncio.run(rt.run())
+  return starts, 66
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--scale', type=float, default=0.005)
+  parser.add_argument('--samples', type=int, default=20)
+  args = parser.parse_args(argv)
+
+  print('%-10s %10s %10s %12s %8s' % ('loop', 'period s', 'jitter s', 'drift s', 'cpu %'))
+  for name, fn in (('iotc-loop', iotc_loop), ('iot-loop', iot_loop), ('runtime', runtime)):
+    wall, cpu = time.time(), time.process_time()
+    starts, nominal = fn(args)
+    wall, cpu = time.time() - wall, time.process_time() - cpu
+    summarise(name, starts, nominal, args.scale, cpu, wall)
+
+  # idle cost: nothing but the pump tick for a few (unscaled) seconds
+  rt = Runtime(lambda: None, lambda r: None, 3600, pump=lambda: None)
+  async def idle():
+    asyncio.get_event_loop().call_later(3.0, rt.stop)
+    await rt.run()
+  cpu = time.process_time()
+  asyncio.run(idle())
+  print('runtime idle: %.3f%% cpu' % (100.0 * (time.process_time() - cpu) / 3.0))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
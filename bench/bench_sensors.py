@@ -0,0 +1,88 @@
+# Samples per second as the number of sensors on one bus grows.
+#
+#   python bench/bench_sensors.py [--max 64] [--cycles 5] [--bus-hz 100000]
+#
+# Simulated BME280s at 0x76/0x77 behind eight-channel TCA9548A muxes
+# (0x70, 0x71, ...) on one FakeSMBus with real transfer times and conversion
+# waits.  "per-sensor" reads them one at a time, selecting the mux channel and
+# waiting out each conversion, as one process per sensor would;
+# "poller" is kaliot.sensors.BusPoller, which switches each channel once,
+# triggers every conversion and waits once.
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.bme280 import BME280
+from kaliot.sensors import BusPoller, parse_sensors
+from kaliot.sim import FakeSMBus, TCA9548A_ADDRESS
+
+
+def rack(count):
+  # two addresses per channel, eight channels per mux
+  return parse_sensors([{'id': 'bme%02d' % i, 'type': 'bme280', 'bus': 1,
+                         'addr': 0x76 + i % 2, 'mux': TCA9548A_ADDRESS + i // 16,
+                         'channel': (i // 2) % 8}
+                        for i in range(count)])
+
+
+def per_sensor(bus, specs):
+  sensors = []
+  for spec in specs:
+    for mux in bus.masks:
+      bus.write_byte(mux, 1 << spec.channel if mux == spec.mux else 0)
+    sensors.append((spec, BME280(bus, spec.addr)))
+  def read():
+    for spec, sensor in sensors:
+      for mux in bus.masks:
+        bus.write_byte(mux, 1 << spec.channel if mux == spec.mux else 0)
+      sensor.read()
+    return len(sensors)
+  return read
+
+
+def poller(bus, specs):
+  p = BusPoller(bus, specs)
+  return lambda: len(p.poll())
+
+
+def measure(read, bus, cycles):
+  bus.transactions = 0
+  samples = 0
+  start = time.time()
+  for _ in range(cycles):
+    samples += read()
+  elapsed = time.time() - start
+  return samples / elapsed, float(bus.transactions) / cycles
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--max', type=int, default=64)
+  parser.add_argument('--cycles', type=int, default=5)
+  parser.add_argument('--bus-hz', type=int, default=100000)
+  args = parser.parse_args(argv)
+
+  print('%8s %14s %14s %10s %10s' % ('sensors', 'per-sensor/s', 'poller/s', 'xfers', 'xfers'))
+  count = 1
+  while count <= args.max:
+    specs = rack(count)
+    row = []
+    for build in (per_sensor, poller):
+      bus = FakeSMBus(bus_hz=args.bus_hz)
+      for spec in specs:
+        bus.add_bme280(spec.addr, channel=spec.channel, mux=spec.mux)
+      row.append(measure(build(bus, specs), bus, args.cycles))
+    (serial, serial_xfers), (polled, polled_xfers) = row
+    print('%8d %14.1f %14.1f %10.0f %10.0f' % (count, serial, polled, serial_xfers, polled_xfers))
+    count *= 2
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
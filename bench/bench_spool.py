@@ -0,0 +1,113 @@
+# Append and drain throughput of the store-and-forward queue, plus a check that
+# the on-disk size stays bounded under oldest-first eviction.
+#
+#   python bench/bench_spool.py [--dir /mnt/sdcard/tmp] [--messages 20000]
+#                               [--join 1 16 256]
+#
+# Point --dir at the storage the device actually spools to; tmpfs numbers
+# say nothing about an SD card.
+#
+# Then --messages single JSON readings (with deviceId, data as in
+# bench_deadband.py) as the backlog of an outage, drained through a deflate Compressor with the entry scripts' threshold,
+# one message per entry and joined --join at a time (kaliot.encoding.join):
+# messages sent, bytes on the wire and drain time.
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_deadband import synthetic
+
+from kaliot.compression import COMPRESS_MIN_BYTES, Compressor
+from kaliot.encoding import JsonEncoder, join
+from kaliot.spool import OutboundQueue, Drainer
+
+PAYLOAD = (b'{"ts":1500000066.0,"airtemperature":45.46,"airpressure":1006.53,'
+           b'"airhumidity":38.28,"lux":257.0,"colortemp":5180.0,"green":352.0,'
+           b'"blue":270.0,"clear":912.0,"red":310.0}')
+
+
+def disk_size(path):
+  total = 0
+  for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(path + suffix):
+      total += os.path.getsize(path + suffix)
+  return total
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dir', default=None, help='directory for the spool file')
+  parser.add_argument('--messages', type=int, default=20000)
+  parser.add_argument('--bound', type=int, default=512 * 1024,
+                      help='max_bytes for the eviction check')
+  parser.add_argument('--join', type=int, nargs='+', default=[1, 16, 256],
+                      help='entries per backlog message')
+  args = parser.parse_args(argv)
+
+  workdir = tempfile.mkdtemp(dir=args.dir)
+  try:
+    path = os.path.join(workdir, 'spool.db')
+    queue = OutboundQueue(path)
+    start = time.time()
+    for _ in range(args.messages):
+      queue.append(PAYLOAD)
+    append_s = time.time() - start
+
+    drainer = Drainer(queue, lambda entry_id, payload: drainer.confirmed(entry_id),
+                      rate=1e9, window=64)
+    start = time.time()
+    while drainer.pump():
+      pass
+    drain_s = time.time() - start
+    left = len(queue)
+    queue.close()
+
+    print('append  %9.0f msg/s  (%d x %d B)' % (args.messages / append_s, args.messages, len(PAYLOAD)))
+    print('drain   %9.0f msg/s  (%d left)' % (args.messages / drain_s, left))
+
+    path = os.path.join(workdir, 'bounded.db')
+    queue = OutboundQueue(path, max_bytes=args.bound)
+    for _ in range(args.messages):
+      queue.append(PAYLOAD)
+    queue.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print('bounded %9d B on disk for max_bytes=%d, %d kept, %d evicted' % (
+      disk_size(path), args.bound, len(queue), queue.evicted))
+    queue.close()
+
+    encoder = JsonEncoder(device_id='us-stl-c0001')
+    backlog = [encoder.encode(r) for r in synthetic(args.messages, 1)]
+    print('%-8s %9s %12s %12s %8s %10s' % ('join', 'messages', 'spooled B', 'wire B', 'ratio', 'drain ms'))
+    for per in args.join:
+      path = os.path.join(workdir, 'backlog-%d.db' % per)
+      queue = OutboundQueue(path)
+      for payload in backlog:
+        queue.append(payload)
+      spooled = queue.bytes
+      compressor = Compressor('deflate', min_bytes=COMPRESS_MIN_BYTES)
+      wire = [0]
+      def send(entry_id, payload):
+        wire[0] += len(compressor.compress(payload)[0])
+        drainer.confirmed(entry_id)
+      drainer = Drainer(queue, send, rate=1e9, window=64, join=join if per > 1 else None, join_max=per)
+      start = time.time()
+      while drainer.pump():
+        pass
+      drain_s = time.time() - start
+      print('%-8d %9d %12d %12d %8.3f %10.0f' % (
+        per, drainer.sent, spooled, wire[0], wire[0] / float(spooled), drain_s * 1e3))
+      queue.close()
+  finally:
+    shutil.rmtree(workdir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
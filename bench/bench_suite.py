@@ -0,0 +1,226 @@
+# Micro-benchmark suite for the sampling and serialisation hot paths, with
+# saved results and a regression check against a stored baseline.
+#
+#   python bench/bench_suite.py run [--out results.json] [--repeat 7] [--only name ...]
+#   python bench/bench_suite.py compare baseline.json results.json [--threshold 0.10]
+#
+# Everything runs against FakeSMBus / FakeTCS34725 with their sleeps off, so
+# the numbers are CPU cost only and comparable across plain Linux boxes.
+# Each case is timed with timeit: the loop count is calibrated to ~0.2 s and
+# the best of --repeat runs is kept, per call.  compare flags every case
+# whose best time got slower than the baseline by more than --threshold and
+# exits 1 if there are any.
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.bme280 import BME280, BME280Calibration
+from kaliot.encoding import BinaryEncoder, JsonEncoder
+from kaliot.sim import BME280_RAW, FakeSMBus, FakeTCS34725, bme280_calibration_blocks
+from kaliot.standin import LocalBroker, StandInClient, StandInMessage
+from kaliot.tcs import SAMPLES, ColorSampler
+from kaliot.telemetry import make_reading
+
+THRESHOLD = 0.10
+REPEAT = 7
+
+
+def _reading(i=0):
+  return make_reading(45.464 + i * 1e-4, 1006.5325814481472, 38.275054276373446,
+                      310.4, 352.1, 270.9, 912.3, 257.0, 5180.0, ts=1500000000.123 + i)
+
+
+def case_calibration_parse():
+  blocks = bme280_calibration_blocks()
+  return lambda: BME280Calibration.from_blocks(*blocks)
+
+
+def case_bme280_init():
+  # driver construction: ctrl_hum write plus the three EEPROM reads
+  bus = FakeSMBus()
+  bus.add_bme280()
+  return lambda: BME280(bus)
+
+
+def case_compensate():
+  cal = BME280Calibration.from_blocks(*bme280_calibration_blocks())
+  pres_raw, temp_raw, hum_raw = BME280_RAW
+  return lambda: cal.compensate(pres_raw, temp_raw, hum_raw)
+
+
+def case_bme280_sample():
+  # readBME280All() without the conversion wait
+  bus = FakeSMBus()
+  bus.add_bme280()
+  sensor = BME280(bus)
+  def sample():
+    sensor.start()
+    return sensor.calibration.compensate(*sensor.fetch_raw())
+  return sample
+
+
+def case_colour_window():
+  # readTCSAll(): a 130-sample window on an enabled chip
+  sampler = ColorSampler(FakeTCS34725(time_scale=0), samples=SAMPLES)
+  return sampler.read
+
+
+def case_encode_json():
+  encoder = JsonEncoder(device_id='us-stl-c0001')
+  reading = _reading()
+  return lambda: encoder.encode(reading)
+
+
+def case_encode_binary():
+  encoder = BinaryEncoder()
+  reading = _reading()
+  return lambda: encoder.encode(reading)
+
+
+def case_encode_json_batch10():
+  encoder = JsonEncoder(device_id='us-stl-c0001')
+  readings = [_reading(i) for i in range(10)]
+  return lambda: encoder.encode_batch(readings)
+
+
+def case_cycle():
+  # sample both sensors, make_reading(), encode, wrap in a message and
+  # send_event_async() it to the local broker stand-in
+  bus = FakeSMBus()
+  bus.add_bme280()
+  sensor = BME280(bus)
+  sampler = ColorSampler(FakeTCS34725(time_scale=0), samples=SAMPLES)
+  encoder = JsonEncoder(device_id='us-stl-c0001')
+  client = StandInClient(LocalBroker(), device_id='us-stl-c0001')
+  def cycle():
+    sensor.start()
+    airtemp, airpressure, airhumidity = sensor.calibration.compensate(*sensor.fetch_raw())
+    r, g, b, c, lux, color_temp = sampler.read()
+    reading = make_reading(airtemp, airpressure, airhumidity, r, g, b, c, lux, color_temp)
+    message = StandInMessage(encoder.encode(reading))
+    message.content_type = encoder.content_type
+    message.content_encoding = encoder.content_encoding
+    client.send_event_async(message, None, 0)
+  return cycle
+
+
+CASES = collections.OrderedDict([
+  ('calibration_parse', case_calibration_parse),
+  ('bme280_init', case_bme280_init),
+  ('compensate', case_compensate),
+  ('bme280_sample', case_bme280_sample),
+  ('colour_window', case_colour_window),
+  ('encode_json', case_encode_json),
+  ('encode_binary', case_encode_binary),
+  ('encode_json_batch10', case_encode_json_batch10),
+  ('cycle', case_cycle),
+])
+
+
+def time_case(fn, repeat):
+  timer = timeit.Timer(fn)
+  number, _ = timer.autorange()
+  # autorange stops at 0.2 s; keep that loop count for every repeat
+  runs = [t / number for t in timer.repeat(repeat, number)]
+  runs.sort()
+  return {'best_us': runs[0] * 1e6, 'median_us': runs[len(runs) // 2] * 1e6, 'loops': number}
+
+
+def _commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=subprocess.STDOUT).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(args):
+  names = args.only or list(CASES)
+  unknown = [name for name in names if name not in CASES]
+  if unknown:
+    print('unknown case(s): %s' % ', '.join(unknown))
+    return 2
+  results = collections.OrderedDict()
+  print('%-22s %12s %12s %10s' % ('case', 'best us', 'median us', 'loops'))
+  for name in names:
+    result = results[name] = time_case(CASES[name](), args.repeat)
+    print('%-22s %12.2f %12.2f %10d' % (name, result['best_us'], result['median_us'], result['loops']))
+  report = {
+    'meta': {
+      'time': time.time(),
+      'commit': _commit(),
+      'python': platform.python_version(),
+      'machine': platform.machine(),
+      'platform': platform.platform(),
+    },
+    'results': results,
+  }
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(report, f, indent=2)
+    print('saved %s' % args.out)
+  return 0
+
+
+def compare(args):
+  with open(args.baseline) as f:
+    baseline = json.load(f)['results']
+  with open(args.current) as f:
+    current = json.load(f)['results']
+  regressions = []
+  print('%-22s %12s %12s %9s' % ('case', 'base us', 'now us', 'change'))
+  for name, result in current.items():
+    if name not in baseline:
+      print('%-22s %12s %12.2f %9s' % (name, '-', result['best_us'], 'new'))
+      continue
+    base = baseline[name]['best_us']
+    change = result['best_us'] / base - 1.0
+    flag = ''
+    if change > args.threshold:
+      flag = '  REGRESSION'
+      regressions.append(name)
+    print('%-22s %12.2f %12.2f %+8.1f%%%s' % (name, base, result['best_us'], change * 100, flag))
+  for name in baseline:
+    if name not in current:
+      print('%-22s %12.2f %12s %9s' % (name, baseline[name]['best_us'], '-', 'missing'))
+  if regressions:
+    print('%d regression(s) over %.0f%%: %s' % (len(regressions), args.threshold * 100,
+                                              ', '.join(regressions)))
+    return 1
+  return 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  commands = parser.add_subparsers(dest='command')
+  run_parser = commands.add_parser('run')
+  run_parser.add_argument('--out')
+  run_parser.add_argument('--repeat', type=int, default=REPEAT)
+  run_parser.add_argument('--only', nargs='+', metavar='CASE')
+  compare_parser = commands.add_parser('compare')
+  compare_parser.add_argument('baseline')
+  compare_parser.add_argument('current')
+  compare_parser.add_argument('--threshold', type=float, default=THRESHOLD)
+  args = parser.parse_args(argv)
+  if args.command == 'run':
+    return run(args)
+  if args.command == 'compare':
+    return compare(args)
+  parser.print_help()
+  return 2
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,62 @@
+# Wall-clock time per colour window against a mocked TCS34725.
+#
+#   python bench/bench_tcs.py [--windows N] [--samples 130] [--time-scale 1.0]
+#
+# "legacy" constructs (and therefore re-probes and re-enables) the chip on
+# every raw read, as the old averaging loop did; "sampler" is ColorSampler.
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.sim import FakeTCS34725
+from kaliot.tcs import ColorSampler, ColorAccumulator, light_reading
+
+
+def legacy_window(samples, time_scale):
+  window = ColorAccumulator()
+  for _ in range(samples):
+    tcs = FakeTCS34725(time_scale=time_scale)
+    r, g, b, c = tcs.get_raw_data()
+    window.add(r, g, b, c)
+    tcs.disable()
+  return light_reading(*window.mean())
+
+
+def measure(fn, windows):
+  FakeTCS34725.constructed = 0
+  start = time.time()
+  for _ in range(windows):
+    result = fn()
+  return result, (time.time() - start) / windows, float(FakeTCS34725.constructed) / windows
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--windows', type=int, default=3)
+  parser.add_argument('--samples', type=int, default=130)
+  parser.add_argument('--time-scale', type=float, default=1.0,
+                      help='multiplier for the simulated chip delays')
+  args = parser.parse_args(argv)
+
+  sampler = ColorSampler(FakeTCS34725(time_scale=args.time_scale), samples=args.samples)
+  rows = [
+    ('legacy', measure(lambda: legacy_window(args.samples, args.time_scale), args.windows)),
+    ('sampler', measure(sampler.read, args.windows)),
+  ]
+  print('%-8s %12s %8s  %s' % ('path', 'ms/window', 'inits', 'reading'))
+  for name, (result, seconds, inits) in rows:
+    print('%-8s %12.1f %8.1f  %s' % (name, seconds * 1e3, inits, result))
+  if rows[0][1][0] != rows[1][1][0]:
+    print('MISMATCH between legacy and sampler readings')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
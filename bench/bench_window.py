@@ -0,0 +1,133 @@
+# Throughput and memory of the send path at different in-flight windows.
+#
+#   python bench/bench_window.py [--windows 1 8 64 512] [--seconds 5]
+#                                [--offered 500] [--latency 0.2] [--link 5000]
+#
+# The asyncio Runtime samples at --offered readings/s, encodes them into a
+# spool and drains it through a Drainer with the given window into a stand-in
+# SDK client.  The client holds every message until its confirmation, which
+# comes back --latency seconds after the link (serialised at --link msg/s)
+# has carried it.  While the window is full the sampler is held back
+# (Runtime backpressure).  Memory is the tracemalloc peak over the run and the
+# most messages the client held at once.
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot.encoding import JsonEncoder
+from kaliot.runtime import Runtime
+from kaliot.spool import Drainer, OutboundQueue
+from kaliot.standin import LocalBroker, StandInMessage
+from kaliot.telemetry import make_reading
+
+
+class DelayedClient(object):
+  # send_event_async look-alike whose confirmations arrive on the event loop
+  # after the link and round-trip delay
+
+  def __init__(self, loop, latency, link_rate):
+    self.loop = loop
+    self.latency = latency
+    self.interval = 1.0 / link_rate
+    self.broker = LocalBroker()
+    self.free = 0.0
+    self.held = {}
+    self.peak = 0
+    self.latencies = []
+
+  def send_event_async(self, message, callback, user_context):
+    now = self.loop.time()
+    self.held[user_context] = message
+    self.peak = max(self.peak, len(self.held))
+    self.free = max(self.free, now) + self.interval
+    self.loop.call_at(self.free + self.latency, self._confirm, message, callback, user_context, now)
+
+  def _confirm(self, message, callback, user_context, sent):
+    del self.held[user_context]
+    self.broker.publish('kaliot-bench', bytes(message.get_bytearray()))
+    self.latencies.append(self.loop.time() - sent)
+    callback(message, 'OK', user_context)
+
+
+def run(window, args, directory):
+  spool = OutboundQueue(os.path.join(directory, 'window-%d.db' % window))
+  encoder = JsonEncoder(device_id='kaliot-bench')
+  state = {}
+
+  def sample():
+    return make_reading(45.46, 1006.53, 38.28, 310.0, 352.0, 270.0, 912.0, 257.0, 5180.0)
+
+  def handle(reading):
+    spool.append(encoder.encode(reading))
+
+  def confirmation(message, result, entry_id):
+    drainer.confirmed(entry_id)
+    runtime.wake()
+
+  def send(entry_id, payload):
+    message = StandInMessage(payload)
+    message.content_type = encoder.content_type
+    state['client'].send_event_async(message, confirmation, entry_id)
+
+  drainer = Drainer(spool, send, rate=1e9, burst=window, window=window)
+  runtime = Runtime(sample, handle, 1.0 / args.offered, drain=drainer.pump,
+                    drain_interval=0.001, queue_size=64, backpressure=drainer.full)
+
+  async def main():
+    loop = asyncio.get_event_loop()
+    state['client'] = DelayedClient(loop, args.latency, args.link)
+    loop.call_later(args.seconds, runtime.stop)
+    await runtime.run()
+
+  tracemalloc.start()
+  asyncio.run(main())
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  spool.close()
+
+  client = state['client']
+  latencies = sorted(client.latencies) or [0.0]
+  return {
+    'confirmed_per_s': client.broker.messages / float(args.seconds),
+    'sampled_per_s': runtime.samples / float(args.seconds),
+    'stalled_pct': 100.0 * runtime.stalled / args.seconds,
+    'p99_ms': latencies[int(0.99 * (len(latencies) - 1))] * 1e3,
+    'peak_held': client.peak,
+    'peak_kb': peak / 1024.0,
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--windows', type=int, nargs='+', default=[1, 8, 64, 512])
+  parser.add_argument('--seconds', type=float, default=5.0)
+  parser.add_argument('--offered', type=float, default=500.0)
+  parser.add_argument('--latency', type=float, default=0.2)
+  parser.add_argument('--link', type=float, default=5000.0)
+  args = parser.parse_args(argv)
+
+  directory = tempfile.mkdtemp(prefix='kaliot-window-')
+  try:
+    print('%7s %12s %12s %10s %10s %10s %10s' % (
+      'window', 'confirmed/s', 'sampled/s', 'stalled %', 'p99 ms', 'held', 'peak KB'))
+    for window in args.windows:
+      r = run(window, args, directory)
+      print('%7d %12.1f %12.1f %10.1f %10.1f %10d %10.0f' % (
+        window, r['confirmed_per_s'], r['sampled_per_s'], r['stalled_pct'],
+        r['p99_ms'], r['peak_held'], r['peak_kb']))
+  finally:
+    shutil.rmtree(directory)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+
+# kaliot gateway - one IoT Hub connection for many kaliot nodes.
+#
+# Nodes run kaliot-iot.py with GATEWAY_ADDRESS pointing here and hand over
+# their payloads through the local protocol in kaliot.gateway.  Every message
+# is spooled, then forwarded under its node's own device identity, all the
+# devices sharing one IoTHubTransport.  The hub multiplexes devices over one
+# connection with AMQP and AMQP_WS (HTTP shares the transport but polls per
+# device); MQTT has no shared transport.  See bench/bench_gateway.py.
+
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from iothub_client import IoTHubClient, IoTHubTransport, IoTHubTransportProvider, IoTHubConfig
+from iothub_client import IoTHubMessage, IoTHubError, IoTHubClientRetryPolicy
+from iothub_client import IoTHubClientConfirmationResult, IoTHubConnectionStatus
+
+from kaliot.gateway import Gateway, open_envelope
+from kaliot.spool import OutboundQueue, Drainer
+from kaliot.connection import Backoff, ConnectionManager
+from kaliot import metrics
+from kaliot import log as kaliot_log
+
+log = logging.getLogger("kaliot.gateway")
+
+
+# AMQP or AMQP_WS, for all the devices over one connection
+PROTOCOL = IoTHubTransportProvider.AMQP
+
+IOTHUB_NAME = "[IoT Hub Name]"
+IOTHUB_SUFFIX = "azure-devices.net"
+
+# the nodes forwarded, device id -> (device key, node secret); messages
+# from any other id are refused.  A node proves it holds its secret
+# (GATEWAY_SECRET in its kaliot-iot.py) when it connects and may then only
+# send as its own device id.
+DEVICES = {
+    "us-stl-c0001": ("[Device Key]", "[Node Secret]"),
+}
+
+# where nodes connect: a (host, port) pair or a Unix socket path.  Loopback
+# by default; for nodes on other boards set the address of the interface
+# they reach the gateway on, rather than "0.0.0.0".  The node secrets keep
+# other hosts from posting as a node, but the link is not encrypted.
+LISTEN = ("127.0.0.1", 7810)
+
+# store-and-forward, as in kaliot-iot.py but for every node together: a
+# message is acked to its node once spooled and deleted once the hub confirms
+# it; at most SEND_WINDOW are in flight, and the backlog drains at DRAIN_RATE
+# messages/s
+SPOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaliot-gateway-spool.db")
+SPOOL_MAX_BYTES = 200 * 1024 * 1024
+DRAIN_RATE = 50.0
+SEND_WINDOW = 32
+SEND_MAX_ATTEMPTS = 3
+MESSAGE_TIMEOUT = 10000
+PUMP_INTERVAL = 0.5
+
+# reconnecting, see kaliot-iot.py.  Each device reports its own status: a
+# device that drops on its own is re-registered on the shared transport with
+# a backoff of its own, and only once every device is down is the transport
+# itself reopened with all of them
+RECONNECT_BASE = 1.0
+RECONNECT_MAX = 120.0
+
+# Prometheus metrics, as in kaliot-iot.py: no authentication, so loopback
+# unless METRICS_ADDRESS says otherwise ("" for every interface)
+METRICS_PORT = 9106
+METRICS_ADDRESS = "127.0.0.1"
+
+# logging, as in kaliot-iot.py
+LOG_LEVEL = logging.WARNING
+LOG_RING_LEVEL = logging.INFO
+LOG_RING_SIZE = 1000
+
+connection = None
+transport = None
+spool = None
+drainer = None
+wake = None
+
+# per-device state, written by the SDK's status callbacks and read by the loop
+devices_lock = threading.Lock()
+device_tokens = {}    # device id -> context of its current client
+device_status = {}    # device id -> True up, False down, None not heard yet
+device_retry = {}     # device id -> (Backoff, when to re-register)
+tokens = itertools.count()
+
+
+def send_confirmation_callback(message, result, entry_id):
+    metrics.CALLBACKS.labels("send_confirmation").inc()
+    if result == IoTHubClientConfirmationResult.MESSAGE_TIMEOUT:
+        metrics.TIMEOUTS.inc()
+    if result == IoTHubClientConfirmationResult.OK:
+        drainer.confirmed(entry_id)
+    else:
+        transient = result in (IoTHubClientConfirmationResult.MESSAGE_TIMEOUT,
+                               IoTHubClientConfirmationResult.BECAUSE_DESTROY)
+        drainer.failed(entry_id, str(result), transient=transient)
+    if wake is not None:
+        wake()
+
+
+def connection_status_callback(result, reason, context):
+    # every device on the transport reports for itself: the transport is up
+    # once any device is, and down only when all of them are
+    device_id, token = context
+    metrics.CALLBACKS.labels("connection_status").inc()
+    with devices_lock:
+        if device_tokens.get(device_id) != token:
+            # a client already replaced or closed
+            return
+        up = result == IoTHubConnectionStatus.AUTHENTICATED
+        device_status[device_id] = up
+        if up:
+            device_retry.pop(device_id, None)
+        elif device_id not in device_retry:
+            backoff = Backoff(RECONNECT_BASE, RECONNECT_MAX)
+            device_retry[device_id] = (backoff, time.time() + backoff.next())
+        all_down = all(status is False for status in device_status.values())
+    if up:
+        log.info("Connection status of %s changed: %s (reason %s)", device_id, result, reason)
+        connection.up()
+    else:
+        log.warning("Connection status of %s changed: %s (reason %s)", device_id, result, reason)
+        if all_down:
+            connection.down()
+
+
+def device_client_init(device_id):
+    # a client for one device on the current transport
+    device_key = DEVICES[device_id][0]
+    config = IoTHubConfig(PROTOCOL, device_id, device_key, "", IOTHUB_NAME, IOTHUB_SUFFIX, "")
+    client = IoTHubClient(transport, config)
+    client.set_option("messageTimeout", MESSAGE_TIMEOUT)
+    token = next(tokens)
+    with devices_lock:
+        device_tokens[device_id] = token
+        device_status[device_id] = None
+    client.set_connection_status_callback(connection_status_callback, (device_id, token))
+    # reconnecting is the supervisor's job, as in kaliot-iot.py
+    client.set_retry_policy(IoTHubClientRetryPolicy.NO_RETRY, 0)
+    return client
+
+
+def gateway_client_init():
+    # one shared transport and a client per device on it
+    global transport
+    with devices_lock:
+        device_retry.clear()
+    transport = IoTHubTransport(PROTOCOL, IOTHUB_NAME, IOTHUB_SUFFIX)
+    clients = dict((device_id, device_client_init(device_id)) for device_id in DEVICES)
+    log.info("Opened %d devices on one %s transport", len(clients), PROTOCOL)
+    return clients
+
+
+def gateway_client_close(clients):
+    # the SDK destroys a client or a transport when the last reference to it
+    # goes: every client first, then the transport they are registered on
+    global transport
+    with devices_lock:
+        device_tokens.clear()
+        device_status.clear()
+        device_retry.clear()
+    clients.clear()
+    transport = None
+
+
+def reregister_devices():
+    # devices that dropped while the transport stayed up, each back on it
+    # once its own backoff allows; the rest keep sending meanwhile
+    clients = connection.client
+    if clients is None or not connection.connected:
+        return
+    now = time.time()
+    with devices_lock:
+        due = [device_id for device_id, (_, when) in device_retry.items() if when <= now]
+        for device_id in due:
+            backoff = device_retry[device_id][0]
+            device_retry[device_id] = (backoff, now + backoff.next())
+            # the old client's last callbacks are ignored from here on
+            device_tokens.pop(device_id, None)
+    for device_id in due:
+        log.info("Re-registering %s on the shared transport", device_id)
+        try:
+            clients[device_id] = device_client_init(device_id)
+        except IoTHubError as iothub_error:
+            log.warning("Re-registering %s failed: %s", device_id, iothub_error)
+
+
+def send_message(entry_id, entry):
+    device_id, content_type, content_encoding, payload = open_envelope(entry)
+    client = connection.client.get(device_id)
+    if client is None:
+        # spooled before the device was taken out of DEVICES
+        drainer.failed(entry_id, "unknown device")
+        return
+    message = IoTHubMessage(bytearray(payload))
+    if content_type:
+        message.content_type = content_type
+    if content_encoding:
+        message.content_encoding = content_encoding
+    client.send_event_async(message, send_confirmation_callback, entry_id)
+
+
+async def gateway_run():
+    global wake
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    wake = lambda: loop.call_soon_threadsafe(ready.set)
+    # accepts run on the loop, so they can set the event directly
+    gateway = Gateway(spool, dict((device_id, secret) for device_id, (_, secret) in DEVICES.items()),
+                      wake=ready.set)
+    await gateway.start(LISTEN)
+    log.info("Listening for nodes on %s", LISTEN)
+    try:
+        while True:
+            connection.poll()
+            reregister_devices()
+            drainer.pump()
+            try:
+                await asyncio.wait_for(ready.wait(), PUMP_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            ready.clear()
+    finally:
+        gateway.close()
+
+
+def main():
+    global connection, spool, drainer
+
+    kaliot_log.setup(LOG_LEVEL, LOG_RING_SIZE, LOG_RING_LEVEL)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT, addr=METRICS_ADDRESS)
+
+    def clients_up(clients):
+        # sends in flight on the old transport go out again
+        drainer.reset()
+        if wake is not None:
+            wake()
+
+    missing = sorted(device_id for device_id, (_, secret) in DEVICES.items() if not secret)
+    if missing:
+        log.error("No node secret in DEVICES for %s", ", ".join(missing))
+        return
+
+    spool = OutboundQueue(SPOOL_PATH, SPOOL_MAX_BYTES)
+    connection = ConnectionManager(gateway_client_init, close=gateway_client_close, on_up=clients_up,
+                                   backoff=Backoff(RECONNECT_BASE, RECONNECT_MAX))
+    drainer = Drainer(spool, send_message, rate=DRAIN_RATE, connected=lambda: connection.connected,
+                      window=SEND_WINDOW, max_attempts=SEND_MAX_ATTEMPTS)
+    try:
+        asyncio.run(gateway_run())
+    except IoTHubError as iothub_error:
+        log.error("Unexpected error %s from IoTHub", iothub_error)
+    except KeyboardInterrupt:
+        log.info("kaliot gateway stopped")
+    finally:
+        if connection.client is not None:
+            gateway_client_close(connection.client)
+
+
+if __name__ == '__main__':
+    print ( "\nPython %s" % sys.version )
+    print ( "kaliot gateway for %d devices, protocol %s" % (len(DEVICES), PROTOCOL) )
+    main()
@@ -1,53 +1,118 @@
-#!/usr/bin/python2
+#!/usr/bin/python3
 
 # Azure Required Headers
-import random
+import asyncio
 import time
 import sys
-import socket
+import os
+import json
+import logging
 import iothub_client
 from iothub_client import IoTHubClient, IoTHubClientError, IoTHubTransportProvider, IoTHubClientResult
 from iothub_client import IoTHubMessage, IoTHubMessageDispositionResult, IoTHubError, DeviceMethodReturnValue
-from iothub_client import IoTHubClientRetryPolicy, GetRetryPolicyReturnValue
+from iothub_client import IoTHubClientRetryPolicy
+from iothub_client import IoTHubClientConfirmationResult, IoTHubConnectionStatus
 from iothub_client_args import get_iothub_opt, OptionError
 
 # BME280 - Temp, Pressure, Humidity - Headers
 import smbus
-from ctypes import c_short
-from ctypes import c_byte
-from ctypes import c_ubyte
+from kaliot.bme280 import BME280, OVERSAMPLE_TEMP, OVERSAMPLE_PRES, OVERSAMPLE_HUM
+from kaliot.bme280 import MODE_FORCED
 
 ### TCS34715 - Light Quality - Headers
-import Adafruit_TCS34725
-import Adafruit_GPIO
+from kaliot.tcs import ColorSampler, SAMPLES
 
+# Both sensors are read at once, sharing the bus through a lock
+from kaliot.acquire import Acquisition, LockedBus, LockedI2C, bus_lock
 
-### BME280 - Temp, Pressure, Humidity
+# Telemetry batching
+from kaliot.batching import TelemetryBatcher
+from kaliot.telemetry import make_reading
+from kaliot.encoding import get_encoder, join
+from kaliot.deadband import DeadbandFilter
+from kaliot.aggregate import WindowAggregator
 
-DEVICE = 0x77 # Default device I2C address
+# Store-and-forward
+from kaliot.spool import OutboundQueue, Drainer
+
+# Compression
+from kaliot.compression import Compressor, DICTIONARY
+
+# Local history
+from kaliot.ring import RingFile, handle_query
+
+# Runtime
+from kaliot.runtime import Runtime
+
+# Several sensors / buses
+from kaliot.sensors import SensorPoller, SampleEncoder, parse_sensors
 
+# Metrics
+from kaliot import metrics
 
-bus = smbus.SMBus(1) # Rev 2 Pi, Pi 2 & Pi 3 uses bus 1
+# Live settings
+from kaliot.settings import Settings, twin_patch
 
-def getShort(data, index):
-  # return two bytes from data as a signed 16-bit value
-  return c_short((data[index+1] << 8) + data[index]).value
+# Connection supervisor
+from kaliot.connection import Backoff, ConnectionManager
 
-def getUShort(data, index):
-  # return two bytes from data as an unsigned 16-bit value
-  return (data[index+1] << 8) + data[index]
+# Capture / replay of raw sensor traffic
+from kaliot.capture import Recorder, RecordingBus, RecordingTCS, Replay
 
-def getChar(data,index):
-  # return one byte from data as a signed char
-  result = data[index]
-  if result > 127:
-    result -= 256
-  return result
+# Gateway mode
+from kaliot.gateway import GatewayClient
 
-def getUChar(data,index):
-  # return one byte from data as an unsigned char
-  result =  data[index] & 0xFF
-  return result
+# Command handling off the SDK thread
+from kaliot.workers import WorkerPool, CALLER_RUNS
+
+# Logging
+from kaliot import log as kaliot_log
+from kaliot.log import Throttle
+
+log = logging.getLogger("kaliot.iot")
+
+
+### BME280 - Temp, Pressure, Humidity
+
+DEVICE = 0x77 # Default device I2C address
+
+
+BUS = 1 # Rev 2 Pi, Pi 2 & Pi 3 uses bus 1
+
+# capture / replay - with CAPTURE_PATH set, every sensor transfer is also
+# appended to that file; with REPLAY_PATH set the sensors are left alone and
+# a capture is played back through the same drivers and pipeline instead,
+# REPLAY_SPEED times the recorded pace (0 for as fast as possible), and the
+# process stops at its end.  See kaliot.capture and bench/bench_replay.py.
+CAPTURE_PATH = None
+REPLAY_PATH = None
+REPLAY_SPEED = 1.0
+
+recorder = Recorder(CAPTURE_PATH) if CAPTURE_PATH else None
+replay = Replay(REPLAY_PATH, speed=REPLAY_SPEED) if REPLAY_PATH else None
+
+def open_bus(busnum):
+  # smbus handle for /dev/i2c-<busnum>, recorded or replayed as configured
+  if replay is not None:
+    return replay.bus(busnum)
+  handle = smbus.SMBus(busnum)
+  if recorder is not None:
+    handle = RecordingBus(handle, recorder, busnum)
+  return handle
+
+def open_tcs():
+  # the TCS34725 on BUS, through the Adafruit driver
+  if replay is not None:
+    return replay.tcs34725(busnum=BUS)
+  import Adafruit_TCS34725
+  tcs = Adafruit_TCS34725.TCS34725(i2c=LockedI2C(BUS))
+  if recorder is not None:
+    tcs = RecordingTCS(tcs, recorder, busnum=BUS)
+  return tcs
+
+# every transfer takes the bus lock, which the TCS34725 driver's own handle
+# shares through LockedI2C
+bus = LockedBus(open_bus(BUS), bus_lock(BUS))
 
 def readBME280ID(addr=DEVICE):
   # Chip ID Register Address
@@ -55,106 +120,45 @@ def readBME280ID(addr=DEVICE):
   (chip_id, chip_version) = bus.read_i2c_block_data(addr, REG_ID, 2)
   return (chip_id, chip_version)
 
+# BME280 oversampling (temperature, pressure, humidity) and colour window
+# length; both can be changed live through the twin, see iothub_client_run
+OVERSAMPLING = [OVERSAMPLE_TEMP, OVERSAMPLE_PRES, OVERSAMPLE_HUM]
+COLOR_SAMPLES = SAMPLES
+
+# BME280 acquisition - MODE_FORCED (lowest power) triggers a conversion on
+# every sample and waits for it; MODE_NORMAL has the chip measure on its own
+# every BME280_STANDBY ms through its IIR filter (BME280_IIR_FILTER: 0, 2, 4,
+# 8 or 16), so a sample is only the data burst.  See bench/bench_bme280.py.
+BME280_MODE = MODE_FORCED
+BME280_STANDBY = 62.5
+BME280_IIR_FILTER = 0
+
+# colour window - with COLOR_AUTO_RANGE the TCS34725 gain and integration
+# time follow the light level and a window stops once its mean is steady
+# (COLOR_SAMPLES is then the most raw reads per window); counts stay scaled
+# as at the default 4x / 2.4 ms.  See bench/bench_autorange.py.
+COLOR_AUTO_RANGE = False
+
+# one driver object per address; calibration is read the first time only
+bme280_sensors = {}
+
 def readBME280All(addr=DEVICE):
-  # Register Addresses
-  REG_DATA = 0xF7
-  REG_CONTROL = 0xF4
-  REG_CONFIG  = 0xF5
-
-  REG_CONTROL_HUM = 0xF2
-  REG_HUM_MSB = 0xFD
-  REG_HUM_LSB = 0xFE
-
-  # Oversample setting - page 27
-  OVERSAMPLE_TEMP = 2
-  OVERSAMPLE_PRES = 2
-  MODE = 1
-
-  # Oversample setting for humidity register - page 26
-  OVERSAMPLE_HUM = 2
-  bus.write_byte_data(addr, REG_CONTROL_HUM, OVERSAMPLE_HUM)
-
-  control = OVERSAMPLE_TEMP<<5 | OVERSAMPLE_PRES<<2 | MODE
-  bus.write_byte_data(addr, REG_CONTROL, control)
-
-  # Read blocks of calibration data from EEPROM
-  # See Page 22 data sheet
-  cal1 = bus.read_i2c_block_data(addr, 0x88, 24)
-  cal2 = bus.read_i2c_block_data(addr, 0xA1, 1)
-  cal3 = bus.read_i2c_block_data(addr, 0xE1, 7)
-
-  # Convert byte data to word values
-  dig_T1 = getUShort(cal1, 0)
-  dig_T2 = getShort(cal1, 2)
-  dig_T3 = getShort(cal1, 4)
-
-  dig_P1 = getUShort(cal1, 6)
-  dig_P2 = getShort(cal1, 8)
-  dig_P3 = getShort(cal1, 10)
-  dig_P4 = getShort(cal1, 12)
-  dig_P5 = getShort(cal1, 14)
-  dig_P6 = getShort(cal1, 16)
-  dig_P7 = getShort(cal1, 18)
-  dig_P8 = getShort(cal1, 20)
-  dig_P9 = getShort(cal1, 22)
-
-  dig_H1 = getUChar(cal2, 0)
-  dig_H2 = getShort(cal3, 0)
-  dig_H3 = getUChar(cal3, 2)
-
-  dig_H4 = getChar(cal3, 3)
-  dig_H4 = (dig_H4 << 24) >> 20
-  dig_H4 = dig_H4 | (getChar(cal3, 4) & 0x0F)
-
-  dig_H5 = getChar(cal3, 5)
-  dig_H5 = (dig_H5 << 24) >> 20
-  dig_H5 = dig_H5 | (getUChar(cal3, 4) >> 4 & 0x0F)
-
-  dig_H6 = getChar(cal3, 6)
-
-  # Wait in ms (Datasheet Appendix B: Measurement time and current calculation)
-  wait_time = 1.25 + (2.3 * OVERSAMPLE_TEMP) + ((2.3 * OVERSAMPLE_PRES) + 0.575) + ((2.3 * OVERSAMPLE_HUM)+0.575)
-  time.sleep(wait_time/1000)  # Wait the required time
-
-  # Read temperature/pressure/humidity
-  data = bus.read_i2c_block_data(addr, REG_DATA, 8)
-  pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
-  temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
-  hum_raw = (data[6] << 8) | data[7]
-
-  #Refine temperature
-  var1 = ((((temp_raw>>3)-(dig_T1<<1)))*(dig_T2)) >> 11
-  var2 = (((((temp_raw>>4) - (dig_T1)) * ((temp_raw>>4) - (dig_T1))) >> 12) * (dig_T3)) >> 14
-  t_fine = var1+var2
-  temperature = float(((t_fine * 5) + 128) >> 8);
-  temperatureF = (temperature * 9 / 5) + 32
-
-  # Refine pressure and adjust for temperature
-  var1 = t_fine / 2.0 - 64000.0
-  var2 = var1 * var1 * dig_P6 / 32768.0
-  var2 = var2 + var1 * dig_P5 * 2.0
-  var2 = var2 / 4.0 + dig_P4 * 65536.0
-  var1 = (dig_P3 * var1 * var1 / 524288.0 + dig_P2 * var1) / 524288.0
-  var1 = (1.0 + var1 / 32768.0) * dig_P1
-  if var1 == 0:
-    pressure=0
-  else:
-    pressure = 1048576.0 - pres_raw
-    pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
-    var1 = dig_P9 * pressure * pressure / 2147483648.0
-    var2 = pressure * dig_P8 / 32768.0
-    pressure = pressure + (var1 + var2 + dig_P7) / 16.0
-
-  # Refine humidity
-  humidity = t_fine - 76800.0
-  humidity = (hum_raw - (dig_H4 * 64.0 + dig_H5 / 16384.0 * humidity)) * (dig_H2 / 65536.0 * (1.0 + dig_H6 / 67108864.0 * humidity * (1.0 + dig_H3 / 67108864.0 * humidity)))
-  humidity = humidity * (1.0 - dig_H1 * humidity / 524288.0)
-  if humidity > 100:
-    humidity = 100
-  elif humidity < 0:
-    humidity = 0
-
-  return temperatureF/100.0,pressure/100.0,humidity
+  sensor = bme280_sensors.get(addr)
+  if sensor is None:
+    sensor = bme280_sensors[addr] = BME280(bus, addr, *OVERSAMPLING, mode=BME280_MODE,
+                                           standby=BME280_STANDBY, iir_filter=BME280_IIR_FILTER)
+  return sensor.read()
+
+## Get TCS Data
+# the chip is initialised once and stays enabled between windows
+tcs_sampler = None
+
+def readTCSAll():
+  global tcs_sampler
+  if tcs_sampler is None:
+    tcs_sampler = ColorSampler(open_tcs(), samples=COLOR_SAMPLES,
+                               auto_range=COLOR_AUTO_RANGE)
+  return tcs_sampler.read()
 
 # HTTP options
 # Because it can poll "after 9 seconds" polls will happen effectively
@@ -170,6 +174,69 @@ MINIMUM_POLLING_TIME = 9
 # By default, messages do not expire.
 MESSAGE_TIMEOUT = 10000
 
+# batching - with BATCH_MAX_COUNT above 1, readings are held and sent as one
+# JSON array once that many are waiting or the oldest is BATCH_MAX_AGE
+# seconds old
+BATCH_MAX_COUNT = 1
+BATCH_MAX_AGE = 3600
+
+# send-on-delta - sample every SAMPLE_INTERVAL seconds but, with DEADBAND on,
+# only report a reading when a channel has left its band
+# (kaliot.deadband.DEADBANDS) or nothing has been sent for HEARTBEAT seconds
+SAMPLE_INTERVAL = 600
+DEADBAND = False
+HEARTBEAT = 600
+
+# windowed aggregation - with AGGREGATE_WINDOW set (seconds), readings are
+# not sent but summarised (min/max/mean/stddev/count per channel) and one
+# summary goes out every AGGREGATE_HOP seconds (default: the window, i.e.
+# tumbling windows).  Lets SAMPLE_INTERVAL go down to a second or so without
+# sending more; DEADBAND and batching do not apply.
+AGGREGATE_WINDOW = 0
+AGGREGATE_HOP = None
+
+# store-and-forward - every payload is spooled to disk first and only deleted
+# once its confirmation comes back OK; timed out messages are sent again.
+# The backlog after an outage drains at DRAIN_RATE messages/s.
+SPOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaliot-iot-spool.db")
+SPOOL_MAX_BYTES = 50 * 1024 * 1024
+DRAIN_RATE = 5.0
+
+# in-flight window - at most SEND_WINDOW messages are with the SDK awaiting
+# confirmation; while the window is full, sampling waits (offline, it goes
+# on into the spool).  Timeouts are retried; other failures
+# SEND_MAX_ATTEMPTS times before the payload is dropped.
+SEND_WINDOW = 8
+SEND_MAX_ATTEMPTS = 3
+
+# reconnecting - the SDK's own retries are off; after a drop the client is
+# replaced with exponential backoff and full jitter: attempt n waits a random
+# time up to min(RECONNECT_MAX, RECONNECT_BASE * 2**n) seconds, so a fleet
+# that lost the hub together comes back spread out (see kaliot.connection).
+# Sampling goes on into the spool meanwhile.
+RECONNECT_BASE = 1.0
+RECONNECT_MAX = 120.0
+
+# local history - every reading is also kept in a fixed-size ring file of
+# RING_CAPACITY records (a week at 1 Hz by default); the "getReadings" direct
+# method returns a time range of it, downsampled to "max_points", in
+# pages that fit a method response.  Set RING_PATH to None to turn it off.
+RING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaliot-iot-ring.dat")
+RING_CAPACITY = 7 * 24 * 3600
+
+# command handling - cloud-to-device messages, direct methods and twin
+# updates are handled on COMMAND_WORKERS threads (kaliot.workers); the SDK's
+# callback thread, which also services the connection and the send
+# confirmations, only queues them.  At most COMMAND_QUEUE wait: beyond that
+# a message is abandoned (the hub delivers it again later) and a method
+# answered 503.  Twin patches build on each other, so they have one worker of
+# their own and are applied in the order they came; with its queue full a
+# patch is applied on the callback thread, and a value from a patch older
+# than the one that last set it is ignored (kaliot.settings).  0 handles
+# everything on the callback thread.  See bench/bench_commands.py.
+COMMAND_WORKERS = 2
+COMMAND_QUEUE = 32
+
 RECEIVE_CONTEXT = 0
 AVG_WIND_SPEED = 10.0
 MIN_TEMPERATURE = 20.0
@@ -181,6 +248,16 @@ TWIN_CONTEXT = 0
 SEND_REPORTED_STATE_CONTEXT = 0
 METHOD_CONTEXT = 0
 
+connection = None
+spool = None
+drainer = None
+runtime = None
+ring = None
+settings = None
+compressor = None
+commands = None
+twins = None
+
 # global counters
 RECEIVE_CALLBACKS = 0
 SEND_CALLBACKS = 0
@@ -197,7 +274,73 @@ PROTOCOL = IoTHubTransportProvider.MQTT
 # "HostName=<host_name>;DeviceId=<device_id>;SharedAccessKey=<device_key>"
 CONNECTION_STRING = "[Device Connection String]"
 
-MSG_TXT = "{\"deviceId\": us-stl-c0001,\"airtemperature\": %.2f,\"airpressure\": %.2f,\"airhumidity\": %.2f,\"red\": %.2f,\"green\": %.2f,\"blue\": %.2f,\"lux\": %.2f,\"colortemp\": %.2f}"
+DEVICE_ID = "us-stl-c0001"
+
+# gateway mode - with GATEWAY_ADDRESS set (a (host, port) pair or a Unix
+# socket path), messages go as DEVICE_ID to a kaliot gateway
+# (kaliot-gateway.py), which holds the one hub connection for many nodes,
+# instead of to the hub; CONNECTION_STRING and PROTOCOL are unused.  Twin
+# settings and direct methods are not available through a gateway.
+# GATEWAY_SECRET is this node's secret, as set for DEVICE_ID in the
+# gateway's DEVICES; the gateway refuses a node without it.
+GATEWAY_ADDRESS = None
+GATEWAY_SECRET = "[Node Secret]"
+
+# compression - payloads of COMPRESS_MIN_BYTES or more (batches, summaries)
+# go out compressed with COMPRESSION ("gzip" or "deflate", None for off) at
+# COMPRESS_LEVEL when that makes them smaller; the codec is in the message's
+# contentEncoding.  A single reading is below that, so with compression on a
+# spool backlog after an outage drains as messages of up to BACKLOG_JOIN
+# spooled payloads joined into one array or binary batch
+# (kaliot.encoding.join), which compress to a fraction; 1 sends them one by
+# one.  COMPRESS_DICTIONARY adds the preset dictionary trained on kaliot
+# records ("deflate-dict"), which makes single JSON readings worth
+# compressing from ~128 bytes.  See bench/bench_compression.py and
+# bench/bench_spool.py for sizes and costs.
+COMPRESSION = None
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_BYTES = 256
+COMPRESS_DICTIONARY = False
+BACKLOG_JOIN = 256
+
+# payload encoding - "json" (one precompiled template) or "binary" (packed
+# scaled integers, for metered links)
+ENCODING = "json"
+
+# several sensors - with SENSORS set, every listed sensor is polled (one
+# poller per bus) instead of the single BME280/TCS34725 pair, and each sample
+# goes out as one JSON array tagged by sensor id; DEADBAND and batching do not
+# apply.  See kaliot.sensors for the entries, e.g.
+#   {"id": "rack1-top", "type": "bme280", "bus": 1, "addr": 0x77}
+#   {"id": "rack2-top", "type": "bme280", "bus": 1, "mux": 0x70, "channel": 2}
+SENSORS = []
+
+# metrics - timings and counters in Prometheus text format, served on
+# http://METRICS_ADDRESS:METRICS_PORT/metrics and/or written to
+# METRICS_TEXTFILE for node-exporter's textfile collector (None/0 to turn
+# either off).  The endpoint has no authentication, so it only listens on
+# the loopback interface; set METRICS_ADDRESS to an interface's address, or
+# "" for all of them, to let a scraper on the network reach it.
+METRICS_PORT = 9105
+METRICS_ADDRESS = "127.0.0.1"
+METRICS_TEXTFILE = None
+METRICS_INTERVAL = 15
+
+# logging - LOG_LEVEL goes to the console (journald), LOG_RING_LEVEL into an
+# in-memory ring of the last LOG_RING_SIZE entries, written to the console on
+# SIGUSR1 and returned by the "getLog" direct method ({"lines": n}, the last
+# 100 by default).  Below both levels a log call is skipped before anything
+# is formatted.  Send confirmations and other per-message lines come at most
+# once every LOG_THROTTLE seconds, with a count of those left out.
+LOG_LEVEL = logging.WARNING
+LOG_RING_LEVEL = logging.INFO
+LOG_RING_SIZE = 1000
+LOG_THROTTLE = 60.0
+
+log_ring = None
+sent_log = Throttle(log, LOG_THROTTLE)
+confirmed_log = Throttle(log, LOG_THROTTLE)
+failed_log = Throttle(log, LOG_THROTTLE)
 
 # some embedded platforms need certificate information
 
@@ -206,80 +349,167 @@ def set_certificates(client):
     from iothub_client_cert import CERTIFICATES
     try:
         client.set_option("TrustedCerts", CERTIFICATES)
-        print ( "set_option TrustedCerts successful" )
+        log.debug("set_option TrustedCerts successful")
     except IoTHubClientError as iothub_client_error:
-        print ( "set_option TrustedCerts failed (%s)" % iothub_client_error )
+        log.warning("set_option TrustedCerts failed (%s)", iothub_client_error)
 
 
 def receive_message_callback(message, counter):
     global RECEIVE_CALLBACKS
-    message_buffer = message.get_bytearray()
-    size = len(message_buffer)
-    print ( "Received Message [%d]:" % counter )
-    print ( "    Data: <<<%s>>> & Size=%d" % (message_buffer[:size].decode('utf-8'), size) )
-    map_properties = message.properties()
-    key_value_pair = map_properties.get_internals()
-    print ( "    Properties: %s" % key_value_pair )
-    counter += 1
     RECEIVE_CALLBACKS += 1
-    print ( "    Total calls received: %d" % RECEIVE_CALLBACKS )
+    metrics.CALLBACKS.labels("receive").inc()
+    with metrics.CALLBACK_HOLD.labels("message").time():
+        # the message is the SDK's again once this returns, so copy it out
+        message_buffer = bytes(message.get_bytearray())
+        key_value_pair = message.properties().get_internals()
+        if commands is None:
+            handle_message(message_buffer, key_value_pair, counter)
+        elif not commands.submit("message", handle_message, message_buffer, key_value_pair, counter):
+            # queue full: the hub delivers it again later
+            return IoTHubMessageDispositionResult.ABANDONED
     return IoTHubMessageDispositionResult.ACCEPTED
 
 
+def handle_message(message_buffer, key_value_pair, counter):
+    log.info("Received message [%d]: <<<%s>>> (%d bytes), properties %s, %d received in total",
+             counter, message_buffer.decode('utf-8', 'replace'), len(message_buffer), key_value_pair,
+             RECEIVE_CALLBACKS)
+
+
 def send_confirmation_callback(message, result, user_context):
     global SEND_CALLBACKS
-    print ( "Confirmation[%d] received for message with result = %s" % (user_context, result) )
-    map_properties = message.properties()
-    print ( "    message_id: %s" % message.message_id )
-    print ( "    correlation_id: %s" % message.correlation_id )
-    key_value_pair = map_properties.get_internals()
-    print ( "    Properties: %s" % key_value_pair )
     SEND_CALLBACKS += 1
-    print ( "    Total calls confirmed: %d" % SEND_CALLBACKS )
+    metrics.CALLBACKS.labels("send_confirmation").inc()
+    if result == IoTHubClientConfirmationResult.OK:
+        confirmed_log.debug("Confirmation[%d] received with result %s, %d in total",
+                            user_context, result, SEND_CALLBACKS)
+    else:
+        failed_log.warning("Confirmation[%d] received with result %s", user_context, result)
+    if result == IoTHubClientConfirmationResult.MESSAGE_TIMEOUT:
+        metrics.TIMEOUTS.inc()
+    if drainer is not None:
+        if result == IoTHubClientConfirmationResult.OK:
+            drainer.confirmed(user_context)
+        else:
+            # still in the spool, goes out again on a later pump
+            transient = result in (IoTHubClientConfirmationResult.MESSAGE_TIMEOUT,
+                                   IoTHubClientConfirmationResult.BECAUSE_DESTROY)
+            drainer.failed(user_context, str(result), transient=transient)
+    if runtime is not None:
+        runtime.wake_threadsafe()
 
 
 def connection_status_callback(result, reason, user_context):
     global CONNECTION_STATUS_CALLBACKS
-    print ( "Connection status changed[%d] with:" % (user_context) )
-    print ( "    reason: %d" % reason )
-    print ( "    result: %s" % result )
     CONNECTION_STATUS_CALLBACKS += 1
-    print ( "    Total calls confirmed: %d" % CONNECTION_STATUS_CALLBACKS )
+    metrics.CALLBACKS.labels("connection_status").inc()
+    if result == IoTHubConnectionStatus.AUTHENTICATED:
+        log.info("Connection status changed[%d]: %s (reason %s)", user_context, result, reason)
+        connection.up()
+    else:
+        log.warning("Connection status changed[%d]: %s (reason %s)", user_context, result, reason)
+        connection.down()
 
 
 def device_twin_callback(update_state, payload, user_context):
     global TWIN_CALLBACKS
-    print ( "")
-    print ( "Twin callback called with:")
-    print ( "updateStatus: %s" % update_state )
-    print ( "context: %s" % user_context )
-    print ( "payload: %s" % payload )
     TWIN_CALLBACKS += 1
-    print ( "Total calls confirmed: %d\n" % TWIN_CALLBACKS )
+    metrics.CALLBACKS.labels("twin").inc()
+    with metrics.CALLBACK_HOLD.labels("twin").time():
+        if twins is None:
+            handle_twin(update_state, payload, user_context)
+        else:
+            # one worker keeps the patches in order; none is dropped, with
+            # the queue full this one is applied here
+            twins.submit("twin", handle_twin, update_state, payload, user_context)
+
+
+def handle_twin(update_state, payload, user_context):
+    log.info("Twin update (%s, context %s): %s, %d in total", update_state, user_context, payload,
+             TWIN_CALLBACKS)
+    if settings is not None:
+        # the full twin on connect, only the desired patch after that; the
+        # changes are applied and reported at the next sample
+        twin = json.loads(payload)
+        desired = twin.get("desired", twin)
+        settings.update(desired, desired.get("$version"))
 
 
 def send_reported_state_callback(status_code, user_context):
     global SEND_REPORTED_STATE_CALLBACKS
-    print ( "Confirmation[%d] for reported state received with:" % (user_context) )
-    print ( "    status_code: %d" % status_code )
     SEND_REPORTED_STATE_CALLBACKS += 1
-    print ( "    Total calls confirmed: %d" % SEND_REPORTED_STATE_CALLBACKS )
+    metrics.CALLBACKS.labels("send_reported_state").inc()
+    log.debug("Confirmation[%d] for reported state received with status %d, %d in total",
+              user_context, status_code, SEND_REPORTED_STATE_CALLBACKS)
 
 
 def device_method_callback(method_name, payload, user_context):
+    # with COMMAND_WORKERS at 0: answered on the callback thread
     global METHOD_CALLBACKS
-    print ( "\nMethod callback called with:\nmethodName = %s\npayload = %s\ncontext = %s" % (method_name, payload, user_context) )
     METHOD_CALLBACKS += 1
-    print ( "Total calls confirmed: %d\n" % METHOD_CALLBACKS )
+    metrics.CALLBACKS.labels("method").inc()
+    with metrics.CALLBACK_HOLD.labels("method").time():
+        status, response = call_method(method_name, payload, user_context)
     device_method_return_value = DeviceMethodReturnValue()
-    device_method_return_value.response = "{ \"Response\": \"This is the response from the device\" }"
-    device_method_return_value.status = 200
+    device_method_return_value.response = response
+    device_method_return_value.status = status
     return device_method_return_value
 
 
+def device_method_callback_ex(method_name, payload, method_id):
+    # with workers: queued, and answered through device_method_response by
+    # the worker, on the client the call came in on
+    global METHOD_CALLBACKS
+    METHOD_CALLBACKS += 1
+    metrics.CALLBACKS.labels("method").inc()
+    client = connection.client
+    def respond(status, response):
+        client.device_method_response(method_id, response, len(response), status)
+    def run():
+        respond(*call_method(method_name, payload, method_id))
+    with metrics.CALLBACK_HOLD.labels("method").time():
+        if not commands.submit("method", run, on_drop=lambda: respond(503, METHOD_BUSY_RESPONSE)):
+            respond(503, METHOD_BUSY_RESPONSE)
+
+
+METHOD_BUSY_RESPONSE = "{ \"Response\": \"Busy, try again later\" }"
+
+
+def call_method(method_name, payload, user_context):
+    # handle_method(), answering 500 if it raises: a method that gets no
+    # answer keeps its caller waiting until the call times out
+    try:
+        return handle_method(method_name, payload, user_context)
+    except Exception as e:
+        log.exception("Method %s failed", method_name)
+        return 500, json.dumps({"error": str(e)})
+
+
+def handle_method(method_name, payload, user_context):
+    # (status, response) for a direct method call
+    log.info("Method %s called (context %s): %s, %d in total", method_name, user_context, payload,
+             METHOD_CALLBACKS)
+    if method_name == "getReadings" and ring is not None:
+        return handle_query(ring, payload, time.time())
+    if method_name == "getLog" and log_ring is not None:
+        try:
+            lines = int(json.loads(payload or "{}").get("lines", 100))
+        except (ValueError, TypeError, AttributeError) as e:
+            return 400, json.dumps({"error": str(e)})
+        return 200, json.dumps({"entries": log_ring.dump(lines)})
+    return 200, "{ \"Response\": \"This is the response from the device\" }"
+
+
 def iothub_client_init():
     # prepare iothub client
-    client = IoTHubClient(CONNECTION_STRING, PROTOCOL)
+    if GATEWAY_ADDRESS:
+        client = GatewayClient(GATEWAY_ADDRESS, DEVICE_ID,
+                               (IoTHubClientConfirmationResult.OK, IoTHubClientConfirmationResult.ERROR,
+                                IoTHubClientConfirmationResult.BECAUSE_DESTROY),
+                               (IoTHubConnectionStatus.AUTHENTICATED, IoTHubConnectionStatus.UNAUTHENTICATED),
+                               secret=GATEWAY_SECRET)
+    else:
+        client = IoTHubClient(CONNECTION_STRING, PROTOCOL)
     if client.protocol == IoTHubTransportProvider.HTTP:
         client.set_option("timeout", TIMEOUT)
         client.set_option("MinimumPollingTime", MINIMUM_POLLING_TIME)
@@ -295,20 +525,25 @@ def iothub_client_init():
     if client.protocol == IoTHubTransportProvider.MQTT or client.protocol == IoTHubTransportProvider.MQTT_WS:
         client.set_device_twin_callback(
             device_twin_callback, TWIN_CONTEXT)
-        client.set_device_method_callback(
-            device_method_callback, METHOD_CONTEXT)
-    if client.protocol == IoTHubTransportProvider.AMQP or client.protocol == IoTHubTransportProvider.AMQP_WS:
-        client.set_connection_status_callback(
-            connection_status_callback, CONNECTION_STATUS_CONTEXT)
-
-    retryPolicy = IoTHubClientRetryPolicy.RETRY_INTERVAL
-    retryInterval = 100
+        if commands is not None:
+            client.set_device_method_callback_ex(
+                device_method_callback_ex, METHOD_CONTEXT)
+        else:
+            client.set_device_method_callback(
+                device_method_callback, METHOD_CONTEXT)
+    # the connection supervisor learns of every drop from here
+    client.set_connection_status_callback(
+        connection_status_callback, CONNECTION_STATUS_CONTEXT)
+
+    # reconnecting is the supervisor's job (ConnectionManager), not the SDK's
+    retryPolicy = IoTHubClientRetryPolicy.NO_RETRY
+    retryInterval = 0
     client.set_retry_policy(retryPolicy, retryInterval)
-    print ( "SetRetryPolicy to: retryPolicy = %d" %  retryPolicy)
-    print ( "SetRetryPolicy to: retryTimeoutLimitInSeconds = %d" %  retryInterval)
-    retryPolicyReturn = client.get_retry_policy()
-    print ( "GetRetryPolicy returned: retryPolicy = %d" %  retryPolicyReturn.retryPolicy)
-    print ( "GetRetryPolicy returned: retryTimeoutLimitInSeconds = %d" %  retryPolicyReturn.retryTimeoutLimitInSeconds)
+    log.debug("SetRetryPolicy to: retryPolicy = %d, retryTimeoutLimitInSeconds = %d", retryPolicy, retryInterval)
+    if log.isEnabledFor(logging.DEBUG):
+        retryPolicyReturn = client.get_retry_policy()
+        log.debug("GetRetryPolicy returned: retryPolicy = %d, retryTimeoutLimitInSeconds = %d",
+                  retryPolicyReturn.retryPolicy, retryPolicyReturn.retryTimeoutLimitInSeconds)
 
     return client
 
@@ -316,89 +551,232 @@ def iothub_client_init():
 def print_last_message_time(client):
     try:
         last_message = client.get_last_message_receive_time()
-        print ( "Last Message: %s" % time.asctime(time.localtime(last_message)) )
-        print ( "Actual time : %s" % time.asctime() )
+        log.info("Last message: %s, actual time: %s", time.asctime(time.localtime(last_message)), time.asctime())
     except IoTHubClientError as iothub_client_error:
         if iothub_client_error.args[0].result == IoTHubClientResult.INDEFINITE_TIME:
-            print ( "No message received" )
+            log.info("No message received")
         else:
-            print ( iothub_client_error )
+            log.warning("%s", iothub_client_error)
+
+def send_message(client, msg_txt_formatted, entry_id, encoder):
+    # messages can be encoded as string or bytearray
+    content_encoding = encoder.content_encoding
+    if compressor is not None:
+        msg_txt_formatted, codec = compressor.compress(msg_txt_formatted)
+        if codec:
+            content_encoding = codec
+    message = IoTHubMessage(bytearray(msg_txt_formatted))
+    message.content_type = encoder.content_type
+    if content_encoding:
+        message.content_encoding = content_encoding
+    # optional: assign properties
+    # prop_map = message.properties()
+    # prop_map.add("temperatureAlert", 'true' if temperature > 28 else 'false')
+
+    # the spool entry id comes back as user_context in the confirmation
+    client.send_event_async(message, send_confirmation_callback, entry_id)
+    sent_log.debug("IoTHubClient.send_event_async accepted message %d for transmission to IoT Hub: %r",
+                   entry_id, msg_txt_formatted)
 
 def iothub_client_run():
+    global spool, drainer, runtime, ring, settings, compressor, connection, commands, twins, log_ring
 
-    try:
+    log_ring = kaliot_log.setup(LOG_LEVEL, LOG_RING_SIZE, LOG_RING_LEVEL)
 
-        client = iothub_client_init()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT, addr=METRICS_ADDRESS)
+    if METRICS_TEXTFILE:
+        metrics.TextfileWriter(METRICS_TEXTFILE, METRICS_INTERVAL).start()
 
-        if client.protocol == IoTHubTransportProvider.MQTT:
-            print ( "IoTHubClient is reporting state" )
-            reported_state = "{\"newState\":\"standBy\"}"
+    try:
+
+        # live settings - twin desired properties named as in
+        # kaliot.settings.TUNABLES change the running device from the next
+        # sample on, without reconnecting; each change is acknowledged in the
+        # reported properties with its status and the desired $version
+        def set_color_samples(samples):
+            global COLOR_SAMPLES
+            COLOR_SAMPLES = samples
+            if tcs_sampler is not None:
+                tcs_sampler.samples = samples
+            if sensors is not None:
+                sensors.set_samples(samples)
+
+        def set_oversampling(index, value):
+            OVERSAMPLING[index] = value
+            for sensor in bme280_sensors.values():
+                sensor.set_oversampling(*OVERSAMPLING)
+            if sensors is not None:
+                sensors.set_oversampling(*OVERSAMPLING)
+
+        def set_message_timeout(timeout):
+            # new clients take MESSAGE_TIMEOUT from iothub_client_init
+            global MESSAGE_TIMEOUT
+            if connection.client is not None:
+                connection.client.set_option("messageTimeout", timeout)
+            MESSAGE_TIMEOUT = timeout
+
+        def report_settings(acks):
+            client = connection.client
+            if not connection.connected or client.protocol != IoTHubTransportProvider.MQTT:
+                # every reconnect reports the settings in force
+                return
+            reported_state = json.dumps(twin_patch(acks))
             client.send_reported_state(reported_state, len(reported_state), send_reported_state_callback, SEND_REPORTED_STATE_CONTEXT)
 
-        while True:
-            print ( "IoTHubClient sending telemetry data" )
-
-	    (airtemp,airpressure,airhumidity) = readBME280All(addr=DEVICE)
-	    avgr = 0
-	    avgg = 0
-	    avgb = 0
-	    avgc = 0
-            count = 0
-	    while (count < 130):
-        		tcs = Adafruit_TCS34725.TCS34725()
-        		r, g, b, c = tcs.get_raw_data()
-        		avgr = avgr + r
-        		avgg = avgg + g
-        		avgb = avgb + b
-        		avgc = avgc + c
-        		count = count + 1
-			tcs.disable()
-     	    avgr = avgr/130
-	    avgg = avgg/130
-	    avgb = avgb/130
-	    avgc = avgc/130
-	    
-            print ( avgr )
-
-	    r = float(avgr)
-	    g = float(avgg)
-	    b = float(avgb)
-	    c = float(avgc)
-
-	    lux = float(Adafruit_TCS34725.calculate_lux(r, g, b))
-
- 	    color_temp = Adafruit_TCS34725.calculate_color_temperature(r, g, b)
-	    if color_temp is None:
-        	color_temp = 0
-	    color_temp = float(color_temp)
-
-            msg_txt_formatted = MSG_TXT % (airtemp, airpressure, airhumidity, r, g, b, lux, color_temp)
-            # messages can be encoded as string or bytearray
-            #if (message_counter & 1) == 1:
-            #    message = IoTHubMessage(bytearray(msg_txt_formatted, 'utf8'))
-            #else:
-            message = IoTHubMessage(msg_txt_formatted)
-            # optional: assign properties
-            # prop_map = message.properties()
-            # prop_map.add("temperatureAlert", 'true' if temperature > 28 else 'false')
-
-            client.send_event_async(message, send_confirmation_callback, 1)
-            print ( "IoTHubClient.send_event_async accepted message 1 for transmission to IoT Hub." )
-	    print ( msg_txt_formatted )
-	    i=1
-	    while i<=60:
-		status = client.get_send_status()
-                print ( "Send status: %s" % status )	
-		i = i + 1
-		time.sleep (10)
+        settings = Settings({"sampleInterval": SAMPLE_INTERVAL, "colorSamples": COLOR_SAMPLES,
+                             "oversampleTemp": OVERSAMPLING[0], "oversamplePres": OVERSAMPLING[1],
+                             "oversampleHum": OVERSAMPLING[2], "messageTimeout": MESSAGE_TIMEOUT},
+                            {"sampleInterval": lambda value: setattr(runtime, "period", value),
+                             "colorSamples": set_color_samples,
+                             "oversampleTemp": lambda value: set_oversampling(0, value),
+                             "oversamplePres": lambda value: set_oversampling(1, value),
+                             "oversampleHum": lambda value: set_oversampling(2, value),
+                             "messageTimeout": set_message_timeout},
+                            report=report_settings)
+
+        # the supervisor owns the IoTHubClient and replaces it after a drop;
+        # a new session only needs the reported state again, and the sends
+        # in flight on the old one to go out again
+        def client_up(client):
+            if client.protocol == IoTHubTransportProvider.MQTT:
+                log.info("IoTHubClient is reporting state")
+                reported_state = "{\"newState\":\"standBy\"}"
+                client.send_reported_state(reported_state, len(reported_state), send_reported_state_callback, SEND_REPORTED_STATE_CONTEXT)
+                report_settings(settings.current())
+            if drainer is not None:
+                drainer.reset()
+            if runtime is not None:
+                runtime.wake_threadsafe()
+
+        if COMMAND_WORKERS:
+            commands = WorkerPool(COMMAND_WORKERS, COMMAND_QUEUE)
+            commands.start()
+            twins = WorkerPool(1, COMMAND_QUEUE, CALLER_RUNS, name="kaliot-twin")
+            twins.start()
+
+        connection = ConnectionManager(iothub_client_init, on_up=client_up,
+                                       close=(lambda client: client.close()) if GATEWAY_ADDRESS else None,
+                                       backoff=Backoff(RECONNECT_BASE, RECONNECT_MAX))
+        connection.poll()
+
+        sensors = None
+        if SENSORS:
+            sensors = SensorPoller(parse_sensors(SENSORS),
+                                   lambda busnum: LockedBus(open_bus(busnum), bus_lock(busnum)),
+                                   bme280_options=dict(mode=BME280_MODE, standby=BME280_STANDBY,
+                                                       iir_filter=BME280_IIR_FILTER),
+                                   auto_range=COLOR_AUTO_RANGE)
+            encoder = SampleEncoder(sensors.kinds, device_id=DEVICE_ID)
+        else:
+            encoder = get_encoder(ENCODING, device_id=DEVICE_ID)
+        spool = OutboundQueue(SPOOL_PATH, SPOOL_MAX_BYTES)
+        if COMPRESSION:
+            compressor = Compressor(COMPRESSION, COMPRESS_LEVEL, COMPRESS_MIN_BYTES,
+                                    DICTIONARY if COMPRESS_DICTIONARY else None)
+        if RING_PATH and not SENSORS:
+            ring = RingFile(RING_PATH, RING_CAPACITY)
+        drainer = Drainer(spool, lambda entry_id, payload: send_message(connection.client, payload, entry_id, encoder),
+                          rate=DRAIN_RATE, connected=lambda: connection.connected,
+                          window=SEND_WINDOW, max_attempts=SEND_MAX_ATTEMPTS,
+                          join=join if compressor is not None and BACKLOG_JOIN > 1 else None,
+                          join_max=BACKLOG_JOIN)
+
+        batcher = None
+        if BATCH_MAX_COUNT > 1:
+            batcher = TelemetryBatcher(spool.append, BATCH_MAX_COUNT, BATCH_MAX_AGE, encoder=encoder)
+
+        deadband = None
+        if DEADBAND:
+            deadband = DeadbandFilter(heartbeat=HEARTBEAT)
+
+        def emit_summary(summary):
+            log.debug("Summary of %d readings for %.0f s", summary.count, summary.end - summary.start)
+            with metrics.ENCODE.time():
+                payload = encoder.encode_summary(summary)
+            spool.append(payload)
+
+        aggregator = None
+        if AGGREGATE_WINDOW:
+            aggregator = WindowAggregator(emit_summary, AGGREGATE_WINDOW, AGGREGATE_HOP)
+
+        # the BME280 conversion is centred on the colour window, so the
+        # reading's timestamp holds for both sensors
+        acquisition = Acquisition([("bme280", lambda: readBME280All(addr=DEVICE)),
+                                   ("tcs34725", readTCSAll)])
+
+        # runs on the runtime's sampling thread
+        def sample():
+            settings.apply()
+
+            samples = acquisition.read()
+            (airtemp,airpressure,airhumidity) = samples["bme280"].value
+            (r,g,b,c,lux,color_temp) = samples["tcs34725"].value
+
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Sampled red %s; BME280 %.1f ms, TCS34725 %.1f ms, skew %.1f ms", r,
+                          samples["bme280"].duration * 1e3, samples["tcs34725"].duration * 1e3,
+                          (samples["bme280"].ts - samples["tcs34725"].ts) * 1e3)
+
+            return make_reading(airtemp, airpressure, airhumidity, r, g, b, c, lux, color_temp,
+                                ts=samples["bme280"].ts)
+
+        def handle(reading):
+            if ring is not None:
+                ring.append(reading)
+            if aggregator is not None:
+                aggregator.add(reading)
+            elif deadband is not None and not deadband.offer(reading):
+                log.debug("Reading suppressed (%d sent, %d suppressed)", deadband.sent, deadband.suppressed)
+            elif batcher is None:
+                with metrics.ENCODE.time():
+                    payload = encoder.encode(reading)
+                spool.append(payload)
+            else:
+                batcher.add(reading)
+
+        # the SDK does its own transport work; the pump reconnects when due
+        # and flushes batches that have reached BATCH_MAX_AGE and windows
+        # that have ended
+        flush = None
+        if aggregator is not None:
+            flush = aggregator.poll
+        elif batcher is not None:
+            flush = batcher.poll
+
+        if sensors is not None:
+            def sample():
+                settings.apply()
+                log.debug("Polling %d sensors", len(sensors.specs))
+                return sensors.read()
+
+            def handle(samples):
+                with metrics.ENCODE.time():
+                    payload = encoder.encode(samples)
+                spool.append(payload)
+
+            flush = None
+
+        def pump():
+            connection.poll()
+            if flush is not None:
+                flush()
+
+        runtime = Runtime(sample, handle, SAMPLE_INTERVAL, drain=drainer.pump,
+                          drain_interval=1.0 / DRAIN_RATE, pump=pump,
+                          backpressure=lambda: connection.connected and drainer.full())
+        if replay is not None:
+            replay.on_end = runtime.stop
+        asyncio.run(runtime.run())
 
     except IoTHubError as iothub_error:
-        print ( "Unexpected error %s from IoTHub" % iothub_error )
+        log.error("Unexpected error %s from IoTHub", iothub_error)
         return
     except KeyboardInterrupt:
-        print ( "IoTHubClient sample stopped" )
+        log.info("IoTHubClient sample stopped")
 
-    print_last_message_time(client)
+    if connection is not None and connection.client is not None and not GATEWAY_ADDRESS:
+        print_last_message_time(connection.client)
 
 def usage():
     print ( "Usage: iothub_client_sample.py -p <protocol> -c <connectionstring>" )
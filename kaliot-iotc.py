@@ -3,78 +3,150 @@
 
 import iotc
 from iotc import IOTConnectType, IOTLogLevel
-from random import randint
+import asyncio
 import time
+import os
+import json
+import logging
+from collections import deque
 
 # BME280 - Temp, Pressure, Humidity - Headers
 import smbus
-from ctypes import c_short
-from ctypes import c_byte
-from ctypes import c_ubyte
+from kaliot.bme280 import BME280, OVERSAMPLE_TEMP, OVERSAMPLE_PRES, OVERSAMPLE_HUM
+from kaliot.bme280 import MODE_FORCED
 
 ### TCS34715 - Light Quality - Headers
-import Adafruit_TCS34725
-import Adafruit_GPIO
+from kaliot.tcs import ColorSampler, SAMPLES
 
+# Both sensors are read at once, sharing the bus through a lock
+from kaliot.acquire import Acquisition, LockedBus, LockedI2C, bus_lock
 
+# Telemetry batching
+from kaliot.batching import TelemetryBatcher
+from kaliot.telemetry import make_reading
+from kaliot.encoding import get_encoder, join
+from kaliot.deadband import DeadbandFilter
+from kaliot.aggregate import WindowAggregator
 
-### BME280 - Temp, Pressure, Humidity
+# Store-and-forward
+from kaliot.spool import OutboundQueue, Drainer
 
-DEVICE = 0x77 # Default device I2C address
+# Compression
+from kaliot.compression import Compressor, DICTIONARY
+
+# Local history
+from kaliot.ring import RingFile, handle_query
+
+# Runtime
+from kaliot.runtime import Runtime
+
+# Several sensors / buses
+from kaliot.sensors import SensorPoller, SampleEncoder, parse_sensors
+
+# Metrics
+from kaliot import metrics
+
+# Live settings
+from kaliot.settings import Settings
+
+# Connection supervisor
+from kaliot.connection import Backoff, ConnectionManager
+
+# Capture / replay of raw sensor traffic
+from kaliot.capture import Recorder, RecordingBus, RecordingTCS, Replay
+
+# Logging
+from kaliot import log as kaliot_log
+from kaliot.log import Throttle
 
+# logging - LOG_LEVEL goes to the console (journald), LOG_RING_LEVEL into an
+# in-memory ring of the last LOG_RING_SIZE entries, written to the console on
+# SIGUSR1 and returned by the "getLog" command ({"lines": n}, the last 100 by
+# default).  Below both levels a log call is skipped before anything is
+# formatted.  MessageSent lines come at most once every LOG_THROTTLE
+# seconds, with a count of those left out.
+LOG_LEVEL = logging.WARNING
+LOG_RING_LEVEL = logging.INFO
+LOG_RING_SIZE = 1000
+LOG_THROTTLE = 60.0
 
-bus = smbus.SMBus(1) # Rev 2 Pi, Pi 2 & Pi 3 uses bus 1
+log = logging.getLogger("kaliot.iotc")
+logRing = kaliot_log.setup(LOG_LEVEL, LOG_RING_SIZE, LOG_RING_LEVEL)
+sentLog = Throttle(log, LOG_THROTTLE)
 
-def getShort(data, index):
-  # return two bytes from data as a signed 16-bit value
-  return c_short((data[index+1] << 8) + data[index]).value
 
-def getUShort(data, index):
-  # return two bytes from data as an unsigned 16-bit value
-  return (data[index+1] << 8) + data[index]
 
-def getChar(data,index):
-  # return one byte from data as a signed char
-  result = data[index]
-  if result > 127:
-    result -= 256
-  return result
+### BME280 - Temp, Pressure, Humidity
+
+DEVICE = 0x77 # Default device I2C address
 
-def getUChar(data,index):
-  # return one byte from data as an unsigned char
-  result =  data[index] & 0xFF
-  return result
+
+BUS = 1 # Rev 2 Pi, Pi 2 & Pi 3 uses bus 1
+
+# capture / replay - with CAPTURE_PATH set, every sensor transfer is also
+# appended to that file; with REPLAY_PATH set the sensors are left alone and
+# a capture is played back through the same drivers and pipeline instead,
+# REPLAY_SPEED times the recorded pace (0 for as fast as possible), and the
+# process stops at its end.  See kaliot.capture and bench/bench_replay.py.
+CAPTURE_PATH = None
+REPLAY_PATH = None
+REPLAY_SPEED = 1.0
+
+recorder = Recorder(CAPTURE_PATH) if CAPTURE_PATH else None
+replay = Replay(REPLAY_PATH, speed=REPLAY_SPEED) if REPLAY_PATH else None
+
+def open_bus(busnum):
+  # smbus handle for /dev/i2c-<busnum>, recorded or replayed as configured
+  if replay is not None:
+    return replay.bus(busnum)
+  handle = smbus.SMBus(busnum)
+  if recorder is not None:
+    handle = RecordingBus(handle, recorder, busnum)
+  return handle
+
+def open_tcs():
+  # the TCS34725 on BUS, through the Adafruit driver
+  if replay is not None:
+    return replay.tcs34725(busnum=BUS)
+  import Adafruit_TCS34725
+  tcs = Adafruit_TCS34725.TCS34725(i2c=LockedI2C(BUS))
+  if recorder is not None:
+    tcs = RecordingTCS(tcs, recorder, busnum=BUS)
+  return tcs
+
+# every transfer takes the bus lock, which the TCS34725 driver's own handle
+# shares through LockedI2C
+bus = LockedBus(open_bus(BUS), bus_lock(BUS))
+
+# BME280 oversampling (temperature, pressure, humidity) and colour window
+# length; both can be changed live, see onsettingsupdated
+OVERSAMPLING = [OVERSAMPLE_TEMP, OVERSAMPLE_PRES, OVERSAMPLE_HUM]
+COLOR_SAMPLES = SAMPLES
+
+# BME280 acquisition - MODE_FORCED (lowest power) triggers a conversion on
+# every sample and waits for it; MODE_NORMAL has the chip measure on its own
+# every BME280_STANDBY ms through its IIR filter (BME280_IIR_FILTER: 0, 2, 4,
+# 8 or 16), so a sample is only the data burst.  See bench/bench_bme280.py.
+BME280_MODE = MODE_FORCED
+BME280_STANDBY = 62.5
+BME280_IIR_FILTER = 0
+
+# colour window - with COLOR_AUTO_RANGE the TCS34725 gain and integration
+# time follow the light level and a window stops once its mean is steady
+# (COLOR_SAMPLES is then the most raw reads per window); counts stay scaled
+# as at the default 4x / 2.4 ms.  See bench/bench_autorange.py.
+COLOR_AUTO_RANGE = False
 
 ## Get TCS Data
+# the chip is initialised once and stays enabled between windows
+tcs_sampler = None
+
 def readTCSAll():
-  avgr = 0
-  avgg = 0
-  avgb = 0
-  avgc = 0
-  count = 0
-  while (count < 130):
-    tcs = Adafruit_TCS34725.TCS34725()
-    r, g, b, c = tcs.get_raw_data()
-    avgr = avgr + r
-    avgg = avgg + g
-    avgb = avgb + b
-    avgc = avgc + c
-    count = count + 1
-    tcs.disable()
-  avgr = avgr/130
-  avgg = avgg/130
-  avgb = avgb/130
-  avgc = avgc/130
-  r = float(avgr)
-  g = float(avgg)
-  b = float(avgb)
-  c = float(avgc)
-  lux = float(Adafruit_TCS34725.calculate_lux(r, g, b))
-  color_temp = Adafruit_TCS34725.calculate_color_temperature(r, g, b)
-  if color_temp is None:
-    color_temp = 0
-  color_temp = float(color_temp)
-  return r,g,b,c,lux,color_temp
+  global tcs_sampler
+  if tcs_sampler is None:
+    tcs_sampler = ColorSampler(open_tcs(), samples=COLOR_SAMPLES,
+                               auto_range=COLOR_AUTO_RANGE)
+  return tcs_sampler.read()
 
 def readBME280ID(addr=DEVICE):
   # Chip ID Register Address
@@ -82,106 +154,15 @@ def readBME280ID(addr=DEVICE):
   (chip_id, chip_version) = bus.read_i2c_block_data(addr, REG_ID, 2)
   return (chip_id, chip_version)
 
+# one driver object per address; calibration is read the first time only
+bme280_sensors = {}
+
 def readBME280All(addr=DEVICE):
-  # Register Addresses
-  REG_DATA = 0xF7
-  REG_CONTROL = 0xF4
-  REG_CONFIG  = 0xF5
-
-  REG_CONTROL_HUM = 0xF2
-  REG_HUM_MSB = 0xFD
-  REG_HUM_LSB = 0xFE
-
-  # Oversample setting - page 27
-  OVERSAMPLE_TEMP = 2
-  OVERSAMPLE_PRES = 2
-  MODE = 1
-
-  # Oversample setting for humidity register - page 26
-  OVERSAMPLE_HUM = 2
-  bus.write_byte_data(addr, REG_CONTROL_HUM, OVERSAMPLE_HUM)
-
-  control = OVERSAMPLE_TEMP<<5 | OVERSAMPLE_PRES<<2 | MODE
-  bus.write_byte_data(addr, REG_CONTROL, control)
-
-  # Read blocks of calibration data from EEPROM
-  # See Page 22 data sheet
-  cal1 = bus.read_i2c_block_data(addr, 0x88, 24)
-  cal2 = bus.read_i2c_block_data(addr, 0xA1, 1)
-  cal3 = bus.read_i2c_block_data(addr, 0xE1, 7)
-
-  # Convert byte data to word values
-  dig_T1 = getUShort(cal1, 0)
-  dig_T2 = getShort(cal1, 2)
-  dig_T3 = getShort(cal1, 4)
-
-  dig_P1 = getUShort(cal1, 6)
-  dig_P2 = getShort(cal1, 8)
-  dig_P3 = getShort(cal1, 10)
-  dig_P4 = getShort(cal1, 12)
-  dig_P5 = getShort(cal1, 14)
-  dig_P6 = getShort(cal1, 16)
-  dig_P7 = getShort(cal1, 18)
-  dig_P8 = getShort(cal1, 20)
-  dig_P9 = getShort(cal1, 22)
-
-  dig_H1 = getUChar(cal2, 0)
-  dig_H2 = getShort(cal3, 0)
-  dig_H3 = getUChar(cal3, 2)
-
-  dig_H4 = getChar(cal3, 3)
-  dig_H4 = (dig_H4 << 24) >> 20
-  dig_H4 = dig_H4 | (getChar(cal3, 4) & 0x0F)
-
-  dig_H5 = getChar(cal3, 5)
-  dig_H5 = (dig_H5 << 24) >> 20
-  dig_H5 = dig_H5 | (getUChar(cal3, 4) >> 4 & 0x0F)
-
-  dig_H6 = getChar(cal3, 6)
-
-  # Wait in ms (Datasheet Appendix B: Measurement time and current calculation)
-  wait_time = 1.25 + (2.3 * OVERSAMPLE_TEMP) + ((2.3 * OVERSAMPLE_PRES) + 0.575) + ((2.3 * OVERSAMPLE_HUM)+0.575)
-  time.sleep(wait_time/1000)  # Wait the required time
-
-  # Read temperature/pressure/humidity
-  data = bus.read_i2c_block_data(addr, REG_DATA, 8)
-  pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
-  temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
-  hum_raw = (data[6] << 8) | data[7]
-
-  #Refine temperature
-  var1 = ((((temp_raw>>3)-(dig_T1<<1)))*(dig_T2)) >> 11
-  var2 = (((((temp_raw>>4) - (dig_T1)) * ((temp_raw>>4) - (dig_T1))) >> 12) * (dig_T3)) >> 14
-  t_fine = var1+var2
-  temperature = float(((t_fine * 5) + 128) >> 8);
-  temperatureF = (temperature * 9 / 5) + 32
-
-  # Refine pressure and adjust for temperature
-  var1 = t_fine / 2.0 - 64000.0
-  var2 = var1 * var1 * dig_P6 / 32768.0
-  var2 = var2 + var1 * dig_P5 * 2.0
-  var2 = var2 / 4.0 + dig_P4 * 65536.0
-  var1 = (dig_P3 * var1 * var1 / 524288.0 + dig_P2 * var1) / 524288.0
-  var1 = (1.0 + var1 / 32768.0) * dig_P1
-  if var1 == 0:
-    pressure=0
-  else:
-    pressure = 1048576.0 - pres_raw
-    pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
-    var1 = dig_P9 * pressure * pressure / 2147483648.0
-    var2 = pressure * dig_P8 / 32768.0
-    pressure = pressure + (var1 + var2 + dig_P7) / 16.0
-
-  # Refine humidity
-  humidity = t_fine - 76800.0
-  humidity = (hum_raw - (dig_H4 * 64.0 + dig_H5 / 16384.0 * humidity)) * (dig_H2 / 65536.0 * (1.0 + dig_H6 / 67108864.0 * humidity * (1.0 + dig_H3 / 67108864.0 * humidity)))
-  humidity = humidity * (1.0 - dig_H1 * humidity / 524288.0)
-  if humidity > 100:
-    humidity = 100
-  elif humidity < 0:
-    humidity = 0
-
-  return temperatureF/100.0,pressure/100.0,humidity
+  sensor = bme280_sensors.get(addr)
+  if sensor is None:
+    sensor = bme280_sensors[addr] = BME280(bus, addr, *OVERSAMPLING, mode=BME280_MODE,
+                                           standby=BME280_STANDBY, iir_filter=BME280_IIR_FILTER)
+  return sensor.read()
 
 ## End BME
 
@@ -189,66 +170,335 @@ deviceId = "17f83c9b-e31c-4e11-8b9c-1b89ee99e714"
 scopeId = "0ne00062CC3"
 deviceKey = "V4sxmvey5dA5PBNqtCatp5uUZn/JwppsfIfZXdusocc="
 
-iotc = iotc.Device(scopeId, deviceKey, deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
-iotc.setLogLevel(IOTLogLevel.IOTC_LOGGING_API_ONLY)
-
 gCanSend = False
 gCounter = 0
 
 def onconnect(info):
   global gCanSend
-  print("- [onconnect] => status:" + str(info.getStatusCode()))
-  if info.getStatusCode() == 0:
-     if iotc.isConnected():
-       gCanSend = True
+  metrics.CALLBACKS.labels("connection_status").inc()
+  gCanSend = info.getStatusCode() == 0
+  if gCanSend:
+    log.info("[onconnect] => status: %s", info.getStatusCode())
+    gConnection.up()
+  else:
+    log.warning("[onconnect] => status: %s", info.getStatusCode())
+    gConnection.down()
 
 def onmessagesent(info):
-  print("\t- [onmessagesent] => " + str(info.getPayload()))
+  sentLog.debug("[onmessagesent] => %s", info.getPayload())
+  metrics.CALLBACKS.labels("message_sent").inc()
+  # MessageSent carries no id, so match the payload against what the drainer
+  # sent, oldest first
+  ids = gInflight.get(info.getPayload())
+  if ids:
+    entry_id = ids.popleft()
+    if not ids:
+      del gInflight[info.getPayload()]
+    drainer.confirmed(entry_id)
+    runtime.wake_threadsafe()
 
 def oncommand(info):
-  print("- [oncommand] => " + info.getTag() + " => " + str(info.getPayload()))
+  log.info("[oncommand] => %s => %s", info.getTag(), info.getPayload())
+  metrics.CALLBACKS.labels("command").inc()
+  if info.getTag() == "getReadings" and ring is not None:
+    status, response = handle_query(ring, info.getPayload(), time.time())
+    info.setResponse(status, response)
+  elif info.getTag() == "getLog" and logRing is not None:
+    try:
+      lines = int(json.loads(info.getPayload() or "{}").get("lines", 100))
+      info.setResponse(200, json.dumps({"entries": logRing.dump(lines)}))
+    except (ValueError, TypeError, AttributeError) as e:
+      info.setResponse(400, json.dumps({"error": str(e)}))
 
 def onsettingsupdated(info):
-  print("- [onsettingsupdated] => " + info.getTag() + " => " + info.getPayload())
-
-iotc.on("ConnectionStatus", onconnect)
-iotc.on("MessageSent", onmessagesent)
-iotc.on("Command", oncommand)
-iotc.on("SettingsUpdated", onsettingsupdated)
+  log.info("[onsettingsupdated] => %s => %s", info.getTag(), info.getPayload())
+  metrics.CALLBACKS.labels("settings_updated").inc()
+  value = info.getPayload()
+  if isinstance(value, dict):
+    value = value.get("value")
+  # applied and acknowledged at the next sample
+  settings.update({info.getTag(): value})
+
+# batching - with BATCH_MAX_COUNT above 1, readings are held and sent as one
+# JSON array once that many are waiting or the oldest is BATCH_MAX_AGE
+# seconds old
+BATCH_MAX_COUNT = 1
+BATCH_MAX_AGE = 3600
+
+# store-and-forward - every payload is spooled to disk first and deleted once
+# MessageSent confirms it; the backlog drains at DRAIN_RATE messages/s
+SPOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaliot-iotc-spool.db")
+SPOOL_MAX_BYTES = 50 * 1024 * 1024
+DRAIN_RATE = 5.0
+
+# reconnecting - after a drop the device reconnects with exponential backoff
+# and full jitter: attempt n waits a random time up to
+# min(RECONNECT_MAX, RECONNECT_BASE * 2**n) seconds, so a fleet that lost the
+# hub together comes back spread out (see kaliot.connection).  Sampling goes
+# on into the spool meanwhile.
+RECONNECT_BASE = 1.0
+RECONNECT_MAX = 120.0
+
+# in-flight window - at most SEND_WINDOW messages await MessageSent; while
+# the window is full, sampling waits (offline, it goes on into the spool)
+SEND_WINDOW = 8
+
+# local history - every reading is also kept in a fixed-size ring file of
+# RING_CAPACITY records (a week at 1 Hz by default); the "getReadings"
+# command returns a time range of it, downsampled to "max_points", in
+# pages that fit a method response.  Set RING_PATH to None to turn it off.
+RING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaliot-iotc-ring.dat")
+RING_CAPACITY = 7 * 24 * 3600
+
+# compression - payloads of COMPRESS_MIN_BYTES or more (batches, summaries)
+# go out compressed with COMPRESSION ("gzip" or "deflate", None for off) at
+# COMPRESS_LEVEL when that makes them smaller; the codec is in the message's
+# content encoding ($.ce).  A single reading is below that, so with
+# compression on a spool backlog after an outage drains as messages of up to
+# BACKLOG_JOIN spooled payloads joined into one array or binary batch
+# (kaliot.encoding.join), which compress to a fraction; 1 sends them one by
+# one.  COMPRESS_DICTIONARY adds the preset dictionary trained on kaliot
+# records ("deflate-dict"), which makes single JSON readings worth
+# compressing from ~128 bytes.  See bench/bench_compression.py and
+# bench/bench_spool.py for sizes and costs.
+COMPRESSION = None
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_BYTES = 256
+COMPRESS_DICTIONARY = False
+BACKLOG_JOIN = 256
+
+# payload encoding - "json" (one precompiled template) or "binary" (packed
+# scaled integers, for metered links)
+ENCODING = "json"
+
+# several sensors - with SENSORS set, every listed sensor is polled (one
+# poller per bus) instead of the single BME280/TCS34725 pair, and each sample
+# goes out as one JSON array tagged by sensor id; DEADBAND and batching do not
+# apply.  See kaliot.sensors for the entries, e.g.
+#   {"id": "rack1-top", "type": "bme280", "bus": 1, "addr": 0x77}
+#   {"id": "rack2-top", "type": "bme280", "bus": 1, "mux": 0x70, "channel": 2}
+SENSORS = []
+
+sensors = None
+if SENSORS:
+  sensors = SensorPoller(parse_sensors(SENSORS),
+                         lambda busnum: LockedBus(open_bus(busnum), bus_lock(busnum)),
+                         bme280_options=dict(mode=BME280_MODE, standby=BME280_STANDBY,
+                                             iir_filter=BME280_IIR_FILTER),
+                         auto_range=COLOR_AUTO_RANGE)
+  encoder = SampleEncoder(sensors.kinds)
+else:
+  encoder = get_encoder(ENCODING)
+gProperties = {"$.ct": encoder.content_type}
+if encoder.content_encoding:
+  gProperties["$.ce"] = encoder.content_encoding
+
+spool = OutboundQueue(SPOOL_PATH, SPOOL_MAX_BYTES)
+compressor = None
+if COMPRESSION:
+  compressor = Compressor(COMPRESSION, COMPRESS_LEVEL, COMPRESS_MIN_BYTES,
+                          DICTIONARY if COMPRESS_DICTIONARY else None)
+ring = None
+if RING_PATH and not SENSORS:
+  ring = RingFile(RING_PATH, RING_CAPACITY)
+gInflight = {}
+
+def spoolSend(entry_id, payload):
+  properties = gProperties
+  codec = None
+  if compressor is not None:
+    payload, codec = compressor.compress(payload)
+  if codec:
+    properties = dict(gProperties)
+    properties["$.ce"] = codec
+  elif encoder.content_encoding == "utf-8":
+    payload = payload.decode('utf-8')
+  gInflight.setdefault(payload, deque()).append(entry_id)
+  gConnection.client.sendTelemetry(payload, properties)
+
+drainer = Drainer(spool, spoolSend, rate=DRAIN_RATE, connected=lambda: gConnection.connected,
+                  window=SEND_WINDOW, join=join if compressor is not None and BACKLOG_JOIN > 1 else None,
+                  join_max=BACKLOG_JOIN)
+
+# send-on-delta - sample every SAMPLE_INTERVAL seconds but, with DEADBAND on,
+# only report a reading when a channel has left its band
+# (kaliot.deadband.DEADBANDS) or nothing has been sent for HEARTBEAT seconds
+SAMPLE_INTERVAL = 66
+DEADBAND = False
+HEARTBEAT = 600
+
+# windowed aggregation - with AGGREGATE_WINDOW set (seconds), readings are
+# not sent but summarised (min/max/mean/stddev/count per channel) and one
+# summary goes out every AGGREGATE_HOP seconds (default: the window, i.e.
+# tumbling windows).  Lets SAMPLE_INTERVAL go down to a second or so without
+# sending more; DEADBAND and batching do not apply.
+AGGREGATE_WINDOW = 0
+AGGREGATE_HOP = None
+
+deadband = None
+if DEADBAND:
+  deadband = DeadbandFilter(heartbeat=HEARTBEAT)
+
+def emitSummary(summary):
+  log.debug("summary of %d readings", summary.count)
+  with metrics.ENCODE.time():
+    payload = encoder.encode_summary(summary)
+  spool.append(payload)
+
+aggregator = None
+if AGGREGATE_WINDOW:
+  aggregator = WindowAggregator(emitSummary, AGGREGATE_WINDOW, AGGREGATE_HOP)
+
+batcher = None
+if BATCH_MAX_COUNT > 1:
+  batcher = TelemetryBatcher(spool.append, BATCH_MAX_COUNT, BATCH_MAX_AGE, encoder=encoder)
+
+# the BME280 conversion is centred on the colour window, so the reading's
+# timestamp holds for both sensors
+acquisition = Acquisition([("bme280", lambda: readBME280All(addr=DEVICE)),
+                           ("tcs34725", readTCSAll)])
+
+# runs on the runtime's sampling thread
+def sample():
+  settings.apply()
+  log.debug("Sampling telemetry..")
+  samples = acquisition.read()
+  (airtemp,airpressure,airhumidity) = samples["bme280"].value
+  (r,g,b,c,lux,color_temp) = samples["tcs34725"].value
+  return make_reading(airtemp,airpressure,airhumidity,r,g,b,c,lux,color_temp,ts=samples["bme280"].ts)
+
+def handle(reading):
+  if ring is not None:
+    ring.append(reading)
+  if aggregator is not None:
+    aggregator.add(reading)
+    return
+  if deadband is not None and not deadband.offer(reading):
+    log.debug("reading suppressed (%d sent, %d suppressed)", deadband.sent, deadband.suppressed)
+    return
+  if batcher is not None:
+    batcher.add(reading)
+    return
+  with metrics.ENCODE.time():
+    payload = encoder.encode(reading)
+  spool.append(payload)
+
+if sensors is not None:
+  def sample():
+    settings.apply()
+    log.debug("Polling %d sensors..", len(sensors.specs))
+    return sensors.read()
+
+  def handle(samples):
+    with metrics.ENCODE.time():
+      payload = encoder.encode(samples)
+    spool.append(payload)
+
+# the supervisor owns the iotc.Device: every attempt gets a fresh one with
+# the handlers registered, while the spool, drainer and sampling carry on as
+# they are
+def openDevice():
+  device = iotc.Device(scopeId, deviceKey, deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  device.setLogLevel(IOTLogLevel.IOTC_LOGGING_API_ONLY)
+  device.on("ConnectionStatus", onconnect)
+  device.on("MessageSent", onmessagesent)
+  device.on("Command", oncommand)
+  device.on("SettingsUpdated", onsettingsupdated)
+  device.connect()
+  return device
+
+def closeDevice(device):
+  if device.isConnected():
+    device.disconnect()
+
+def onDeviceUp(device):
+  # sends of the old session will never be confirmed; they go out again,
+  # oldest first, and the settings in force are reported afresh
+  gInflight.clear()
+  drainer.reset()
+  sendSettings(settings.current())
+  runtime.wake_threadsafe()
+
+gConnection = ConnectionManager(openDevice, close=closeDevice, on_up=onDeviceUp,
+                                backoff=Backoff(RECONNECT_BASE, RECONNECT_MAX))
+
+# iotc is not thread safe: doNext(), connect() and sendTelemetry() all run on
+# the event loop, only sampling runs on a worker thread
+PUMP_INTERVAL = 1
+
+def pump():
+  if gConnection.connected and not gConnection.client.isConnected():
+    # dropped without a ConnectionStatus
+    gConnection.down()
+  gConnection.poll()
+  if gConnection.connected:
+    gConnection.client.doNext() # do the async work needed to be done for MQTT
+  if batcher is not None:
+    batcher.poll()
+  if aggregator is not None:
+    aggregator.poll()
+
+runtime = Runtime(sample, handle, SAMPLE_INTERVAL, drain=drainer.pump,
+                  drain_interval=1.0 / DRAIN_RATE, pump=pump, pump_interval=PUMP_INTERVAL,
+                  backpressure=lambda: gConnection.connected and drainer.full())
+if replay is not None:
+  replay.on_end = runtime.stop
+
+# live settings - IoT Central settings named as in kaliot.settings.TUNABLES
+# change the running device from the next sample on, without reconnecting;
+# each change is acknowledged as a property with its status.  iotc has no
+# message timeout to tune.
+def setColorSamples(samples):
+  global COLOR_SAMPLES
+  COLOR_SAMPLES = samples
+  if tcs_sampler is not None:
+    tcs_sampler.samples = samples
+  if sensors is not None:
+    sensors.set_samples(samples)
+
+def setOversampling(index, value):
+  OVERSAMPLING[index] = value
+  for sensor in bme280_sensors.values():
+    sensor.set_oversampling(*OVERSAMPLING)
+  if sensors is not None:
+    sensors.set_oversampling(*OVERSAMPLING)
+
+def sendSettings(acks):
+  # iotc is only used from the event loop; while offline the acks are lost,
+  # but every reconnect reports the settings in force
+  if not gConnection.connected:
+    return
+  properties = {}
+  for name, ack in acks.items():
+    properties[name] = {"value": ack.value, "statusCode": ack.status, "status": ack.description}
+  gConnection.client.sendProperty(json.dumps(properties))
+
+settings = Settings({"sampleInterval": SAMPLE_INTERVAL, "colorSamples": COLOR_SAMPLES,
+                     "oversampleTemp": OVERSAMPLING[0], "oversamplePres": OVERSAMPLING[1],
+                     "oversampleHum": OVERSAMPLING[2]},
+                    {"sampleInterval": lambda value: setattr(runtime, "period", value),
+                     "colorSamples": setColorSamples,
+                     "oversampleTemp": lambda value: setOversampling(0, value),
+                     "oversamplePres": lambda value: setOversampling(1, value),
+                     "oversampleHum": lambda value: setOversampling(2, value)},
+                    report=lambda acks: runtime.loop.call_soon_threadsafe(sendSettings, acks))
+
+# metrics - timings and counters in Prometheus text format, served on
+# http://METRICS_ADDRESS:METRICS_PORT/metrics and/or written to
+# METRICS_TEXTFILE for node-exporter's textfile collector (None/0 to turn
+# either off).  The endpoint has no authentication, so it only listens on
+# the loopback interface; set METRICS_ADDRESS to an interface's address, or
+# "" for all of them, to let a scraper on the network reach it.
+METRICS_PORT = 9105
+METRICS_ADDRESS = "127.0.0.1"
+METRICS_TEXTFILE = None
+METRICS_INTERVAL = 15
+
+if METRICS_PORT:
+  metrics.serve(METRICS_PORT, addr=METRICS_ADDRESS)
+if METRICS_TEXTFILE:
+  metrics.TextfileWriter(METRICS_TEXTFILE, METRICS_INTERVAL).start()
 
 # Start by Connecting then Sending
-iotc.connect()
-(airtemp,airpressure,airhumidity) = readBME280All(addr=DEVICE)
-(r,g,b,c,lux,color_temp) = readTCSAll()
-iotc.sendTelemetry("{ \
-\"airtemperature\": " + str(airtemp) + ", \
-\"airpressure\": " + str(airpressure) + ", \
-\"airhumidity\": " + str(airhumidity) + ", \
-\"lux\": " + str(lux) + ", \
-\"colortemp\": " + str(color_temp) + ", \
-\"green\": " + str(g) + ", \
-\"blue\": " + str(b) + ", \
-\"clear\": " + str(c) + ", \
-\"red\": " + str(r) + "}")
-starttime = time.time()
-while iotc.isConnected():
-  time.sleep(5)
-  iotc.doNext() # do the async work needed to be done for MQTT
-  elapsedtime = time.time() - starttime
-  if elapsedtime > 66:
-   print("Sending telemetry..")
-   ## Collect Telemetry Data
-   (airtemp,airpressure,airhumidity) = readBME280All(addr=DEVICE)
-   (r,g,b,c,lux,color_temp) = readTCSAll()
-   elapsedtime = 0
-   starttime = time.time()
-   iotc.sendTelemetry("{ \
-\"airtemperature\": " + str(airtemp) + ", \
-\"airpressure\": " + str(airpressure) + ", \
-\"airhumidity\": " + str(airhumidity) + ", \
-\"lux\": " + str(lux) + ", \
-\"colortemp\": " + str(color_temp) + ", \
-\"green\": " + str(g) + ", \
-\"blue\": " + str(b) + ", \
-\"clear\": " + str(c) + ", \
-\"red\": " + str(r) + "}")
+gConnection.poll()
+asyncio.run(runtime.run())
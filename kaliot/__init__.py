@@ -0,0 +1,2 @@
+# kaliot - shared sensor and telemetry code for the kaliot-iot / kaliot-iotc
+# entry scripts.
@@ -0,0 +1,106 @@
+# Concurrent sensor acquisition.
+#
+# Independent sensors are read at the same time on worker threads, so a cycle
+# takes as long as the slowest sensor instead of the sum of all of them.  The
+# I2C bus itself is still serialised: every transfer goes through a lock held
+# per bus number, shared by our smbus handle and the one the Adafruit driver
+# opens, while conversion waits and integration sleeps run unlocked.
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+from kaliot import metrics
+
+_bus_locks = {}
+_bus_locks_lock = threading.Lock()
+
+
+def bus_lock(busnum):
+  # the one lock for every handle on /dev/i2c-<busnum>
+  with _bus_locks_lock:
+    lock = _bus_locks.get(busnum)
+    if lock is None:
+      lock = _bus_locks[busnum] = threading.RLock()
+    return lock
+
+
+class LockedBus(object):
+  # Proxy that holds `lock` for the duration of every method call on `bus`;
+  # works for smbus.SMBus and Adafruit_GPIO.I2C.Device alike.
+
+  def __init__(self, bus, lock):
+    self._bus = bus
+    self._lock = lock
+
+  def __getattr__(self, name):
+    attr = getattr(self._bus, name)
+    if not callable(attr):
+      return attr
+    lock = self._lock
+    def locked(*args, **kwargs):
+      with lock:
+        return attr(*args, **kwargs)
+    # cache so the wrapper is only built once per method
+    setattr(self, name, locked)
+    return locked
+
+
+class LockedI2C(object):
+  # Stand-in for the Adafruit_GPIO.I2C module, passed as i2c= to driver
+  # constructors so their register access takes the bus lock.
+
+  def __init__(self, busnum, lock=None):
+    self.busnum = busnum
+    self.lock = bus_lock(busnum) if lock is None else lock
+
+  def get_i2c_device(self, address, **kwargs):
+    import Adafruit_GPIO.I2C as I2C
+    kwargs.setdefault('busnum', self.busnum)
+    return LockedBus(I2C.get_i2c_device(address, **kwargs), self.lock)
+
+
+# one sensor's result: ts is the middle of the read, so for a window
+# average it is the centre of the window
+Sample = collections.namedtuple('Sample', 'name ts duration value')
+
+
+class Acquisition(object):
+  # sensors: (name, read) pairs where read() blocks and returns the value.
+  #
+  # With align on, shorter reads are started late by half the difference to
+  # the longest one (durations from the previous cycle), so all captures are
+  # centred on the same instant: a 10ms BME280 conversion lands in the middle
+  # of a 0.5s colour window instead of at its start.  Cycle time is unchanged.
+
+  def __init__(self, sensors, align=True, clock=time.time, sleep=time.sleep):
+    self.sensors = list(sensors)
+    self.align = align
+    self.clock = clock
+    self.sleep = sleep
+    self.durations = {}
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=max(1, len(self.sensors)))
+
+  def _read(self, name, read, delay=0):
+    if delay > 0:
+      self.sleep(delay)
+    start = self.clock()
+    value = read()
+    end = self.clock()
+    self.durations[name] = end - start
+    metrics.SENSOR_READ.labels(name).observe(end - start)
+    return Sample(name, (start + end) / 2.0, end - start, value)
+
+  def read(self):
+    # {name: Sample} for all sensors, read concurrently
+    durations = self.durations
+    longest = max(durations.values()) if self.align and durations else 0
+    futures = [self.executor.submit(self._read, name, read,
+                                    (longest - durations.get(name, longest)) / 2.0)
+               for name, read in self.sensors]
+    return dict((sample.name, sample) for sample in [f.result() for f in futures])
+
+  def close(self):
+    self.executor.shutdown()
@@ -0,0 +1,140 @@
+# On-device windowed aggregation.
+#
+# Readings are folded into Welford running statistics (count, mean, M2, min,
+# max per channel) as they arrive, so memory does not grow with the sampling
+# rate.  Time is cut into panes of `hop` seconds by reading timestamp; when a
+# pane closes, the last window/hop panes are merged (Chan et al.) into one
+# Summary and emitted.  hop == window gives tumbling windows, a smaller hop
+# sliding ones at the cost of one set of running stats per pane.
+
+import collections
+import math
+import time
+
+from kaliot.telemetry import FIELDS
+
+AGGREGATE_WINDOW = 600 # seconds summarised per record
+
+# per channel: (min, max, mean, stddev) with the sample standard deviation
+ChannelStats = collections.namedtuple('ChannelStats', 'min max mean stddev')
+Summary = collections.namedtuple('Summary', ('start', 'end', 'count') + FIELDS)
+
+
+class RunningStats(object):
+
+  __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+  def __init__(self):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.min = float('inf')
+    self.max = float('-inf')
+
+  def add(self, x):
+    self.count += 1
+    delta = x - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (x - self.mean)
+    if x < self.min:
+      self.min = x
+    if x > self.max:
+      self.max = x
+
+  def merge(self, other):
+    if not other.count:
+      return
+    if not self.count:
+      self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+      self.min, self.max = other.min, other.max
+      return
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.mean += delta * other.count / count
+    self.m2 += other.m2 + delta * delta * self.count * other.count / count
+    self.count = count
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+
+  def stddev(self):
+    return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+  def result(self):
+    return ChannelStats(self.min, self.max, self.mean, self.stddev())
+
+
+class Pane(object):
+  # running stats of every channel over [start, start + hop)
+
+  __slots__ = ('start', 'channels')
+
+  def __init__(self, start):
+    self.start = start
+    self.channels = [RunningStats() for _ in FIELDS]
+
+  def add(self, reading):
+    for stats, value in zip(self.channels, reading[1:]):
+      stats.add(value)
+
+
+class WindowAggregator(object):
+  # emit(summary) is called for every window that saw at least one reading,
+  # as TelemetryBatcher calls send(payload).
+
+  def __init__(self, emit, window=AGGREGATE_WINDOW, hop=None, clock=time.time):
+    hop = window if hop is None else hop
+    if hop <= 0 or window < hop or abs(window / hop - round(window / hop)) > 1e-9:
+      raise ValueError('window (%r) must be a whole number of hops (%r)' % (window, hop))
+    self.emit = emit
+    self.window = window
+    self.hop = hop
+    self.clock = clock
+    self.panes = collections.deque(maxlen=int(round(window / hop)))
+    self.current = None
+    self.readings = 0
+    self.summaries = 0
+
+  def _pane_start(self, ts):
+    return math.floor(ts / self.hop) * self.hop
+
+  def add(self, reading):
+    start = self._pane_start(reading.ts)
+    if self.current is not None and start > self.current.start:
+      self._close(start)
+    if self.current is None:
+      self.current = Pane(start)
+    self.current.add(reading)
+    self.readings += 1
+
+  def poll(self):
+    # call from the main loop so a quiet spell still closes the pane
+    if self.current is not None and self.clock() >= self.current.start + self.hop:
+      self._close(self._pane_start(self.clock()))
+
+  def _close(self, next_start):
+    # close the current pane, then slide over any empty panes up to
+    # next_start; each hop boundary passed emits its window.  While the
+    # window still holds readings the next pane stays current even if empty,
+    # so poll() keeps sliding it and a later reading cannot skip the gap
+    pane = self.current
+    self.current = None
+    while pane.start < next_start:
+      self.panes.append(pane)
+      end = pane.start + self.hop
+      self._emit(end)
+      pane = Pane(end)
+      if not any(p.channels[0].count for p in self.panes):
+        return
+    self.current = pane
+
+  def _emit(self, end):
+    merged = [RunningStats() for _ in FIELDS]
+    count = 0
+    for pane in self.panes:
+      count += pane.channels[0].count
+      for total, stats in zip(merged, pane.channels):
+        total.merge(stats)
+    if not count:
+      return
+    self.summaries += 1
+    self.emit(Summary(end - self.window, end, count, *[stats.result() for stats in merged]))
@@ -0,0 +1,55 @@
+# Batched telemetry: hold readings until a count or age limit is reached and
+# send them as one message (a JSON array by default), each element keeping
+# its own ts.
+
+import time
+
+from kaliot import metrics
+from kaliot.encoding import JsonEncoder
+
+BATCH_MAX_COUNT = 10   # readings per message
+BATCH_MAX_AGE = 600    # seconds the oldest held reading may wait
+
+
+class TelemetryBatcher(object):
+  # send(payload) is called with the encoded bytes of each batch, e.g. a
+  # wrapper around client.send_event_async or iotc.sendTelemetry.
+
+  def __init__(self, send, max_count=BATCH_MAX_COUNT, max_age=BATCH_MAX_AGE, clock=time.time,
+               encoder=None):
+    self.send = send
+    self.encoder = JsonEncoder() if encoder is None else encoder
+    self.max_count = max_count
+    self.max_age = max_age
+    self.clock = clock
+    self.pending = []
+    self.oldest = None
+    self.messages = 0
+    self.readings = 0
+    self.bytes = 0
+
+  def add(self, reading):
+    if not self.pending:
+      self.oldest = self.clock()
+    self.pending.append(reading)
+    if len(self.pending) >= self.max_count:
+      self.flush()
+    else:
+      self.poll()
+
+  def poll(self):
+    # call from the main loop so a quiet period still flushes on age
+    if self.pending and self.clock() - self.oldest >= self.max_age:
+      self.flush()
+
+  def flush(self):
+    if not self.pending:
+      return
+    with metrics.ENCODE.time():
+      payload = self.encoder.encode_batch(self.pending)
+    self.messages += 1
+    self.readings += len(self.pending)
+    self.bytes += len(payload)
+    self.pending = []
+    self.oldest = None
+    self.send(payload)
@@ -0,0 +1,242 @@
+### BME280 - Temp, Pressure, Humidity
+#
+# Driver object that reads and decodes the factory calibration once and then
+# only touches the data registers on every sample.  The bus is any object with
+# the smbus.SMBus interface (write_byte_data / read_i2c_block_data), so a fake
+# bus can be injected for benchmarks.
+
+import time
+from ctypes import c_short
+
+from kaliot import metrics
+
+DEVICE = 0x77 # Default device I2C address
+
+# Register Addresses
+REG_ID = 0xD0
+REG_DATA = 0xF7
+REG_CONTROL = 0xF4
+REG_CONFIG  = 0xF5
+REG_CONTROL_HUM = 0xF2
+
+# Calibration blocks - see Page 22 data sheet
+REG_CAL1 = 0x88
+REG_CAL2 = 0xA1
+REG_CAL3 = 0xE1
+
+# Oversample setting - page 26/27
+OVERSAMPLE_TEMP = 2
+OVERSAMPLE_PRES = 2
+OVERSAMPLE_HUM = 2
+MODE_SLEEP = 0
+MODE_FORCED = 1
+MODE_NORMAL = 3
+
+# Normal mode and IIR filter - page 27/28: config holds the standby time
+# between normal-mode measurements (t_sb) and the filter coefficient, both by
+# register code, i.e. index in these tuples
+STANDBY_MS = (0.5, 62.5, 125, 250, 500, 1000, 10, 20)
+IIR_COEFFICIENTS = (0, 2, 4, 8, 16) # 0 is filter off
+MODE = MODE_FORCED
+STANDBY = 62.5  # ms
+IIR_FILTER = 0
+
+
+def getShort(data, index):
+  # return two bytes from data as a signed 16-bit value
+  return c_short((data[index+1] << 8) + data[index]).value
+
+def getUShort(data, index):
+  # return two bytes from data as an unsigned 16-bit value
+  return (data[index+1] << 8) + data[index]
+
+def getChar(data,index):
+  # return one byte from data as a signed char
+  result = data[index]
+  if result > 127:
+    result -= 256
+  return result
+
+def getUChar(data,index):
+  # return one byte from data as an unsigned char
+  result =  data[index] & 0xFF
+  return result
+
+
+def measurement_time(oversample_temp, oversample_pres, oversample_hum):
+  # Wait in ms (Datasheet Appendix B: Measurement time and current calculation)
+  return 1.25 + (2.3 * oversample_temp) + ((2.3 * oversample_pres) + 0.575) + ((2.3 * oversample_hum)+0.575)
+
+
+def unpack_data(data):
+  # split the 8-byte burst at 0xF7 into (pres_raw, temp_raw, hum_raw)
+  pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+  temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+  hum_raw = (data[6] << 8) | data[7]
+  return pres_raw, temp_raw, hum_raw
+
+
+class BME280Calibration(object):
+  # Decoded trimming parameters of one chip.
+
+  __slots__ = ('dig_T1', 'dig_T2', 'dig_T3',
+               'dig_P1', 'dig_P2', 'dig_P3', 'dig_P4', 'dig_P5',
+               'dig_P6', 'dig_P7', 'dig_P8', 'dig_P9',
+               'dig_H1', 'dig_H2', 'dig_H3', 'dig_H4', 'dig_H5', 'dig_H6')
+
+  @classmethod
+  def from_blocks(cls, cal1, cal2, cal3):
+    # Convert byte data to word values
+    self = cls()
+    self.dig_T1 = getUShort(cal1, 0)
+    self.dig_T2 = getShort(cal1, 2)
+    self.dig_T3 = getShort(cal1, 4)
+
+    self.dig_P1 = getUShort(cal1, 6)
+    self.dig_P2 = getShort(cal1, 8)
+    self.dig_P3 = getShort(cal1, 10)
+    self.dig_P4 = getShort(cal1, 12)
+    self.dig_P5 = getShort(cal1, 14)
+    self.dig_P6 = getShort(cal1, 16)
+    self.dig_P7 = getShort(cal1, 18)
+    self.dig_P8 = getShort(cal1, 20)
+    self.dig_P9 = getShort(cal1, 22)
+
+    self.dig_H1 = getUChar(cal2, 0)
+    self.dig_H2 = getShort(cal3, 0)
+    self.dig_H3 = getUChar(cal3, 2)
+
+    dig_H4 = getChar(cal3, 3)
+    dig_H4 = (dig_H4 << 24) >> 20
+    self.dig_H4 = dig_H4 | (getChar(cal3, 4) & 0x0F)
+
+    dig_H5 = getChar(cal3, 5)
+    dig_H5 = (dig_H5 << 24) >> 20
+    self.dig_H5 = dig_H5 | (getUChar(cal3, 4) >> 4 & 0x0F)
+
+    self.dig_H6 = getChar(cal3, 6)
+    return self
+
+  def compensate(self, pres_raw, temp_raw, hum_raw):
+    # returns (temperature, pressure in hPa, relative humidity) exactly as
+    # readBME280All() always has
+    dig_T1 = self.dig_T1
+
+    #Refine temperature
+    var1 = ((((temp_raw>>3)-(dig_T1<<1)))*(self.dig_T2)) >> 11
+    var2 = (((((temp_raw>>4) - (dig_T1)) * ((temp_raw>>4) - (dig_T1))) >> 12) * (self.dig_T3)) >> 14
+    t_fine = var1+var2
+    temperature = float(((t_fine * 5) + 128) >> 8)
+    temperatureF = (temperature * 9 / 5) + 32
+
+    # Refine pressure and adjust for temperature
+    var1 = t_fine / 2.0 - 64000.0
+    var2 = var1 * var1 * self.dig_P6 / 32768.0
+    var2 = var2 + var1 * self.dig_P5 * 2.0
+    var2 = var2 / 4.0 + self.dig_P4 * 65536.0
+    var1 = (self.dig_P3 * var1 * var1 / 524288.0 + self.dig_P2 * var1) / 524288.0
+    var1 = (1.0 + var1 / 32768.0) * self.dig_P1
+    if var1 == 0:
+      pressure=0
+    else:
+      pressure = 1048576.0 - pres_raw
+      pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
+      var1 = self.dig_P9 * pressure * pressure / 2147483648.0
+      var2 = pressure * self.dig_P8 / 32768.0
+      pressure = pressure + (var1 + var2 + self.dig_P7) / 16.0
+
+    # Refine humidity
+    dig_H3 = self.dig_H3
+    humidity = t_fine - 76800.0
+    humidity = (hum_raw - (self.dig_H4 * 64.0 + self.dig_H5 / 16384.0 * humidity)) * (self.dig_H2 / 65536.0 * (1.0 + self.dig_H6 / 67108864.0 * humidity * (1.0 + dig_H3 / 67108864.0 * humidity)))
+    humidity = humidity * (1.0 - self.dig_H1 * humidity / 524288.0)
+    if humidity > 100:
+      humidity = 100
+    elif humidity < 0:
+      humidity = 0
+
+    return temperatureF/100.0,pressure/100.0,humidity
+
+
+class BME280(object):
+  # One chip on one bus.  Construction writes the humidity oversampling and
+  # reads the calibration EEPROM.  In forced mode (the default, lowest power)
+  # read() then costs one trigger write, the conversion wait and the 8-byte
+  # data burst.  In normal mode the chip measures every `standby` ms on its
+  # own, optionally through its IIR filter, and read() is only the burst.
+
+  __slots__ = ('bus', 'addr', 'calibration', 'mode', '_control', '_wait')
+
+  def __init__(self, bus, addr=DEVICE, oversample_temp=OVERSAMPLE_TEMP,
+               oversample_pres=OVERSAMPLE_PRES, oversample_hum=OVERSAMPLE_HUM,
+               mode=MODE, standby=STANDBY, iir_filter=IIR_FILTER):
+    self.bus = bus
+    self.addr = addr
+    self.mode = MODE_FORCED
+
+    self.set_oversampling(oversample_temp, oversample_pres, oversample_hum)
+
+    cal1 = bus.read_i2c_block_data(addr, REG_CAL1, 24)
+    cal2 = bus.read_i2c_block_data(addr, REG_CAL2, 1)
+    cal3 = bus.read_i2c_block_data(addr, REG_CAL3, 7)
+    self.calibration = BME280Calibration.from_blocks(cal1, cal2, cal3)
+
+    if mode != MODE_FORCED or iir_filter:
+      self.configure(mode, standby, iir_filter)
+
+  def configure(self, mode=MODE_FORCED, standby=STANDBY, iir_filter=IIR_FILTER):
+    # config writes may be ignored outside sleep mode, so the chip is put to
+    # sleep first.  Normal mode starts measuring straight away; the first
+    # result is waited for here, once, instead of on every read.
+    if mode not in (MODE_FORCED, MODE_NORMAL):
+      raise ValueError('BME280 mode must be forced (1) or normal (3), not %r' % (mode,))
+    if standby not in STANDBY_MS:
+      raise ValueError('BME280 standby must be one of %s ms, not %r' % (STANDBY_MS, standby))
+    if iir_filter not in IIR_COEFFICIENTS:
+      raise ValueError('BME280 IIR filter must be one of %s, not %r' % (IIR_COEFFICIENTS, iir_filter))
+    self.bus.write_byte_data(self.addr, REG_CONTROL, self._control & ~0x03 | MODE_SLEEP)
+    self.bus.write_byte_data(self.addr, REG_CONFIG,
+                             STANDBY_MS.index(standby)<<5 | IIR_COEFFICIENTS.index(iir_filter)<<2)
+    self.mode = mode
+    self._control = self._control & ~0x03 | mode
+    if mode == MODE_NORMAL:
+      self.bus.write_byte_data(self.addr, REG_CONTROL, self._control)
+      time.sleep(self._wait)
+
+  def set_oversampling(self, oversample_temp, oversample_pres, oversample_hum):
+    # ctrl_hum only takes effect on the next ctrl_meas write: in forced mode
+    # start() does that anyway, in normal mode it is done here, so a change
+    # applies from the next conversion either way
+    self.bus.write_byte_data(self.addr, REG_CONTROL_HUM, oversample_hum)
+    self._control = oversample_temp<<5 | oversample_pres<<2 | self.mode
+    self._wait = measurement_time(oversample_temp, oversample_pres, oversample_hum) / 1000
+    if self.mode == MODE_NORMAL:
+      self.bus.write_byte_data(self.addr, REG_CONTROL, self._control)
+
+  def read_id(self):
+    (chip_id, chip_version) = self.bus.read_i2c_block_data(self.addr, REG_ID, 2)
+    return (chip_id, chip_version)
+
+  def start(self):
+    # a forced-mode conversion has to be started by writing ctrl_meas; the
+    # chip goes back to sleep once it is done.  Returns the seconds until the
+    # result can be fetched.  In normal mode the data registers always hold
+    # the latest (filtered) result, so there is nothing to start or wait for.
+    if self.mode == MODE_NORMAL:
+      return 0
+    self.bus.write_byte_data(self.addr, REG_CONTROL, self._control)
+    return self._wait
+
+  def fetch_raw(self):
+    return unpack_data(self.bus.read_i2c_block_data(self.addr, REG_DATA, 8))
+
+  def read_raw(self):
+    wait = self.start()
+    if wait:
+      time.sleep(wait)
+    return self.fetch_raw()
+
+  def read(self):
+    pres_raw, temp_raw, hum_raw = self.read_raw()
+    with metrics.COMPENSATE.time():
+      return self.calibration.compensate(pres_raw, temp_raw, hum_raw)
@@ -0,0 +1,331 @@
+# Capture and replay of raw sensor traffic.
+#
+# A Recorder appends what the sensors said to a capture file.  RecordingBus
+# wraps an smbus.SMBus-style handle and logs every transfer: BME280
+# calibration blocks and data bursts, mux selections, the bus TCS34725
+# driver's bursts.  RecordingTCS wraps an Adafruit-style TCS34725 and logs
+# each raw (r, g, b, c) frame with the integration time and gain it was
+# taken at.  The file is a 16-byte header followed by records, each a fixed
+# 14-byte header and its data, only ever appended; a capture cut short by a
+# power loss keeps every whole record.  Capture reads one back through mmap.
+#
+# Replay serves a capture back to the unchanged drivers through ReplayBus
+# and ReplayTCS, as fast as it is asked or paced as recorded (speed).  Reads
+# are queued per (bus, mux routing, operation, address, register), so sensors
+# may be read in another interleaving than at capture time.  Writes are
+# accepted and dropped, apart from mux selections, which steer the routing.
+# When a queue runs dry the capture is used up: on_end() is called and
+# ReplayFinished raised to the reader.
+
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+from kaliot import tcs
+
+MAGIC = b'KCAP'
+VERSION = 1
+HEADER = struct.Struct('<4sHHd')   # magic, version, reserved, created
+RECORD = struct.Struct('<dBBBBH')  # ts, op, bus, addr, reg, data length
+TCS_FRAME_DATA = struct.Struct('<HHHHBB')  # r, g, b, c, integration time, gain
+
+# operations, as the smbus method that made them
+WRITE_BYTE = 1
+READ_BYTE = 2
+WRITE_BYTE_DATA = 3
+READ_BYTE_DATA = 4
+READ_BLOCK = 5
+WRITE_BLOCK = 6
+TCS_FRAME = 7
+READS = (READ_BYTE, READ_BYTE_DATA, READ_BLOCK, TCS_FRAME)
+
+FLUSH_INTERVAL = 1.0  # seconds; at most this much is lost on power loss
+
+Frame = collections.namedtuple('Frame', 'ts op bus addr reg data')
+
+
+class ReplayFinished(EOFError):
+  pass
+
+
+class Capture(object):
+  # Read-only view of a capture file; iterating gives Frames in file order.
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self._map) < HEADER.size:
+      raise ValueError('%s: too short for a capture file' % path)
+    magic, version, _, self.created = HEADER.unpack_from(self._map, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError('%s: not a version %d capture file' % (path, VERSION))
+
+  def end(self):
+    # offset just past the last whole record
+    offset = HEADER.size
+    size = len(self._map)
+    while offset + RECORD.size <= size:
+      length = RECORD.unpack_from(self._map, offset)[5]
+      if offset + RECORD.size + length > size:
+        break
+      offset += RECORD.size + length
+    return offset
+
+  def __iter__(self):
+    buf = self._map
+    offset = HEADER.size
+    size = len(buf)
+    while offset + RECORD.size <= size:
+      ts, op, bus, addr, reg, length = RECORD.unpack_from(buf, offset)
+      start = offset + RECORD.size
+      if start + length > size:
+        # torn last record
+        return
+      yield Frame(ts, op, bus, addr, reg, buf[start:start + length])
+      offset = start + length
+
+  def close(self):
+    self._map.close()
+
+
+class Recorder(object):
+  # Appends records to path, creating it if need be.  An existing capture is
+  # continued after its last whole record.  Safe to share between threads.
+
+  def __init__(self, path, clock=time.time, flush_interval=FLUSH_INTERVAL):
+    self.path = path
+    self.clock = clock
+    self.flush_interval = flush_interval
+    self.lock = threading.Lock()
+    self.records = 0
+    if os.path.exists(path) and os.path.getsize(path):
+      capture = Capture(path)
+      end = capture.end()
+      capture.close()
+      self.file = open(path, 'r+b')
+      self.file.truncate(end)
+      self.file.seek(end)
+    else:
+      self.file = open(path, 'wb')
+      self.file.write(HEADER.pack(MAGIC, VERSION, 0, clock()))
+    self._flushed = clock()
+
+  def record(self, op, bus, addr, reg, data):
+    now = self.clock()
+    data = bytes(bytearray(data))
+    with self.lock:
+      self.file.write(RECORD.pack(now, op, bus, addr, reg, len(data)) + data)
+      self.records += 1
+      if now - self._flushed >= self.flush_interval:
+        self.file.flush()
+        self._flushed = now
+
+  def flush(self):
+    with self.lock:
+      self.file.flush()
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+
+
+class RecordingBus(object):
+  # smbus.SMBus-style proxy that logs every transfer on bus number busnum
+
+  def __init__(self, bus, recorder, busnum):
+    self._bus = bus
+    self._recorder = recorder
+    self._busnum = busnum
+
+  def write_byte(self, addr, val):
+    self._bus.write_byte(addr, val)
+    self._recorder.record(WRITE_BYTE, self._busnum, addr, 0, (val & 0xFF,))
+
+  def read_byte(self, addr):
+    val = self._bus.read_byte(addr)
+    self._recorder.record(READ_BYTE, self._busnum, addr, 0, (val,))
+    return val
+
+  def write_byte_data(self, addr, cmd, val):
+    self._bus.write_byte_data(addr, cmd, val)
+    self._recorder.record(WRITE_BYTE_DATA, self._busnum, addr, cmd, (val & 0xFF,))
+
+  def read_byte_data(self, addr, cmd):
+    val = self._bus.read_byte_data(addr, cmd)
+    self._recorder.record(READ_BYTE_DATA, self._busnum, addr, cmd, (val,))
+    return val
+
+  def read_i2c_block_data(self, addr, cmd, length=32):
+    data = self._bus.read_i2c_block_data(addr, cmd, length)
+    self._recorder.record(READ_BLOCK, self._busnum, addr, cmd, data)
+    return data
+
+  def write_i2c_block_data(self, addr, cmd, vals):
+    self._bus.write_i2c_block_data(addr, cmd, vals)
+    self._recorder.record(WRITE_BLOCK, self._busnum, addr, cmd, vals)
+
+  def __getattr__(self, name):
+    return getattr(self._bus, name)
+
+
+class RecordingTCS(object):
+  # Adafruit_TCS34725.TCS34725-style proxy that logs every raw frame
+
+  def __init__(self, tcs, recorder, addr=tcs.TCS34725_ADDRESS, busnum=1):
+    self._tcs = tcs
+    self._recorder = recorder
+    self._addr = addr
+    self._busnum = busnum
+
+  def get_raw_data(self):
+    r, g, b, c = self._tcs.get_raw_data()
+    self._recorder.record(TCS_FRAME, self._busnum, self._addr, 0, TCS_FRAME_DATA.pack(
+      r, g, b, c, self._tcs.get_integration_time(), self._tcs.get_gain()))
+    return r, g, b, c
+
+  def __getattr__(self, name):
+    return getattr(self._tcs, name)
+
+
+def _route(routes):
+  # mux selections in force, as part of a queue key
+  return tuple(sorted((addr, mask) for addr, mask in routes.items() if mask))
+
+
+class Replay(object):
+  # speed: 0 serves reads as fast as they come, n paces them at n times the
+  # recorded rate.  bus() and tcs34725() make the handles for the drivers.
+
+  def __init__(self, path, speed=0, clock=time.time, sleep=time.sleep, on_end=None):
+    self.speed = speed
+    self.clock = clock
+    self.sleep = sleep
+    self.on_end = on_end
+    self.lock = threading.Lock()
+    self.queues = collections.defaultdict(collections.deque)
+    self.first = None
+    self.started = None
+    self.finished = False
+    self.served = 0
+    capture = Capture(path)
+    routes = collections.defaultdict(dict)
+    try:
+      for frame in capture:
+        if self.first is None:
+          self.first = frame.ts
+        if frame.op == WRITE_BYTE:
+          routes[frame.bus][frame.addr] = bytearray(frame.data)[0]
+        elif frame.op in READS:
+          route = () if frame.op == TCS_FRAME else _route(routes[frame.bus])
+          self.queues[(frame.bus, route, frame.op, frame.addr, frame.reg)].append(frame)
+    finally:
+      capture.close()
+
+  def next(self, bus, routes, op, addr, reg):
+    # the next recorded read for this key, once its time has come
+    with self.lock:
+      route = () if op == TCS_FRAME else _route(routes)
+      queue = self.queues.get((bus, route, op, addr, reg))
+      frame = None
+      if queue:
+        frame = queue.popleft()
+        self.served += 1
+        if self.started is None:
+          self.started = self.clock()
+      else:
+        finished, self.finished = self.finished, True
+    if frame is None:
+      if not finished and self.on_end is not None:
+        self.on_end()
+      raise ReplayFinished('capture has no more reads of 0x%02x register 0x%02x on bus %d' % (
+        addr, reg, bus))
+    if self.speed:
+      wait = self.started + (frame.ts - self.first) / self.speed - self.clock()
+      if wait > 0:
+        self.sleep(wait)
+    return frame
+
+  def bus(self, busnum):
+    return ReplayBus(self, busnum)
+
+  def tcs34725(self, addr=tcs.TCS34725_ADDRESS, busnum=1):
+    return ReplayTCS(self, addr, busnum)
+
+
+class ReplayBus(object):
+  # smbus.SMBus-style handle answering from a Replay
+
+  def __init__(self, replay, busnum):
+    self.replay = replay
+    self.busnum = busnum
+    self.routes = {}
+
+  def _read(self, op, addr, reg, length=None):
+    data = bytearray(self.replay.next(self.busnum, self.routes, op, addr, reg).data)
+    if length is not None and len(data) != length:
+      raise ValueError('replay out of step: %d bytes recorded from 0x%02x register 0x%02x, %d asked' % (
+        len(data), addr, reg, length))
+    return data
+
+  def write_byte(self, addr, val):
+    self.routes[addr] = val & 0xFF
+
+  def read_byte(self, addr):
+    return self._read(READ_BYTE, addr, 0, 1)[0]
+
+  def write_byte_data(self, addr, cmd, val):
+    pass
+
+  def read_byte_data(self, addr, cmd):
+    return self._read(READ_BYTE_DATA, addr, cmd, 1)[0]
+
+  def read_i2c_block_data(self, addr, cmd, length=32):
+    return list(self._read(READ_BLOCK, addr, cmd, length))
+
+  def write_i2c_block_data(self, addr, cmd, vals):
+    pass
+
+  def close(self):
+    pass
+
+
+class ReplayTCS(object):
+  # Adafruit_TCS34725.TCS34725-style chip answering from a Replay.  Gain and
+  # integration time start as recorded in the first frame; the settings a
+  # driver makes are kept but the frames are served as recorded.
+
+  def __init__(self, replay, addr=tcs.TCS34725_ADDRESS, busnum=1):
+    self.replay = replay
+    self.addr = addr
+    self.busnum = busnum
+    self._integration_time = tcs.INTEGRATIONTIME_2_4MS
+    self._gain = tcs.GAIN_4X
+    queue = replay.queues.get((busnum, (), TCS_FRAME, addr, 0))
+    if queue:
+      self._integration_time, self._gain = TCS_FRAME_DATA.unpack(queue[0].data)[4:]
+
+  def enable(self):
+    pass
+
+  def disable(self):
+    pass
+
+  def set_integration_time(self, integration_time):
+    self._integration_time = integration_time
+
+  def get_integration_time(self):
+    return self._integration_time
+
+  def set_gain(self, gain):
+    self._gain = gain
+
+  def get_gain(self):
+    return self._gain
+
+  def get_raw_data(self):
+    frame = self.replay.next(self.busnum, None, TCS_FRAME, self.addr, 0)
+    return TCS_FRAME_DATA.unpack(frame.data)[:4]
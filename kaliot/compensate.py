@@ -0,0 +1,58 @@
+# Batch BME280 compensation with NumPy.
+#
+# Same arithmetic, in the same order, as BME280Calibration.compensate(), applied
+# to whole arrays of raw ADC values from one chip.  Used to backfill archived
+# frames; the on-device path stays scalar and does not need NumPy.
+
+import numpy as np
+
+
+def unpack_frames(data):
+  # (N, 8) array of 0xF7 bursts -> (pres_raw, temp_raw, hum_raw) arrays
+  data = np.asarray(data, dtype=np.int64)
+  pres_raw = (data[:, 0] << 12) | (data[:, 1] << 4) | (data[:, 2] >> 4)
+  temp_raw = (data[:, 3] << 12) | (data[:, 4] << 4) | (data[:, 5] >> 4)
+  hum_raw = (data[:, 6] << 8) | data[:, 7]
+  return pres_raw, temp_raw, hum_raw
+
+
+def compensate_batch(cal, pres_raw, temp_raw, hum_raw):
+  # cal is a BME280Calibration; returns float64 arrays of
+  # (temperature, pressure in hPa, relative humidity)
+  pres_raw = np.asarray(pres_raw, dtype=np.int64)
+  temp_raw = np.asarray(temp_raw, dtype=np.int64)
+  hum_raw = np.asarray(hum_raw, dtype=np.int64)
+  dig_T1 = cal.dig_T1
+
+  #Refine temperature
+  var1 = ((((temp_raw>>3)-(dig_T1<<1)))*(cal.dig_T2)) >> 11
+  delta = (temp_raw>>4) - (dig_T1)
+  var2 = (((delta * delta) >> 12) * (cal.dig_T3)) >> 14
+  t_fine = var1+var2
+  temperature = (((t_fine * 5) + 128) >> 8).astype(np.float64)
+  temperatureF = (temperature * 9 / 5) + 32
+
+  # Refine pressure and adjust for temperature
+  var1 = t_fine / 2.0 - 64000.0
+  var2 = var1 * var1 * cal.dig_P6 / 32768.0
+  var2 = var2 + var1 * cal.dig_P5 * 2.0
+  var2 = var2 / 4.0 + cal.dig_P4 * 65536.0
+  var1 = (cal.dig_P3 * var1 * var1 / 524288.0 + cal.dig_P2 * var1) / 524288.0
+  var1 = (1.0 + var1 / 32768.0) * cal.dig_P1
+  # pressure is 0 wherever var1 == 0; divide by 1 there to keep the other
+  # lanes free of inf/nan
+  invalid = var1 == 0
+  pressure = 1048576.0 - pres_raw
+  pressure = ((pressure - var2 / 4096.0) * 6250.0) / np.where(invalid, 1.0, var1)
+  var1 = cal.dig_P9 * pressure * pressure / 2147483648.0
+  var2 = pressure * cal.dig_P8 / 32768.0
+  pressure = pressure + (var1 + var2 + cal.dig_P7) / 16.0
+  pressure = np.where(invalid, 0.0, pressure)
+
+  # Refine humidity
+  humidity = t_fine - 76800.0
+  humidity = (hum_raw - (cal.dig_H4 * 64.0 + cal.dig_H5 / 16384.0 * humidity)) * (cal.dig_H2 / 65536.0 * (1.0 + cal.dig_H6 / 67108864.0 * humidity * (1.0 + cal.dig_H3 / 67108864.0 * humidity)))
+  humidity = humidity * (1.0 - cal.dig_H1 * humidity / 524288.0)
+  humidity = np.where(humidity > 100, 100.0, np.where(humidity < 0, 0.0, humidity))
+
+  return temperatureF/100.0,pressure/100.0,humidity
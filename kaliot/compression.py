@@ -0,0 +1,123 @@
+# Payload compression at the message layer.
+#
+# A Compressor sits between the spool and the transport: payloads of at least
+# min_bytes (batches, summaries, and a backlog the Drainer joins after an
+# outage) are compressed with zlib as "gzip" or "deflate", and sent as is
+# when that does not make them smaller.  The codec goes in the message's
+# contentEncoding, so the spool keeps plain payloads and the cloud side knows
+# what to undo.
+#
+# "deflate-dict" is deflate with DICTIONARY preset, fragments of kaliot JSON
+# records that otherwise only pay off once a message repeats them; it makes
+# single records and short batches worth compressing.  The zlib header
+# carries the dictionary's Adler-32 id, which decompress() looks up in
+# DICTIONARIES.
+
+import collections
+import re
+import struct
+import zlib
+
+from kaliot import metrics
+from kaliot.aggregate import ChannelStats, Summary
+from kaliot.encoding import JsonEncoder
+from kaliot.telemetry import FIELDS, Reading
+
+CODECS = {'gzip': 31, 'deflate': 15} # codec -> zlib wbits
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_BYTES = 256  # below this the header and lost utf-8 routing outweigh the gain
+DICTIONARY_SIZE = 1024
+
+_NUMBER = re.compile(br'-?[0-9][0-9.]*')
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+  # a preset dictionary from sample payloads: the text between numbers
+  # (keys, ids, punctuation), scored by how many samples hold it times its
+  # length.  Deflate reaches nearer matches more cheaply, so the best
+  # fragments go last.
+  counts = collections.Counter()
+  for payload in samples:
+    counts.update(set(_NUMBER.split(payload)))
+  fragments = sorted((f for f, n in counts.items() if f and n > 1),
+                     key=lambda f: (counts[f] * len(f), f), reverse=True)
+  picked = []
+  total = 0
+  for fragment in fragments:
+    if total + len(fragment) <= size:
+      picked.append(fragment)
+      total += len(fragment)
+  return b''.join(reversed(picked))
+
+
+def _dictionary_samples():
+  # fixed readings and summaries through JsonEncoder, so every kaliot build
+  # trains the same dictionary
+  encoder = JsonEncoder()
+  readings = [Reading(1500000000.0 + 60 * i, *[float(10 * i + j) for j in range(len(FIELDS))])
+              for i in range(16)]
+  samples = [encoder.encode(r) for r in readings]
+  samples.append(encoder.encode_batch(readings[:4]))
+  stats = ChannelStats(1.0, 2.0, 1.5, 0.5)
+  samples += [encoder.encode_summary(Summary(1500000000.0, 1500000600.0 + i, 600, *[stats] * len(FIELDS)))
+              for i in range(4)]
+  return samples
+
+
+DICTIONARY = train_dictionary(_dictionary_samples())
+DICTIONARIES = {zlib.adler32(DICTIONARY): DICTIONARY}
+
+
+class Compressor(object):
+
+  def __init__(self, codec='deflate', level=COMPRESS_LEVEL, min_bytes=COMPRESS_MIN_BYTES,
+               dictionary=None):
+    if codec not in CODECS:
+      raise ValueError('unknown codec %r (one of %s)' % (codec, ', '.join(sorted(CODECS))))
+    if dictionary is not None and codec != 'deflate':
+      raise ValueError('a preset dictionary needs the deflate codec')
+    self.codec = codec
+    self.wbits = CODECS[codec]
+    self.level = level
+    self.min_bytes = min_bytes
+    self.dictionary = dictionary
+    self.content_encoding = codec if dictionary is None else 'deflate-dict'
+    self.messages = 0
+    self.compressed = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+  def compress(self, payload):
+    # (payload, content_encoding); content_encoding is None when the payload
+    # goes as is and keeps its encoder's own
+    self.messages += 1
+    if len(payload) < self.min_bytes:
+      return payload, None
+    with metrics.COMPRESS.time():
+      if self.dictionary is None:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+      else:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits, zdict=self.dictionary)
+      compressed = compressor.compress(payload) + compressor.flush()
+    if len(compressed) >= len(payload):
+      return payload, None
+    self.compressed += 1
+    self.bytes_in += len(payload)
+    self.bytes_out += len(compressed)
+    metrics.COMPRESSED.labels('in').inc(len(payload))
+    metrics.COMPRESSED.labels('out').inc(len(compressed))
+    return compressed, self.content_encoding
+
+
+def decompress(payload, content_encoding, dictionaries=DICTIONARIES):
+  # undo Compressor.compress for a message's contentEncoding; anything else
+  # is returned unchanged
+  if content_encoding in CODECS:
+    return zlib.decompress(payload, CODECS[content_encoding])
+  if content_encoding == 'deflate-dict':
+    dictid, = struct.unpack_from('>I', payload, 2)
+    if dictid not in dictionaries:
+      raise ValueError('unknown preset dictionary %08x' % dictid)
+    decompressor = zlib.decompressobj(zdict=dictionaries[dictid])
+    return decompressor.decompress(payload) + decompressor.flush()
+  return payload
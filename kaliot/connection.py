@@ -0,0 +1,155 @@
+# Connection supervisor for the entry scripts.
+#
+# ConnectionManager owns the transport client (IoTHubClient, iotc.Device):
+# open() makes a new one and starts it connecting, and the SDK's connection
+# status callback reports back through up() / down().  After a drop, a
+# failed open() or an attempt that hears nothing for `timeout` seconds, the
+# next attempt waits a uniform random time in [0, min(cap, base * 2**n)) -
+# exponential backoff with full jitter - so a fleet that lost the hub at the
+# same moment does not come back in lockstep.  A connection that held for
+# `stable` seconds resets the backoff, so the first retry after an isolated
+# drop goes out within `base` seconds (fast resume); a flapping link keeps
+# backing off.
+#
+# Sampling, the spool and the drainer carry on regardless; on_up(client) only
+# re-sends what the new session needs (reported state) and rewinds the
+# drainer.  poll() does the reconnecting and must run where the client may be
+# used (the event loop for iotc); up() and down() can be called from any
+# thread.
+
+import random
+import threading
+import time
+
+from kaliot import metrics
+
+BACKOFF_BASE = 1.0      # seconds; first retry window
+BACKOFF_CAP = 120.0     # seconds; longest retry window
+CONNECT_TIMEOUT = 30.0  # seconds an attempt may go without up() or down()
+STABLE = 60.0           # seconds up before a drop counts as isolated
+
+
+class Backoff(object):
+
+  def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_CAP, random=random.random):
+    self.base = base
+    self.cap = cap
+    self.random = random
+    self.attempts = 0
+
+  def next(self):
+    window = min(self.cap, self.base * 2 ** min(self.attempts, 32))
+    self.attempts += 1
+    return self.random() * window
+
+  def reset(self):
+    self.attempts = 0
+
+
+class ConnectionManager(object):
+
+  def __init__(self, open, close=None, on_up=None, on_down=None, backoff=None,
+               timeout=CONNECT_TIMEOUT, stable=STABLE, clock=time.time):
+    self.open = open
+    self.close = close
+    self.on_up = on_up
+    self.on_down = on_down
+    self.backoff = Backoff() if backoff is None else backoff
+    self.timeout = timeout
+    self.stable = stable
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.client = None
+    self.connected = False
+    self.due = clock()       # when the next attempt may start
+    self.attempting = None   # when the current attempt started
+    self.since = None        # when the current connection came up
+    self._opening = False
+    self._up_pending = False
+    self.attempts = 0
+    self.connects = 0
+    self.drops = 0
+    self.failures = 0
+
+  def _retry(self, now):
+    # call with the lock held
+    self.attempting = None
+    self.due = now + self.backoff.next()
+
+  def poll(self):
+    now = self.clock()
+    with self.lock:
+      if self.connected:
+        return
+      if self.attempting is not None:
+        if now - self.attempting < self.timeout:
+          return
+        # nothing back from the SDK; give up on this client
+        self.failures += 1
+        metrics.CONNECTS.labels('timeout').inc()
+        self._retry(now)
+        return
+      if now < self.due:
+        return
+      old, self.client = self.client, None
+    if old is not None and self.close is not None:
+      # before the attempt starts, so the old client's last status callback
+      # is not taken for the new one failing
+      self.close(old)
+    with self.lock:
+      self.attempting = now
+      self.attempts += 1
+      self._opening = True
+    try:
+      client = self.open()
+    except Exception:
+      # open() raising (DNS, TLS, the SDK refusing) is one more failed attempt
+      with self.lock:
+        self._opening = False
+        self.failures += 1
+        metrics.CONNECTS.labels('failed').inc()
+        self._retry(self.clock())
+      return
+    with self.lock:
+      self._opening = False
+      self.client = client
+      # an SDK that connects inside open() called up() before we had the
+      # client to hand to on_up
+      notify, self._up_pending = self._up_pending and self.connected, False
+    if notify and self.on_up is not None:
+      self.on_up(client)
+
+  def up(self):
+    with self.lock:
+      if self.connected:
+        return
+      self.connected = True
+      self.attempting = None
+      self.since = self.clock()
+      self.connects += 1
+      metrics.CONNECTS.labels('ok').inc()
+      if self._opening:
+        self._up_pending = True
+        return
+      client = self.client
+    if self.on_up is not None:
+      self.on_up(client)
+
+  def down(self):
+    now = self.clock()
+    with self.lock:
+      was_up = self.connected
+      if was_up:
+        self.connected = False
+        self.drops += 1
+        if now - self.since >= self.stable:
+          self.backoff.reset()
+      elif self.attempting is None:
+        # already waiting to retry
+        return
+      else:
+        self.failures += 1
+        metrics.CONNECTS.labels('failed').inc()
+      self._retry(now)
+    if was_up and self.on_down is not None:
+      self.on_down()
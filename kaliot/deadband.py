@@ -0,0 +1,76 @@
+# Send-on-delta reporting.
+#
+# Readings are still taken at the local sampling rate, but one is only passed
+# on when some channel has moved past its deadband since the last reading that
+# was sent, or when nothing has been sent for `heartbeat` seconds.
+
+import time
+
+from kaliot.telemetry import FIELDS
+
+# channel: ('abs', width in reported units) or ('rel', fraction of last sent)
+DEADBANDS = {
+  'airtemperature': ('abs', 0.02),
+  'airpressure': ('abs', 0.5),
+  'airhumidity': ('abs', 1.0),
+  'lux': ('rel', 0.10),
+  'colortemp': ('abs', 100.0),
+  'red': ('rel', 0.10),
+  'green': ('rel', 0.10),
+  'blue': ('rel', 0.10),
+  'clear': ('rel', 0.10),
+}
+HEARTBEAT = 600 # seconds of silence before a reading is sent regardless
+
+
+class DeadbandFilter(object):
+
+  def __init__(self, bands=None, heartbeat=HEARTBEAT, clock=time.time):
+    bands = DEADBANDS if bands is None else bands
+    for name, (kind, width) in bands.items():
+      if name not in FIELDS or kind not in ('abs', 'rel'):
+        raise ValueError('bad deadband %s: %r' % (name, (kind, width)))
+    # (index in Reading, is_relative, width); channels without a band are
+    # reported on heartbeats only
+    self.bands = [(FIELDS.index(name) + 1, kind == 'rel', float(width))
+                  for name, (kind, width) in sorted(bands.items())]
+    self.heartbeat = heartbeat
+    self.clock = clock
+    self.last = None
+    self.last_time = None
+    self.sent = 0
+    self.suppressed = 0
+    self.heartbeats = 0
+    self.triggers = dict((name, 0) for name in bands)
+
+  def offer(self, reading):
+    # True if the reading should be transmitted
+    now = self.clock()
+    last = self.last
+    send = last is None
+    if not send:
+      for index, relative, width in self.bands:
+        delta = abs(reading[index] - last[index])
+        if delta > (width * abs(last[index]) if relative else width):
+          self.triggers[FIELDS[index - 1]] += 1
+          send = True
+      if not send and now - self.last_time >= self.heartbeat:
+        self.heartbeats += 1
+        send = True
+    if send:
+      self.last = reading
+      self.last_time = now
+      self.sent += 1
+    else:
+      self.suppressed += 1
+    return send
+
+  def stats(self):
+    total = self.sent + self.suppressed
+    return {
+      'sent': self.sent,
+      'suppressed': self.suppressed,
+      'heartbeats': self.heartbeats,
+      'reduction': float(self.suppressed) / total if total else 0.0,
+      'triggers': dict(self.triggers),
+    }
@@ -0,0 +1,206 @@
+# Payload encoders for Reading tuples.
+#
+# JsonEncoder fills one %-template built at construction time (valid JSON,
+# fixed precision); BinaryEncoder packs a fixed-layout record of scaled
+# integers behind a schema version byte, for metered links.  Both report the
+# content type/encoding the message properties should carry, and both encode
+# single readings, batches and window summaries (kaliot.aggregate.Summary).
+
+import json
+import struct
+
+from kaliot.aggregate import ChannelStats, Summary
+from kaliot.telemetry import FIELDS, Reading
+
+ENCODING = 'json' # default encoder for the entry scripts
+
+
+class JsonEncoder(object):
+
+  content_type = 'application/json'
+  content_encoding = 'utf-8'
+
+  def __init__(self, device_id=None, precision=2):
+    parts = ['"ts":%.3f']
+    parts += ['"%s":%%.%df' % (name, precision) for name in FIELDS]
+    if device_id is not None:
+      # escaped once here rather than on every message
+      parts.insert(0, '"deviceId":' + json.dumps(device_id).replace('%', '%%'))
+    self.template = '{' + ','.join(parts) + '}'
+    stats = '{"min":%%.%df,"max":%%.%df,"mean":%%.%df,"stddev":%%.%df}' % ((precision,) * 4)
+    parts = ['"start":%.3f', '"end":%.3f', '"count":%d']
+    parts += ['"%s":%s' % (name, stats) for name in FIELDS]
+    if device_id is not None:
+      parts.insert(0, '"deviceId":' + json.dumps(device_id).replace('%', '%%'))
+    self.summary_template = '{' + ','.join(parts) + '}'
+
+  def encode(self, reading):
+    return (self.template % tuple(reading)).encode('utf-8')
+
+  def encode_batch(self, readings):
+    template = self.template
+    return ('[' + ','.join([template % tuple(r) for r in readings]) + ']').encode('utf-8')
+
+  def encode_summary(self, summary):
+    values = list(summary[:3])
+    for stats in summary[3:]:
+      values += stats
+    return (self.summary_template % tuple(values)).encode('utf-8')
+
+  def decode(self, payload):
+    return json.loads(payload.decode('utf-8'))
+
+
+# Version 1 record, little-endian: ts as whole seconds + milliseconds, then
+# every channel scaled to an integer.  Batches are the version byte with the
+# high bit set, a record count, and the records without their version byte.
+# Summaries set bit 6 instead: start and end (seconds + milliseconds), the
+# reading count, then min, max, mean and stddev of every channel, each
+# scaled like the channel itself.
+SCHEMA_VERSION = 1
+SCHEMA_V1 = (
+  # name, struct code, scale
+  ('airtemperature', 'h', 100),
+  ('airpressure', 'I', 100),
+  ('airhumidity', 'H', 100),
+  ('lux', 'i', 10),
+  ('colortemp', 'i', 10),
+  ('green', 'H', 1),
+  ('blue', 'H', 1),
+  ('clear', 'H', 1),
+  ('red', 'H', 1),
+)
+BATCH_FLAG = 0x80
+SUMMARY_FLAG = 0x40
+
+_LIMITS = {
+  'h': (-0x8000, 0x7FFF), 'H': (0, 0xFFFF),
+  'i': (-0x80000000, 0x7FFFFFFF), 'I': (0, 0xFFFFFFFF),
+}
+
+
+class BinaryEncoder(object):
+
+  content_type = 'application/x-kaliot-reading'
+  content_encoding = None
+
+  def __init__(self, device_id=None):
+    # device_id is accepted for symmetry with JsonEncoder; the identity of a
+    # binary record comes from the connection it arrives on
+    assert tuple(name for name, _, _ in SCHEMA_V1) == FIELDS
+    self.record = struct.Struct('<IH' + ''.join(code for _, code, _ in SCHEMA_V1))
+    self.header = struct.Struct('<B')
+    self.batch_header = struct.Struct('<BH')
+    self.summary = struct.Struct('<BIHIHI' + ''.join(code * 4 for _, code, _ in SCHEMA_V1))
+    self.scales = [scale for _, _, scale in SCHEMA_V1]
+    self.limits = [_LIMITS[code] for _, code, _ in SCHEMA_V1]
+
+  def _pack(self, reading):
+    ms = int(round(reading.ts * 1000))
+    values = [ms // 1000, ms % 1000]
+    for value, scale, (low, high) in zip(reading[1:], self.scales, self.limits):
+      value = int(round(value * scale))
+      values.append(low if value < low else high if value > high else value)
+    return self.record.pack(*values)
+
+  def encode_summary(self, summary):
+    start = int(round(summary.start * 1000))
+    end = int(round(summary.end * 1000))
+    values = [SCHEMA_VERSION | SUMMARY_FLAG, start // 1000, start % 1000, end // 1000, end % 1000,
+              summary.count]
+    for stats, scale, (low, high) in zip(summary[3:], self.scales, self.limits):
+      for value in stats:
+        value = int(round(value * scale))
+        values.append(low if value < low else high if value > high else value)
+    return self.summary.pack(*values)
+
+  def _unpack_summary(self, payload):
+    values = self.summary.unpack_from(payload, 0)
+    channels = []
+    for i, scale in enumerate(self.scales):
+      channels.append(ChannelStats(*[float(v) / scale for v in values[6 + 4 * i:10 + 4 * i]]))
+    return Summary(values[1] + values[2] / 1000.0, values[3] + values[4] / 1000.0, values[5], *channels)
+
+  def encode(self, reading):
+    return self.header.pack(SCHEMA_VERSION) + self._pack(reading)
+
+  def encode_batch(self, readings):
+    return (self.batch_header.pack(SCHEMA_VERSION | BATCH_FLAG, len(readings)) +
+            b''.join([self._pack(r) for r in readings]))
+
+  def _unpack(self, payload, offset):
+    values = self.record.unpack_from(payload, offset)
+    ts = values[0] + values[1] / 1000.0
+    return Reading(ts, *[float(v) / scale for v, scale in zip(values[2:], self.scales)])
+
+  def decode(self, payload):
+    # a Reading, a list of them for a batch, or a Summary
+    version = bytearray(payload[:1])[0]
+    if version & ~(BATCH_FLAG | SUMMARY_FLAG) != SCHEMA_VERSION:
+      raise ValueError('unknown kaliot schema version %d' % version)
+    if version & SUMMARY_FLAG:
+      return self._unpack_summary(payload)
+    if not version & BATCH_FLAG:
+      return self._unpack(payload, self.header.size)
+    _, count = self.batch_header.unpack_from(payload, 0)
+    offset = self.batch_header.size
+    size = self.record.size
+    return [self._unpack(payload, offset + i * size) for i in range(count)]
+
+
+_BATCH_HEADER = struct.Struct('<BH')
+
+
+def join(payloads, max_records=0xFFFF):
+  # consecutive spooled payloads as one message, for draining a backlog:
+  # JSON objects and the elements of JSON arrays into one array, binary
+  # readings and batches into one batch of at most max_records.  Returns
+  # (payload, n) for the first n payloads; n is 1, and the payload the first
+  # one as it is, when that does not join with the next (a binary summary,
+  # or a change of encoding between runs).
+  parts = []
+  n = 0
+  if payloads[0][:1] in (b'{', b'['):
+    for payload in payloads:
+      if payload[:1] == b'{':
+        parts.append(payload)
+      elif payload[:1] == b'[':
+        if len(payload) > 2:
+          parts.append(payload[1:-1])
+      else:
+        break
+      n += 1
+    if n > 1:
+      return b'[' + b','.join(parts) + b']', n
+    return payloads[0], 1
+  records = 0
+  for payload in payloads:
+    version = bytearray(payload[:1])[0] if payload else None
+    if version == SCHEMA_VERSION:
+      count, body = 1, payload[1:]
+    elif version == SCHEMA_VERSION | BATCH_FLAG:
+      count, body = _BATCH_HEADER.unpack_from(payload, 0)[1], payload[_BATCH_HEADER.size:]
+    else:
+      break
+    if records + count > max_records:
+      break
+    parts.append(body)
+    records += count
+    n += 1
+  if n > 1:
+    return _BATCH_HEADER.pack(SCHEMA_VERSION | BATCH_FLAG, records) + b''.join(parts), n
+  return payloads[0], 1
+
+
+ENCODERS = {
+  'json': JsonEncoder,
+  'binary': BinaryEncoder,
+}
+
+
+def get_encoder(name, **kwargs):
+  try:
+    encoder = ENCODERS[name]
+  except KeyError:
+    raise ValueError('unknown encoding %r (choose from %s)' % (name, ', '.join(sorted(ENCODERS))))
+  return encoder(**kwargs)
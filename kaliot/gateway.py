@@ -0,0 +1,354 @@
+# Gateway mode: many local nodes, one hub connection.
+#
+# Nodes hand their encoded payloads to a gateway process over a local socket
+# instead of each holding a hub connection.  The protocol is one frame per
+# message, FRAME followed by the device id and the payload; the gateway
+# answers every MESSAGE with an ACK carrying the same sequence number once
+# the payload is in its spool (or REFUSED for a device it does not forward).
+#
+# A connection starts with a handshake: the gateway sends a CHALLENGE of
+# NONCE_SIZE random bytes, the node answers HELLO with its device id and
+# HMAC-SHA256(node secret, nonce + device id), and the gateway ACKs it or
+# REFUSES and hangs up.  After that the node may only send as that device.
+# This keeps other hosts from posting as a node; the link is not encrypted,
+# so the payloads are not secret from the network in between.
+#
+# Gateway is the gateway end, on an asyncio loop: every accepted message goes
+# into one OutboundQueue as an envelope (device id, content type and
+# encoding, payload), which the gateway's Drainer forwards under the right
+# device identity (see kaliot-gateway.py).  GatewayLink is the node end, a
+# socket with acks read on a background thread; GatewayClient puts it behind
+# the IoTHubClient calls kaliot-iot.py makes, so a node only swaps its client.
+
+import asyncio
+import collections
+import hashlib
+import hmac
+import os
+import socket
+import struct
+import threading
+
+from kaliot import metrics
+
+FRAME = struct.Struct('<BBHII')  # kind, code / status, device id length, sequence, payload length
+ENVELOPE = struct.Struct('<BB')  # code, device id length
+
+MESSAGE = 1
+ACK = 2
+CHALLENGE = 3
+HELLO = 4
+ACCEPTED = 0
+REFUSED = 1
+
+MAX_PAYLOAD = 256 * 1024  # the hub's message size limit
+CONNECT_TIMEOUT = 10.0
+HELLO_TIMEOUT = 10.0  # seconds a node has to answer the challenge
+NONCE_SIZE = 16
+
+# a message's content type and encoding travel as one code byte, an index
+# into each of these
+CONTENT_TYPES = (None, 'application/json', 'application/x-kaliot-reading')
+CONTENT_ENCODINGS = (None, 'utf-8', 'gzip', 'deflate', 'deflate-dict')
+
+RetryPolicy = collections.namedtuple('RetryPolicy', 'retryPolicy retryTimeoutLimitInSeconds')
+
+
+def content_code(content_type, content_encoding):
+  return CONTENT_TYPES.index(content_type) << 4 | CONTENT_ENCODINGS.index(content_encoding)
+
+
+def content_of(code):
+  # (content_type, content_encoding) for a code byte
+  return CONTENT_TYPES[code >> 4], CONTENT_ENCODINGS[code & 0x0F]
+
+
+def proof(secret, nonce, device):
+  # the HELLO answer to a challenge; secret as str or bytes, device as bytes
+  if not isinstance(secret, bytes):
+    secret = (secret or '').encode('utf-8')
+  return hmac.new(secret, nonce + device, hashlib.sha256).digest()
+
+
+def envelope(device_id, code, payload):
+  # a spool entry for the gateway's drainer
+  device = device_id.encode('utf-8')
+  return ENVELOPE.pack(code, len(device)) + device + bytes(payload)
+
+
+def open_envelope(entry):
+  # (device_id, content_type, content_encoding, payload) from envelope()
+  code, length = ENVELOPE.unpack_from(entry)
+  start = ENVELOPE.size
+  content_type, content_encoding = content_of(code)
+  return (entry[start:start + length].decode('utf-8'), content_type, content_encoding,
+          entry[start + length:])
+
+
+class Gateway(object):
+  # queue: where accepted messages go (an OutboundQueue).  secrets: device id
+  # -> node secret for the devices forwarded; None takes any HELLO and any
+  # device id on one connection, for a hub stand-in.  wake() is called after
+  # every append so the sender can drain straight away.
+
+  def __init__(self, queue, secrets=None, wake=None):
+    self.queue = queue
+    self.secrets = None if secrets is None else dict(secrets)
+    self.devices = None if secrets is None else set(secrets)
+    self.wake = wake
+    self.server = None
+    self.connections = 0   # nodes connected now
+    self.peak = 0
+    self.accepted = collections.Counter()
+    self.refused = 0
+    self.rejected = 0      # nodes that failed the handshake
+
+  async def start(self, address):
+    # address: (host, port), or a path for a Unix socket
+    if isinstance(address, str):
+      self.server = await asyncio.start_unix_server(self._serve, path=address)
+    else:
+      self.server = await asyncio.start_server(self._serve, address[0], address[1])
+    return self.server
+
+  def close(self):
+    if self.server is not None:
+      self.server.close()
+
+  async def _hello(self, reader, writer):
+    # the device id the node proved it is, or None to hang up
+    nonce = os.urandom(NONCE_SIZE)
+    writer.write(FRAME.pack(CHALLENGE, 0, 0, 0, len(nonce)) + nonce)
+    kind, _, id_length, _, length = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if kind != HELLO or length != hashlib.sha256().digest_size:
+      return None
+    body = await reader.readexactly(id_length + length)
+    device_id = body[:id_length].decode('utf-8', 'replace')
+    if self.secrets is not None:
+      secret = self.secrets.get(device_id)
+      if secret is None or not hmac.compare_digest(proof(secret, nonce, body[:id_length]),
+                                                  body[id_length:]):
+        return None
+    return device_id
+
+  async def _serve(self, reader, writer):
+    self.connections += 1
+    self.peak = max(self.peak, self.connections)
+    try:
+      try:
+        node = await asyncio.wait_for(self._hello(reader, writer), HELLO_TIMEOUT)
+      except asyncio.TimeoutError:
+        node = None
+      if node is None:
+        self.rejected += 1
+        writer.write(FRAME.pack(ACK, REFUSED, 0, 0, 0))
+        return
+      writer.write(FRAME.pack(ACK, ACCEPTED, 0, 0, 0))
+      while True:
+        kind, code, id_length, seq, length = FRAME.unpack(await reader.readexactly(FRAME.size))
+        if kind != MESSAGE or length > MAX_PAYLOAD:
+          # not a kaliot node; nothing after this can be trusted
+          break
+        body = await reader.readexactly(id_length + length)
+        device_id = body[:id_length].decode('utf-8', 'replace')
+        if self.secrets is not None and device_id != node:
+          status = self._refuse()
+        else:
+          status = self.accept(device_id, code, body[id_length:])
+        writer.write(FRAME.pack(ACK, status, 0, seq, 0))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      self.connections -= 1
+      writer.close()
+
+  def accept(self, device_id, code, payload):
+    if (self.devices is not None and device_id not in self.devices) or \
+       (code & 0x0F) >= len(CONTENT_ENCODINGS) or (code >> 4) >= len(CONTENT_TYPES):
+      return self._refuse()
+    self.queue.append(envelope(device_id, code, payload))
+    self.accepted[device_id] += 1
+    if self.wake is not None:
+      self.wake()
+    return ACCEPTED
+
+  def _refuse(self):
+    self.refused += 1
+    metrics.DROPPED.labels('refused').inc()
+    return REFUSED
+
+
+def _recv_exact(sock, size):
+  data = b''
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if not chunk:
+      raise EOFError('gateway closed the link')
+    data += chunk
+  return data
+
+
+class GatewayLink(object):
+  # Node end of the protocol.  The constructor connects and answers the
+  # challenge as device_id with secret, and raises IOError if the gateway
+  # refuses it.  send() writes one frame and returns; its callback(accepted)
+  # runs on the reader thread with True once the gateway has the message,
+  # False if refused, or None if the link went down first, in which case
+  # on_down() is called once.  Sends go out pipelined.
+
+  def __init__(self, address, timeout=CONNECT_TIMEOUT, on_down=None, device_id='', secret=None):
+    if isinstance(address, str):
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.sock.settimeout(timeout)
+      self.sock.connect(address)
+    else:
+      self.sock = socket.create_connection(address, timeout)
+      self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+      self._hello(device_id, secret)
+    except (EOFError, IOError, OSError) as e:
+      self.sock.close()
+      raise IOError('gateway refused %r: %s' % (device_id, e))
+    self.sock.settimeout(None)
+    self.on_down = on_down
+    self.lock = threading.Lock()
+    self.pending = {}  # sequence -> callback
+    self.seq = 0
+    self.connected = True
+    self._thread = threading.Thread(target=self._read, name='kaliot-gateway-link')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _hello(self, device_id, secret):
+    kind, _, _, _, length = FRAME.unpack(_recv_exact(self.sock, FRAME.size))
+    if kind != CHALLENGE or length > 64:
+      raise IOError('not a kaliot gateway')
+    nonce = _recv_exact(self.sock, length)
+    device = device_id.encode('utf-8')
+    mac = proof(secret, nonce, device)
+    self.sock.sendall(FRAME.pack(HELLO, 0, len(device), 0, len(mac)) + device + mac)
+    kind, status, _, _, _ = FRAME.unpack(_recv_exact(self.sock, FRAME.size))
+    if kind != ACK or status != ACCEPTED:
+      raise IOError('wrong device id or secret')
+
+  def send(self, device_id, payload, code=0, callback=None):
+    device = device_id.encode('utf-8')
+    frame = FRAME.pack(MESSAGE, code, len(device), 0, len(payload))
+    with self.lock:
+      if not self.connected:
+        raise IOError('gateway link is down')
+      self.seq = (self.seq + 1) & 0xFFFFFFFF
+      self.pending[self.seq] = callback
+      frame = frame[:4] + struct.pack('<I', self.seq) + frame[8:]
+      try:
+        self.sock.sendall(frame + device + bytes(payload))
+        return
+      except (IOError, OSError):
+        pass
+    # the reader sees the same error and fails everything pending
+    self.sock.close()
+
+  def _read(self):
+    try:
+      while True:
+        kind, status, _, seq, length = FRAME.unpack(_recv_exact(self.sock, FRAME.size))
+        if length:
+          _recv_exact(self.sock, length)
+        if kind != ACK:
+          continue
+        with self.lock:
+          callback = self.pending.pop(seq, None)
+        if callback is not None:
+          callback(status == ACCEPTED)
+    except (EOFError, IOError, OSError):
+      pass
+    with self.lock:
+      self.connected = False
+      pending, self.pending = self.pending, {}
+      on_down, self.on_down = self.on_down, None
+    self.sock.close()
+    for callback in pending.values():
+      if callback is not None:
+        callback(None)
+    if on_down is not None:
+      on_down()
+
+  def close(self):
+    # no on_down() for a link closed on purpose
+    with self.lock:
+      self.on_down = None
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except (IOError, OSError):
+      pass
+
+
+class GatewayClient(object):
+  # The IoTHubClient calls kaliot-iot.py makes, sent through a gateway as
+  # device_id.  The SDK's own values come in from the script: results is
+  # (ok, refused, lost) for send confirmations, statuses (up, down) for the
+  # connection status callback.  Twin, method and cloud-to-device callbacks
+  # are accepted and never called; those stay with the gateway.  Connects in
+  # the constructor with the node's secret, so a gateway that is not there
+  # or does not take the secret fails the attempt.
+
+  protocol = None
+
+  def __init__(self, address, device_id, results, statuses, secret=None, timeout=CONNECT_TIMEOUT):
+    self.device_id = device_id
+    self.results = results
+    self.statuses = statuses
+    self.options = {}
+    self.retry_policy = RetryPolicy(0, 0)
+    self._status = None
+    self.link = GatewayLink(address, timeout, on_down=self._down, device_id=device_id, secret=secret)
+
+  def _down(self):
+    if self._status is not None:
+      callback, context = self._status
+      callback(self.statuses[1], 0, context)
+
+  def set_option(self, name, value):
+    self.options[name] = value
+
+  def set_message_callback(self, callback, context):
+    pass
+
+  def set_device_twin_callback(self, callback, context):
+    pass
+
+  def set_device_method_callback(self, callback, context):
+    pass
+
+  def set_connection_status_callback(self, callback, context):
+    self._status = (callback, context)
+    if self.link.connected:
+      callback(self.statuses[0], 0, context)
+
+  def set_retry_policy(self, policy, timeout):
+    self.retry_policy = RetryPolicy(policy, timeout)
+
+  def get_retry_policy(self):
+    return self.retry_policy
+
+  def send_event_async(self, message, callback, context):
+    ok, refused, lost = self.results
+    def done(accepted):
+      if callback is not None:
+        callback(message, ok if accepted else (lost if accepted is None else refused), context)
+    try:
+      code = content_code(message.content_type, message.content_encoding)
+    except ValueError:
+      done(False)
+      return
+    try:
+      self.link.send(self.device_id, message.get_bytearray(), code, done)
+    except IOError:
+      done(None)
+
+  def get_send_status(self):
+    return 'BUSY' if self.link.pending else 'IDLE'
+
+  def close(self):
+    self.link.close()
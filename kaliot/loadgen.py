@@ -0,0 +1,210 @@
+# Fleet load generator.
+#
+# Many virtual kaliot devices on one asyncio loop (or one loop per worker
+# process), each sampling simulated sensors through the same BME280 driver,
+# colour window, make_reading() and payload encoder as the entry scripts, and
+# publishing to an in-process stand-in for the IoT Hub MQTT endpoint.  The
+# stand-in acks every message after a fixed network delay, serialised through
+# one ingestion worker so it queues up like a real endpoint under load.
+
+import asyncio
+import random
+import time
+
+from kaliot.bme280 import BME280
+from kaliot.encoding import get_encoder
+from kaliot.sim import BME280_RAW, TCS34725_RAW, FakeSMBus, FakeTCS34725
+from kaliot.standin import OK, LocalBroker, StandInMessage
+from kaliot.tcs import ColorSampler
+from kaliot.telemetry import make_reading
+
+ACK_DELAY = 0.005      # seconds of simulated network round trip per message
+INGEST_TIME = 0.0      # seconds the endpoint spends on each message
+WINDOW = 130           # colour samples per reading, as on the devices
+
+
+class AsyncBroker(object):
+  # publish() returns once the message is acked.  Messages are accepted in
+  # order by a single ingestion task; ack_delay is added on top as latency
+  # without taking ingestion capacity.
+
+  def __init__(self, ack_delay=ACK_DELAY, ingest_time=INGEST_TIME):
+    self.broker = LocalBroker()
+    self.ack_delay = ack_delay
+    self.ingest_time = ingest_time
+    self.queue = None
+    self._task = None
+
+  def start(self):
+    self.queue = asyncio.Queue()
+    self._task = asyncio.ensure_future(self._ingest())
+
+  async def stop(self):
+    self._task.cancel()
+    await asyncio.gather(self._task, return_exceptions=True)
+
+  async def _ingest(self):
+    loop = asyncio.get_event_loop()
+    while True:
+      device_id, payload, properties, future = await self.queue.get()
+      if self.ingest_time:
+        await asyncio.sleep(self.ingest_time)
+      result = self.broker.publish(device_id, payload, properties)
+      loop.call_later(self.ack_delay, _resolve, future, result)
+
+  def publish(self, device_id, payload, properties=None):
+    future = asyncio.get_event_loop().create_future()
+    self.queue.put_nowait((device_id, payload, properties, future))
+    return future
+
+
+def _resolve(future, result):
+  if not future.done():
+    future.set_result(result)
+
+
+class VirtualDevice(object):
+  # One simulated node: a FakeSMBus with a BME280, a fake TCS34725 without
+  # sleeps, and the encoder the scripts would use.  Raw values wander a
+  # little from sample to sample so the payloads are not all identical.
+
+  def __init__(self, device_id, encoding='json', window=WINDOW, rng=None):
+    self.device_id = device_id
+    self.rng = random.Random(device_id) if rng is None else rng
+    self.bus = FakeSMBus()
+    self.bus.add_bme280()
+    self.bme280 = BME280(self.bus)
+    self.raw = list(TCS34725_RAW)
+    self.colour = ColorSampler(FakeTCS34725(raw=self._colour_raw, time_scale=0), samples=window)
+    self.encoder = get_encoder(encoding, device_id=device_id)
+    self.properties = {'$.ct': self.encoder.content_type}
+    if self.encoder.content_encoding:
+      self.properties['$.ce'] = self.encoder.content_encoding
+
+  def _colour_raw(self):
+    rng = self.rng
+    return tuple(max(0, v + rng.randint(-3, 3)) for v in self.raw)
+
+  def sample(self):
+    # readBME280All() + readTCSAll() -> make_reading(); the fake conversion
+    # is done as soon as it is triggered, so there is no wait between the two
+    pres, temp, hum = BME280_RAW
+    rng = self.rng
+    self.bus.set_bme280_raw(self.bme280.addr, pres + rng.randint(-200, 200),
+                            temp + rng.randint(-200, 200), hum + rng.randint(-100, 100))
+    self.bme280.start()
+    airtemp, airpressure, airhumidity = self.bme280.calibration.compensate(*self.bme280.fetch_raw())
+    r, g, b, c, lux, color_temp = self.colour.read()
+    return make_reading(airtemp, airpressure, airhumidity, r, g, b, c, lux, color_temp)
+
+  def message(self):
+    # the IoTHubMessage kaliot-iot.py would hand to send_event_async
+    message = StandInMessage(self.encoder.encode(self.sample()))
+    message.content_type = self.encoder.content_type
+    message.content_encoding = self.encoder.content_encoding
+    return message
+
+
+class FleetStats(object):
+
+  def __init__(self):
+    self.sent = 0
+    self.acked = 0
+    self.failed = 0
+    self.late = 0
+    self.latencies = []
+    self.cpu = 0.0
+    self.elapsed = 0.0
+    self.devices = 0
+    self.wire_bytes = 0
+
+  def merge(self, other):
+    self.sent += other.sent
+    self.acked += other.acked
+    self.failed += other.failed
+    self.late += other.late
+    self.latencies += other.latencies
+    self.cpu += other.cpu
+    self.elapsed = max(self.elapsed, other.elapsed)
+    self.devices += other.devices
+    self.wire_bytes += other.wire_bytes
+    return self
+
+  def percentile(self, p):
+    if not self.latencies:
+      return 0.0
+    ordered = sorted(self.latencies)
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+  def summary(self):
+    elapsed = self.elapsed or 1.0
+    return {
+      'devices': self.devices,
+      'messages': self.acked,
+      'failed': self.failed,
+      # samples that started over an interval behind: the generator, not the
+      # endpoint, is the limit and the latencies include its backlog
+      'late': self.late,
+      'messages_per_s': self.acked / elapsed,
+      'p50_ms': self.percentile(50) * 1e3,
+      'p99_ms': self.percentile(99) * 1e3,
+      'cpu_ms_per_message': self.cpu / self.acked * 1e3 if self.acked else 0.0,
+      # share of one core each device needs at this interval
+      'cpu_pct_per_device': 100.0 * self.cpu / elapsed / self.devices if self.devices else 0.0,
+      'wire_bytes_per_s': self.wire_bytes / elapsed,
+    }
+
+
+async def _device(device, broker, interval, until, stats):
+  loop = asyncio.get_event_loop()
+  # spread the fleet over the first interval instead of firing in lockstep
+  deadline = loop.time() + device.rng.random() * interval
+  pending = set()
+  while deadline < until:
+    await asyncio.sleep(max(0.0, deadline - loop.time()))
+    if loop.time() - deadline > interval:
+      stats.late += 1
+    message = device.message()
+    sent = loop.time()
+    stats.sent += 1
+    future = broker.publish(device.device_id, bytes(message.get_bytearray()), device.properties)
+    future.add_done_callback(lambda f, sent=sent: _confirmed(f, sent, loop, stats))
+    pending.add(future)
+    future.add_done_callback(pending.discard)
+    deadline += interval
+  if pending:
+    await asyncio.wait(pending)
+
+
+def _confirmed(future, sent, loop, stats):
+  if future.result() == OK:
+    stats.acked += 1
+    stats.latencies.append(loop.time() - sent)
+  else:
+    stats.failed += 1
+
+
+async def run_fleet(first, count, duration, interval, encoding='json', window=WINDOW,
+                    ack_delay=ACK_DELAY, ingest_time=INGEST_TIME, prefix='kaliot-load-'):
+  # devices first..first+count-1 for duration seconds; returns FleetStats
+  broker = AsyncBroker(ack_delay, ingest_time)
+  broker.start()
+  devices = [VirtualDevice('%s%05d' % (prefix, n), encoding, window)
+             for n in range(first, first + count)]
+  stats = FleetStats()
+  stats.devices = count
+  loop = asyncio.get_event_loop()
+  cpu = time.process_time()
+  start = loop.time()
+  await asyncio.gather(*[_device(d, broker, interval, start + duration, stats) for d in devices])
+  stats.elapsed = loop.time() - start
+  stats.cpu = time.process_time() - cpu
+  stats.wire_bytes = broker.broker.wire_bytes
+  await broker.stop()
+  return stats
+
+
+def run_worker(args):
+  # process pool entry point: (first, count, duration, interval, kwargs)
+  first, count, duration, interval, kwargs = args
+  return asyncio.run(run_fleet(first, count, duration, interval, **kwargs))
@@ -0,0 +1,125 @@
+# Logging for the entry scripts: stdlib logging, set up for an SD card.
+#
+# Everything goes through loggers under "kaliot" with %-style arguments, so
+# a message is only formatted when a handler takes it, and a call below the
+# level in force costs one isEnabledFor().  setup() gives the "kaliot"
+# logger two handlers: the console (stderr, i.e. journald) at `level`, and a
+# RingHandler keeping the last `ring_size` records at `ring_level` in memory,
+# unformatted until dumped - on demand, or to the console on SIGUSR1.
+#
+# Events that repeat every sample or every send (confirmations, send
+# accepted, status polls) go through a Throttle: at most `burst` lines per
+# `interval` seconds, the rest counted and the count added to the next line
+# let through.
+
+import collections
+import logging
+import signal
+import sys
+import threading
+import time
+
+LEVEL = logging.WARNING       # console
+RING_LEVEL = logging.INFO
+RING_SIZE = 1000              # records
+THROTTLE_INTERVAL = 60.0      # seconds
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class RingHandler(logging.Handler):
+  # the last `capacity` records, formatted only when dumped
+
+  def __init__(self, capacity=RING_SIZE, level=RING_LEVEL):
+    logging.Handler.__init__(self, level)
+    self.records = collections.deque(maxlen=capacity)
+
+  def emit(self, record):
+    self.records.append(record)
+
+  def dump(self, limit=None):
+    records = list(self.records)
+    if limit is not None:
+      records = records[-limit:] if limit > 0 else []
+    return [self.format(record) for record in records]
+
+
+class Throttle(object):
+  # one repetitive event on `logger`: at most burst lines per interval
+  # seconds.  log() returns True when the line went out.
+
+  def __init__(self, logger, interval=THROTTLE_INTERVAL, burst=1, clock=time.time):
+    self.logger = logger
+    self.interval = interval
+    self.burst = burst
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.tokens = float(burst)
+    self.last = clock()
+    self.suppressed = 0
+
+  def log(self, level, msg, *args):
+    if not self.logger.isEnabledFor(level):
+      return False
+    now = self.clock()
+    with self.lock:
+      if self.interval:
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.burst / self.interval)
+      else:
+        self.tokens = self.burst
+      self.last = now
+      if self.tokens < 1:
+        self.suppressed += 1
+        return False
+      self.tokens -= 1
+      suppressed, self.suppressed = self.suppressed, 0
+    if suppressed:
+      msg += ' (%d more since)'
+      args += (suppressed,)
+    self.logger.log(level, msg, *args)
+    return True
+
+  def debug(self, msg, *args):
+    return self.log(logging.DEBUG, msg, *args)
+
+  def info(self, msg, *args):
+    return self.log(logging.INFO, msg, *args)
+
+  def warning(self, msg, *args):
+    return self.log(logging.WARNING, msg, *args)
+
+
+def setup(level=LEVEL, ring_size=RING_SIZE, ring_level=RING_LEVEL, stream=None,
+          dump_signal=signal.SIGUSR1, lean_records=False):
+  # configures the "kaliot" logger; returns the RingHandler (None with
+  # ring_size 0).  Call from the main thread, for the signal handler.
+  # lean_records leaves thread and process details out of every record.
+  # Those switches are module-wide in logging, so they change the records of
+  # every logger in the process (the SDK's too); it is off unless the
+  # script knows no handler of anyone's prints those fields.
+  logger = logging.getLogger('kaliot')
+  for handler in list(logger.handlers):
+    logger.removeHandler(handler)
+  logger.propagate = False
+  formatter = logging.Formatter(FORMAT)
+  console = logging.StreamHandler(sys.stderr if stream is None else stream)
+  console.setLevel(level)
+  console.setFormatter(formatter)
+  logger.addHandler(console)
+  ring = None
+  if ring_size:
+    ring = RingHandler(ring_size, ring_level)
+    ring.setFormatter(formatter)
+    logger.addHandler(ring)
+  # the level gate: nothing below what some handler wants makes a record
+  logger.setLevel(min(level, ring_level) if ring is not None else level)
+  if lean_records:
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+  if ring is not None and dump_signal is not None:
+    def dump(signum, frame):
+      for line in ring.dump():
+        console.stream.write(line + '\n')
+      console.flush()
+    signal.signal(dump_signal, dump)
+  return ring
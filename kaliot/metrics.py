@@ -0,0 +1,300 @@
+# Process metrics in Prometheus text format.
+#
+# Counters and fixed-bucket histograms cost a lock and a bisect per update,
+# cheap enough for every sample and every send.  The kaliot modules record
+# into the metrics defined at the bottom of this file; the scripts expose
+# REGISTRY either on a local HTTP endpoint (serve) or as a node-exporter
+# textfile (TextfileWriter) so slow nodes can be found across the fleet.
+
+import bisect
+import os
+import threading
+import time
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_ADDRESS = '127.0.0.1'  # no authentication: listening wider is a choice
+
+# seconds; spans a 2 us encode up to a 10 s confirmation
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+           0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+  parts = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+  if extra:
+    parts.append(extra)
+  return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer(object):
+
+  __slots__ = ('histogram', 'start')
+
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Counter(object):
+
+  kind = 'counter'
+
+  def __init__(self):
+    self.value = 0
+    self.lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self.lock:
+      self.value += amount
+
+  def samples(self, name, labels):
+    return ['%s_total%s %s' % (name, labels(''), _number(self.value))]
+
+
+class Gauge(object):
+  # fn() is called at scrape time
+
+  kind = 'gauge'
+
+  def __init__(self, fn=None):
+    self.value = 0
+    self.fn = fn
+
+  def set(self, value):
+    self.value = value
+
+  def samples(self, name, labels):
+    value = self.fn() if self.fn is not None else self.value
+    return ['%s%s %s' % (name, labels(''), _number(value))]
+
+
+class Histogram(object):
+
+  kind = 'histogram'
+
+  def __init__(self, buckets=BUCKETS):
+    self.bounds = tuple(buckets)
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.sum = 0.0
+    self.count = 0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.bounds, value)
+    with self.lock:
+      self.counts[i] += 1
+      self.sum += value
+      self.count += 1
+
+  def time(self):
+    # with histogram.time(): ...
+    return _Timer(self)
+
+  def samples(self, name, labels):
+    with self.lock:
+      counts = list(self.counts)
+      total, count = self.sum, self.count
+    lines = []
+    cumulative = 0
+    for bound, n in zip(self.bounds + (float('inf'),), counts):
+      cumulative += n
+      lines.append('%s_bucket%s %d' % (name, labels('le="%s"' % _number(bound)), cumulative))
+    lines.append('%s_sum%s %s' % (name, labels(''), _number(total)))
+    lines.append('%s_count%s %d' % (name, labels(''), count))
+    return lines
+
+
+class Family(object):
+  # one named metric, with a child per label value combination
+
+  def __init__(self, cls, name, help, labelnames=(), **kwargs):
+    self.cls = cls
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.kwargs = kwargs
+    self.children = {}
+    self.lock = threading.Lock()
+    if not self.labelnames:
+      child = self.children[()] = cls(**kwargs)
+      # bound once, so FAMILY.observe(...) costs no attribute lookup
+      for method in ('inc', 'set', 'observe', 'time'):
+        if hasattr(child, method):
+          setattr(self, method, getattr(child, method))
+
+  def labels(self, *values):
+    child = self.children.get(values)
+    if child is None:
+      values = tuple(str(v) for v in values)
+      with self.lock:
+        child = self.children.get(values)
+        if child is None:
+          child = self.children[values] = self.cls(**self.kwargs)
+    return child
+
+  def __getattr__(self, name):
+    # unlabelled families act as their only child
+    try:
+      child = self.__dict__['children'][()]
+    except KeyError:
+      raise AttributeError(name)
+    return getattr(child, name)
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help),
+             '# TYPE %s %s' % (self.name, self.cls.kind)]
+    for values, child in sorted(self.children.items()):
+      lines += child.samples(self.name, lambda extra, v=values: _labels(self.labelnames, v, extra))
+    return lines
+
+
+class Registry(object):
+
+  def __init__(self):
+    self.families = []
+    self.by_name = {}
+
+  def _add(self, cls, name, help, labelnames=(), **kwargs):
+    if name in self.by_name:
+      raise ValueError('metric %s already registered' % name)
+    family = self.by_name[name] = Family(cls, name, help, labelnames, **kwargs)
+    self.families.append(family)
+    return family
+
+  def counter(self, name, help, labelnames=()):
+    return self._add(Counter, name, help, labelnames)
+
+  def gauge(self, name, help, fn=None):
+    return self._add(Gauge, name, help, fn=fn)
+
+  def histogram(self, name, help, labelnames=(), buckets=BUCKETS):
+    return self._add(Histogram, name, help, labelnames, buckets=buckets)
+
+  def render(self):
+    lines = []
+    for family in self.families:
+      lines += family.render()
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def serve(port, registry=None, addr=METRICS_ADDRESS):
+  # /metrics on a daemon thread; returns the server (shutdown() to stop).
+  # Local only unless addr says otherwise ('' for every interface)
+  registry = REGISTRY if registry is None else registry
+
+  class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      body = registry.render()
+      self.send_response(200)
+      self.send_header('Content-Type', CONTENT_TYPE)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = HTTPServer((addr, port), Handler)
+  thread = threading.Thread(target=server.serve_forever, name='kaliot-metrics')
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def write_textfile(path, registry=None):
+  # atomically, so node-exporter never reads a half-written file
+  registry = REGISTRY if registry is None else registry
+  tmp = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp, 'wb') as f:
+    f.write(registry.render())
+  os.rename(tmp, path)
+
+
+class TextfileWriter(object):
+  # rewrites path every interval seconds from a daemon thread
+
+  def __init__(self, path, interval=15, registry=None):
+    self.path = path
+    self.interval = interval
+    self.registry = registry
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    def run():
+      while True:
+        write_textfile(self.path, self.registry)
+        if self._stop.wait(self.interval):
+          return
+    self._thread = threading.Thread(target=run, name='kaliot-textfile')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+
+
+REGISTRY = Registry()
+
+SENSOR_READ = REGISTRY.histogram(
+  'kaliot_sensor_read_seconds', 'Time to read one sensor, including conversion waits.', ('sensor',))
+COMPENSATE = REGISTRY.histogram(
+  'kaliot_compensate_seconds', 'BME280 compensation time per sample.')
+ENCODE = REGISTRY.histogram(
+  'kaliot_encode_seconds', 'Payload encode time per message.')
+COMPRESS = REGISTRY.histogram(
+  'kaliot_compress_seconds', 'Payload compression time per message.')
+QUEUE_WAIT = REGISTRY.histogram(
+  'kaliot_queue_wait_seconds', 'Time a reading waits between sampler and handler.')
+SPOOL_WAIT = REGISTRY.histogram(
+  'kaliot_spool_wait_seconds', 'Time a payload waits in the spool before it is sent.')
+SEND_LATENCY = REGISTRY.histogram(
+  'kaliot_send_confirm_seconds', 'Time from send to confirmation callback.', ('result',))
+STALLED = REGISTRY.histogram(
+  'kaliot_backpressure_seconds', 'Time sampling was held back by a full send window.')
+CALLBACK_HOLD = REGISTRY.histogram(
+  'kaliot_callback_hold_seconds', 'Time an SDK callback holds the SDK thread.', ('kind',))
+COMMAND_WAIT = REGISTRY.histogram(
+  'kaliot_command_wait_seconds', 'Time a command waits for a worker.', ('kind',))
+COMMAND_TIME = REGISTRY.histogram(
+  'kaliot_command_seconds', 'Time to handle one command on a worker.', ('kind',))
+SENT = REGISTRY.counter('kaliot_messages_sent', 'Messages handed to the transport.')
+CONFIRMED = REGISTRY.counter('kaliot_messages_confirmed', 'Messages confirmed by the transport.')
+RETRIES = REGISTRY.counter('kaliot_send_retries', 'Sends that failed and will be retried.')
+TIMEOUTS = REGISTRY.counter('kaliot_send_timeouts', 'Sends that timed out before confirmation.')
+INFLIGHT = REGISTRY.gauge('kaliot_inflight', 'Sends awaiting confirmation.')
+SPOOL_BYTES = REGISTRY.gauge('kaliot_spool_bytes', 'Payload bytes held in the spool.')
+DROPPED = REGISTRY.counter('kaliot_dropped', 'Readings or payloads dropped.', ('reason',))
+STAGE_ERRORS = REGISTRY.counter(
+  'kaliot_stage_errors', 'Exceptions from a runtime stage that then carried on.', ('stage',))
+CALLBACKS = REGISTRY.counter('kaliot_callbacks', 'SDK callbacks received.', ('kind',))
+COMMANDS = REGISTRY.counter(
+  'kaliot_commands', 'Cloud-to-device messages, methods and twin updates by outcome.', ('kind', 'result'))
+CONNECTS = REGISTRY.counter('kaliot_connects', 'Connection attempts by outcome.', ('result',))
+SATURATED = REGISTRY.counter('kaliot_light_saturated', 'Light readings with a clipped channel.', ('sensor',))
+COMPRESSED = REGISTRY.counter(
+  'kaliot_compressed_bytes', 'Bytes of compressed payloads before and after compression.', ('stage',))
@@ -0,0 +1,214 @@
+# Local time-series ring buffer.
+#
+# Every reading is written to a fixed-size, mmap-backed file of fixed-width
+# records (the BinaryEncoder record layout: scaled integers, 30 bytes), so a
+# week of 1 Hz samples is ~18 MB and the file never grows.  Records are in
+# time order around the ring, which lets query() binary-search a time range
+# by reading only timestamps and copy the matching records out as one
+# BinaryEncoder batch: the file is viewed as a table of records, so every
+# step-th record up to the end of the file (and on from its start) is one
+# strided copy, and nothing is decoded or allocated per record on the way.
+#
+# A direct method response is capped at 128 KB by the hub, so handle_query()
+# answers in pages of at most RESPONSE_LIMIT bytes; a page that stops short
+# of the range carries "next", the request for the rest.  Pages resume from
+# a record's sequence number rather than its timestamp, so records that
+# share a timestamp across a page boundary are neither repeated nor lost.
+
+import base64
+import json
+import mmap
+import os
+import struct
+import threading
+
+from kaliot.encoding import BATCH_FLAG, SCHEMA_VERSION, BinaryEncoder
+from kaliot.telemetry import Reading
+
+RING_CAPACITY = 7 * 24 * 3600 # records: a week at 1 Hz
+MAX_POINTS = 3600             # records per query result by default
+BATCH_LIMIT = 0xFFFF          # a batch header counts records in 16 bits
+RESPONSE_LIMIT = 120 * 1024   # bytes per direct method response
+RESPONSE_OVERHEAD = 512       # bytes of a response besides its records
+
+MAGIC = b'KRNG'
+# magic, schema version, record size, capacity, head (next slot), count,
+# written (records ever appended: the sequence number of the next one)
+HEADER = struct.Struct('<4sHHIIIQ')
+HEADER_SIZE = 64
+_TS = struct.Struct('<IH')
+
+
+class RingFile(object):
+
+  def __init__(self, path, capacity=RING_CAPACITY):
+    self.path = path
+    self.encoder = BinaryEncoder()
+    self.record = self.encoder.record
+    self.size = self.record.size
+    self.capacity = capacity
+    self.lock = threading.Lock()
+    length = HEADER_SIZE + capacity * self.size
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fresh = os.fstat(fd).st_size != length
+      if fresh:
+        os.ftruncate(fd, length)
+      self.map = mmap.mmap(fd, length)
+    finally:
+      os.close(fd)
+    magic, version, size, stored_capacity, self.head, self.count, self.written = \
+      HEADER.unpack_from(self.map, 0)
+    if fresh or (magic, version, size, stored_capacity) != (MAGIC, SCHEMA_VERSION, self.size, capacity):
+      # new file, or one written with another layout: start empty
+      self.head = self.count = self.written = 0
+      self._write_header()
+    # a file from before the counter has 0 there
+    self.written = max(self.written, self.count)
+
+  def _write_header(self):
+    HEADER.pack_into(self.map, 0, MAGIC, SCHEMA_VERSION, self.size, self.capacity,
+                     self.head, self.count, self.written)
+
+  def __len__(self):
+    return self.count
+
+  def _offset(self, index):
+    # byte offset of the index-th oldest record
+    return HEADER_SIZE + (self.head - self.count + index) % self.capacity * self.size
+
+  def _ts(self, index):
+    seconds, ms = _TS.unpack_from(self.map, self._offset(index))
+    return seconds + ms / 1000.0
+
+  def append(self, reading):
+    with self.lock:
+      offset = HEADER_SIZE + self.head * self.size
+      # same packing as BinaryEncoder, straight into the map
+      self.map[offset:offset + self.size] = self.encoder._pack(reading)
+      self.head = (self.head + 1) % self.capacity
+      if self.count < self.capacity:
+        self.count += 1
+      self.written += 1
+      self._write_header()
+
+  def _bisect(self, ts):
+    # first index whose timestamp is >= ts
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._ts(mid) < ts:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def page(self, start, end, max_points=MAX_POINTS, step=None, limit=BATCH_LIMIT, cursor=None):
+    # records with start <= ts < end as a BinaryEncoder batch payload of at
+    # most limit records, every step-th record kept (by default the step
+    # that keeps at most max_points over the range).  Returns (batch, step,
+    # next): next is the cursor for the rest of the range, None when done;
+    # pass it back as cursor with the same start, end and step
+    limit = max(1, min(limit, BATCH_LIMIT))
+    with self.lock:
+      oldest = self.written - self.count
+      first = self._bisect(start)
+      if cursor is not None:
+        # records overwritten since the last page are simply gone
+        first = max(first, cursor - oldest)
+      last = self._bisect(end)
+      n = max(0, last - first)
+      if step is None:
+        step = -(-n // max(1, max_points)) if n else 1
+      kept = -(-n // step) if n else 0
+      resume = None
+      if kept > limit:
+        kept = limit
+        resume = oldest + first + kept * step
+      out = bytearray(self.encoder.batch_header.pack(SCHEMA_VERSION | BATCH_FLAG, kept))
+      if kept:
+        with memoryview(self.map) as view, view[HEADER_SIZE:] as body, \
+             body.cast('B', (self.capacity, self.size)) as records:
+          slot = (self.head - self.count + first) % self.capacity
+          # at most two strided runs: up to the end of the file, then from
+          # its start
+          while kept:
+            run = min(kept, -(-(self.capacity - slot) // step))
+            out += records[slot:slot + (run - 1) * step + 1:step].tobytes()
+            kept -= run
+            slot += run * step - self.capacity
+    return bytes(out), step, resume
+
+  def query(self, start, end, max_points=MAX_POINTS):
+    # the whole range in one batch, every step-th record kept so at most
+    # max_points come back
+    max_points = max(1, min(max_points, BATCH_LIMIT))
+    return self.page(start, end, max_points)[0]
+
+  def flush(self):
+    self.map.flush()
+
+  def close(self):
+    with self.lock:
+      self.map.flush()
+      self.map.close()
+
+
+def _widest_json(encoder):
+  # bytes one reading can take in the "json" format, at its most digits
+  values = [4294967295.999]
+  for (low, high), scale in zip(encoder.limits, encoder.scales):
+    values.append(max(float(low) / scale, float(high) / scale, key=lambda v: len(repr(v))))
+  return len(json.dumps(Reading(*values)._asdict())) + len(', ')
+
+
+def handle_query(ring, payload, now, limit=RESPONSE_LIMIT):
+  # direct method / command body -> (status, response JSON string).
+  # payload: {"start": ts, "end": ts} or {"seconds": n} for the last n
+  # seconds, plus optional "max_points" and "format" ("binary" returns the
+  # batch base64-encoded, "json" decodes it into a JsonEncoder-style array).
+  # A result that does not fit in limit bytes comes back a page at a time:
+  # each page but the last has "next", the payload that asks for the rest
+  # at the same step (its "cursor" is opaque to the caller).
+  try:
+    request = json.loads(payload) if payload else {}
+    if not isinstance(request, dict):
+      raise ValueError('request must be a JSON object, not %s' % type(request).__name__)
+    if 'seconds' in request:
+      end = now
+      start = end - float(request['seconds'])
+    else:
+      start = float(request.get('start', 0))
+      end = float(request.get('end', now + 1))
+    max_points = int(request.get('max_points', MAX_POINTS))
+    step = request.get('step')
+    if step is not None:
+      step = int(step)
+      if step < 1:
+        raise ValueError('step must be at least 1, not %d' % step)
+    cursor = request.get('cursor')
+    if cursor is not None:
+      cursor = int(cursor)
+      if cursor < 0:
+        raise ValueError('bad cursor %d' % cursor)
+    fmt = request.get('format', 'binary')
+    if fmt not in ('binary', 'json'):
+      raise ValueError('unknown format %r' % fmt)
+  except (ValueError, TypeError, KeyError) as e:
+    return 400, json.dumps({'error': str(e)})
+  if fmt == 'binary':
+    # base64 takes 4 bytes for every 3
+    points = (limit - RESPONSE_OVERHEAD) * 3 // 4 // ring.size - 1
+  else:
+    points = (limit - RESPONSE_OVERHEAD) // _widest_json(ring.encoder)
+  batch, step, resume = ring.page(start, end, max_points, step, max(1, points), cursor)
+  if fmt == 'binary':
+    count = ring.encoder.batch_header.unpack_from(batch, 0)[1]
+    response = {'count': count, 'encoding': ring.encoder.content_type,
+                'data': base64.b64encode(batch).decode('ascii')}
+  else:
+    readings = ring.encoder.decode(batch)
+    response = {'count': len(readings), 'readings': [r._asdict() for r in readings]}
+  if resume is not None:
+    response['next'] = {'start': start, 'end': end, 'step': step, 'cursor': resume, 'format': fmt}
+  return 200, json.dumps(response)
@@ -0,0 +1,203 @@
+# asyncio runtime for the entry scripts.
+#
+# Three stages run as independent tasks:
+#
+#   sampler  - calls sample() on a drift-free schedule (deadlines advance by
+#              exactly one period from the first one, so time spent sampling
+#              does not push later samples back); sample() blocks on I2C, so
+#              it runs on a worker thread
+#   handler  - takes readings off a queue and calls handle(reading), which
+#              encodes/filters/batches and appends to the spool
+#   sender   - calls drain() whenever there may be something to send: after
+#              a new payload, after a confirmation callback (wake_threadsafe),
+#              or when the drain rate limit lets more out
+#
+# plus an optional pump() every pump_interval for transports that need their
+# work done on the caller's thread (iotc.doNext).
+#
+# With a backpressure() predicate (e.g. Drainer.full), the sampler holds off
+# while it is true and resumes on the next wake, so a transport that stops
+# confirming slows sampling down instead of piling up unconfirmed sends.
+#
+# An exception from sample(), handle(), drain() or pump() is logged and
+# counted and the stage carries on at its next turn (the next sample slot,
+# reading, drain retry or pump), so an I2C NACK costs one sample rather than
+# all of them.  Anything else that ends a stage's task is fatal: run() stops
+# the others and raises it.
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import math
+
+from kaliot import metrics
+
+log = logging.getLogger('kaliot.runtime')
+
+QUEUE_SIZE = 8        # readings waiting for the handler
+DRAIN_RETRY = 5.0     # seconds before re-checking an idle/offline drain
+PUMP_INTERVAL = 1.0
+BACKPRESSURE_POLL = 1.0  # seconds between backpressure checks with no wake
+
+
+class Runtime(object):
+
+  def __init__(self, sample, handle, period, drain=None, drain_interval=None,
+               pump=None, pump_interval=PUMP_INTERVAL, queue_size=QUEUE_SIZE,
+               backpressure=None):
+    self.sample = sample
+    self.handle = handle
+    self.period = period
+    self.drain = drain
+    # when drain() sent something, call it again after this long even with
+    # no event (lets a rate-limited backlog keep flowing)
+    self.drain_interval = drain_interval
+    self.pump = pump
+    self.pump_interval = pump_interval
+    self.queue_size = queue_size
+    self.backpressure = backpressure
+    self.samples = 0
+    self.stalls = 0
+    self.stalled = 0.0
+    self.dropped = 0
+    self.overruns = 0
+    self.errors = 0
+    # seconds between each sample's deadline and when it actually started
+    self.lateness = collections.deque(maxlen=1024)
+    self.loop = None
+    self._wake = None
+    self._space = None
+    self._stop = None
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+  def wake(self):
+    # call from the event loop thread
+    if self._wake is not None:
+      self._wake.set()
+      self._space.set()
+
+  def wake_threadsafe(self):
+    # call from SDK callback threads
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.wake)
+
+  def stop(self):
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self._stop.set)
+
+  def _failed(self, stage, e):
+    self.errors += 1
+    metrics.STAGE_ERRORS.labels(stage).inc()
+    log.warning("%s raised %r; carrying on", stage, e, exc_info=True)
+
+  async def _sampler(self, queue):
+    loop = self.loop
+    deadline = loop.time()
+    while True:
+      if self.backpressure is not None and self.backpressure():
+        await self._hold()
+      self.lateness.append(loop.time() - deadline)
+      try:
+        reading = await loop.run_in_executor(self._executor, self.sample)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        # this slot is lost; the next one is sampled as scheduled
+        self._failed('sample', e)
+      else:
+        self.samples += 1
+        if queue.full():
+          # the handler is behind; keep the newest readings
+          queue.get_nowait()
+          self.dropped += 1
+          metrics.DROPPED.labels('queue_full').inc()
+        queue.put_nowait((reading, loop.time()))
+      deadline += self.period
+      now = loop.time()
+      if now > deadline:
+        # sampling took longer than a period: skip the missed slots rather
+        # than firing them back-to-back
+        missed = math.ceil((now - deadline) / self.period)
+        self.overruns += missed
+        deadline += missed * self.period
+      await asyncio.sleep(deadline - now)
+
+  async def _hold(self):
+    # wait for backpressure() to clear; a confirmation wakes us, the poll
+    # covers transports that never call wake
+    self.stalls += 1
+    start = self.loop.time()
+    while self.backpressure():
+      self._space.clear()
+      try:
+        await asyncio.wait_for(self._space.wait(), BACKPRESSURE_POLL)
+      except asyncio.TimeoutError:
+        pass
+    self.stalled += self.loop.time() - start
+    metrics.STALLED.observe(self.loop.time() - start)
+
+  async def _handler(self, queue):
+    while True:
+      reading, queued = await queue.get()
+      metrics.QUEUE_WAIT.observe(self.loop.time() - queued)
+      try:
+        self.handle(reading)
+      except Exception as e:
+        self._failed('handle', e)
+        continue
+      self.wake()
+
+  async def _sender(self):
+    while True:
+      timeout = DRAIN_RETRY
+      try:
+        if self.drain() and self.drain_interval:
+          timeout = self.drain_interval
+      except Exception as e:
+        self._failed('drain', e)
+      try:
+        await asyncio.wait_for(self._wake.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+      self._wake.clear()
+
+  async def _pumper(self):
+    while True:
+      try:
+        self.pump()
+      except Exception as e:
+        self._failed('pump', e)
+      await asyncio.sleep(self.pump_interval)
+
+  async def run(self):
+    self.loop = asyncio.get_event_loop()
+    self._wake = asyncio.Event()
+    self._space = asyncio.Event()
+    self._stop = asyncio.Event()
+    queue = asyncio.Queue(maxsize=self.queue_size)
+    tasks = [asyncio.ensure_future(self._sampler(queue)),
+             asyncio.ensure_future(self._handler(queue))]
+    if self.drain is not None:
+      tasks.append(asyncio.ensure_future(self._sender()))
+    if self.pump is not None:
+      tasks.append(asyncio.ensure_future(self._pumper()))
+    # the stages never return, so the first of them to finish has raised
+    stop = asyncio.ensure_future(self._stop.wait())
+    try:
+      done, _ = await asyncio.wait(tasks + [stop], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+      for task in tasks + [stop]:
+        task.cancel()
+      await asyncio.gather(*tasks, stop, return_exceptions=True)
+      self._executor.shutdown(wait=False)
+    for task in done:
+      if task is not stop:
+        task.result()
+
+  def jitter(self):
+    # (mean, max) sample start lateness in seconds
+    if not self.lateness:
+      return 0.0, 0.0
+    return sum(self.lateness) / len(self.lateness), max(self.lateness)
+
@@ -0,0 +1,339 @@
+# Multi-sensor, multi-bus polling.
+#
+# Sensors are declared in config as a list of dicts, e.g.
+#
+#   {"id": "rack1-top", "type": "bme280", "bus": 1, "addr": 0x77}
+#   {"id": "rack2-top", "type": "bme280", "bus": 1, "mux": 0x70, "channel": 2}
+#   {"id": "rack1-light", "type": "tcs34725", "bus": 1}
+#
+# One BusPoller per I2C bus walks its devices round-robin, grouped by mux
+# channel so each TCA9548A is switched once per group rather than once per
+# transfer.  BME280 conversions are all triggered first and fetched after one
+# shared wait; TCS34725 colour windows run interleaved, one raw frame from
+# every chip per integration period.  SensorPoller runs the buses at the same
+# time and returns one list of kaliot.acquire.Sample tagged by sensor id.
+# With auto_range every TCS34725 is auto-ranged by its own tcs.LightMeter and
+# its window ends when its mean is good enough; a light record's saturated
+# field is 1 when a channel clipped.
+
+import collections
+import json
+import threading
+import time
+
+from kaliot.acquire import Acquisition, Sample, bus_lock
+from kaliot.bme280 import BME280, DEVICE
+from kaliot import metrics, tcs
+
+# reported field names for each sensor type, in the order of its value tuple
+KINDS = {
+  'bme280': ('airtemperature', 'airpressure', 'airhumidity'),
+  'tcs34725': ('red', 'green', 'blue', 'clear', 'lux', 'colortemp', 'saturated'),
+}
+FLAGS = ('saturated',) # reported as 0/1
+DEFAULT_ADDRESS = {
+  'bme280': DEVICE,
+  'tcs34725': tcs.TCS34725_ADDRESS,
+}
+BUS = 1
+
+SensorSpec = collections.namedtuple('SensorSpec', 'id kind bus addr mux channel')
+
+
+def parse_sensors(config):
+  # list of config dicts -> list of SensorSpec, checked for typos and clashes
+  specs = []
+  seen = set()
+  places = set()
+  for entry in config:
+    entry = dict(entry)
+    sensor_id = entry.pop('id')
+    kind = entry.pop('type')
+    if kind not in KINDS:
+      raise ValueError('sensor %s: unknown type %r (choose from %s)' % (
+        sensor_id, kind, ', '.join(sorted(KINDS))))
+    spec = SensorSpec(sensor_id, kind, entry.pop('bus', BUS),
+                      entry.pop('addr', DEFAULT_ADDRESS[kind]),
+                      entry.pop('mux', None), entry.pop('channel', None))
+    if entry:
+      raise ValueError('sensor %s: unknown keys %s' % (sensor_id, ', '.join(sorted(entry))))
+    if (spec.mux is None) != (spec.channel is None):
+      raise ValueError('sensor %s: mux and channel go together' % sensor_id)
+    if spec.channel is not None and not 0 <= spec.channel < 8:
+      raise ValueError('sensor %s: bad mux channel %r' % (sensor_id, spec.channel))
+    if sensor_id in seen:
+      raise ValueError('duplicate sensor id %s' % sensor_id)
+    # a device outside the muxes answers on every channel
+    clash = [p for p in places if p[0] == spec.bus and p[3] == spec.addr and
+             (p[1:3] == (spec.mux, spec.channel) or p[1] is None or spec.mux is None)]
+    if clash:
+      raise ValueError('sensor %s: address 0x%02x already used on that bus/channel' % (
+        sensor_id, spec.addr))
+    seen.add(sensor_id)
+    places.add((spec.bus, spec.mux, spec.channel, spec.addr))
+    specs.append(spec)
+  return specs
+
+
+class BusPoller(object):
+  # All sensors on one bus.  Holds lock for each mux group, so mux selection
+  # and the transfers behind it cannot interleave with another user of the
+  # bus.  A sensor that stops answering is skipped (and counted in errors)
+  # without holding up the others.
+
+  def __init__(self, bus, specs, lock=None, samples=tcs.SAMPLES,
+               clock=time.time, sleep=time.sleep, bme280_options=None, auto_range=False):
+    self.bus = bus
+    self.bme280_options = bme280_options or {}  # BME280() keywords: mode, standby, iir_filter
+    self.lock = threading.RLock() if lock is None else lock
+    self.samples = samples
+    self.clock = clock
+    self.sleep = sleep
+    self.selected = {}  # mux address -> channel mask last written
+    self.errors = collections.Counter()
+    # [((mux, channel), [(spec, driver), ...]), ...] in bus order
+    groups = collections.OrderedDict()
+    for spec in sorted(specs, key=lambda s: (s.mux or 0, -1 if s.channel is None else s.channel, s.addr)):
+      groups.setdefault((spec.mux, spec.channel), []).append(spec)
+    self.groups = []
+    with self.lock:
+      for place, group in groups.items():
+        self._select(*place)
+        self.groups.append((place, [(spec, self._open(spec)) for spec in group]))
+    self.bme280 = [(place, [d for d in devices if d[0].kind == 'bme280']) for place, devices in self.groups]
+    self.tcs34725 = [(place, [d for d in devices if d[0].kind == 'tcs34725']) for place, devices in self.groups]
+    self.delay = max([driver.delay for _, devices in self.tcs34725 for _, driver in devices] or [0])
+    self.meters = None
+    if auto_range:
+      self.meters = dict((spec.id, tcs.LightMeter(driver))
+                         for _, devices in self.tcs34725 for spec, driver in devices)
+
+  def _open(self, spec):
+    if spec.kind == 'bme280':
+      return BME280(self.bus, spec.addr, **self.bme280_options)
+    return tcs.TCS34725(self.bus, spec.addr)
+
+  def _select(self, mux, channel):
+    # route the bus to one mux channel, closing every other mux so devices
+    # with the same address behind them stay off the bus
+    for other, mask in self.selected.items():
+      if other != mux and mask:
+        self.bus.write_byte(other, 0)
+        self.selected[other] = 0
+    if mux is not None and self.selected.get(mux) != 1 << channel:
+      self.bus.write_byte(mux, 1 << channel)
+      self.selected[mux] = 1 << channel
+
+  def _each(self, groups, fn):
+    # fn(spec, driver) for every device, one mux selection per group
+    for place, devices in groups:
+      if not devices:
+        continue
+      with self.lock:
+        try:
+          self._select(*place)
+        except IOError:
+          # mux gone; its state is unknown until the next write works
+          self.selected.pop(place[0], None)
+          self.errors.update(spec.id for spec, _ in devices)
+          continue
+        for spec, driver in devices:
+          try:
+            fn(spec, driver)
+          except IOError:
+            self.errors[spec.id] += 1
+
+  def _read_bme280(self):
+    started = {}
+    ready = [0]
+    def start(spec, driver):
+      # only a conversion that was started is fetched
+      now = self.clock()
+      ready[0] = max(ready[0], now + driver.start())
+      started[spec.id] = now
+    self._each(self.bme280, start)
+    if not started:
+      return []
+    # every conversion runs in parallel on its own chip; wait once for the
+    # slowest instead of once per sensor
+    wait = ready[0] - self.clock()
+    if wait > 0:
+      self.sleep(wait)
+    samples = []
+    def fetch(spec, driver):
+      if spec.id not in started:
+        return
+      raw = driver.fetch_raw()
+      end = self.clock()
+      begin = started[spec.id]
+      metrics.SENSOR_READ.labels(spec.id).observe(end - begin)
+      with metrics.COMPENSATE.time():
+        value = driver.calibration.compensate(*raw)
+      samples.append(Sample(spec.id, (begin + end) / 2.0, end - begin, value))
+    self._each(self.bme280, fetch)
+    return samples
+
+  def poll(self):
+    # one reading of every sensor on the bus, as a list of Samples.  The
+    # BME280s are read halfway through the colour window so both describe
+    # the same moment.
+    if not any(devices for _, devices in self.tcs34725):
+      return self._read_bme280()
+    if self.meters is not None:
+      return self._poll_ranged()
+    windows = {}
+    begin = {}
+    saturated = set()
+    def frame(spec, driver):
+      r, g, b, c = driver.read_raw()
+      window = windows.get(spec.id)
+      if window is None:
+        window = windows[spec.id] = tcs.ColorAccumulator()
+        begin[spec.id] = self.clock()
+      if max(r, g, b, c) >= tcs.full_scale(driver.get_integration_time()):
+        saturated.add(spec.id)
+      window.add(r, g, b, c)
+    samples = []
+    for n in range(self.samples):
+      if n == self.samples // 2:
+        samples += self._read_bme280()
+      start = self.clock()
+      self._each(self.tcs34725, frame)
+      # every chip has finished a new integration one period after the last
+      # pass started
+      wait = start + self.delay - self.clock()
+      if wait > 0:
+        self.sleep(wait)
+    end = self.clock()
+    for sensor_id, window in windows.items():
+      metrics.SENSOR_READ.labels(sensor_id).observe(end - begin[sensor_id])
+      samples.append(Sample(sensor_id, (begin[sensor_id] + end) / 2.0, end - begin[sensor_id],
+                            tcs.light_reading(*window.mean()) + (sensor_id in saturated,)))
+    return samples
+
+  def _poll_ranged(self):
+    # as poll(), but each chip's window ends when its LightMeter is done; a
+    # pass waits for the longest integration still running.  Ranged windows
+    # are short in daylight, so the BME280s are simply read first.
+    meters = self.meters
+    begin = {}
+    end = {}
+    for meter in meters.values():
+      meter.reset()
+    def frame(spec, driver):
+      if spec.id in end:
+        return
+      meter = meters[spec.id]
+      begin.setdefault(spec.id, self.clock())
+      r, g, b, c = driver.read_raw()
+      meter.add(r, g, b, c)
+      if meter.done(self.samples):
+        end[spec.id] = self.clock()
+    samples = self._read_bme280()
+    # settling frames do not count towards samples; a chip that stops
+    # answering never gets done, so the passes are bounded
+    for _ in range(self.samples + len(tcs.RANGES)):
+      start = self.clock()
+      self._each(self.tcs34725, frame)
+      pending = [meter.delay for sensor_id, meter in meters.items() if sensor_id not in end]
+      if not pending:
+        break
+      wait = start + max(pending) - self.clock()
+      if wait > 0:
+        self.sleep(wait)
+    now = self.clock()
+    for sensor_id, meter in meters.items():
+      if not meter.count and meter.last is None:
+        continue
+      stop = end.get(sensor_id, now)
+      metrics.SENSOR_READ.labels(sensor_id).observe(stop - begin[sensor_id])
+      if meter.saturated:
+        metrics.SATURATED.labels(sensor_id).inc()
+      samples.append(Sample(sensor_id, (begin[sensor_id] + stop) / 2.0, stop - begin[sensor_id],
+                            tcs.light_reading(*meter.mean()) + (meter.saturated,)))
+    return samples
+
+  def set_oversampling(self, oversample_temp, oversample_pres, oversample_hum):
+    def configure(spec, driver):
+      driver.set_oversampling(oversample_temp, oversample_pres, oversample_hum)
+    self._each(self.bme280, configure)
+
+  def close(self):
+    def disable(spec, driver):
+      driver.disable()
+    self._each(self.tcs34725, disable)
+
+
+class SensorPoller(object):
+  # specs: SensorSpec list (see parse_sensors); open_bus(busnum) returns an
+  # smbus.SMBus-style handle.  Buses are polled concurrently.
+
+  def __init__(self, specs, open_bus, samples=tcs.SAMPLES, bme280_options=None, auto_range=False):
+    by_bus = collections.OrderedDict()
+    for spec in specs:
+      by_bus.setdefault(spec.bus, []).append(spec)
+    self.specs = list(specs)
+    self.kinds = dict((spec.id, spec.kind) for spec in self.specs)
+    self.buses = collections.OrderedDict(
+      (busnum, BusPoller(open_bus(busnum), bus_specs, lock=bus_lock(busnum), samples=samples,
+                         bme280_options=bme280_options, auto_range=auto_range))
+      for busnum, bus_specs in by_bus.items())
+    self.acquisition = Acquisition([('bus%s' % busnum, poller.poll) for busnum, poller in self.buses.items()],
+                                   align=False)
+
+  def read(self):
+    # every sensor on every bus, oldest capture first
+    samples = []
+    for bus_sample in self.acquisition.read().values():
+      samples += bus_sample.value
+    samples.sort(key=lambda s: s.ts)
+    return samples
+
+  def set_samples(self, samples):
+    # colour window length, from the next read()
+    for poller in self.buses.values():
+      poller.samples = samples
+
+  def set_oversampling(self, oversample_temp, oversample_pres, oversample_hum):
+    # call between reads (e.g. from the sampling thread before read())
+    for poller in self.buses.values():
+      poller.set_oversampling(oversample_temp, oversample_pres, oversample_hum)
+
+  def errors(self):
+    errors = collections.Counter()
+    for poller in self.buses.values():
+      errors.update(poller.errors)
+    return errors
+
+  def close(self):
+    self.acquisition.close()
+    for poller in self.buses.values():
+      poller.close()
+
+
+class SampleEncoder(object):
+  # One JSON array per poll, one object per sensor: {"sensor": id, "ts": ...,
+  # <fields of its type>}.  Templates are built once per sensor, as
+  # kaliot.encoding.JsonEncoder does for Readings.
+
+  content_type = 'application/json'
+  content_encoding = 'utf-8'
+
+  def __init__(self, kinds, device_id=None, precision=2):
+    # kinds: {sensor id: type}, e.g. SensorPoller.kinds
+    self.templates = {}
+    for sensor_id, kind in kinds.items():
+      parts = ['"sensor":' + json.dumps(sensor_id).replace('%', '%%'), '"ts":%.3f']
+      parts += ['"%s":%%d' % name if name in FLAGS else '"%s":%%.%df' % (name, precision)
+                for name in KINDS[kind]]
+      if device_id is not None:
+        parts.insert(0, '"deviceId":' + json.dumps(device_id).replace('%', '%%'))
+      self.templates[sensor_id] = '{' + ','.join(parts) + '}'
+
+  def encode(self, samples):
+    templates = self.templates
+    return ('[' + ','.join([templates[s.name] % ((s.ts,) + tuple(s.value)) for s in samples]) +
+            ']').encode('utf-8')
+
+  def decode(self, payload):
+    return json.loads(payload.decode('utf-8'))
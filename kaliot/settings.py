@@ -0,0 +1,116 @@
+# Runtime-tunable parameters.
+#
+# Desired values (device twin desired properties, IoT Central settings) are
+# checked against TUNABLES as they arrive and queued.  apply() runs the queued
+# ones at the next sampling boundary - the entry scripts call it first thing in
+# sample(), on the sampling thread, so a sensor is never reconfigured in the
+# middle of a read and the connection is left alone.  Every change is then
+# acknowledged through report(acks): the applied value with status 200, or
+# the value still in force with 400 (rejected) or 500 (failed to apply).
+#
+# A twin patch carries its desired $version.  Each name remembers the version
+# that last set it, and a value from a patch at or below that version is
+# stale and ignored, so patches handled out of order cannot put an older
+# desired value back.
+
+import collections
+import threading
+
+Tunable = collections.namedtuple('Tunable', 'type low high')
+Ack = collections.namedtuple('Ack', 'value status description version')
+
+TUNABLES = collections.OrderedDict([
+  ('sampleInterval', Tunable(float, 1, 86400)),     # seconds between samples
+  ('colorSamples', Tunable(int, 1, 1000)),          # TCS34725 reads per colour window
+  ('oversampleTemp', Tunable(int, 1, 5)),           # BME280 osrs codes, 1 = x1 .. 5 = x16
+  ('oversamplePres', Tunable(int, 1, 5)),
+  ('oversampleHum', Tunable(int, 1, 5)),
+  ('messageTimeout', Tunable(int, 1000, 3600000)),  # ms
+])
+
+
+def check(name, value):
+  # the value as its tunable's type; ValueError if it does not fit
+  tunable = TUNABLES[name]
+  if isinstance(value, bool) or not isinstance(value, (int, float)):
+    raise ValueError('%s must be a number, not %r' % (name, value))
+  if tunable.type is int and value != int(value):
+    raise ValueError('%s must be a whole number, not %r' % (name, value))
+  value = tunable.type(value)
+  if not tunable.low <= value <= tunable.high:
+    raise ValueError('%s must be between %g and %g, not %g' % (name, tunable.low, tunable.high, value))
+  return value
+
+
+class Settings(object):
+  # values: name -> value currently in force.  appliers: name -> fn(value),
+  # one for each name this device can change; other names in a desired
+  # update are not ours and are left alone.
+
+  def __init__(self, values, appliers, report=None):
+    self.values = dict(values)
+    self.appliers = appliers
+    self.report = report
+    self.lock = threading.Lock()
+    self.pending = collections.OrderedDict()
+    self.acks = collections.OrderedDict()
+    self.versions = {}  # name -> $version of the patch that last set it
+    self.applied = 0
+    self.rejected = 0
+    self.stale = 0
+
+  def update(self, desired, version=None):
+    # desired: {name: value} from a twin patch or a settings update; call
+    # from any thread.  version: the patch's $version, None if unversioned
+    with self.lock:
+      for name, value in desired.items():
+        if name not in self.appliers:
+          continue
+        if version is not None:
+          last = self.versions.get(name)
+          if last is not None and version <= last:
+            self.stale += 1
+            continue
+          self.versions[name] = version
+        try:
+          self.pending[name] = (check(name, value), version)
+        except ValueError as e:
+          self.pending.pop(name, None)
+          self.acks[name] = Ack(self.values[name], 400, str(e), version)
+          self.rejected += 1
+
+  def apply(self):
+    # run queued changes; returns (and reports) {name: Ack}
+    with self.lock:
+      pending, self.pending = self.pending, collections.OrderedDict()
+      acks, self.acks = self.acks, collections.OrderedDict()
+    for name, (value, version) in pending.items():
+      try:
+        self.appliers[name](value)
+      except Exception as e:
+        # a bus error or an SDK refusing an option; the old value stays and
+        # sampling goes on
+        acks[name] = Ack(self.values[name], 500, str(e), version)
+        continue
+      self.values[name] = value
+      self.applied += 1
+      acks[name] = Ack(value, 200, 'applied', version)
+    if acks and self.report is not None:
+      self.report(acks)
+    return acks
+
+  def current(self):
+    # every value in force, as acks to report after a reconnect
+    return collections.OrderedDict((name, Ack(self.values[name], 200, 'current', None))
+                                   for name in self.appliers)
+
+
+def twin_patch(acks):
+  # reported properties for a twin, in the value/ac/av/ad convention for
+  # acknowledging desired properties
+  patch = {}
+  for name, ack in acks.items():
+    patch[name] = {'value': ack.value, 'ac': ack.status, 'ad': ack.description}
+    if ack.version is not None:
+      patch[name]['av'] = ack.version
+  return patch
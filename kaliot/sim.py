@@ -0,0 +1,295 @@
+# Simulated sensors for running the kaliot code paths without hardware.
+#
+# FakeSMBus implements the part of the smbus.SMBus interface the drivers use
+# on top of a plain per-address register file, and can model the time an I2C
+# transfer takes at a given bus clock.
+
+import random
+import time
+
+from kaliot import bme280, tcs
+
+TCA9548A_ADDRESS = 0x70 # first of eight mux addresses (0x70-0x77)
+
+# Calibration of a typical BME280 (values taken from a bench unit)
+BME280_CALIBRATION = {
+  'dig_T1': 27504, 'dig_T2': 26435, 'dig_T3': -1000,
+  'dig_P1': 36477, 'dig_P2': -10685, 'dig_P3': 3024, 'dig_P4': 2855,
+  'dig_P5': 140, 'dig_P6': -7, 'dig_P7': 15500, 'dig_P8': -14600,
+  'dig_P9': 6000,
+  'dig_H1': 75, 'dig_H2': 362, 'dig_H3': 0, 'dig_H4': 313, 'dig_H5': 50,
+  'dig_H6': 30,
+}
+
+# Raw ADC values around 25C / 1006hPa / 45%RH for the calibration above
+BME280_RAW = (415148, 519888, 27000)
+
+
+def _le16(value):
+  value &= 0xFFFF
+  return [value & 0xFF, value >> 8]
+
+
+def bme280_calibration_blocks(cal=BME280_CALIBRATION):
+  # encode a calibration dict into the three EEPROM blocks at 0x88/0xA1/0xE1
+  cal1 = []
+  for name in ('dig_T1', 'dig_T2', 'dig_T3', 'dig_P1', 'dig_P2', 'dig_P3',
+               'dig_P4', 'dig_P5', 'dig_P6', 'dig_P7', 'dig_P8', 'dig_P9'):
+    cal1 += _le16(cal[name])
+  cal2 = [cal['dig_H1'] & 0xFF]
+  h4 = cal['dig_H4']
+  h5 = cal['dig_H5']
+  cal3 = _le16(cal['dig_H2']) + [
+    cal['dig_H3'] & 0xFF,
+    (h4 >> 4) & 0xFF,
+    (h4 & 0x0F) | ((h5 & 0x0F) << 4),
+    (h5 >> 4) & 0xFF,
+    cal['dig_H6'] & 0xFF,
+  ]
+  return cal1, cal2, cal3
+
+
+def bme280_data_block(pres_raw, temp_raw, hum_raw):
+  # inverse of bme280.unpack_data()
+  return [(pres_raw >> 12) & 0xFF, (pres_raw >> 4) & 0xFF, (pres_raw << 4) & 0xF0,
+          (temp_raw >> 12) & 0xFF, (temp_raw >> 4) & 0xFF, (temp_raw << 4) & 0xF0,
+          (hum_raw >> 8) & 0xFF, hum_raw & 0xFF]
+
+
+class FakeSMBus(object):
+  # Register-file backed stand-in for smbus.SMBus.  With bus_hz set, every
+  # transfer sleeps for the time it would occupy the wire (9 clocks per byte
+  # including ACK, plus address/register/restart overhead).
+  #
+  # Devices can sit behind TCA9548A muxes (add_device(..., channel=n)); they
+  # only answer while their channel is selected by writing a mask to the mux
+  # address.  Addressing a device that is not visible raises IOError, as the
+  # real driver does on a missing ACK.
+
+  def __init__(self, bus_hz=0):
+    self.registers = {}
+    self.muxed = {}   # (mux, channel, addr) -> registers
+    self.masks = {}   # mux address -> selected channel mask
+    self.visible = {}
+    self.bus_hz = bus_hz
+    self.transactions = 0
+    self.bytes = 0
+
+  def add_device(self, addr, registers=None, channel=None, mux=TCA9548A_ADDRESS):
+    registers = bytearray(256) if registers is None else registers
+    if channel is None:
+      self.registers[addr] = registers
+    else:
+      self.masks.setdefault(mux, 0)
+      self.muxed[(mux, channel, addr)] = registers
+    self._route()
+    return registers
+
+  def device(self, addr, channel=None, mux=TCA9548A_ADDRESS):
+    if channel is None:
+      return self.registers[addr]
+    return self.muxed[(mux, channel, addr)]
+
+  def _route(self):
+    visible = dict(self.registers)
+    for (mux, channel, addr), registers in self.muxed.items():
+      if self.masks[mux] & (1 << channel):
+        visible[addr] = registers
+    self.visible = visible
+
+  def _regs(self, addr):
+    try:
+      return self.visible[addr]
+    except KeyError:
+      raise IOError(121, 'Remote I/O error')
+
+  def add_bme280(self, addr=bme280.DEVICE, cal=BME280_CALIBRATION, raw=BME280_RAW,
+                 channel=None, mux=TCA9548A_ADDRESS):
+    regs = self.add_device(addr, channel=channel, mux=mux)
+    cal1, cal2, cal3 = bme280_calibration_blocks(cal)
+    regs[bme280.REG_CAL1:bme280.REG_CAL1 + 24] = bytearray(cal1)
+    regs[bme280.REG_CAL2:bme280.REG_CAL2 + 1] = bytearray(cal2)
+    regs[bme280.REG_CAL3:bme280.REG_CAL3 + 7] = bytearray(cal3)
+    regs[bme280.REG_ID] = 0x60
+    self.set_bme280_raw(addr, *raw, channel=channel, mux=mux)
+    return regs
+
+  def set_bme280_raw(self, addr, pres_raw, temp_raw, hum_raw, channel=None, mux=TCA9548A_ADDRESS):
+    self.device(addr, channel, mux)[bme280.REG_DATA:bme280.REG_DATA + 8] = \
+      bytearray(bme280_data_block(pres_raw, temp_raw, hum_raw))
+
+  def add_tcs34725(self, addr=tcs.TCS34725_ADDRESS, raw=None, channel=None, mux=TCA9548A_ADDRESS):
+    # registers as seen through the command bit; integration is not
+    # modelled, the data registers always hold raw
+    regs = self.add_device(addr, channel=channel, mux=mux)
+    regs[tcs.COMMAND_BIT | tcs.REG_ID] = tcs.TCS34725_ID[0]
+    self.set_tcs34725_raw(addr, *(TCS34725_RAW if raw is None else raw), channel=channel, mux=mux)
+    return regs
+
+  def set_tcs34725_raw(self, addr, r, g, b, c, channel=None, mux=TCA9548A_ADDRESS):
+    start = tcs.COMMAND_BIT | tcs.REG_CDATAL
+    self.device(addr, channel, mux)[start:start + 8] = bytearray(_le16(c) + _le16(r) + _le16(g) + _le16(b))
+
+  def _transfer(self, nbytes):
+    self.transactions += 1
+    self.bytes += nbytes
+    if self.bus_hz:
+      time.sleep((nbytes + 3) * 9.0 / self.bus_hz)
+
+  def write_byte(self, addr, val):
+    if addr in self.masks:
+      self._transfer(0)
+      self.masks[addr] = val & 0xFF
+      self._route()
+      return
+    self._regs(addr)
+    self._transfer(0)
+
+  def read_byte(self, addr):
+    if addr in self.masks:
+      self._transfer(0)
+      return self.masks[addr]
+    self._regs(addr)
+    self._transfer(0)
+    return 0
+
+  def write_byte_data(self, addr, cmd, val):
+    regs = self._regs(addr)
+    self._transfer(1)
+    regs[cmd] = val & 0xFF
+
+  def read_byte_data(self, addr, cmd):
+    regs = self._regs(addr)
+    self._transfer(1)
+    return regs[cmd]
+
+  def read_i2c_block_data(self, addr, cmd, length=32):
+    regs = self._regs(addr)
+    self._transfer(length)
+    return list(regs[cmd:cmd + length])
+
+  def write_i2c_block_data(self, addr, cmd, vals):
+    regs = self._regs(addr)
+    self._transfer(len(vals))
+    regs[cmd:cmd + len(vals)] = bytearray(vals)
+
+  def close(self):
+    pass
+
+
+# TCS34725 register values and integration delays as used by the Adafruit
+# driver
+TCS34725_INTEGRATIONTIME_2_4MS = 0xFF
+TCS34725_INTEGRATIONTIME_24MS = 0xF6
+TCS34725_INTEGRATIONTIME_50MS = 0xEB
+TCS34725_INTEGRATIONTIME_101MS = 0xD5
+TCS34725_INTEGRATIONTIME_154MS = 0xC0
+TCS34725_INTEGRATIONTIME_700MS = 0x00
+TCS34725_GAIN_1X = 0x00
+TCS34725_GAIN_4X = 0x01
+TCS34725_GAIN_16X = 0x02
+TCS34725_GAIN_60X = 0x03
+
+INTEGRATION_TIME_DELAY = tcs.INTEGRATION_TIME_DELAY
+
+# (r, g, b, c) of an office under fluorescent light at 4x gain / 2.4ms
+TCS34725_RAW = (310, 352, 270, 912)
+TCS34725_ADDRESS = tcs.TCS34725_ADDRESS
+# command bit | CDATAL, RDATAL, GDATAL, BDATAL
+TCS34725_DATA = (0x94, 0x96, 0x98, 0x9A)
+
+# Light model for FakeTCS34725(light=...): photons behind one count at the
+# reference 4x / 2.4 ms (shot noise does not shrink with gain, only with
+# integration time) and the ADC's own noise in counts
+PHOTONS_PER_COUNT = 4.0
+READ_NOISE = 0.5
+
+
+def tcs34725_counts(light, integration_time, gain, rng):
+  # (r, g, b, c) as the chip would return them for light in reference
+  # counts: scaled to the range, with shot and read noise, whole counts,
+  # clipped at full scale
+  cycles = 256 - integration_time
+  scale = tcs.sensitivity(integration_time, gain)
+  full = tcs.full_scale(integration_time)
+  counts = []
+  for level in light:
+    photons = max(level, 0.0) * cycles * PHOTONS_PER_COUNT
+    value = scale * level
+    if photons > 0:
+      value *= 1 + rng.gauss(0, 1 / photons ** 0.5)
+    value = int(round(value + rng.gauss(0, READ_NOISE)))
+    counts.append(min(max(value, 0), full))
+  return tuple(counts)
+
+
+class FakeTCS34725(object):
+  # Stand-in for Adafruit_TCS34725.TCS34725 with the driver's sleeps (scaled
+  # by time_scale).  raw is either a fixed (r, g, b, c) tuple or a callable
+  # returning one.  With a bus (e.g. a FakeSMBus, or one wrapped in
+  # kaliot.acquire.LockedBus) every raw read also makes the driver's four
+  # 16-bit register transfers on it.  FakeTCS34725.constructed counts chip
+  # initialisations.
+  #
+  # With light - (r, g, b, c) in counts at the reference 4x / 2.4 ms, or a
+  # callable returning that - raw is ignored and every read follows the
+  # current gain and integration time (see tcs34725_counts).  elapsed adds
+  # up the integration time of every read, whatever time_scale is.
+
+  constructed = 0
+
+  def __init__(self, integration_time=TCS34725_INTEGRATIONTIME_2_4MS,
+               gain=TCS34725_GAIN_4X, raw=TCS34725_RAW, time_scale=1.0,
+               bus=None, addr=TCS34725_ADDRESS, light=None, rng=None):
+    FakeTCS34725.constructed += 1
+    self.raw = raw
+    self.light = light
+    self.rng = random.Random(1) if rng is None else rng
+    self.elapsed = 0.0
+    self.time_scale = time_scale
+    self.bus = bus
+    self.addr = addr
+    self.reads = 0
+    self._integration_time = integration_time
+    self._gain = gain
+    self._enabled = False
+    self.enable()
+
+  def _sleep(self, seconds):
+    if self.time_scale:
+      time.sleep(seconds * self.time_scale)
+
+  def enable(self):
+    # power on, then wait for the first integration to complete
+    self._sleep(0.01)
+    self._sleep(INTEGRATION_TIME_DELAY[self._integration_time])
+    self._enabled = True
+
+  def disable(self):
+    self._enabled = False
+
+  def set_integration_time(self, integration_time):
+    self._integration_time = integration_time
+
+  def get_integration_time(self):
+    return self._integration_time
+
+  def set_gain(self, gain):
+    self._gain = gain
+
+  def get_gain(self):
+    return self._gain
+
+  def get_raw_data(self):
+    self._sleep(INTEGRATION_TIME_DELAY[self._integration_time])
+    self.elapsed += INTEGRATION_TIME_DELAY[self._integration_time]
+    self.reads += 1
+    if self.bus is not None:
+      for reg in TCS34725_DATA:
+        self.bus.read_i2c_block_data(self.addr, reg, 2)
+    if self.light is not None:
+      light = self.light() if callable(self.light) else self.light
+      return tcs34725_counts(light, self._integration_time, self._gain, self.rng)
+    if callable(self.raw):
+      return self.raw()
+    return self.raw
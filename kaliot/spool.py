@@ -0,0 +1,291 @@
+# Disk-backed store-and-forward queue.
+#
+# Every outbound payload is appended to a SQLite database in WAL mode and only
+# deleted once the transport confirms it, so readings taken while offline (or
+# before a crash/restart) are replayed later.  The queue is bounded: once the
+# stored payload bytes exceed max_bytes the oldest entries are evicted.
+#
+# Drainer replays the backlog at a limited rate with a bounded number of
+# sends in flight; it can be pumped from a main loop or run on its own thread.
+# Given a join function (kaliot.encoding.join), it sends a backlog as
+# messages of up to join_max consecutive entries instead of one message each,
+# which is what makes a backlog of single readings worth compressing.
+
+import sqlite3
+import threading
+import time
+
+from kaliot import metrics
+
+SPOOL_MAX_BYTES = 50 * 1024 * 1024
+DRAIN_RATE = 5.0    # messages per second while catching up
+DRAIN_WINDOW = 8    # sends awaiting confirmation
+MAX_ATTEMPTS = 3    # hard failures before an entry is dropped
+JOIN_MAX = 256      # entries per joined message
+JOIN_BYTES = 64 * 1024  # payload bytes per joined message, before compression
+
+
+class OutboundQueue(object):
+
+  def __init__(self, path, max_bytes=SPOOL_MAX_BYTES):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.evicted = 0
+    self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    # NORMAL only syncs at checkpoints: a power cut can lose the last few
+    # appends, but an SD card is not fsynced on every sample
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.execute('CREATE TABLE IF NOT EXISTS outbound ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, payload BLOB)')
+    self.bytes = self.db.execute(
+      'SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM outbound').fetchone()[0]
+
+  def __len__(self):
+    with self.lock:
+      return self.db.execute('SELECT COUNT(*) FROM outbound').fetchone()[0]
+
+  def append(self, payload, ts=None):
+    if not isinstance(payload, (bytes, bytearray)):
+      payload = payload.encode('utf-8')
+    if ts is None:
+      ts = time.time()
+    with self.lock:
+      entry_id = self.db.execute('INSERT INTO outbound (ts, payload) VALUES (?, ?)',
+                                 (ts, sqlite3.Binary(payload))).lastrowid
+      self.bytes += len(payload)
+      if self.bytes > self.max_bytes:
+        self._evict()
+    return entry_id
+
+  def _evict(self):
+    # drop oldest entries until back under the bound; freed pages are reused
+    # by later appends, so the file stops growing
+    while self.bytes > self.max_bytes:
+      rows = self.db.execute('SELECT id, LENGTH(payload) FROM outbound ORDER BY id LIMIT 64').fetchall()
+      if not rows:
+        self.bytes = 0
+        return
+      last = None
+      for entry_id, size in rows:
+        self.bytes -= size
+        self.evicted += 1
+        metrics.DROPPED.labels('spool_full').inc()
+        last = entry_id
+        if self.bytes <= self.max_bytes:
+          break
+      self.db.execute('DELETE FROM outbound WHERE id <= ?', (last,))
+
+  def after(self, entry_id, limit):
+    # up to limit (id, payload, ts) with id > entry_id, oldest first
+    with self.lock:
+      rows = self.db.execute('SELECT id, payload, ts FROM outbound WHERE id > ? ORDER BY id LIMIT ?',
+                             (entry_id, limit)).fetchall()
+    return [(row[0], bytes(row[1]), row[2]) for row in rows]
+
+  def ack(self, entry_id):
+    self.ack_all((entry_id,))
+
+  def ack_all(self, entry_ids):
+    # one transaction for the entries of a joined message
+    with self.lock:
+      self.db.execute('BEGIN')
+      try:
+        for entry_id in entry_ids:
+          row = self.db.execute('SELECT LENGTH(payload) FROM outbound WHERE id = ?', (entry_id,)).fetchone()
+          if row is not None:
+            self.db.execute('DELETE FROM outbound WHERE id = ?', (entry_id,))
+            self.bytes -= row[0]
+      finally:
+        self.db.execute('COMMIT')
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+
+class Drainer(object):
+  # send(entry_id, payload) starts a send; whoever gets the confirmation calls
+  # confirmed(entry_id) or failed(entry_id).  Failed entries are resent in
+  # order on a later pump; transient failures (timeouts, client teardown)
+  # always, others until max_attempts is reached, after which the entry is
+  # dropped from the spool.  full() is true while window sends are
+  # unconfirmed, for the sampler to back off on.
+  #
+  # With join(payloads) -> (payload, n), entries waiting together go out
+  # joined, as one send under the id of the first of them, and its
+  # confirmation acks them all.  A joined send that fails hard is retried
+  # an entry at a time, so one entry the hub refuses cannot take the rest of
+  # the backlog with it.
+
+  def __init__(self, queue, send, rate=DRAIN_RATE, window=DRAIN_WINDOW,
+               connected=lambda: True, clock=time.time, burst=None,
+               max_attempts=MAX_ATTEMPTS, join=None, join_max=JOIN_MAX,
+               join_bytes=JOIN_BYTES):
+    self.queue = queue
+    self.send = send
+    self.rate = rate
+    # sends allowed in one pump after an idle spell; pumping less often than
+    # once a second needs a burst of rate * interval to reach rate
+    self.burst = max(rate, 1.0) if burst is None else burst
+    self.window = window
+    self.max_attempts = max_attempts
+    self.join = join
+    self.join_max = join_max
+    self.join_bytes = join_bytes
+    self.connected = connected
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.inflight = {}  # entry id -> when it was sent
+    self.joined = {}    # entry id of a joined send -> the ids it carries
+    self.single = set() # entry ids not to be joined again
+    self.attempts = {}  # entry id -> hard failures so far
+    self.cursor = 0
+    self.tokens = 1.0
+    self.last = clock()
+    self.sent = 0
+    self.entries = 0
+    self.retried = 0
+    self.dropped = 0
+    self._stop = threading.Event()
+    self._thread = None
+
+  def _retire(self, entry_id, result):
+    sent = self.inflight.pop(entry_id, None)
+    if sent is not None:
+      metrics.SEND_LATENCY.labels(result).observe(self.clock() - sent)
+
+  def confirmed(self, entry_id):
+    with self.lock:
+      self._retire(entry_id, 'OK')
+      entry_ids = self.joined.pop(entry_id, (entry_id,))
+      for carried in entry_ids:
+        self.attempts.pop(carried, None)
+        self.single.discard(carried)
+    metrics.CONFIRMED.inc()
+    self.queue.ack_all(entry_ids)
+
+  def failed(self, entry_id, result='failed', transient=False):
+    with self.lock:
+      self._retire(entry_id, result)
+      entry_ids = self.joined.pop(entry_id, None)
+      drop = False
+      if entry_ids is not None:
+        if not transient:
+          self.single.update(entry_ids)
+      elif not transient:
+        attempts = self.attempts[entry_id] = self.attempts.get(entry_id, 0) + 1
+        drop = attempts >= self.max_attempts
+      if drop:
+        del self.attempts[entry_id]
+        self.single.discard(entry_id)
+        self.dropped += 1
+        metrics.DROPPED.labels('send_failed').inc()
+      else:
+        self.retried += 1
+        metrics.RETRIES.inc()
+        # rewind so this entry goes out again before anything newer
+        self.cursor = min(self.cursor, entry_id - 1)
+    if drop:
+      self.queue.ack(entry_id)
+
+  def full(self):
+    return len(self.inflight) >= self.window
+
+  def reset(self):
+    # forget sends that will never be confirmed (e.g. after a reconnect) so
+    # they go out again
+    with self.lock:
+      metrics.TIMEOUTS.inc(len(self.inflight))
+      self.inflight.clear()
+      self.joined.clear()
+      self.cursor = 0
+
+  def _messages(self, entries, room):
+    # up to room (entry id, entry ids, payload, ts) from entries, joining
+    # runs of them when there is a join function
+    messages = []
+    i = 0
+    while i < len(entries) and len(messages) < room:
+      entry_id, payload, ts = entries[i]
+      n = 1
+      if self.join is not None and entry_id not in self.single:
+        size = len(payload)
+        end = i + 1
+        while (end < len(entries) and end - i < self.join_max and entries[end][0] not in self.single
+               and size + len(entries[end][1]) <= self.join_bytes):
+          size += len(entries[end][1])
+          end += 1
+        if end - i > 1:
+          payload, n = self.join([e[1] for e in entries[i:end]])
+      messages.append((entry_id, [e[0] for e in entries[i:i + n]], payload, ts))
+      i += n
+    return messages
+
+  def pump(self):
+    # send whatever the rate budget and in-flight window allow; never blocks.
+    # A send() that raises is retried on a later pump and the exception
+    # passed on to the caller
+    now = self.clock()
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+    metrics.SPOOL_BYTES.set(self.queue.bytes)
+    if not self.connected():
+      return 0
+    with self.lock:
+      room = min(int(self.tokens), self.window - len(self.inflight))
+      if room <= 0:
+        return 0
+      busy = set(self.inflight)
+      for carried in self.joined.values():
+        busy.update(carried)
+      per = 1 if self.join is None else self.join_max
+      entries = [e for e in self.queue.after(self.cursor, room * per + len(busy))
+                 if e[0] not in busy]
+      messages = self._messages(entries, room)
+      for entry_id, entry_ids, _, _ in messages:
+        self.inflight[entry_id] = now
+        if len(entry_ids) > 1:
+          self.joined[entry_id] = entry_ids
+      if messages:
+        self.cursor = max(self.cursor, messages[-1][1][-1])
+      metrics.INFLIGHT.set(len(self.inflight))
+    for i, (entry_id, entry_ids, payload, ts) in enumerate(messages):
+      try:
+        self.send(entry_id, payload)
+      except Exception:
+        # e.g. a client being torn down: this send goes out again, and the
+        # ones after it were never made, so they leave the window too
+        self._unsend(messages[i + 1:])
+        self.failed(entry_id, 'error', transient=True)
+        raise
+      self.tokens -= 1
+      self.sent += 1
+      self.entries += len(entry_ids)
+      metrics.SENT.inc()
+      metrics.SPOOL_WAIT.observe(now - ts)
+    return len(messages)
+
+  def _unsend(self, messages):
+    if not messages:
+      return
+    with self.lock:
+      for entry_id, _, _, _ in messages:
+        self.inflight.pop(entry_id, None)
+        self.joined.pop(entry_id, None)
+      self.cursor = min(self.cursor, messages[0][0] - 1)
+      metrics.INFLIGHT.set(len(self.inflight))
+
+  def start(self, interval=0.2):
+    def run():
+      while not self._stop.wait(interval):
+        self.pump()
+    self._thread = threading.Thread(target=run, name='kaliot-drainer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
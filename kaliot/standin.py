@@ -0,0 +1,297 @@
+# Local stand-in for the IoT Hub / IoT Central MQTT endpoint.
+#
+# LocalBroker counts what would go over the wire (payload plus MQTT PUBLISH
+# framing and the QoS 1 PUBACK); StandInClient and StandInDevice look enough
+# like iothub_client.IoTHubClient and iotc.Device for the kaliot send paths to
+# run against it.  set_online(False) drops every connected StandInDevice and
+# refuses new ones, and connect_rate throttles connects per second as the
+# hub does, for simulating outages and reconnect storms.
+
+import time
+
+try:
+  from urllib import quote
+except ImportError:
+  from urllib.parse import quote
+
+PUBACK_SIZE = 4
+
+# confirmation results, named as in IoTHubClientConfirmationResult
+OK = 'OK'
+
+
+def _varint_len(value):
+  n = 1
+  while value > 127:
+    value >>= 7
+    n += 1
+  return n
+
+
+def mqtt_publish_size(topic, payload_len, qos=1):
+  remaining = 2 + len(topic) + (2 if qos else 0) + payload_len
+  return 1 + _varint_len(remaining) + remaining
+
+
+def event_topic(device_id, properties=None):
+  # devices/{id}/messages/events/{url-encoded properties}
+  topic = 'devices/%s/messages/events/' % device_id
+  if properties:
+    topic += '&'.join('%s=%s' % (quote(k, ''), quote(str(v), ''))
+                      for k, v in sorted(properties.items()))
+  return topic
+
+
+class LocalBroker(object):
+
+  def __init__(self, clock=time.time, connect_rate=None):
+    self.clock = clock
+    self.started = clock()
+    self.messages = 0
+    self.payload_bytes = 0
+    self.wire_bytes = 0
+    self.online = True
+    self.connect_rate = connect_rate  # connects accepted per second, None for no limit
+    self.sessions = set()
+    self.connect_attempts = 0
+    self.refused = 0
+    self._second = None
+    self._accepted = 0
+
+  def connect(self, device):
+    # True if the session is accepted
+    self.connect_attempts += 1
+    if self.online and self.connect_rate is not None:
+      second = int(self.clock())
+      if second != self._second:
+        self._second = second
+        self._accepted = 0
+      if self._accepted >= self.connect_rate:
+        self.refused += 1
+        return False
+      self._accepted += 1
+    if not self.online:
+      self.refused += 1
+      return False
+    self.sessions.add(device)
+    return True
+
+  def disconnect(self, device):
+    self.sessions.discard(device)
+
+  def set_online(self, online):
+    self.online = online
+    if not online:
+      sessions, self.sessions = self.sessions, set()
+      for device in sessions:
+        device.drop()
+
+  def publish(self, device_id, payload, properties=None):
+    topic = event_topic(device_id, properties)
+    self.messages += 1
+    self.payload_bytes += len(payload)
+    self.wire_bytes += mqtt_publish_size(topic, len(payload)) + PUBACK_SIZE
+    return OK
+
+  def stats(self, elapsed=None):
+    if elapsed is None:
+      elapsed = self.clock() - self.started
+    hours = elapsed / 3600.0 if elapsed else 0
+    return {
+      'messages': self.messages,
+      'payload_bytes': self.payload_bytes,
+      'wire_bytes': self.wire_bytes,
+      'messages_per_hour': self.messages / hours if hours else 0.0,
+      'wire_bytes_per_hour': self.wire_bytes / hours if hours else 0.0,
+    }
+
+
+class _PropertyMap(object):
+
+  def __init__(self):
+    self._map = {}
+
+  def add(self, key, value):
+    self._map[key] = value
+
+  def get_internals(self):
+    return dict(self._map)
+
+
+class StandInMessage(object):
+  # the IoTHubMessage surface used by kaliot
+
+  def __init__(self, payload):
+    if not isinstance(payload, (bytes, bytearray)):
+      payload = payload.encode('utf-8')
+    self._payload = bytearray(payload)
+    self._properties = _PropertyMap()
+    self.message_id = None
+    self.correlation_id = None
+    self.content_type = None
+    self.content_encoding = None
+
+  def get_bytearray(self):
+    return self._payload
+
+  def get_string(self):
+    return self._payload.decode('utf-8')
+
+  def properties(self):
+    return self._properties
+
+
+class StandInClient(object):
+  # IoTHubClient look-alike; confirmations are delivered synchronously.
+  # receive() and invoke() play the hub sending a cloud-to-device message or
+  # calling a direct method, on the caller's thread as the SDK's own thread
+  # would; method responses land in responses.
+
+  def __init__(self, broker, device_id='kaliot-standin', protocol='MQTT'):
+    self.broker = broker
+    self.device_id = device_id
+    self.protocol = protocol
+    self.options = {}
+    self.responses = {}  # method id -> (status, response, when)
+    self._message = None
+    self._method = None
+    self._method_ex = None
+    self._method_ids = 0
+
+  def set_option(self, name, value):
+    self.options[name] = value
+
+  def set_message_callback(self, callback, context):
+    self._message = (callback, context)
+
+  def set_device_method_callback(self, callback, context):
+    self._method = (callback, context)
+
+  def set_device_method_callback_ex(self, callback, context):
+    self._method_ex = callback
+
+  def device_method_response(self, method_id, response, size, status):
+    self.responses[method_id] = (status, response, self.broker.clock())
+
+  def receive(self, payload, properties=None):
+    # the disposition the callback returned
+    message = StandInMessage(payload)
+    for key, value in (properties or {}).items():
+      message.properties().add(key, value)
+    callback, context = self._message
+    return callback(message, context)
+
+  def invoke(self, method_name, payload):
+    # the method id; the response is in responses once given
+    self._method_ids += 1
+    method_id = self._method_ids
+    if self._method_ex is not None:
+      self._method_ex(method_name, payload, method_id)
+    else:
+      callback, context = self._method
+      value = callback(method_name, payload, context)
+      self.device_method_response(method_id, value.response, len(value.response), value.status)
+    return method_id
+
+  def _wire_properties(self, message):
+    properties = message.properties().get_internals()
+    if message.content_type:
+      properties['$.ct'] = message.content_type
+    if message.content_encoding:
+      properties['$.ce'] = message.content_encoding
+    return properties
+
+  def send_event_async(self, message, callback, user_context):
+    result = self.broker.publish(self.device_id, bytes(message.get_bytearray()),
+                                 self._wire_properties(message))
+    if callback is not None:
+      callback(message, result, user_context)
+
+  def get_send_status(self):
+    return 'IDLE'
+
+
+class _Info(object):
+  # the callback argument iotc hands to on(...) handlers
+
+  def __init__(self, tag=None, payload=None, status=0):
+    self._tag = tag
+    self._payload = payload
+    self._status = status
+    self.response = None
+
+  def getTag(self):
+    return self._tag
+
+  def getPayload(self):
+    return self._payload
+
+  def getStatusCode(self):
+    return self._status
+
+  def setResponse(self, status, message):
+    self.response = (status, message)
+
+
+class StandInDevice(object):
+  # iotc.Device look-alike; MessageSent fires from doNext() like the real one
+
+  def __init__(self, broker, device_id='kaliot-standin'):
+    self.broker = broker
+    self.device_id = device_id
+    self.handlers = {}
+    self.connected = False
+    self._sent = []
+    self.reported = []
+
+  def on(self, event, handler):
+    self.handlers[event] = handler
+
+  def _fire(self, event, info):
+    handler = self.handlers.get(event)
+    if handler is not None:
+      handler(info)
+
+  def setLogLevel(self, level):
+    pass
+
+  def connect(self):
+    if self.broker.connect(self):
+      self.connected = True
+      self._fire('ConnectionStatus', _Info(status=0))
+    else:
+      self._fire('ConnectionStatus', _Info(status=1))
+
+  def disconnect(self):
+    self.broker.disconnect(self)
+    self.connected = False
+    self._fire('ConnectionStatus', _Info(status=1))
+
+  def drop(self):
+    # the link went away: anything not yet confirmed is lost
+    self.connected = False
+    self._sent = []
+    self._fire('ConnectionStatus', _Info(status=1))
+
+  def isConnected(self):
+    return self.connected
+
+  def sendTelemetry(self, data, properties=None):
+    if not self.connected:
+      return 1
+    if not isinstance(data, (bytes, bytearray)):
+      data = data.encode('utf-8')
+    self.broker.publish(self.device_id, data, properties)
+    self._sent.append(data)
+    return 0
+
+  def sendProperty(self, data):
+    if not self.connected:
+      return 1
+    self.reported.append(data)
+    return 0
+
+  def doNext(self):
+    sent, self._sent = self._sent, []
+    for data in sent:
+      self._fire('MessageSent', _Info(payload=data))
@@ -0,0 +1,353 @@
+### TCS34725 - Light Quality
+#
+# Long-lived colour sampler: the chip is probed and enabled once, then a
+# window of raw reads is taken back-to-back (each read already waits one
+# integration period inside the driver) and averaged with a streaming
+# accumulator.
+#
+# With auto_range, a LightMeter picks gain and integration time from the
+# clear channel instead: short and insensitive in daylight so nothing
+# saturates, long and sensitive in the dark so there are counts to average.
+# Frames are rescaled to the default 4x / 2.4 ms, so readings keep their
+# meaning across ranges, and the window ends as soon as the 95% confidence
+# interval of the clear mean is within TOLERANCE (or WINDOW_BUDGET seconds
+# of integration are used up) rather than after a fixed count.
+
+import math
+import time
+
+from kaliot import metrics
+
+try:
+  from Adafruit_TCS34725 import calculate_lux, calculate_color_temperature
+except ImportError:
+  # same formulas as the Adafruit driver, for running without it installed
+  def calculate_color_temperature(r, g, b):
+    X = (-0.14282 * r) + (1.54924 * g) + (-0.95641 * b)
+    Y = (-0.32466 * r) + (1.57837 * g) + (-0.73191 * b)
+    Z = (-0.68202 * r) + (0.77073 * g) + ( 0.56332 * b)
+    if (X + Y + Z) == 0:
+      return None
+    xc = (X) / (X + Y + Z)
+    yc = (Y) / (X + Y + Z)
+    if (0.1858 - yc) == 0:
+      return None
+    n = (xc - 0.3320) / (0.1858 - yc)
+    cct = (449.0 * (n ** 3.0)) + (3525.0 *(n ** 2.0)) + (6823.3 * n) + 5520.33
+    return int(cct)
+
+  def calculate_lux(r, g, b):
+    illuminance = (-0.32466 * r) + (1.57837 * g) + (-0.73191 * b)
+    return int(illuminance)
+
+SAMPLES = 130 # raw reads averaged per light reading
+
+TCS34725_ADDRESS = 0x29
+TCS34725_ID = (0x44, 0x4D) # TCS34721/5, TCS34723/7
+
+# Registers, addressed with the command bit set (auto-increment for bursts)
+COMMAND_BIT = 0x80
+REG_ENABLE = 0x00
+REG_ATIME = 0x01
+REG_CONTROL = 0x0F
+REG_ID = 0x12
+REG_CDATAL = 0x14 # clear, red, green, blue as four little-endian words
+ENABLE_PON = 0x01
+ENABLE_AEN = 0x02
+
+INTEGRATIONTIME_2_4MS = 0xFF
+GAIN_1X = 0x00
+GAIN_4X = 0x01
+GAIN_16X = 0x02
+GAIN_60X = 0x03
+GAIN_FACTOR = {GAIN_1X: 1, GAIN_4X: 4, GAIN_16X: 16, GAIN_60X: 60}
+
+# ATIME register value -> seconds per integration, as used by the Adafruit
+# driver
+INTEGRATION_TIME_DELAY = {
+  0xFF: 0.0024,
+  0xF6: 0.024,
+  0xEB: 0.050,
+  0xD5: 0.101,
+  0xC0: 0.154,
+  0x00: 0.700,
+}
+
+# Auto-ranging.  Every (integration time, gain) pair, fastest first and the
+# highest gain first within a time; LightMeter takes the first that puts the
+# clear count between RANGE_LOW and RANGE_HIGH of full scale.
+RANGES = sorted([(atime, gain) for atime in INTEGRATION_TIME_DELAY for gain in GAIN_FACTOR],
+                key=lambda r: (INTEGRATION_TIME_DELAY[r[0]], -GAIN_FACTOR[r[1]]))
+RANGE_LOW = 0.1
+RANGE_HIGH = 0.75
+TOLERANCE = 0.01      # relative half-width of the 95% CI of the clear mean
+CONFIDENCE_Z = 1.96
+DARK_FLOOR = 0.05     # absolute half-width (reference counts) good enough in the dark
+MIN_SAMPLES = 4       # frames before the CI is trusted
+WINDOW_BUDGET = 1.0   # seconds of integration per light reading
+
+
+def full_scale(integration_time):
+  # 1024 counts per 2.4 ms cycle, at most 16 bits
+  return min(0xFFFF, 1024 * (256 - integration_time))
+
+
+def sensitivity(integration_time, gain):
+  # counts per count at the reference 4x / 2.4 ms
+  return (256 - integration_time) * GAIN_FACTOR[gain] / 4.0
+
+
+def light_reading(r, g, b, c):
+  # (r, g, b, c) averages -> the (r, g, b, c, lux, color_temp) tuple we report
+  r = float(r)
+  g = float(g)
+  b = float(b)
+  c = float(c)
+  lux = float(calculate_lux(r, g, b))
+  color_temp = calculate_color_temperature(r, g, b)
+  if color_temp is None:
+    color_temp = 0
+  color_temp = float(color_temp)
+  return r,g,b,c,lux,color_temp
+
+
+class ColorAccumulator(object):
+  # running r/g/b/c totals for one window
+
+  __slots__ = ('r', 'g', 'b', 'c', 'count')
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.r = self.g = self.b = self.c = 0
+    self.count = 0
+
+  def add(self, r, g, b, c):
+    self.r += r
+    self.g += g
+    self.b += b
+    self.c += c
+    self.count += 1
+
+  def mean(self):
+    n = self.count
+    return self.r/n, self.g/n, self.b/n, self.c/n
+
+
+class LightMeter(object):
+  # One chip's window with auto-ranging and early stop: reset(), add() each
+  # raw frame until done(samples), then mean() in reference counts.  The
+  # range carries over from one window to the next; a frame taken while a
+  # new range settles is dropped, as is the one that made the meter change
+  # range.  saturated is set when a frame clipped even at the least
+  # sensitive range (direct sun); the reading is then a lower bound.  A
+  # window whose budget runs out before a frame could be kept (the range
+  # still moving) ends all the same, on the last frame taken.
+
+  def __init__(self, tcs, tolerance=TOLERANCE, budget=WINDOW_BUDGET, min_samples=MIN_SAMPLES,
+               low=RANGE_LOW, high=RANGE_HIGH):
+    self.tcs = tcs
+    self.tolerance = tolerance
+    self.budget = budget
+    self.min_samples = min_samples
+    self.low = low
+    self.high = high
+    self.window = ColorAccumulator()
+    self.adjustments = 0
+    self._use(tcs.get_integration_time(), tcs.get_gain())
+    self.settle = 0
+    self.reset()
+
+  def _use(self, integration_time, gain):
+    self.integration_time = integration_time
+    self.gain = gain
+    self.scale = 1.0 / sensitivity(integration_time, gain)
+    self.full = full_scale(integration_time)
+    self.delay = INTEGRATION_TIME_DELAY[integration_time]
+
+  def reset(self):
+    self.window.reset()
+    self.mean_clear = 0.0
+    self.m2 = 0.0
+    self.elapsed = 0.0
+    self.saturated = False
+    self.last = None
+    self.last_clipped = False
+
+  @property
+  def count(self):
+    return self.window.count
+
+  def choose(self, clear):
+    # the range for a clear count (reference counts): the first in RANGES in
+    # band, else the most sensitive that does not saturate, else the least
+    # sensitive of all
+    best = None
+    for integration_time, gain in RANGES:
+      expected = clear * sensitivity(integration_time, gain)
+      full = full_scale(integration_time)
+      if expected > self.high * full:
+        continue
+      if expected >= self.low * full:
+        return integration_time, gain
+      if best is None or sensitivity(integration_time, gain) > sensitivity(*best):
+        best = integration_time, gain
+    if best is None:
+      best = min(RANGES, key=lambda r: sensitivity(*r))
+    return best
+
+  def add(self, r, g, b, c):
+    self.elapsed += self.delay
+    if self.settle:
+      self.settle -= 1
+      return
+    clipped = max(r, g, b, c) >= self.full
+    scale = self.scale
+    self.last = (r * scale, g * scale, b * scale, c * scale)
+    self.last_clipped = clipped
+    if clipped or not self.low * self.full <= c <= self.high * self.full:
+      target = self.choose(c * self.scale)
+      if target != (self.integration_time, self.gain):
+        if target[0] != self.integration_time:
+          self.tcs.set_integration_time(target[0])
+        if target[1] != self.gain:
+          self.tcs.set_gain(target[1])
+        # the frame that showed the range was wrong is dropped: clipped, or
+        # too few counts to be worth averaging with the better ones
+        self._use(*target)
+        self.settle = 1
+        self.adjustments += 1
+        return
+      self.saturated = self.saturated or clipped
+    self._accumulate(*self.last)
+
+  def _accumulate(self, r, g, b, c):
+    # Welford on the clear channel, for the confidence interval
+    self.window.add(r, g, b, c)
+    delta = c - self.mean_clear
+    self.mean_clear += delta / self.window.count
+    self.m2 += delta * (c - self.mean_clear)
+
+  def done(self, samples):
+    n = self.window.count
+    if n >= samples:
+      return True
+    if self.elapsed >= self.budget:
+      if not n and self.last is not None:
+        self.saturated = self.last_clipped
+      return n > 0 or self.last is not None
+    if n < self.min_samples:
+      return False
+    half = CONFIDENCE_Z * math.sqrt(self.m2 / (n - 1) / n)
+    return half <= max(self.tolerance * self.mean_clear, DARK_FLOOR)
+
+  def mean(self):
+    if not self.window.count and self.last is not None:
+      return self.last
+    return self.window.mean()
+
+
+class ColorSampler(object):
+  # tcs is anything with the Adafruit_TCS34725.TCS34725 interface; by default
+  # one is created (and the chip enabled) here and kept for the process, on
+  # the i2c provider given (see kaliot.acquire.LockedI2C) if any.  samples
+  # is the window length, or with auto_range the most frames a window may
+  # take; saturated tells whether the last reading clipped.
+
+  def __init__(self, tcs=None, samples=SAMPLES, i2c=None, auto_range=False):
+    if tcs is None:
+      import Adafruit_TCS34725
+      tcs = Adafruit_TCS34725.TCS34725(i2c=i2c)
+    self.tcs = tcs
+    self.samples = samples
+    self.window = ColorAccumulator()
+    self.meter = LightMeter(tcs) if auto_range else None
+    self.saturated = False
+
+  def read(self):
+    if self.meter is not None:
+      return self._read_ranged()
+    window = self.window
+    window.reset()
+    get_raw_data = self.tcs.get_raw_data
+    top = 0
+    for _ in range(self.samples):
+      r, g, b, c = get_raw_data()
+      window.add(r, g, b, c)
+      top = max(top, r, g, b, c)
+    # the range is fixed, so a clipped frame stays in the mean
+    self.saturated = top >= full_scale(self.tcs.get_integration_time())
+    if self.saturated:
+      metrics.SATURATED.labels('tcs34725').inc()
+    return light_reading(*window.mean())
+
+  def _read_ranged(self):
+    meter = self.meter
+    meter.reset()
+    get_raw_data = self.tcs.get_raw_data
+    while not meter.done(self.samples):
+      r, g, b, c = get_raw_data()
+      meter.add(r, g, b, c)
+    self.saturated = meter.saturated
+    if meter.saturated:
+      metrics.SATURATED.labels('tcs34725').inc()
+    return light_reading(*meter.mean())
+
+  def close(self):
+    self.tcs.disable()
+
+
+class TCS34725(object):
+  # Minimal driver on an smbus.SMBus-style bus, with the same interface as
+  # Adafruit_TCS34725.TCS34725.  Used where the bus has to be shared with
+  # other devices (locks, mux channels); a raw read is one 8-byte burst
+  # instead of four word reads.
+
+  def __init__(self, bus, addr=TCS34725_ADDRESS,
+               integration_time=INTEGRATIONTIME_2_4MS, gain=GAIN_4X):
+    self.bus = bus
+    self.addr = addr
+    chip_id = bus.read_byte_data(addr, COMMAND_BIT | REG_ID)
+    if chip_id not in TCS34725_ID:
+      raise RuntimeError('Failed to read TCS34725 chip ID, check your wiring.')
+    self.set_integration_time(integration_time)
+    self.set_gain(gain)
+    self.enable()
+
+  def enable(self):
+    self.bus.write_byte_data(self.addr, COMMAND_BIT | REG_ENABLE, ENABLE_PON)
+    time.sleep(0.01)
+    self.bus.write_byte_data(self.addr, COMMAND_BIT | REG_ENABLE, ENABLE_PON | ENABLE_AEN)
+    time.sleep(self.delay)
+
+  def disable(self):
+    self.bus.write_byte_data(self.addr, COMMAND_BIT | REG_ENABLE, 0)
+
+  def set_integration_time(self, integration_time):
+    self._integration_time = integration_time
+    self.delay = INTEGRATION_TIME_DELAY[integration_time]
+    self.bus.write_byte_data(self.addr, COMMAND_BIT | REG_ATIME, integration_time)
+
+  def get_integration_time(self):
+    return self._integration_time
+
+  def set_gain(self, gain):
+    self._gain = gain
+    self.bus.write_byte_data(self.addr, COMMAND_BIT | REG_CONTROL, gain)
+
+  def get_gain(self):
+    return self._gain
+
+  def read_raw(self):
+    # latest completed integration as (r, g, b, c), without waiting
+    data = self.bus.read_i2c_block_data(self.addr, COMMAND_BIT | REG_CDATAL, 8)
+    c = data[0] | data[1] << 8
+    r = data[2] | data[3] << 8
+    g = data[4] | data[5] << 8
+    b = data[6] | data[7] << 8
+    return r, g, b, c
+
+  def get_raw_data(self):
+    time.sleep(self.delay)
+    return self.read_raw()
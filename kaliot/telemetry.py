@@ -0,0 +1,18 @@
+# One sample of every channel we report, plus its capture time.
+
+import time
+from collections import namedtuple
+
+# JSON field names, in the order the iotc payload has always used
+FIELDS = ('airtemperature', 'airpressure', 'airhumidity', 'lux', 'colortemp',
+          'green', 'blue', 'clear', 'red')
+
+Reading = namedtuple('Reading', ('ts',) + FIELDS)
+
+
+def make_reading(airtemp, airpressure, airhumidity, r, g, b, c, lux, color_temp, ts=None):
+  # argument order follows readBME280All() + readTCSAll()
+  if ts is None:
+    ts = time.time()
+  return Reading(ts, airtemp, airpressure, airhumidity, lux, color_temp, g, b, c, r)
+
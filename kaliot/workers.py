@@ -0,0 +1,150 @@
+# Bounded worker pool for work that arrives on SDK callback threads.
+#
+# The SDK delivers cloud-to-device messages, direct methods and twin updates
+# on the thread that also services the connection and delivers send
+# confirmations, so whatever a callback does there holds all of that up.
+# Callbacks copy out what they need and submit() it here instead; `workers`
+# threads run the handlers, oldest first.  At most `size` jobs wait.  When
+# the queue is full the job's policy decides:
+#   REJECT       submit() returns False; the callback refuses the work to the
+#                cloud (abandon the message, answer the method 503)
+#   DROP_OLDEST  the oldest waiting job is dropped, its on_drop() called, and
+#                the new one queued
+#   CALLER_RUNS  the job runs on the submitting thread, for work that must not
+#                be lost (twin patches)
+
+import collections
+import logging
+import threading
+import time
+
+from kaliot import metrics
+
+WORKERS = 2
+QUEUE_SIZE = 32
+
+REJECT = 'reject'
+DROP_OLDEST = 'drop_oldest'
+CALLER_RUNS = 'caller_runs'
+POLICIES = (REJECT, DROP_OLDEST, CALLER_RUNS)
+
+log = logging.getLogger('kaliot.workers')
+
+Job = collections.namedtuple('Job', 'kind fn args on_drop queued')
+
+
+class WorkerPool(object):
+
+  def __init__(self, workers=WORKERS, size=QUEUE_SIZE, policy=REJECT, clock=time.time,
+               name='kaliot-worker'):
+    if policy not in POLICIES:
+      raise ValueError('policy must be one of %s' % ', '.join(POLICIES))
+    self.workers = workers
+    self.size = size
+    self.policy = policy
+    self.clock = clock
+    self.name = name
+    self.lock = threading.Lock()
+    self.ready = threading.Condition(self.lock)
+    self.idle = threading.Condition(self.lock)
+    self.jobs = collections.deque()
+    self.busy = 0
+    self.done = 0
+    self.errors = 0
+    self.rejected = 0
+    self.dropped = 0
+    self.inline = 0
+    self.last_error = None  # (kind, exception) of the last handler that raised
+    self._stopping = False
+    self._threads = []
+
+  def __len__(self):
+    return len(self.jobs)
+
+  def start(self):
+    for n in range(self.workers):
+      thread = threading.Thread(target=self._work, name='%s-%d' % (self.name, n))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def submit(self, kind, fn, *args, on_drop=None, policy=None):
+    # True once the job is queued (or, CALLER_RUNS, has run); kind labels the
+    # metrics
+    job = Job(kind, fn, args, on_drop, self.clock())
+    policy = policy or self.policy
+    dropped = None
+    with self.lock:
+      if len(self.jobs) < self.size and not self._stopping:
+        self.jobs.append(job)
+        self.ready.notify()
+        return True
+      if policy == REJECT or self._stopping:
+        self.rejected += 1
+        metrics.COMMANDS.labels(kind, 'rejected').inc()
+        return False
+      if policy == DROP_OLDEST and self.jobs:
+        dropped = self.jobs.popleft()
+        self.jobs.append(job)
+        self.dropped += 1
+      else:
+        self.inline += 1
+    if dropped is not None:
+      metrics.COMMANDS.labels(dropped.kind, 'dropped').inc()
+      if dropped.on_drop is not None:
+        dropped.on_drop()
+      return True
+    metrics.COMMANDS.labels(kind, 'inline').inc()
+    self._run(job)
+    return True
+
+  def _run(self, job):
+    metrics.COMMAND_WAIT.labels(job.kind).observe(self.clock() - job.queued)
+    try:
+      with metrics.COMMAND_TIME.labels(job.kind).time():
+        job.fn(*job.args)
+      result = 'ok'
+    except Exception as e:
+      # one bad command must not take a worker with it
+      result = 'error'
+      self.last_error = (job.kind, e)
+      log.exception("%s job failed", job.kind)
+    metrics.COMMANDS.labels(job.kind, result).inc()
+    with self.lock:
+      self.done += 1
+      self.errors += result == 'error'
+
+  def _work(self):
+    while True:
+      with self.lock:
+        while not self.jobs and not self._stopping:
+          self.ready.wait()
+        if not self.jobs:
+          return
+        job = self.jobs.popleft()
+        self.busy += 1
+      self._run(job)
+      with self.lock:
+        self.busy -= 1
+        if not self.jobs and not self.busy:
+          self.idle.notify_all()
+
+  def join(self, timeout=None):
+    # wait until every queued job has run; False on timeout
+    deadline = None if timeout is None else time.time() + timeout
+    with self.lock:
+      while self.jobs or self.busy:
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          return False
+        self.idle.wait(remaining)
+    return True
+
+  def stop(self, wait=True):
+    # runs what is queued, refuses anything new
+    with self.lock:
+      self._stopping = True
+      self.ready.notify_all()
+    if wait:
+      for thread in self._threads:
+        thread.join()
@@ -0,0 +1,31 @@
+# the tests import kaliot from the checkout, as the bench scripts do
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kaliot import bme280
+
+
+class FakeClock(object):
+  # a clock= callable that only moves when a test sets or advances now
+
+  def __init__(self, now=1000.0):
+    self.now = now
+
+  def __call__(self):
+    return self.now
+
+
+@pytest.fixture
+def clock():
+  return FakeClock()
+
+
+@pytest.fixture
+def no_wait(monkeypatch):
+  # BME280 conversion waits, for tests that drive the driver on a fake bus
+  monkeypatch.setattr(bme280.time, 'sleep', lambda seconds: None)
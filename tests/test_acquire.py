@@ -0,0 +1,117 @@
+import threading
+
+import pytest
+
+from kaliot import bme280, tcs
+from kaliot.acquire import Acquisition, LockedBus, bus_lock
+from kaliot.sim import FakeSMBus
+
+
+class CheckedSMBus(FakeSMBus):
+  # FakeSMBus that records how many transfers were on the wire at once
+
+  def __init__(self, bus_hz=0):
+    FakeSMBus.__init__(self, bus_hz)
+    self.active = 0
+    self.overlaps = 0
+    self.count_lock = threading.Lock()
+
+  def _transfer(self, nbytes):
+    with self.count_lock:
+      self.active += 1
+      if self.active > 1:
+        self.overlaps += 1
+    try:
+      FakeSMBus._transfer(self, nbytes)
+    finally:
+      with self.count_lock:
+        self.active -= 1
+
+
+class Holding(object):
+  # a lock that says whether it is held when a transfer runs
+
+  def __init__(self):
+    self.held = False
+    self.taken = 0
+
+  def __enter__(self):
+    self.held = True
+    self.taken += 1
+
+  def __exit__(self, *exc):
+    self.held = False
+
+
+def test_bus_lock_is_one_per_bus():
+  assert bus_lock(1) is bus_lock(1)
+  assert bus_lock(1) is not bus_lock(2)
+  # reentrant: a driver holding the bus can call through another handle
+  with bus_lock(1):
+    with bus_lock(1):
+      pass
+
+
+def test_locked_bus_holds_lock_for_every_call():
+  lock = Holding()
+  fake = FakeSMBus()
+  fake.add_device(0x29)
+  seen = []
+  read = fake.read_byte_data
+  def checked(addr, cmd):
+    seen.append(lock.held)
+    return read(addr, cmd)
+  fake.read_byte_data = checked
+  bus = LockedBus(fake, lock)
+  bus.write_byte_data(0x29, 0x80, 0x03)
+  assert bus.read_byte_data(0x29, 0x80) == 0x03
+  assert seen == [True] and lock.taken == 2 and not lock.held
+  # attributes pass through, methods are wrapped once
+  assert bus.transactions == 2
+  assert bus.read_byte_data is bus.read_byte_data
+
+
+def test_locked_bus_releases_on_error():
+  lock = threading.RLock()
+  bus = LockedBus(FakeSMBus(), lock)
+  with pytest.raises(IOError):
+    bus.read_byte_data(0x29, 0x80)
+  # from another thread, so the RLock's reentrancy cannot hide a leak
+  free = []
+  thread = threading.Thread(target=lambda: free.append(lock.acquire(False)))
+  thread.start()
+  thread.join(5)
+  assert free == [True]
+
+
+def test_handles_on_one_bus_never_overlap():
+  fake = CheckedSMBus(bus_hz=400000)
+  fake.add_bme280()
+  fake.add_tcs34725()
+  lock = bus_lock('test-overlap')
+  handles = [LockedBus(fake, lock), LockedBus(fake, lock)]
+  def hammer(bus, addr):
+    for _ in range(50):
+      bus.read_i2c_block_data(addr, 0x80, 8)
+  threads = [threading.Thread(target=hammer, args=(bus, addr))
+             for bus, addr in zip(handles, (bme280.DEVICE, tcs.TCS34725_ADDRESS))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join(10)
+  assert fake.transactions == 100 and fake.overlaps == 0
+
+
+def test_acquisition_reads_all_and_centres_short_reads():
+  slept = []
+  acquisition = Acquisition([('slow', lambda: 1), ('fast', lambda: 2)], sleep=slept.append)
+  try:
+    samples = acquisition.read()
+    assert sorted(samples) == ['fast', 'slow'] and samples['fast'].value == 2
+    assert slept == []
+    # the shorter read starts late by half the difference
+    acquisition.durations = {'slow': 0.5, 'fast': 0.1}
+    acquisition.read()
+    assert slept == [pytest.approx(0.2)]
+  finally:
+    acquisition.close()
@@ -0,0 +1,70 @@
+import math
+import statistics
+
+import pytest
+
+from kaliot.aggregate import RunningStats, WindowAggregator
+from kaliot.telemetry import make_reading
+
+
+def reading(ts, airtemp):
+  return make_reading(airtemp, 1013.25, 40.0, 100, 90, 80, 300, 123.4, 4100.0, ts=ts)
+
+
+def test_running_stats_merge_matches_one_pass():
+  values = [3.5, -1.25, 8.0, 2.0, 2.0, 11.5, 0.0]
+  whole, left, right = RunningStats(), RunningStats(), RunningStats()
+  for i, x in enumerate(values):
+    whole.add(x)
+    (left if i < 3 else right).add(x)
+  left.merge(right)
+  left.merge(RunningStats())
+  for stats in (whole, left):
+    assert stats.count == len(values) and stats.min == -1.25 and stats.max == 11.5
+    assert math.isclose(stats.mean, statistics.mean(values))
+    assert math.isclose(stats.stddev(), statistics.stdev(values))
+
+
+def test_tumbling_windows(clock):
+  summaries = []
+  aggregate = WindowAggregator(summaries.append, window=60, clock=clock)
+  for ts, value in ((0, 20.0), (30, 22.0), (59, 24.0), (61, 30.0), (200, 40.0)):
+    aggregate.add(reading(ts, value))
+  assert [(s.start, s.end, s.count) for s in summaries] == [(0, 60, 3), (60, 120, 1)]
+  first = summaries[0].airtemperature
+  assert (first.min, first.max, first.mean, first.stddev) == (20.0, 24.0, 22.0, 2.0)
+
+
+def test_sliding_windows_and_poll(clock):
+  summaries = []
+  aggregate = WindowAggregator(summaries.append, window=60, hop=20, clock=clock)
+  aggregate.add(reading(5, 1.0))
+  aggregate.add(reading(25, 3.0))
+  clock.now = 39
+  aggregate.poll()
+  assert [(s.end, s.count) for s in summaries] == [(20, 1)]
+  clock.now = 40
+  aggregate.poll()
+  assert [(s.end, s.count) for s in summaries] == [(20, 1), (40, 2)]
+  # a quiet spell slides the window on until it is empty, then stops
+  clock.now = 500
+  aggregate.poll()
+  assert [(s.end, s.count) for s in summaries][2:] == [(60, 2), (80, 1)]
+
+
+def test_window_must_be_whole_hops():
+  with pytest.raises(ValueError):
+    WindowAggregator(None, window=60, hop=25)
+
+
+def test_sliding_window_forgets_panes_across_a_gap(clock):
+  summaries = []
+  aggregate = WindowAggregator(summaries.append, window=60, hop=20, clock=clock)
+  aggregate.add(reading(5, 1.0))
+  aggregate.add(reading(25, 3.0))
+  clock.now = 40
+  aggregate.poll()
+  aggregate.add(reading(1000, 100.0))
+  aggregate.add(reading(1025, 100.0))
+  assert [(s.end, s.count) for s in summaries] == [(20, 1), (40, 2), (60, 2), (80, 1), (1020, 1)]
+  assert summaries[-1].airtemperature.min == 100.0
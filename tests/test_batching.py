@@ -0,0 +1,48 @@
+import json
+
+from kaliot.batching import TelemetryBatcher
+from kaliot.encoding import BinaryEncoder
+from kaliot.telemetry import make_reading
+
+
+def reading(i):
+  return make_reading(21.5, 1013.25, 40.0, 100 + i, 90, 80, 300, 123.4, 4100.0, ts=1700000000.0 + i)
+
+
+def test_flushes_on_count(clock):
+  sent = []
+  batcher = TelemetryBatcher(sent.append, max_count=3, clock=clock)
+  for i in range(7):
+    batcher.add(reading(i))
+  assert [[r['red'] for r in json.loads(p)] for p in sent] == [[100, 101, 102], [103, 104, 105]]
+  assert batcher.messages == 2 and batcher.readings == 6 and len(batcher.pending) == 1
+  batcher.flush()
+  assert json.loads(sent[-1])[0]['ts'] == 1700000006.0
+  batcher.flush()
+  assert len(sent) == 3
+
+
+def test_flushes_on_age_of_oldest(clock):
+  sent = []
+  batcher = TelemetryBatcher(sent.append, max_count=10, max_age=60, clock=clock)
+  batcher.add(reading(0))
+  clock.now += 59
+  batcher.add(reading(1))
+  batcher.poll()
+  assert sent == []
+  clock.now += 1
+  batcher.poll()
+  assert len(json.loads(sent[0])) == 2
+  clock.now += 600
+  batcher.poll()
+  assert len(sent) == 1
+
+
+def test_encoder_is_pluggable():
+  sent = []
+  encoder = BinaryEncoder()
+  batcher = TelemetryBatcher(sent.append, max_count=2, encoder=encoder)
+  batcher.add(reading(0))
+  batcher.add(reading(1))
+  assert [r.red for r in encoder.decode(sent[0])] == [100, 101]
+  assert batcher.bytes == len(sent[0])
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from bench import bench_suite
+
+
+def save(path, results):
+  path.write_text(json.dumps({'meta': {}, 'results': dict(
+    (name, {'best_us': best, 'median_us': best, 'loops': 1}) for name, best in results.items())}))
+  return str(path)
+
+
+def test_run_saves_results(tmp_path, capsys):
+  out = tmp_path / 'results.json'
+  assert bench_suite.main(['run', '--only', 'compensate', '--repeat', '1', '--out', str(out)]) == 0
+  report = json.loads(out.read_text())
+  assert list(report['results']) == ['compensate']
+  result = report['results']['compensate']
+  assert 0 < result['best_us'] <= result['median_us'] and result['loops'] >= 1
+  assert report['meta']['python']
+
+
+def test_run_rejects_unknown_case(capsys):
+  assert bench_suite.main(['run', '--only', 'nope']) == 2
+  assert 'unknown case(s): nope' in capsys.readouterr().out
+
+
+def test_every_case_builds_and_runs():
+  for name, case in bench_suite.CASES.items():
+    case()()
+
+
+@pytest.mark.parametrize('now, code', [(10.9, 0), (11.1, 1), (5.0, 0)])
+def test_compare_flags_slowdowns_over_threshold(tmp_path, capsys, now, code):
+  baseline = save(tmp_path / 'base.json', {'compensate': 10.0, 'colour_window': 100.0})
+  current = save(tmp_path / 'now.json', {'compensate': now, 'colour_window': 100.0})
+  assert bench_suite.main(['compare', baseline, current]) == code
+  assert ('REGRESSION' in capsys.readouterr().out) == bool(code)
+
+
+def test_compare_threshold_and_changed_cases(tmp_path, capsys):
+  baseline = save(tmp_path / 'base.json', {'compensate': 10.0, 'cycle': 500.0})
+  current = save(tmp_path / 'now.json', {'compensate': 12.0, 'encode_json': 3.0})
+  assert bench_suite.main(['compare', baseline, current, '--threshold', '0.25']) == 0
+  out = capsys.readouterr().out
+  assert '+20.0%' in out
+  assert [line.split()[-1] for line in out.splitlines()[2:]] == ['new', 'missing']
@@ -0,0 +1,55 @@
+import pytest
+
+from kaliot import bme280
+from kaliot.bme280 import BME280, BME280Calibration
+from kaliot.sim import BME280_CALIBRATION, BME280_RAW, FakeSMBus, bme280_calibration_blocks
+
+pytestmark = pytest.mark.usefixtures('no_wait')
+
+
+def test_calibration_decodes_signed_and_split_fields():
+  cal = dict(BME280_CALIBRATION, dig_T2=-26435, dig_H4=-313, dig_H5=-50, dig_H6=-30)
+  decoded = BME280Calibration.from_blocks(*bme280_calibration_blocks(cal))
+  assert dict((name, getattr(decoded, name)) for name in BME280Calibration.__slots__) == cal
+
+
+def test_reads_calibration_once():
+  bus = FakeSMBus()
+  bus.add_bme280()
+  sensor = BME280(bus)
+  reads = bus.bytes
+  expected = BME280Calibration.from_blocks(*bme280_calibration_blocks()).compensate(*BME280_RAW)
+  bus.transactions = 0
+  for _ in range(3):
+    assert sensor.read() == expected
+  # forced mode: the trigger write and the data burst, no calibration
+  assert bus.transactions == 6
+  assert bus.bytes - reads == 3 * (1 + 8)
+
+
+def test_read_follows_the_data_registers():
+  bus = FakeSMBus()
+  bus.add_bme280()
+  sensor = BME280(bus)
+  before = sensor.read()
+  bus.set_bme280_raw(bme280.DEVICE, BME280_RAW[0], BME280_RAW[1] + 5000, BME280_RAW[2])
+  assert sensor.read()[0] > before[0]
+
+
+def test_normal_mode_reads_the_burst_only():
+  bus = FakeSMBus()
+  regs = bus.add_bme280()
+  sensor = BME280(bus, mode=bme280.MODE_NORMAL, standby=125, iir_filter=4)
+  assert regs[bme280.REG_CONFIG] == 2 << 5 | 2 << 2
+  assert regs[bme280.REG_CONTROL] & 0x03 == bme280.MODE_NORMAL
+  bus.transactions = 0
+  sensor.read()
+  assert bus.transactions == 1
+
+
+@pytest.mark.parametrize('options', [dict(mode=2), dict(mode=3, standby=100), dict(iir_filter=3)])
+def test_configure_rejects_unknown_settings(options):
+  bus = FakeSMBus()
+  bus.add_bme280()
+  with pytest.raises(ValueError):
+    BME280(bus, **options)
@@ -0,0 +1,101 @@
+import pytest
+
+from kaliot import bme280
+from kaliot.bme280 import BME280
+from kaliot.capture import (Capture, Recorder, RecordingBus, RecordingTCS, Replay, ReplayFinished,
+                            READ_BLOCK, TCS_FRAME, WRITE_BYTE, WRITE_BYTE_DATA)
+from kaliot.sim import TCA9548A_ADDRESS, FakeSMBus, FakeTCS34725
+
+pytestmark = pytest.mark.usefixtures('no_wait')
+
+
+def record_bme280(path, samples, clock=None):
+  # a BME280 behind mux channel 2, its raw values changing every sample
+  fake = FakeSMBus()
+  fake.add_bme280(channel=2)
+  recorder = Recorder(path) if clock is None else Recorder(path, clock=clock)
+  bus = RecordingBus(fake, recorder, 1)
+  bus.write_byte(TCA9548A_ADDRESS, 1 << 2)
+  sensor = BME280(bus)
+  readings = []
+  for i in range(samples):
+    fake.set_bme280_raw(bme280.DEVICE, 415148 + 100 * i, 519888 + 50 * i, 27000 + 10 * i, channel=2)
+    readings.append(sensor.read())
+    if clock is not None:
+      clock.now += 1.0
+  recorder.close()
+  return readings
+
+
+def test_replay_serves_what_was_recorded(tmp_path):
+  path = str(tmp_path / 'kaliot.kcap')
+  readings = record_bme280(path, 3)
+  ends = []
+  replay = Replay(path, on_end=lambda: ends.append(True))
+  bus = replay.bus(1)
+  bus.write_byte(TCA9548A_ADDRESS, 1 << 2)
+  sensor = BME280(bus)
+  assert [sensor.read() for _ in range(3)] == readings
+  for _ in range(2):
+    with pytest.raises(ReplayFinished):
+      sensor.read()
+  assert ends == [True]
+
+
+def test_replay_follows_mux_routing(tmp_path):
+  path = str(tmp_path / 'kaliot.kcap')
+  record_bme280(path, 1)
+  bus = Replay(path).bus(1)
+  # the chip was only read with channel 2 selected
+  with pytest.raises(ReplayFinished):
+    BME280(bus)
+
+
+def test_replay_paced_as_recorded(tmp_path, clock):
+  path = str(tmp_path / 'kaliot.kcap')
+  record_bme280(path, 3, clock=clock)
+  waits = []
+  def sleep(seconds):
+    waits.append(seconds)
+    clock.now += seconds
+  replay = Replay(path, speed=2, clock=clock, sleep=sleep)
+  bus = replay.bus(1)
+  bus.write_byte(TCA9548A_ADDRESS, 1 << 2)
+  sensor = BME280(bus)
+  for _ in range(3):
+    sensor.read()
+  assert waits == [0.5, 0.5]
+
+
+def test_torn_record_is_dropped_and_recording_continues(tmp_path):
+  path = str(tmp_path / 'kaliot.kcap')
+  record_bme280(path, 1)
+  capture = Capture(path)
+  frames = list(capture)
+  end = capture.end()
+  capture.close()
+  assert [f.op for f in frames][:2] == [WRITE_BYTE, WRITE_BYTE_DATA]
+  with open(path, 'ab') as f:
+    f.write(b'\x00' * 7)
+  recorder = Recorder(path)
+  recorder.record(READ_BLOCK, 1, 0x29, 0x14, b'\x01\x02')
+  recorder.close()
+  capture = Capture(path)
+  assert len(list(capture)) == len(frames) + 1 and capture.end() == end + 14 + 2
+  capture.close()
+
+
+def test_tcs_frames(tmp_path):
+  path = str(tmp_path / 'kaliot.kcap')
+  recorder = Recorder(path)
+  chip = RecordingTCS(FakeTCS34725(raw=(10, 20, 30, 70), time_scale=0, gain=0x02), recorder)
+  chip.set_integration_time(0xC0)
+  assert chip.get_raw_data() == (10, 20, 30, 70)
+  recorder.close()
+  replay = Replay(path)
+  assert [f.op for q in replay.queues.values() for f in q] == [TCS_FRAME]
+  chip = replay.tcs34725()
+  assert (chip.get_integration_time(), chip.get_gain()) == (0xC0, 0x02)
+  assert chip.get_raw_data() == (10, 20, 30, 70)
+  with pytest.raises(ReplayFinished):
+    chip.get_raw_data()
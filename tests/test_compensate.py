@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from kaliot.bme280 import BME280Calibration
+from kaliot.compensate import compensate_batch, unpack_frames
+from kaliot.sim import BME280_CALIBRATION, bme280_calibration_blocks, bme280_data_block
+
+
+def calibration(**changes):
+  return BME280Calibration.from_blocks(*bme280_calibration_blocks(dict(BME280_CALIBRATION, **changes)))
+
+
+def raw_frames(n, seed=1):
+  rng = random.Random(seed)
+  return [(rng.randrange(1 << 20), rng.randrange(1 << 20), rng.randrange(1 << 16)) for _ in range(n)]
+
+
+def scalar(cal, frames):
+  return [cal.compensate(*frame) for frame in frames]
+
+
+def batch(cal, frames):
+  columns = compensate_batch(cal, *zip(*frames))
+  return [tuple(float(column[i]) for column in columns) for i in range(len(frames))]
+
+
+def test_matches_scalar_exactly():
+  cal = calibration()
+  frames = raw_frames(20000)
+  assert batch(cal, frames) == scalar(cal, frames)
+
+
+def test_zero_p1_gives_zero_pressure():
+  cal = calibration(dig_P1=0)
+  frames = raw_frames(100)
+  results = batch(cal, frames)
+  assert results == scalar(cal, frames)
+  assert all(pressure == 0 for _, pressure, _ in results)
+  assert all(np.isfinite(value) for result in results for value in result)
+
+
+def test_humidity_clamped():
+  cal = calibration()
+  frames = [(415148, 519888, hum_raw) for hum_raw in (0, 27000, 65535)]
+  humidity = [h for _, _, h in batch(cal, frames)]
+  assert humidity == [h for _, _, h in scalar(cal, frames)]
+  assert humidity[0] == 0.0 and humidity[2] == 100.0 and 0 < humidity[1] < 100
+
+
+def test_unpack_frames():
+  frames = raw_frames(50)
+  data = [bme280_data_block(*frame) for frame in frames]
+  assert [tuple(int(c[i]) for c in unpack_frames(data)) for i in range(len(frames))] == frames
@@ -0,0 +1,89 @@
+from kaliot.connection import Backoff, ConnectionManager
+
+
+def test_backoff_full_jitter_capped():
+  backoff = Backoff(base=1.0, cap=10.0, random=lambda: 1.0)
+  assert [backoff.next() for _ in range(6)] == [1.0, 2.0, 4.0, 8.0, 10.0, 10.0]
+  backoff.reset()
+  assert backoff.next() == 1.0
+  assert Backoff(random=lambda: 0.0).next() == 0.0
+
+
+def manager(clock, opened, closed=None, ups=None, **kwargs):
+  def open():
+    client = 'client-%d' % len(opened)
+    opened.append(client)
+    return client
+  return ConnectionManager(open, close=None if closed is None else closed.append,
+                           on_up=None if ups is None else ups.append,
+                           backoff=Backoff(1.0, 60.0, random=lambda: 1.0), clock=clock, **kwargs)
+
+
+def test_reconnects_after_drop_with_backoff(clock):
+  opened, closed, ups = [], [], []
+  connection = manager(clock, opened, closed, ups)
+  connection.poll()
+  connection.up()
+  assert connection.connected and ups == ['client-0']
+  connection.down()
+  connection.poll()
+  assert opened == ['client-0']
+  clock.now += 1.0
+  connection.poll()
+  assert closed == ['client-0'] and opened == ['client-0', 'client-1'] and connection.client == 'client-1'
+  # the new attempt fails too: the next wait doubles
+  connection.down()
+  clock.now += 1.9
+  connection.poll()
+  assert len(opened) == 2
+  clock.now += 0.1
+  connection.poll()
+  assert len(opened) == 3 and connection.failures == 1 and connection.drops == 1
+
+
+def test_stable_connection_resets_backoff(clock):
+  opened = []
+  connection = manager(clock, opened, stable=60.0)
+  for _ in range(3):
+    connection.poll()
+    connection.down()
+    clock.now += 100.0
+  connection.poll()
+  connection.up()
+  clock.now += 60.0
+  connection.down()
+  clock.now += 1.0
+  connection.poll()
+  assert len(opened) == 5
+
+
+def test_silent_attempt_times_out(clock):
+  opened = []
+  connection = manager(clock, opened, timeout=30.0)
+  connection.poll()
+  clock.now += 29.0
+  connection.poll()
+  clock.now += 1.0
+  connection.poll()
+  assert connection.failures == 1 and len(opened) == 1
+  clock.now += 1.0
+  connection.poll()
+  assert len(opened) == 2
+
+
+def test_open_raising_is_a_failed_attempt(clock):
+  def open():
+    raise IOError('no route to host')
+  connection = ConnectionManager(open, backoff=Backoff(1.0, 60.0, random=lambda: 1.0), clock=clock)
+  connection.poll()
+  assert connection.failures == 1 and connection.client is None and not connection.connected
+
+
+def test_up_inside_open_reaches_on_up(clock):
+  ups = []
+  def open():
+    connection.up()
+    return 'client'
+  connection = ConnectionManager(open, on_up=ups.append, clock=clock)
+  connection.poll()
+  assert ups == ['client'] and connection.connected
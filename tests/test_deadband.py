@@ -0,0 +1,39 @@
+import pytest
+
+from kaliot.deadband import DeadbandFilter
+from kaliot.telemetry import make_reading
+
+
+def reading(airtemp=21.5, lux=100.0):
+  return make_reading(airtemp, 1013.25, 40.0, 100, 90, 80, 300, lux, 4100.0)
+
+
+def test_sends_first_and_moves_past_band(clock):
+  deadband = DeadbandFilter({'airtemperature': ('abs', 0.5), 'lux': ('rel', 0.1)}, clock=clock)
+  assert deadband.offer(reading())
+  assert not deadband.offer(reading(airtemp=21.9, lux=109.0))
+  assert deadband.offer(reading(airtemp=22.1))
+  # relative to the last reading sent, not the last offered
+  assert not deadband.offer(reading(airtemp=22.1, lux=109.0))
+  assert deadband.offer(reading(airtemp=22.1, lux=111.0))
+  stats = deadband.stats()
+  assert stats['sent'] == 3 and stats['suppressed'] == 2 and stats['reduction'] == 0.4
+  assert stats['triggers'] == {'airtemperature': 1, 'lux': 1}
+
+
+def test_heartbeat_after_silence(clock):
+  deadband = DeadbandFilter({'airtemperature': ('abs', 0.5)}, heartbeat=60, clock=clock)
+  assert deadband.offer(reading())
+  clock.now += 59
+  assert not deadband.offer(reading())
+  clock.now += 1
+  assert deadband.offer(reading())
+  clock.now += 30
+  assert not deadband.offer(reading())
+  assert deadband.stats()['heartbeats'] == 1
+
+
+@pytest.mark.parametrize('bands', [{'nope': ('abs', 1)}, {'lux': ('pct', 1)}])
+def test_rejects_bad_bands(bands):
+  with pytest.raises(ValueError):
+    DeadbandFilter(bands)
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from kaliot.aggregate import ChannelStats, Summary
+from kaliot.encoding import BinaryEncoder, JsonEncoder, get_encoder, join
+from kaliot.telemetry import FIELDS, make_reading
+
+
+def readings(n, t0=1700000000.0):
+  return [make_reading(21.5 + i, 1013.25, 40.0, 100 + i, 90, 80, 300, 123.4, 4100.0, ts=t0 + i)
+          for i in range(n)]
+
+
+def test_json_round_trip():
+  encoder = JsonEncoder(device_id='us-stl-"c"%d', precision=1)
+  r = readings(2)
+  decoded = encoder.decode(encoder.encode(r[0]))
+  assert decoded['deviceId'] == 'us-stl-"c"%d'
+  assert decoded['ts'] == r[0].ts and decoded['airtemperature'] == 21.5 and decoded['lux'] == 123.4
+  assert [x['red'] for x in encoder.decode(encoder.encode_batch(r))] == [100, 101]
+
+
+def test_binary_round_trip_and_clamp():
+  encoder = BinaryEncoder()
+  r = readings(3)
+  assert encoder.decode(encoder.encode(r[0])) == r[0]
+  assert encoder.decode(encoder.encode_batch(r)) == r
+  assert len(encoder.encode(r[0])) == 1 + encoder.record.size
+  # out of range values saturate instead of failing the pack
+  hot = r[0]._replace(airtemperature=1000.0, red=-5)
+  decoded = encoder.decode(encoder.encode(hot))
+  assert decoded.airtemperature == 327.67 and decoded.red == 0
+  with pytest.raises(ValueError):
+    encoder.decode(b'\x02' + encoder.encode(r[0])[1:])
+
+
+def test_summaries():
+  # whole numbers: the colour counts go at a scale of 1
+  stats = ChannelStats(1.0, 3.0, 2.0, 1.0)
+  summary = Summary(1700000000.0, 1700000600.0, 12, *[stats] * len(FIELDS))
+  assert BinaryEncoder().decode(BinaryEncoder().encode_summary(summary)) == summary
+  decoded = JsonEncoder().decode(JsonEncoder().encode_summary(summary))
+  assert decoded['count'] == 12 and decoded['lux'] == {'min': 1.0, 'max': 3.0, 'mean': 2.0, 'stddev': 1.0}
+
+
+def test_get_encoder():
+  assert isinstance(get_encoder('binary'), BinaryEncoder)
+  encoder = get_encoder('json', device_id='x')
+  assert encoder.decode(encoder.encode(readings(1)[0]))['deviceId'] == 'x'
+  with pytest.raises(ValueError):
+    get_encoder('xml')
+
+
+def test_join_json():
+  encoder = JsonEncoder()
+  r = readings(5)
+  payloads = [encoder.encode(r[0]), encoder.encode_batch(r[1:3]), b'[]', encoder.encode(r[3]),
+              BinaryEncoder().encode(r[4])]
+  payload, n = join(payloads)
+  assert n == 4
+  assert [x['ts'] for x in json.loads(payload)] == [x['ts'] for x in json.loads(encoder.encode_batch(r[:4]))]
+
+
+def test_join_binary():
+  encoder = BinaryEncoder()
+  r = readings(5)
+  payloads = [encoder.encode(r[0]), encoder.encode_batch(r[1:3]), encoder.encode(r[3]), b'{}']
+  payload, n = join(payloads)
+  assert n == 3
+  assert payload == encoder.encode_batch(r[:4])
+  assert join(payloads, max_records=2) == (payloads[0], 1)
+
+
+def test_join_alone():
+  encoder = JsonEncoder()
+  single = encoder.encode(readings(1)[0])
+  assert join([single]) == (single, 1)
+  assert join([single, b'\x01']) == (single, 1)
@@ -0,0 +1,103 @@
+import asyncio
+import queue
+import socket
+import threading
+
+import pytest
+
+from kaliot.gateway import Gateway, GatewayClient, GatewayLink, content_code, open_envelope
+
+
+class Spool(list):
+
+  def append(self, entry):
+    list.append(self, open_envelope(entry))
+
+
+@pytest.fixture
+def start():
+  loop = asyncio.new_event_loop()
+  thread = threading.Thread(target=loop.run_forever)
+  thread.daemon = True
+  thread.start()
+  gateways = []
+
+  def start(secrets=None):
+    gateway = Gateway(Spool(), secrets)
+    server = asyncio.run_coroutine_threadsafe(gateway.start(('127.0.0.1', 0)), loop).result()
+    gateways.append(gateway)
+    return gateway, ('127.0.0.1', server.sockets[0].getsockname()[1])
+
+  yield start
+
+  async def shutdown():
+    # every connection handler ends before the loop does
+    for gateway in gateways:
+      gateway.close()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  asyncio.run_coroutine_threadsafe(shutdown(), loop).result(5)
+  loop.call_soon_threadsafe(loop.stop)
+  thread.join()
+  loop.close()
+
+
+def send(link, device_id, payload, code=0):
+  results = queue.Queue()
+  link.send(device_id, payload, code, results.put)
+  return results.get(timeout=5)
+
+
+def test_node_with_its_secret_sends_as_itself(start):
+  gateway, address = start({'node-1': 'one', 'node-2': 'two'})
+  link = GatewayLink(address, device_id='node-1', secret='one')
+  code = content_code('application/json', 'utf-8')
+  assert send(link, 'node-1', b'{"t": 1}', code) is True
+  assert gateway.queue == [('node-1', 'application/json', 'utf-8', b'{"t": 1}')]
+  # only as itself, even for a device the gateway forwards
+  assert send(link, 'node-2', b'{}') is False
+  assert gateway.refused == 1 and len(gateway.queue) == 1
+  link.close()
+
+
+@pytest.mark.parametrize('device_id, secret', [('node-1', 'two'), ('node-1', None), ('node-3', 'one')])
+def test_handshake_refuses_wrong_secret_or_device(start, device_id, secret):
+  gateway, address = start({'node-1': 'one', 'node-2': 'two'})
+  with pytest.raises(IOError):
+    GatewayLink(address, device_id=device_id, secret=secret)
+  assert gateway.rejected == 1 and gateway.queue == []
+
+
+def test_no_secrets_takes_any_device(start):
+  gateway, address = start()
+  link = GatewayLink(address)
+  assert send(link, 'node-1', b'a') is True
+  assert send(link, 'node-2', b'b') is True
+  assert [e[0] for e in gateway.queue] == ['node-1', 'node-2']
+  link.close()
+
+
+class Message(object):
+
+  content_type = 'application/json'
+  content_encoding = 'utf-8'
+
+  def get_bytearray(self):
+    return bytearray(b'{}')
+
+
+def test_client_reports_status_and_results(start):
+  gateway, address = start({'node-1': 'one'})
+  client = GatewayClient(address, 'node-1', ('OK', 'ERROR', 'DESTROY'), ('UP', 'DOWN'), secret='one')
+  statuses = queue.Queue()
+  client.set_connection_status_callback(lambda status, reason, context: statuses.put(status), None)
+  assert statuses.get(timeout=5) == 'UP'
+  results = queue.Queue()
+  client.send_event_async(Message(), lambda message, result, context: results.put(result), 7)
+  assert results.get(timeout=5) == 'OK'
+  # the link dropping is reported, a close() is not
+  client.link.sock.shutdown(socket.SHUT_RDWR)
+  assert statuses.get(timeout=5) == 'DOWN'
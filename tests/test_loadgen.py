@@ -0,0 +1,52 @@
+import asyncio
+
+from kaliot.loadgen import AsyncBroker, FleetStats, VirtualDevice, run_fleet
+
+
+def test_device_sends_what_the_scripts_would():
+  device = VirtualDevice('kaliot-load-00001', window=4)
+  first, second = [device.encoder.decode(bytes(device.message().get_bytearray())) for _ in range(2)]
+  assert first['deviceId'] == 'kaliot-load-00001'
+  assert 40 < first['airtemperature'] < 50 and 900 < first['airpressure'] < 1100
+  assert 300 < first['red'] < 320 and first['lux'] > 0
+  # raw values wander, so payloads differ from sample to sample
+  assert first != second
+  assert device.properties['$.ct'] == 'application/json'
+  # seeded by device id: a rerun replays the same values
+  assert VirtualDevice('kaliot-load-00001', window=4).sample()[1:] == \
+    VirtualDevice('kaliot-load-00001', window=4).sample()[1:]
+
+
+def test_broker_ingests_one_message_at_a_time():
+  async def publish_all():
+    broker = AsyncBroker(ack_delay=0.0, ingest_time=0.01)
+    broker.start()
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    results = await asyncio.gather(*[broker.publish('d%d' % n, b'{}') for n in range(5)])
+    elapsed = loop.time() - start
+    await broker.stop()
+    return broker, results, elapsed
+  broker, results, elapsed = asyncio.run(publish_all())
+  assert results == ['OK'] * 5 and broker.broker.messages == 5
+  assert elapsed >= 0.05
+
+
+def test_fleet_run_acks_every_message():
+  stats = asyncio.run(run_fleet(0, 3, duration=0.3, interval=0.1, window=4, ack_delay=0.002))
+  summary = stats.summary()
+  # each device starts somewhere in the first interval, so sends 2 or 3
+  assert 6 <= stats.sent <= 9 and stats.acked == stats.sent and stats.failed == 0
+  assert summary['devices'] == 3 and summary['messages'] == stats.acked
+  assert min(stats.latencies) >= 0.002 and summary['p99_ms'] >= summary['p50_ms']
+  assert summary['wire_bytes_per_s'] > 0 and summary['cpu_ms_per_message'] > 0
+
+
+def test_stats_merge_and_percentiles():
+  a, b = FleetStats(), FleetStats()
+  a.devices, a.acked, a.elapsed, a.latencies = 2, 2, 1.0, [0.001, 0.002]
+  b.devices, b.acked, b.elapsed, b.latencies = 1, 2, 2.0, [0.003, 0.004]
+  merged = a.merge(b)
+  assert merged.devices == 3 and merged.elapsed == 2.0
+  assert merged.percentile(50) == 0.003 and merged.percentile(99) == 0.004
+  assert FleetStats().percentile(50) == 0.0 and FleetStats().summary()['cpu_ms_per_message'] == 0.0
@@ -0,0 +1,80 @@
+import io
+import logging
+
+import pytest
+
+from kaliot import log as kaliot_log
+from kaliot.log import RingHandler, Throttle
+
+
+@pytest.fixture
+def kaliot_logger():
+  # setup() reconfigures the "kaliot" logger; put it back for the other tests
+  logger = logging.getLogger('kaliot')
+  saved = list(logger.handlers), logger.propagate, logger.level
+  yield logger
+  logger.handlers[:], logger.propagate, logger.level = saved
+
+
+def recorder(level=logging.DEBUG):
+  logger = logging.getLogger('kaliot.test.throttle')
+  logger.propagate = False
+  logger.setLevel(level)
+  ring = RingHandler(100, logging.DEBUG)
+  logger.handlers[:] = [ring]
+  return logger, ring
+
+
+def test_throttle_suppresses_and_counts(clock):
+  logger, ring = recorder()
+  throttle = Throttle(logger, interval=60.0, burst=2, clock=clock)
+  sent = [throttle.info('sent %d', n) for n in range(5)]
+  assert sent == [True, True, False, False, False] and throttle.suppressed == 3
+  # one token back every interval / burst seconds
+  clock.now += 30.0
+  assert throttle.info('sent %d', 5)
+  assert throttle.suppressed == 0
+  assert [r.getMessage() for r in ring.records] == ['sent 0', 'sent 1', 'sent 5 (3 more since)']
+
+
+def test_throttle_below_level_is_not_counted(clock):
+  logger, ring = recorder(logging.INFO)
+  throttle = Throttle(logger, clock=clock)
+  assert not throttle.debug('quiet')
+  assert throttle.suppressed == 0 and throttle.tokens == 1
+  assert throttle.info('heard') and not ring.records[0].getMessage().endswith('since)')
+
+
+def test_throttle_interval_zero_lets_everything_through(clock):
+  logger, ring = recorder()
+  throttle = Throttle(logger, interval=0, clock=clock)
+  assert all(throttle.warning('w') for _ in range(10))
+  assert len(ring.records) == 10
+
+
+def test_ring_keeps_last_records_at_its_level():
+  logger, _ = recorder()
+  ring = RingHandler(3, logging.INFO)
+  ring.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+  logger.handlers[:] = [ring]
+  for n in range(5):
+    logger.info('info %d', n)
+    logger.debug('debug %d', n)
+  assert ring.dump() == ['INFO info 2', 'INFO info 3', 'INFO info 4']
+  assert ring.dump(1) == ['INFO info 4'] and ring.dump(0) == []
+
+
+def test_setup_levels_and_leaves_logging_module_alone(kaliot_logger):
+  stream = io.StringIO()
+  flags = logging.logThreads, logging.logProcesses, logging.logMultiprocessing
+  ring = kaliot_log.setup(logging.WARNING, 10, logging.INFO, stream=stream, dump_signal=None)
+  assert (logging.logThreads, logging.logProcesses, logging.logMultiprocessing) == flags
+  log = logging.getLogger('kaliot.test')
+  log.debug('nowhere')
+  log.info('ring only')
+  log.warning('both')
+  assert [r.getMessage() for r in ring.records] == ['ring only', 'both']
+  assert stream.getvalue().count('\n') == 1 and 'both' in stream.getvalue()
+  assert not kaliot_logger.isEnabledFor(logging.DEBUG)
+  assert kaliot_log.setup(logging.INFO, 0, stream=stream, dump_signal=None) is None
+  assert len(kaliot_logger.handlers) == 1
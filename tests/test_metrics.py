@@ -0,0 +1,49 @@
+try:
+  from urllib.request import urlopen
+except ImportError:
+  from urllib2 import urlopen
+
+from kaliot.metrics import CONTENT_TYPE, Registry, serve, write_textfile
+
+
+def registry():
+  registry = Registry()
+  sent = registry.counter('kaliot_test_sent', 'Sent.')
+  latency = registry.histogram('kaliot_test_seconds', 'Latency.', ('result',), buckets=(0.1, 1.0))
+  registry.gauge('kaliot_test_depth', 'Depth.', fn=lambda: 7)
+  sent.inc()
+  sent.inc(2)
+  latency.labels('OK').observe(0.05)
+  latency.labels('OK').observe(0.5)
+  latency.labels('ERROR "x"').observe(5)
+  return registry
+
+
+def test_render():
+  lines = registry().render().decode('utf-8').splitlines()
+  assert '# TYPE kaliot_test_sent counter' in lines
+  assert 'kaliot_test_sent_total 3' in lines
+  assert 'kaliot_test_seconds_bucket{result="OK",le="0.1"} 1' in lines
+  assert 'kaliot_test_seconds_bucket{result="OK",le="+Inf"} 2' in lines
+  assert 'kaliot_test_seconds_count{result="ERROR \\"x\\""} 1' in lines
+  assert 'kaliot_test_depth 7' in lines
+
+
+def test_serve_is_local_by_default():
+  server = serve(0, registry())
+  try:
+    host, port = server.server_address
+    assert host == '127.0.0.1'
+    response = urlopen('http://127.0.0.1:%d/metrics' % port, timeout=5)
+    assert response.headers['Content-Type'] == CONTENT_TYPE
+    assert b'kaliot_test_sent_total 3' in response.read()
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def test_textfile(tmp_path):
+  path = str(tmp_path / 'kaliot.prom')
+  write_textfile(path, registry())
+  with open(path, 'rb') as f:
+    assert b'kaliot_test_depth 7' in f.read()
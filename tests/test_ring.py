@@ -0,0 +1,164 @@
+import base64
+import json
+
+import pytest
+
+from kaliot.encoding import BinaryEncoder
+from kaliot.ring import RingFile, handle_query
+from kaliot.telemetry import make_reading
+
+T0 = 1700000000.0
+
+
+def reading(n):
+  return make_reading(20 + n % 50 / 10.0, 1000 + n % 7, 40.5, n % 1000, 2, 3, 4, 5.5, 3000.0,
+                      ts=T0 + n)
+
+
+def expected(n):
+  # as it comes back out of the ring, through the record packing
+  encoder = BinaryEncoder()
+  return encoder.decode(encoder.encode(reading(n)))
+
+
+@pytest.fixture
+def ring(tmp_path):
+  # 1000 records, written 1300: the oldest 300 are gone and the range wraps
+  ring = RingFile(str(tmp_path / 'ring.dat'), 1000)
+  for n in range(1300):
+    ring.append(reading(n))
+  yield ring
+  ring.close()
+
+
+def decode(batch):
+  return BinaryEncoder().decode(batch)
+
+
+def test_reopen_keeps_records(tmp_path):
+  path = str(tmp_path / 'ring.dat')
+  ring = RingFile(path, 10)
+  for n in range(15):
+    ring.append(reading(n))
+  ring.close()
+  ring = RingFile(path, 10)
+  assert len(ring) == 10
+  assert decode(ring.query(0, T0 + 100)) == [expected(n) for n in range(5, 15)]
+  ring.close()
+  # another capacity is another layout: start empty
+  ring = RingFile(path, 20)
+  assert len(ring) == 0
+  ring.close()
+
+
+def test_query_range_across_wrap(ring):
+  assert decode(ring.query(T0 + 950, T0 + 1050)) == [expected(n) for n in range(950, 1050)]
+  assert decode(ring.query(0, T0 + 300)) == []
+  assert len(decode(ring.query(0, T0 + 5000))) == 1000
+
+
+@pytest.mark.parametrize('max_points', [1, 7, 99, 333, 1000])
+def test_query_downsampled_across_wrap(ring, max_points):
+  window = [expected(n) for n in range(300, 1300)]
+  step = -(-len(window) // max_points)
+  got = decode(ring.query(0, T0 + 5000, max_points))
+  assert got == window[::step]
+  assert len(got) <= max_points
+
+
+def test_pages_join_up(ring):
+  whole, step, resume = ring.page(T0 + 400, T0 + 1290, 100)
+  assert resume is None
+  got = []
+  cursor = None
+  while True:
+    batch, page_step, cursor = ring.page(T0 + 400, T0 + 1290, step=step, limit=7, cursor=cursor)
+    assert page_step == step
+    got += decode(batch)
+    if cursor is None:
+      break
+  assert got == decode(whole)
+
+
+def test_pages_split_equal_timestamps(tmp_path):
+  # ten records per second: every page boundary falls inside a run of
+  # equal timestamps
+  ring = RingFile(str(tmp_path / 'ring.dat'), 100)
+  records = [make_reading(20.0, 1000.0, 40.5, n, 2, 3, 4, 5.5, 3000.0, ts=T0 + n // 10)
+             for n in range(130)]
+  for record in records:
+    ring.append(record)
+  for fmt in ('binary', 'json'):
+    payload = json.dumps({'start': 0, 'format': fmt})
+    reds = []
+    while payload is not None:
+      status, response = handle_query(ring, payload, T0 + 100, limit=4096)
+      assert status == 200
+      response = json.loads(response)
+      if fmt == 'binary':
+        reds += [r.red for r in decode(base64.b64decode(response['data']))]
+      else:
+        reds += [r['red'] for r in response['readings']]
+      payload = json.dumps(response['next']) if 'next' in response else None
+    assert reds == list(range(30, 130))
+  ring.close()
+
+
+def test_cursor_survives_appends_and_reopen(tmp_path):
+  path = str(tmp_path / 'ring.dat')
+  ring = RingFile(path, 10)
+  for n in range(8):
+    ring.append(reading(n))
+  batch, step, cursor = ring.page(0, T0 + 100, limit=3)
+  assert [r.red for r in decode(batch)] == [0, 1, 2]
+  ring.close()
+  ring = RingFile(path, 10)
+  # seven more wrap the ring over records 0-4: the two the cursor points
+  # at are gone, so the next page starts at the oldest left
+  for n in range(8, 15):
+    ring.append(reading(n))
+  batch, step, cursor = ring.page(0, T0 + 100, limit=3, cursor=cursor)
+  assert [r.red for r in decode(batch)] == [5, 6, 7]
+  batch, step, cursor = ring.page(0, T0 + 100, limit=3, cursor=cursor)
+  assert [r.red for r in decode(batch)] == [8, 9, 10]
+  ring.close()
+
+
+def test_method_pages_fit_limit(tmp_path):
+  ring = RingFile(str(tmp_path / 'ring.dat'), 10000)
+  for n in range(10000):
+    ring.append(reading(n))
+  for fmt, key in (('binary', 'data'), ('json', 'readings')):
+    payload = json.dumps({'start': 0, 'max_points': 3600, 'format': fmt})
+    got = []
+    pages = 0
+    while payload is not None:
+      status, response = handle_query(ring, payload, T0 + 10000)
+      assert status == 200
+      assert len(response) < 120 * 1024
+      response = json.loads(response)
+      if fmt == 'binary':
+        got += decode(base64.b64decode(response['data']))
+      else:
+        got += response['readings']
+      payload = json.dumps(response['next']) if 'next' in response else None
+      pages += 1
+    assert pages > 1
+    assert len(got) == 3334
+  ring.close()
+
+
+@pytest.mark.parametrize('payload', ['[1, 2]', '"hour"', '{"seconds": "x"}', '{"format": "xml"}',
+                                     '{"step": 0}', '{"max_points": null}', '{"cursor": -1}',
+                                     'nonsense'])
+def test_bad_request(ring, payload):
+  status, response = handle_query(ring, payload, T0 + 1300)
+  assert status == 400
+  assert 'error' in json.loads(response)
+
+
+def test_last_seconds(ring):
+  status, response = handle_query(ring, '{"seconds": 10, "format": "json"}', T0 + 1300)
+  response = json.loads(response)
+  assert status == 200 and response['count'] == 10 and 'next' not in response
+  assert response['readings'][0] == expected(1290)._asdict()
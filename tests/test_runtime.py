@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from kaliot.runtime import Runtime
+
+
+def run_for(runtime, seconds):
+  async def main():
+    asyncio.get_event_loop().call_later(seconds, runtime.stop)
+    await runtime.run()
+  asyncio.run(main())
+
+
+def test_sample_error_costs_one_sample():
+  calls = []
+  handled = []
+
+  def sample():
+    calls.append(None)
+    if len(calls) == 2:
+      raise IOError('I2C NACK')
+    return len(calls)
+
+  runtime = Runtime(sample, handled.append, 0.01)
+  run_for(runtime, 0.2)
+  assert runtime.errors == 1
+  assert 2 not in handled
+  assert len(handled) >= 5 and handled[0] == 1 and handled[1] == 3
+
+
+def test_handle_and_drain_errors_carry_on():
+  handled = []
+  drains = []
+
+  def handle(reading):
+    handled.append(reading)
+    if len(handled) == 1:
+      raise ValueError('bad reading')
+
+  def drain():
+    drains.append(None)
+    if len(drains) == 1:
+      raise RuntimeError('transport gone')
+    return False
+
+  runtime = Runtime(lambda: 1, handle, 0.01, drain=drain)
+  run_for(runtime, 0.2)
+  assert runtime.errors == 2
+  assert len(handled) >= 5
+  assert len(drains) >= 3
+
+
+def test_stage_that_dies_stops_run():
+  def backpressure():
+    raise KeyError('window')
+
+  runtime = Runtime(lambda: 1, lambda reading: None, 0.01, backpressure=backpressure)
+  with pytest.raises(KeyError):
+    asyncio.run(asyncio.wait_for(runtime.run(), 5))
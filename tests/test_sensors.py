@@ -0,0 +1,159 @@
+import pytest
+
+from kaliot import bme280, tcs
+from kaliot.acquire import Sample
+from kaliot.sensors import BUS, BusPoller, SampleEncoder, SensorSpec, parse_sensors
+from kaliot.sim import BME280_RAW, TCA9548A_ADDRESS, FakeSMBus
+
+pytestmark = pytest.mark.usefixtures('no_wait')
+
+
+class FlakySMBus(FakeSMBus):
+  # FakeSMBus where the addresses in dead stop answering, counting writes to
+  # the mux
+
+  def __init__(self):
+    FakeSMBus.__init__(self)
+    self.dead = set()
+    self.mux_writes = 0
+
+  def _regs(self, addr):
+    if addr in self.dead:
+      raise IOError(121, 'Remote I/O error')
+    return FakeSMBus._regs(self, addr)
+
+  def write_byte(self, addr, val):
+    if addr in self.dead:
+      raise IOError(121, 'Remote I/O error')
+    if addr in self.masks:
+      self.mux_writes += 1
+    FakeSMBus.write_byte(self, addr, val)
+
+
+def poller(bus, specs, clock, **kwargs):
+  def sleep(seconds):
+    clock.now += seconds
+  return BusPoller(bus, specs, clock=clock, sleep=sleep, **kwargs)
+
+
+def test_parse_fills_defaults():
+  specs = parse_sensors([
+    {'id': 'top', 'type': 'bme280'},
+    {'id': 'light', 'type': 'tcs34725', 'bus': 3},
+    {'id': 'rack2', 'type': 'bme280', 'addr': 0x76, 'mux': 0x70, 'channel': 2},
+  ])
+  assert specs == [SensorSpec('top', 'bme280', BUS, bme280.DEVICE, None, None),
+                   SensorSpec('light', 'tcs34725', 3, tcs.TCS34725_ADDRESS, None, None),
+                   SensorSpec('rack2', 'bme280', BUS, 0x76, 0x70, 2)]
+
+
+def test_parse_allows_one_address_behind_each_channel():
+  specs = parse_sensors([
+    {'id': 'a', 'type': 'bme280', 'mux': 0x70, 'channel': 0},
+    {'id': 'b', 'type': 'bme280', 'mux': 0x70, 'channel': 1},
+    {'id': 'c', 'type': 'bme280', 'mux': 0x71, 'channel': 0},
+    {'id': 'd', 'type': 'bme280', 'bus': 2},
+  ])
+  assert [spec.id for spec in specs] == ['a', 'b', 'c', 'd']
+
+
+@pytest.mark.parametrize('config, message', [
+  ([{'id': 'a', 'type': 'bmp180'}], 'unknown type'),
+  ([{'id': 'a', 'type': 'bme280', 'adr': 0x76}], 'unknown keys adr'),
+  ([{'id': 'a', 'type': 'bme280', 'mux': 0x70}], 'mux and channel'),
+  ([{'id': 'a', 'type': 'bme280', 'channel': 1}], 'mux and channel'),
+  ([{'id': 'a', 'type': 'bme280', 'mux': 0x70, 'channel': 8}], 'bad mux channel'),
+  ([{'id': 'a', 'type': 'bme280'}, {'id': 'a', 'type': 'tcs34725'}], 'duplicate sensor id'),
+  ([{'id': 'a', 'type': 'bme280'}, {'id': 'b', 'type': 'bme280'}], 'address 0x77'),
+  ([{'id': 'a', 'type': 'bme280', 'mux': 0x70, 'channel': 3},
+    {'id': 'b', 'type': 'bme280', 'mux': 0x70, 'channel': 3}], 'address 0x77'),
+  # a device outside the mux answers on every channel, in either order
+  ([{'id': 'a', 'type': 'bme280'},
+    {'id': 'b', 'type': 'bme280', 'mux': 0x70, 'channel': 3}], 'address 0x77'),
+  ([{'id': 'a', 'type': 'bme280', 'mux': 0x70, 'channel': 3},
+    {'id': 'b', 'type': 'bme280'}], 'address 0x77'),
+])
+def test_parse_rejects(config, message):
+  with pytest.raises(ValueError) as error:
+    parse_sensors(config)
+  assert message in str(error.value)
+
+
+def test_parse_rejects_missing_id_or_type():
+  with pytest.raises(KeyError):
+    parse_sensors([{'type': 'bme280'}])
+  with pytest.raises(KeyError):
+    parse_sensors([{'id': 'a'}])
+
+
+def test_poller_switches_mux_once_per_group(clock):
+  bus = FlakySMBus()
+  specs = []
+  for channel in (0, 2):
+    for addr in (0x76, 0x77):
+      bus.add_bme280(addr, channel=channel)
+      specs.append(SensorSpec('c%d-%x' % (channel, addr), 'bme280', 1, addr, TCA9548A_ADDRESS, channel))
+  bus.set_bme280_raw(0x77, BME280_RAW[0], BME280_RAW[1] + 5000, BME280_RAW[2], channel=2)
+  bus_poller = poller(bus, specs, clock)
+  bus.mux_writes = 0
+  samples = dict((sample.name, sample) for sample in bus_poller.poll())
+  assert sorted(samples) == sorted(spec.id for spec in specs)
+  # start and fetch pass over both channels: four switches for eight transfers
+  assert bus.mux_writes == 4
+  assert samples['c2-77'].value[0] > samples['c0-77'].value[0]
+  assert samples['c0-76'].value == samples['c0-77'].value
+  assert not bus_poller.errors
+
+
+def test_poller_skips_dead_sensor_and_dead_mux(clock):
+  bus = FlakySMBus()
+  bus.add_bme280(0x76)
+  bus.add_bme280(0x77, channel=1)
+  bus.add_tcs34725()
+  specs = [SensorSpec('plain', 'bme280', 1, 0x76, None, None),
+           SensorSpec('muxed', 'bme280', 1, 0x77, TCA9548A_ADDRESS, 1),
+           SensorSpec('light', 'tcs34725', 1, tcs.TCS34725_ADDRESS, None, None)]
+  bus_poller = poller(bus, specs, clock, samples=4)
+  bus.dead.add(0x76)
+  assert sorted(s.name for s in bus_poller.poll()) == ['light', 'muxed']
+  # a conversion that could not be started is not fetched
+  assert bus_poller.errors == {'plain': 1}
+  bus.dead.add(TCA9548A_ADDRESS)
+  assert [s.name for s in bus_poller.poll()] == ['light']
+  assert bus_poller.errors == {'plain': 2, 'muxed': 1}
+  bus.dead.clear()
+  assert len(bus_poller.poll()) == 3
+
+
+def test_poller_flags_saturated_window(clock):
+  bus = FlakySMBus()
+  bus.add_tcs34725()
+  specs = [SensorSpec('light', 'tcs34725', 1, tcs.TCS34725_ADDRESS, None, None)]
+  bus_poller = poller(bus, specs, clock, samples=4)
+  sample, = bus_poller.poll()
+  assert sample.value[-1] is False and sample.duration == pytest.approx(4 * bus_poller.delay)
+  bus.set_tcs34725_raw(tcs.TCS34725_ADDRESS, 310, 352, 270, tcs.full_scale(tcs.INTEGRATIONTIME_2_4MS))
+  sample, = bus_poller.poll()
+  assert sample.value[-1] is True
+
+
+def test_encoder_templates_per_sensor():
+  encoder = SampleEncoder({'top%d': 'bme280', 'light': 'tcs34725'}, device_id='dev"1', precision=1)
+  payload = encoder.encode([Sample('top%d', 1700000000.25, 0.01, (21.54, 1013.25, 40.0)),
+                            Sample('light', 1700000000.5, 0.5, (310, 352, 270, 912, 123.4, 4100.0, True))])
+  top, light = encoder.decode(payload)
+  assert top == {'deviceId': 'dev"1', 'sensor': 'top%d', 'ts': 1700000000.25,
+                 'airtemperature': 21.5, 'airpressure': 1013.2, 'airhumidity': 40.0}
+  assert light['saturated'] == 1 and light['red'] == 310.0 and light['sensor'] == 'light'
+  assert encoder.decode(encoder.encode([])) == []
+
+
+def test_encoder_errors():
+  with pytest.raises(KeyError):
+    SampleEncoder({'a': 'bmp180'})
+  encoder = SampleEncoder({'a': 'bme280'})
+  # a sensor it was not built for, and a value of the wrong shape
+  with pytest.raises(KeyError):
+    encoder.encode([Sample('b', 0.0, 0.0, (1.0, 2.0, 3.0))])
+  with pytest.raises(TypeError):
+    encoder.encode([Sample('a', 0.0, 0.0, (1.0, 2.0))])
@@ -0,0 +1,61 @@
+import pytest
+
+from kaliot.settings import Settings, check, twin_patch
+
+
+def make(reported=None):
+  applied = {}
+  settings = Settings({'sampleInterval': 66.0, 'colorSamples': 10},
+                      {'sampleInterval': lambda value: applied.__setitem__('sampleInterval', value),
+                       'colorSamples': lambda value: applied.__setitem__('colorSamples', value)},
+                      report=reported.update if reported is not None else None)
+  return settings, applied
+
+
+def test_check():
+  assert check('colorSamples', 5.0) == 5
+  assert isinstance(check('sampleInterval', 5), float)
+  for value in (0, 1001, 2.5, True, '5', None):
+    with pytest.raises(ValueError):
+      check('colorSamples', value)
+
+
+def test_applied_at_apply_and_reported():
+  reported = {}
+  settings, applied = make(reported)
+  settings.update({'colorSamples': 20, 'unknown': 1, '$version': 3}, 3)
+  assert applied == {}
+  acks = settings.apply()
+  assert applied == {'colorSamples': 20}
+  assert settings.values['colorSamples'] == 20
+  assert acks['colorSamples'].status == 200 and reported == acks
+  assert twin_patch(acks) == {'colorSamples': {'value': 20, 'ac': 200, 'ad': 'applied', 'av': 3}}
+  assert settings.apply() == {}
+
+
+def test_rejected_and_failed_keep_value_in_force():
+  settings = Settings({'colorSamples': 10}, {'colorSamples': lambda value: 1 / 0})
+  settings.update({'colorSamples': 0})
+  assert settings.apply()['colorSamples'][:2] == (10, 400)
+  settings.update({'colorSamples': 50})
+  assert settings.apply()['colorSamples'][:2] == (10, 500)
+  assert settings.values['colorSamples'] == 10
+
+
+def test_older_patch_is_ignored():
+  settings, applied = make()
+  settings.update({'colorSamples': 30}, 6)
+  settings.update({'colorSamples': 20, 'sampleInterval': 10}, 5)
+  settings.update({'colorSamples': 40}, 6)
+  settings.apply()
+  # v5 came late: its colorSamples is older than v6's, its sampleInterval not
+  assert applied == {'colorSamples': 30, 'sampleInterval': 10.0}
+  assert settings.stale == 2
+
+
+def test_unversioned_updates_always_apply():
+  settings, applied = make()
+  settings.update({'colorSamples': 30}, 6)
+  settings.update({'colorSamples': 20})
+  settings.apply()
+  assert applied == {'colorSamples': 20}
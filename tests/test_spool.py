@@ -0,0 +1,172 @@
+import json
+
+import pytest
+
+from kaliot.encoding import join
+from kaliot.spool import Drainer, OutboundQueue
+
+
+def spool(tmp_path, n=0, max_bytes=1 << 20):
+  queue = OutboundQueue(str(tmp_path / 'spool.db'), max_bytes)
+  for i in range(n):
+    queue.append(json.dumps({'n': i}))
+  return queue
+
+
+def test_append_after_ack(tmp_path):
+  queue = spool(tmp_path, 5)
+  entries = queue.after(0, 10)
+  assert [json.loads(p)['n'] for _, p, _ in entries] == [0, 1, 2, 3, 4]
+  assert queue.bytes == sum(len(p) for _, p, _ in entries)
+  queue.ack(entries[1][0])
+  queue.ack_all([entries[0][0], entries[3][0], 999])
+  assert [e[0] for e in queue.after(0, 10)] == [entries[2][0], entries[4][0]]
+  assert queue.bytes == len(entries[2][1]) + len(entries[4][1])
+  queue.close()
+  # survives a restart
+  queue = OutboundQueue(str(tmp_path / 'spool.db'))
+  assert len(queue) == 2 and queue.bytes == len(entries[2][1]) + len(entries[4][1])
+  queue.close()
+
+
+def test_evicts_oldest_past_bound(tmp_path):
+  queue = spool(tmp_path, 100, max_bytes=200)
+  assert queue.bytes <= 200
+  assert queue.evicted == 100 - len(queue)
+  assert json.loads(queue.after(0, 1000)[-1][1])['n'] == 99
+  queue.close()
+
+
+def test_rate_and_window(tmp_path, clock):
+  queue = spool(tmp_path, 20)
+  sent = []
+  drainer = Drainer(queue, lambda entry_id, payload: sent.append(entry_id), rate=2.0,
+                    window=3, clock=clock, burst=2.0)
+  assert drainer.pump() == 1  # one token to start with
+  clock.now += 10
+  assert drainer.pump() == 2  # burst caps the saved-up tokens
+  assert drainer.full()
+  clock.now += 10
+  assert drainer.pump() == 0
+  drainer.confirmed(sent[0])
+  assert drainer.pump() == 1
+  assert sent == [1, 2, 3, 4]
+  assert len(queue) == 19
+
+
+def test_failures_rewind_and_drop(tmp_path, clock):
+  queue = spool(tmp_path, 4)
+  sent = []
+  drainer = Drainer(queue, lambda entry_id, payload: sent.append(entry_id), rate=100.0,
+                    window=10, clock=clock, max_attempts=2)
+  clock.now += 1
+  drainer.pump()
+  assert sent == [1, 2, 3, 4]
+  drainer.failed(2)
+  drainer.failed(3, transient=True)
+  for entry_id in (1, 4):
+    drainer.confirmed(entry_id)
+  clock.now += 1
+  drainer.pump()
+  # resent in order, nothing that is still in flight twice
+  assert sent[4:] == [2, 3]
+  drainer.failed(3, transient=True)
+  drainer.failed(2)
+  assert drainer.dropped == 1 and [e[0] for e in queue.after(0, 10)] == [3]
+  drainer.reset()
+  clock.now += 1
+  drainer.pump()
+  assert sent[6:] == [3]
+
+
+def test_send_that_raises_leaves_nothing_in_flight(tmp_path, clock):
+  queue = spool(tmp_path, 5)
+  sent, raised = [], []
+  def send(entry_id, payload):
+    if entry_id == 3 and not raised:
+      raised.append(entry_id)
+      raise IOError('client torn down')
+    sent.append(entry_id)
+  drainer = Drainer(queue, send, rate=100.0, window=10, clock=clock)
+  clock.now += 1
+  with pytest.raises(IOError):
+    drainer.pump()
+  assert sent == [1, 2] and sorted(drainer.inflight) == [1, 2] and not drainer.full()
+  # 3 and what was behind it go out on the next pump, without a reset()
+  clock.now += 1
+  assert drainer.pump() == 3
+  assert sent == [1, 2, 3, 4, 5]
+
+
+def test_joined_send_that_raises_is_retried(tmp_path, clock):
+  queue = spool(tmp_path, 6)
+  sent = []
+  def send(entry_id, payload):
+    if not sent:
+      sent.append(None)
+      raise IOError('client torn down')
+    sent.append(json.loads(payload))
+  drainer = Drainer(queue, send, rate=100.0, window=10, clock=clock, join=join, join_max=3)
+  clock.now += 1
+  with pytest.raises(IOError):
+    drainer.pump()
+  assert drainer.inflight == {} and drainer.joined == {}
+  clock.now += 1
+  assert drainer.pump() == 2
+  assert [[x['n'] for x in batch] for batch in sent[1:]] == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_offline_sends_nothing(tmp_path):
+  queue = spool(tmp_path, 3)
+  online = [False]
+  drainer = Drainer(queue, lambda entry_id, payload: None, connected=lambda: online[0])
+  assert drainer.pump() == 0
+  online[0] = True
+  assert drainer.pump() == 1
+
+
+def test_backlog_goes_joined(tmp_path, clock):
+  queue = spool(tmp_path, 10)
+  sent = []
+  drainer = Drainer(queue, lambda entry_id, payload: sent.append((entry_id, payload)), rate=100.0,
+                    window=10, clock=clock, join=join, join_max=4)
+  clock.now += 1
+  drainer.pump()
+  assert [entry_id for entry_id, _ in sent] == [1, 5, 9]
+  assert [r['n'] for r in json.loads(sent[0][1])] == [0, 1, 2, 3]
+  assert [r['n'] for r in json.loads(sent[2][1])] == [8, 9]
+  drainer.confirmed(5)
+  assert [e[0] for e in queue.after(0, 20)] == [1, 2, 3, 4, 9, 10]
+  assert drainer.sent == 3 and drainer.entries == 10
+
+
+def test_joined_send_that_fails_goes_entry_by_entry(tmp_path, clock):
+  queue = spool(tmp_path, 3)
+  sent = []
+  drainer = Drainer(queue, lambda entry_id, payload: sent.append(entry_id), rate=100.0,
+                    window=10, clock=clock, join=join)
+  clock.now += 1
+  drainer.pump()
+  assert sent == [1]
+  drainer.failed(1, transient=True)
+  clock.now += 1
+  drainer.pump()
+  assert sent == [1, 1]  # a timeout: joined again
+  drainer.failed(1)
+  clock.now += 1
+  drainer.pump()
+  assert sent == [1, 1, 1, 2, 3]
+  for entry_id in (1, 2, 3):
+    drainer.confirmed(entry_id)
+  assert len(queue) == 0 and not drainer.single
+
+
+def test_join_bytes_limit(tmp_path, clock):
+  queue = spool(tmp_path, 10)
+  sent = []
+  drainer = Drainer(queue, lambda entry_id, payload: sent.append(entry_id), rate=100.0,
+                    window=10, clock=clock, join=join, join_bytes=30)
+  clock.now += 1
+  drainer.pump()
+  # 8 bytes per entry: three to a message
+  assert sent == [1, 4, 7, 10]
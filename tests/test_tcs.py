@@ -0,0 +1,90 @@
+from kaliot import tcs
+from kaliot.sim import FakeTCS34725
+
+LEAST = min(tcs.RANGES, key=lambda r: tcs.sensitivity(*r))
+
+
+class Flicker(object):
+  # light that is always out of band for the range in force: dark at the
+  # least sensitive range, clipped at every other, so the meter never keeps
+  # a frame
+
+  def __init__(self):
+    self.range = (0xFF, tcs.GAIN_4X)
+    self.reads = 0
+
+  def get_integration_time(self):
+    return self.range[0]
+
+  def get_gain(self):
+    return self.range[1]
+
+  def set_integration_time(self, integration_time):
+    self.range = (integration_time, self.range[1])
+
+  def set_gain(self, gain):
+    self.range = (self.range[0], gain)
+
+  def get_raw_data(self):
+    self.reads += 1
+    if self.range == LEAST:
+      return 0, 0, 0, 0
+    return 0xFFFF, 0xFFFF, 0xFFFF, 0xFFFF
+
+
+def test_window_ends_on_budget_while_range_keeps_moving():
+  chip = Flicker()
+  meter = tcs.LightMeter(chip, budget=0.5)
+  meter.reset()
+  while not meter.done(130):
+    assert chip.reads < 1000
+    meter.add(*chip.get_raw_data())
+  assert meter.count == 0
+  assert meter.elapsed >= 0.5
+  assert meter.mean() == meter.last
+  assert meter.adjustments > 1
+
+
+def test_sampler_reads_through_flicker():
+  sampler = tcs.ColorSampler(Flicker(), samples=130, auto_range=True)
+  reading = sampler.read()
+  assert len(reading) == len(tcs.light_reading(1, 1, 1, 1))
+
+
+def test_steady_light_stops_early_in_band():
+  chip = FakeTCS34725(light=(200, 180, 150, 600), time_scale=0)
+  meter = tcs.LightMeter(chip)
+  meter.reset()
+  while not meter.done(130):
+    meter.add(*chip.get_raw_data())
+  assert tcs.MIN_SAMPLES <= meter.count < 130
+  assert not meter.saturated
+  assert abs(meter.mean()[3] - 600) < 600 * 0.05
+
+
+def test_direct_sun_is_flagged():
+  chip = FakeTCS34725(light=(1e7, 1e7, 1e7, 1e7), time_scale=0)
+  meter = tcs.LightMeter(chip)
+  meter.reset()
+  while not meter.done(20):
+    meter.add(*chip.get_raw_data())
+  assert meter.saturated
+  assert (chip.get_integration_time(), chip.get_gain()) == LEAST
+
+
+def test_fixed_range_window_and_saturation():
+  chip = FakeTCS34725(raw=(310, 352, 270, 912), time_scale=0)
+  sampler = tcs.ColorSampler(chip, samples=4)
+  assert sampler.read() == tcs.light_reading(310, 352, 270, 912)
+  assert chip.reads == 4 and not sampler.saturated
+  assert (chip.get_integration_time(), chip.get_gain()) == (tcs.INTEGRATIONTIME_2_4MS, tcs.GAIN_4X)
+  # one frame at full scale clips the window; the range does not move
+  full = tcs.full_scale(tcs.INTEGRATIONTIME_2_4MS)
+  frames = iter([(310, 352, 270, 912)] * 3 + [(310, 352, 270, full)])
+  chip.raw = lambda: next(frames)
+  sampler.read()
+  assert sampler.saturated
+  assert (chip.get_integration_time(), chip.get_gain()) == (tcs.INTEGRATIONTIME_2_4MS, tcs.GAIN_4X)
+  chip.raw = (310, 352, 270, full - 1)
+  sampler.read()
+  assert not sampler.saturated
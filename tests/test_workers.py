@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from kaliot.workers import CALLER_RUNS, DROP_OLDEST, REJECT, WorkerPool
+
+
+def blocked(pool):
+  # a job that holds the pool's only worker until released
+  started = threading.Event()
+  release = threading.Event()
+  def hold():
+    started.set()
+    release.wait(5)
+  pool.submit('hold', hold)
+  assert started.wait(5)
+  return release
+
+
+def test_one_worker_runs_in_order():
+  pool = WorkerPool(1, 100)
+  pool.start()
+  order = []
+  release = blocked(pool)
+  for n in range(50):
+    pool.submit('twin', order.append, n)
+  release.set()
+  assert pool.join(5)
+  pool.stop()
+  assert order == list(range(50))
+
+
+def test_full_queue_policies():
+  pool = WorkerPool(1, 2, REJECT)
+  pool.start()
+  release = blocked(pool)
+  ran, dropped = [], []
+  assert pool.submit('a', ran.append, 1, on_drop=lambda: dropped.append(1))
+  assert pool.submit('a', ran.append, 2)
+  assert not pool.submit('a', ran.append, 3)
+  assert pool.submit('a', ran.append, 4, policy=DROP_OLDEST)
+  assert dropped == [1]
+  # runs on this thread, ahead of the queue
+  assert pool.submit('a', ran.append, 5, policy=CALLER_RUNS)
+  assert ran == [5]
+  release.set()
+  pool.join(5)
+  pool.stop()
+  assert ran == [5, 2, 4]
+  assert (pool.rejected, pool.dropped, pool.inline) == (1, 1, 1)
+
+
+def test_handler_error_keeps_worker(caplog):
+  pool = WorkerPool(1, 4)
+  pool.start()
+  ran = []
+  pool.submit('a', lambda: 1 / 0)
+  pool.submit('a', ran.append, 1)
+  pool.join(5)
+  pool.stop()
+  assert ran == [1] and pool.errors == 1
+  assert isinstance(pool.last_error[1], ZeroDivisionError)
+  assert [(r.name, r.getMessage(), r.exc_info[0]) for r in caplog.records] == [
+    ('kaliot.workers', 'a job failed', ZeroDivisionError)]
+
+
+def test_stopped_pool_refuses():
+  pool = WorkerPool(1, 4, CALLER_RUNS)
+  pool.start()
+  pool.stop()
+  assert not pool.submit('a', lambda: None)
+  with pytest.raises(ValueError):
+    WorkerPool(policy='block')